@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""Measure GTRServer.handle_game_actions() latency under different logging
+setups.
+
+Games are played to the end with Thinker actions through a GTRServer backed
+by the in-memory database from the server tests, so the time includes
+decoding, handling, encoding and storing the game. Each setup is timed
+with:
+
+    WARNING : debug and info messages disabled
+    INFO file : INFO enabled, written to a RotatingFileHandler
+    INFO queue : as above, through cloaca.log_queue
+    DEBUG file, DEBUG queue : the same with DEBUG enabled
+
+The p50 and p99 latency per action are reported.
+
+With --profile PREFIX, the WARNING setup is run again with the game engine
+profiler enabled, and its timings are written to PREFIX.json and
+PREFIX.folded (see cloaca.profiling).
+
+Usage:
+    python benchmarks/action_latency.py [--games N] [--profile PREFIX]
+"""
+import argparse
+import logging
+import logging.handlers
+import os
+import shutil
+import tempfile
+import time
+
+from tornado import gen
+import tornado.ioloop
+
+from cloaca.game import Game
+from cloaca.message import GameAction
+from cloaca.server import GTRServer
+from cloaca.test.server import MemoryDatabase
+import cloaca.message as message
+import cloaca.encode_binary as encode
+
+try:
+    from cloaca.log_queue import start_queue_logging
+except ImportError:
+    start_queue_logging = None
+
+try:
+    from cloaca.profiling import profiler
+except ImportError:
+    profiler = None
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values)-1, int(p/100.0 * len(values)))]
+
+
+def next_action(game):
+    if game.expected_action == message.THINKERORLEAD:
+        return GameAction(message.THINKERORLEAD, True)
+    elif game.expected_action == message.THINKERTYPE:
+        return GameAction(message.THINKERTYPE, False)
+    else:
+        return GameAction(message.SKIPTHINKER, False)
+
+
+@gen.coroutine
+def play(n_games):
+    """Play `n_games` games and return the list of latencies."""
+    db = MemoryDatabase()
+    db.users = {1: {'username': 'p1'}, 2: {'username': 'p2'}}
+    server = GTRServer(db)
+    server.send_commands = lambda user_id, commands: None
+
+    latencies = []
+    for game_id in range(1, n_games+1):
+        game = Game(game_id=game_id, host='p1')
+        game.add_player(1, 'p1')
+        game.add_player(2, 'p2')
+        game.start()
+        db.games[game_id] = encode.game_to_str(game)
+
+        while not game.finished:
+            action = next_action(game)
+            uid = game.active_player.uid
+
+            t0 = time.time()
+            yield server.handle_game_actions(game_id, uid,
+                    [[game.action_number, action]])
+            latencies.append(time.time() - t0)
+
+            game = encode.str_to_game(db.games[game_id])
+
+    raise gen.Return(latencies)
+
+
+@gen.coroutine
+def run(name, level, use_queue, n_games, log_dir):
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+
+    handler = logging.handlers.RotatingFileHandler(
+            os.path.join(log_dir, 'bench.log'), maxBytes=10485760,
+            backupCount=2)
+    handler.setFormatter(logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    root.addHandler(handler)
+    logging.getLogger('cloaca').setLevel(level)
+
+    listener = None
+    if use_queue:
+        if start_queue_logging is None:
+            print '{0:>12} cloaca.log_queue not available'.format(name)
+            return
+        listener = start_queue_logging()
+
+    latencies = yield play(n_games)
+
+    if listener is not None:
+        listener.stop()
+
+    print '{0:>12} {1:8d} {2:8.3f} {3:8.3f}'.format(name, len(latencies),
+            1000*percentile(latencies, 50), 1000*percentile(latencies, 99))
+
+
+@gen.coroutine
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--games', default=10, type=int)
+    parser.add_argument('--profile', metavar='PREFIX',
+            help='write game engine timings to PREFIX.json/.folded')
+    args = parser.parse_args()
+
+    log_dir = tempfile.mkdtemp()
+    try:
+        print '{0:>12} {1:>8} {2:>8} {3:>8}'.format(
+                'logging', 'actions', 'p50 ms', 'p99 ms')
+        yield run('WARNING', logging.WARNING, False, args.games, log_dir)
+        yield run('INFO file', logging.INFO, False, args.games, log_dir)
+        yield run('INFO queue', logging.INFO, True, args.games, log_dir)
+        yield run('DEBUG file', logging.DEBUG, False, args.games, log_dir)
+        yield run('DEBUG queue', logging.DEBUG, True, args.games, log_dir)
+
+        if args.profile is not None and profiler is not None:
+            profiler.enable()
+            yield run('profiled', logging.WARNING, False, args.games, log_dir)
+            profiler.disable()
+            profiler.dump(args.profile)
+    finally:
+        shutil.rmtree(log_dir)
+
+
+if __name__ == '__main__':
+    tornado.ioloop.IOLoop.current().run_sync(main)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""Compare scoring a batch of game states with the Game methods and with
+cloaca.vector_score.
+
+Random end-of-game states are scored both ways: Game._player_score() and
+Game._calc_winners() for each game, and vector_score.player_scores() and
+winners() once for the whole batch. The time to build the arrays with
+game_arrays() is reported separately, since callers that keep states as
+arrays don't pay it.
+
+Usage:
+    python benchmarks/batch_score.py [--games N]
+"""
+import argparse
+import random
+import time
+
+from cloaca.test.vector_score import random_game
+import cloaca.vector_score as vs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--games', default=200, type=int)
+    parser.add_argument('--repeat', default=100, type=int,
+            help='times to repeat the vectorized scoring')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    games = [random_game(rng) for _ in xrange(args.games)]
+    n_players = sum(len(g.players) for g in games)
+
+    t0 = time.time()
+    for g in games:
+        [g._player_score(p) for p in g.players]
+        g._calc_winners()
+    t_scalar = time.time() - t0
+
+    t0 = time.time()
+    arrays = vs.game_arrays(games)
+    t_arrays = time.time() - t0
+
+    t0 = time.time()
+    for _ in xrange(args.repeat):
+        scores = vs.player_scores(arrays)
+        vs.winners(arrays, scores)
+    t_vector = (time.time() - t0) / args.repeat
+
+    print '{0:d} games, {1:d} players'.format(args.games, n_players)
+    print '{0:>12} {1:12.1f} games/s'.format('Game', args.games/t_scalar)
+    print '{0:>12} {1:12.1f} games/s'.format('game_arrays', args.games/t_arrays)
+    print '{0:>12} {1:12.1f} games/s'.format('vectorized', args.games/t_vector)
+
+
+if __name__ == '__main__':
+    main()
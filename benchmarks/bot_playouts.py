@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""Measure the playout throughput of the MCTS bot.
+
+A game is played with random legal actions (see cloaca.bot) and stopped
+after --actions actions. The active player then chooses an action with
+MCTSBot.choose_action() for each number of processes given with
+--processes, with a time budget of --time seconds per move. Each search
+is repeated --moves times and the playouts per second and the action
+chosen by the last search are reported.
+
+With 0 processes, the search runs in the calling thread. Otherwise the
+searches run in a process pool, which is started with a search that isn't
+counted.
+
+Usage:
+    python benchmarks/bot_playouts.py [--players N] [--actions N]
+        [--processes N [N ...]] [--time SECONDS] [--moves N]
+"""
+import argparse
+import random
+
+import tornado.ioloop
+
+from cloaca.game import Game
+from cloaca.bot import MCTSBot, legal_actions
+
+
+def play(n_players, n_actions, seed):
+    """Return a new game after `n_actions` random legal actions."""
+    rng = random.Random(seed)
+    game = Game(game_id=1, host='p1')
+    for i in range(1, n_players+1):
+        game.add_player(i, 'p{0:d}'.format(i))
+    game.start()
+
+    for _ in range(n_actions):
+        if game.finished:
+            break
+        game = rng.choice(legal_actions(game))[1]
+
+    return game
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--players', default=2, type=int)
+    parser.add_argument('--actions', default=20, type=int,
+            help='Number of random actions to play before searching')
+    parser.add_argument('--processes', default=[0, 1, 2, 4], type=int,
+            nargs='+', help='Numbers of processes to search with')
+    parser.add_argument('--time', default=2.0, type=float,
+            help='Time budget per move in seconds')
+    parser.add_argument('--moves', default=3, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    game = play(args.players, args.actions, args.seed)
+    name = game.active_player.name
+    n_legal = len(legal_actions(game))
+    io_loop = tornado.ioloop.IOLoop.current()
+
+    print 'Action {0:d}, {1} to play, {2:d} legal actions:'.format(
+            game.action_number, name, n_legal)
+
+    for n_processes in args.processes:
+        bot = MCTSBot(time_budget=args.time, n_processes=n_processes,
+                seed=args.seed)
+
+        if n_processes > 0:
+            io_loop.run_sync(lambda: bot.choose_action(game, name))
+            bot.n_playouts = 0
+            bot.search_time = 0.0
+
+        for _ in range(args.moves):
+            action = io_loop.run_sync(lambda: bot.choose_action(game, name))
+
+        bot.shutdown()
+
+        print '{0:>4d} processes {1:10.1f} playouts/s   {2!r}'.format(
+                n_processes, bot.n_playouts / bot.search_time, action)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""Measure human game latency while the server plays bot games.
+
+A GTRServer backed by the in-memory database from the server tests hosts
+--bot-games games between two bot users and --human-games games whose
+players take Thinker actions (see action_latency.py) every --think-time
+seconds. After --seconds, the following are reported for each mode:
+
+    none : no bots play, for reference
+    scheduler : the bots are played by a cloaca.bot_scheduler.BotScheduler
+        with --workers processes
+    player : the bots are cloaca.bot.BotPlayer pseudo-users, each with its
+        own single-process pool
+
+For human actions, the p50 and p99 latency of handle_game_actions() are
+reported. For the scheduler, so is the scheduling latency from a game
+state reaching a bot to its move being dispatched, and the number of
+moves that missed the deadline. Both bot modes search for --time-budget
+seconds per move.
+
+Usage:
+    python benchmarks/bot_scheduler.py [--bot-games N] [--human-games N]
+        [--seconds SECONDS] [--workers N] [--modes MODE [MODE ...]]
+"""
+import argparse
+import time
+
+from tornado import gen
+from tornado.process import cpu_count
+import tornado.ioloop
+
+from cloaca.game import Game
+from cloaca.server import GTRServer
+from cloaca.bot import MCTSBot, BotPlayer
+from cloaca.test.server import MemoryDatabase
+import cloaca.bot_scheduler
+import cloaca.encode_binary as encode
+
+from action_latency import next_action, percentile
+
+BOT_USERS = {1: 'bot1', 2: 'bot2'}
+
+
+class Recorder(object):
+    """Stands in for a Histogram to keep every observation."""
+
+    def __init__(self):
+        self.values = []
+
+    def observe(self, value):
+        self.values.append(value)
+
+
+def new_game(db, game_id, uids):
+    game = Game(game_id=game_id, host=db.users[uids[0]]['username'])
+    for uid in uids:
+        game.add_player(uid, db.users[uid]['username'])
+    game.start()
+    db.games[game_id] = encode.game_to_str(game)
+    return game
+
+
+@gen.coroutine
+def play_human(server, db, game_id, uids, think_time, deadline, latencies):
+    """Play Thinker actions in game `game_id` until `deadline`, starting
+    a new game when it finishes.
+    """
+    game = new_game(db, game_id, uids)
+    while time.time() < deadline:
+        yield gen.sleep(think_time)
+
+        t0 = time.time()
+        yield server.handle_game_actions(game_id, game.active_player.uid,
+                [[game.action_number, next_action(game)]])
+        latencies.append(time.time() - t0)
+
+        game = encode.str_to_game(db.games[game_id])
+        if game.finished:
+            game = new_game(db, game_id, uids)
+
+
+@gen.coroutine
+def run(mode, args):
+    db = MemoryDatabase()
+    db.users = dict((uid, {'username': name})
+            for uid, name in BOT_USERS.items())
+    for i in range(2*args.human_games):
+        db.users[100+i] = {'username': 'human{0:d}'.format(i)}
+
+    server = GTRServer(db)
+    server.send_commands = lambda u, commands: None
+
+    scheduler = None
+    bots = []
+    recorder = cloaca.bot_scheduler.BOT_SCHEDULE_SECONDS = Recorder()
+    if mode == 'scheduler':
+        scheduler = cloaca.bot_scheduler.BotScheduler(server,
+                max_workers=args.workers, time_budget=args.time_budget,
+                deadline=args.deadline)
+        for uid, name in BOT_USERS.items():
+            scheduler.add_user(uid, name)
+    elif mode == 'player':
+        for uid, name in BOT_USERS.items():
+            bots.append(MCTSBot(time_budget=args.time_budget))
+            server.add_bot(BotPlayer(server, uid, name, bots[-1]))
+
+    bot_game_ids = range(1, args.bot_games+1)
+    for game_id in bot_game_ids:
+        new_game(db, game_id, sorted(BOT_USERS))
+
+    deadline = time.time() + args.seconds
+    if mode != 'none':
+        for game_id in bot_game_ids:
+            uid = encode.str_to_game(db.games[game_id]).active_player.uid
+            yield server._retrieve_and_send_game(uid, game_id)
+
+    latencies = []
+    yield [play_human(server, db, 1000+i, [100+2*i, 101+2*i],
+            args.think_time, deadline, latencies)
+            for i in range(args.human_games)]
+
+    # Stop the bots. Moves being computed are still submitted.
+    server.bots.clear()
+    if scheduler is not None:
+        scheduler.shutdown()
+    for bot in bots:
+        bot.shutdown()
+
+    n_bot_actions = sum(encode.str_to_game(db.games[i]).action_number - 1
+            for i in bot_game_ids)
+
+    n_human_actions = len(latencies)
+    latencies = latencies or [float('nan')]
+    schedule = recorder.values or [float('nan')]
+    print '{0:>10} {1:8d} {2:8.1f} {3:8.1f} {4:10d} {5:8.1f} {6:8.1f} {7:8d}'.format(
+            mode, n_human_actions, 1000*percentile(latencies, 50),
+            1000*percentile(latencies, 99), n_bot_actions,
+            1000*percentile(schedule, 50), 1000*percentile(schedule, 99),
+            scheduler.n_timeouts if scheduler else 0)
+
+
+@gen.coroutine
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--bot-games', default=100, type=int)
+    parser.add_argument('--human-games', default=10, type=int)
+    parser.add_argument('--seconds', default=20.0, type=float)
+    parser.add_argument('--think-time', default=0.25, type=float,
+            help='Seconds between the actions of each human game')
+    parser.add_argument('--workers', default=cpu_count(), type=int)
+    parser.add_argument('--time-budget', default=0.2, type=float,
+            help='Seconds of search per bot move')
+    parser.add_argument('--deadline', default=2.0, type=float)
+    parser.add_argument('--modes', default=['none', 'scheduler', 'player'],
+            nargs='+', choices=['none', 'scheduler', 'player'])
+    args = parser.parse_args()
+
+    print '{0} bot games, {1} human games, {2} workers, {3}s:'.format(
+            args.bot_games, args.human_games, args.workers, args.seconds)
+    print '{0:>10} {1:>8} {2:>8} {3:>8} {4:>10} {5:>8} {6:>8} {7:>8}'.format(
+            'mode', 'human', 'p50 ms', 'p99 ms', 'bot', 'sched', 'sched',
+            'missed')
+    print '{0:>10} {1:>8} {2:>8} {3:>8} {4:>10} {5:>8} {6:>8} {7:>8}'.format(
+            '', 'actions', '', '', 'actions', 'p50 ms', 'p99 ms',
+            'deadline')
+    for mode in args.modes:
+        yield run(mode, args)
+
+
+if __name__ == '__main__':
+    tornado.ioloop.IOLoop.current().run_sync(main)
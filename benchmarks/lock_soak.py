@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Soak test for GameLockManager.
+
+Acquires and releases locks for millions of distinct game IDs, with a
+configurable number of concurrent coroutines contending on a small set of
+hot games, and reports throughput, contention metrics, lock table size and
+peak memory.
+
+Usage:
+    python benchmarks/lock_soak.py [--games N] [--hot H] [--concurrency C]
+"""
+import argparse
+import datetime
+import resource
+import time
+
+from tornado import gen
+import tornado.ioloop
+
+from cloaca.lock_manager import GameLockManager
+
+
+@gen.coroutine
+def soak(manager, n_games, n_hot, concurrency):
+    timeout = datetime.timedelta(seconds=1)
+
+    @gen.coroutine
+    def worker(w):
+        for game_id in xrange(w, n_games, concurrency):
+            # Every other acquisition is on a hot game to create contention.
+            if game_id % 2:
+                game_id = -(game_id % n_hot) - 1
+            with (yield manager.acquire(game_id, timeout)):
+                yield gen.moment
+
+    yield [worker(w) for w in range(concurrency)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='GameLockManager soak test')
+    parser.add_argument('--games', default=2000000, type=int)
+    parser.add_argument('--hot', default=10, type=int)
+    parser.add_argument('--concurrency', default=100, type=int)
+    args = parser.parse_args()
+
+    manager = GameLockManager()
+    start = time.time()
+    tornado.ioloop.IOLoop.current().run_sync(
+            lambda: soak(manager, args.games, args.hot, args.concurrency))
+    elapsed = time.time() - start
+
+    stats = manager.stats()
+    print '{0:d} acquisitions in {1:.1f} s ({2:.0f}/s)'.format(
+            stats['n_acquired'], elapsed, stats['n_acquired']/elapsed)
+    for k in sorted(stats):
+        print '  {0}: {1}'.format(k, stats[k])
+    print 'peak RSS: {0:.1f} MB'.format(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.)
+
+
+if __name__ == '__main__':
+    main()
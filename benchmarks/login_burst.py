@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""Measure IOLoop latency for game traffic during a burst of logins.
+
+A probe coroutine stands in for in-game websocket traffic: every
+--interval milliseconds it encodes a game state, as GTRServer does for each
+GAMESTATE command, and records how late it woke up. Meanwhile --logins
+password checks are submitted at once, either to a ThreadPoolExecutor (the
+old handlers.py setup) or to a PasswordHasher process pool.
+
+The lateness percentiles are reported for each mode, along with the login
+throughput and the number of logins shed with ServerBusyError.
+
+Usage:
+    python benchmarks/login_burst.py [--logins N] [--work-factor W]
+            [--max-pending P]
+"""
+import argparse
+import time
+
+from tornado import gen
+from tornado.process import cpu_count
+import tornado.ioloop
+
+from concurrent.futures import ThreadPoolExecutor
+import bcrypt
+
+from cloaca.game import Game
+from cloaca.passwords import PasswordHasher
+from cloaca.error import ServerBusyError
+import cloaca.encode_binary as encode
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values)-1, int(p/100.0 * len(values)))]
+
+
+@gen.coroutine
+def probe(interval, stop, lateness):
+    game = Game(game_id=1, host='p0')
+    game.add_player(1, 'p0')
+    game.add_player(2, 'p1')
+    game.start()
+
+    while not stop:
+        t0 = time.time()
+        yield gen.sleep(interval)
+        lateness.append(time.time() - t0 - interval)
+        encode.game_to_str(game.privatized_game_state_copy('p0'))
+
+
+@gen.coroutine
+def burst(check, n_logins, hashed):
+    results = []
+
+    @gen.coroutine
+    def login():
+        try:
+            ok = yield check('secret', hashed)
+        except ServerBusyError:
+            results.append(None)
+        else:
+            results.append(ok)
+
+    t0 = time.time()
+    yield [login() for _ in xrange(n_logins)]
+    elapsed = time.time() - t0
+
+    raise gen.Return((elapsed, results.count(None)))
+
+
+@gen.coroutine
+def run(mode, check, args, hashed):
+    lateness = []
+    stop = []
+    p = probe(args.interval/1000., stop, lateness)
+
+    yield gen.sleep(0.2)
+    elapsed, n_shed = yield burst(check, args.logins, hashed)
+    stop.append(True)
+    yield p
+
+    print '{0:>8} {1:8.2f} {2:8.2f} {3:8.2f} {4:10.1f} {5:6d}'.format(
+            mode,
+            1000*percentile(lateness, 50),
+            1000*percentile(lateness, 99),
+            1000*max(lateness),
+            (args.logins - n_shed) / elapsed,
+            n_shed)
+
+
+@gen.coroutine
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--logins', default=1000, type=int)
+    parser.add_argument('--work-factor', default=8, type=int)
+    parser.add_argument('--max-pending', default=1000, type=int)
+    parser.add_argument('--interval', default=5, type=float,
+            help='probe interval in milliseconds')
+    args = parser.parse_args()
+
+    hashed = bcrypt.hashpw('secret', bcrypt.gensalt(args.work_factor))
+
+    print '{0} logins, work factor {1}, {2} CPUs'.format(
+            args.logins, args.work_factor, cpu_count())
+    print '{0:>8} {1:>8} {2:>8} {3:>8} {4:>10} {5:>6}'.format(
+            'mode', 'p50 ms', 'p99 ms', 'max ms', 'logins/s', 'shed')
+
+    threads = ThreadPoolExecutor(cpu_count())
+    def thread_check(auth, hashed):
+        return threads.submit(bcrypt.hashpw, auth, hashed)
+    yield run('thread', thread_check, args, hashed)
+    threads.shutdown()
+
+    hasher = PasswordHasher(max_pending=args.max_pending)
+    yield run('process', hasher.check_password, args, hashed)
+    hasher.shutdown()
+
+
+if __name__ == '__main__':
+    tornado.ioloop.IOLoop.current().run_sync(main)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Measure the cost of recording metrics with cloaca.metrics.
+
+The time per call of Counter.inc(), Gauge.inc(), Histogram.observe() and
+PhaseTimer.mark() is measured in a loop, with labels looked up on each
+call as the server does. Then games are played through a GTRServer backed
+by the in-memory test database (see action_latency.py), and the metrics
+recorded per action are multiplied by those costs to estimate the overhead
+as a fraction of the action latency.
+
+A two-player action with Redis records about: 7 phase marks and
+observations, 6 Redis call observations (game read, action log, game log,
+game store and one game read per player sent), 1 message received and
+4 messages sent.
+
+Usage:
+    python benchmarks/metrics_overhead.py [--calls N] [--games N]
+"""
+import argparse
+import time
+
+import tornado.ioloop
+from tornado import gen
+
+from cloaca.metrics import (Registry, Counter, Gauge, Histogram, PhaseTimer,
+        GAME_ACTION_PHASE_SECONDS)
+
+from action_latency import play, percentile
+
+PHASES_PER_ACTION = 7
+REDIS_CALLS_PER_ACTION = 6
+MESSAGES_PER_ACTION = 5
+
+
+def per_call(f, n_calls):
+    """Return the seconds per call of f(), less the loop overhead."""
+    def nothing():
+        pass
+
+    t0 = time.time()
+    for _ in xrange(n_calls):
+        nothing()
+    t_loop = time.time() - t0
+
+    t0 = time.time()
+    for _ in xrange(n_calls):
+        f()
+    return max(time.time() - t0 - t_loop, 0.0) / n_calls
+
+
+@gen.coroutine
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--calls', default=200000, type=int)
+    parser.add_argument('--games', default=3, type=int)
+    args = parser.parse_args()
+
+    registry = Registry()
+    counter = Counter('c', 'Counter.', ['action'], registry=registry)
+    gauge = Gauge('g', 'Gauge.', registry=registry)
+    histogram = Histogram('h', 'Histogram.', ['command'], registry=registry)
+    timer = PhaseTimer(Histogram('p', 'Phases.', ['phase'],
+            registry=registry), time.time)
+
+    t_counter = per_call(lambda: counter.labels('thinkerorlead').inc(),
+            args.calls)
+    t_gauge = per_call(gauge.inc, args.calls)
+    t_histogram = per_call(lambda: histogram.labels('HGET').observe(0.0003),
+            args.calls)
+    t_mark = per_call(lambda: timer.mark('engine'), args.calls)
+
+    print '{0:>20} {1:10.3f} us'.format('Counter.inc', 1e6*t_counter)
+    print '{0:>20} {1:10.3f} us'.format('Gauge.inc', 1e6*t_gauge)
+    print '{0:>20} {1:10.3f} us'.format('Histogram.observe', 1e6*t_histogram)
+    print '{0:>20} {1:10.3f} us'.format('PhaseTimer.mark', 1e6*t_mark)
+
+    engine = GAME_ACTION_PHASE_SECONDS.labels('engine')
+    before = sum(engine.counts)
+    latencies = yield play(args.games)
+    n_cycles = sum(engine.counts) - before
+
+    t_action = (PHASES_PER_ACTION * (t_mark + t_histogram) +
+            REDIS_CALLS_PER_ACTION * t_histogram +
+            MESSAGES_PER_ACTION * t_counter)
+    p50 = percentile(latencies, 50)
+
+    print
+    print '{0:d} actions in {1:d} cycles, p50 {2:.3f} ms'.format(
+            len(latencies), n_cycles, 1000*p50)
+    print 'estimated recording per action: {0:.1f} us ({1:.3f}% of p50)'.format(
+            1e6*t_action, 100*t_action/p50)
+
+
+if __name__ == '__main__':
+    tornado.ioloop.IOLoop.current().run_sync(main)
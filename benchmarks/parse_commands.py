@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""Measure parsing throughput for JSON commands from the client.
+
+Parses realistic LEADROLE, LEGIONARY and MERCHANT messages with
+Command.from_json(), which decodes the JSON and validates and converts the
+arguments of each GameAction, and reports commands parsed per second.
+
+Usage:
+    python benchmarks/parse_commands.py [--repeat N]
+"""
+import argparse
+import json
+import time
+
+from cloaca.message import Command
+import cloaca.message as message
+
+
+MESSAGES = [
+    ('LEADROLE', {'game': 12, 'number': 57, 'action':
+        {'action': message.LEADROLE, 'args': ['Laborer', 1, 17]}}),
+    ('LEADROLE petition', {'game': 12, 'number': 58, 'action':
+        {'action': message.LEADROLE, 'args': ['Craftsman', 1, 41, 52, 77]}}),
+    ('LEGIONARY', {'game': 12, 'number': 59, 'action':
+        {'action': message.LEGIONARY, 'args': [23, 88]}}),
+    ('MERCHANT', {'game': 12, 'number': 60, 'action':
+        {'action': message.MERCHANT, 'args': [False, 105]}}),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', default=50000, type=int)
+    parser.add_argument('--no-ujson', action='store_true',
+            help='decode with json even if ujson is installed')
+    args = parser.parse_args()
+
+    if args.no_ujson:
+        message.ujson = None
+
+    print 'JSON backend: {0}'.format(
+            'ujson' if message.ujson is not None else 'json')
+
+    total_n = 0
+    total_t = 0.0
+    for name, d in MESSAGES:
+        s = json.dumps(d)
+        t0 = time.time()
+        for _ in xrange(args.repeat):
+            Command.from_json(s)
+        elapsed = time.time() - t0
+
+        total_n += args.repeat
+        total_t += elapsed
+        print '{0:>18} {1:10.0f} commands/s'.format(name, args.repeat/elapsed)
+
+    print '{0:>18} {1:10.0f} commands/s'.format('all', total_n/total_t)
+
+
+if __name__ == '__main__':
+    main()
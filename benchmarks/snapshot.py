@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""Compare the cost of Game.snapshot() and Game.restore() to copy.deepcopy().
+
+A two-player game is played with Thinker actions (see action_latency.py)
+and stopped after each number of actions given with --actions. At each
+point the following are timed, per call:
+
+    deepcopy : copy.deepcopy(game)
+    copy : game._copy(), used by snapshots and privatized_game_state_copy
+    snapshot, restore : Game.snapshot() and Game.restore()
+    snapshot binary, restore binary : the same with binary=True
+    game_to_str, str_to_game : the encoding used for storage, with the
+        header, checksum and base64 encoding, for reference
+
+The size of the binary snapshot state is also reported.
+
+Usage:
+    python benchmarks/snapshot.py [--actions N [N ...]] [--calls N]
+"""
+import argparse
+import copy
+import time
+
+from cloaca.game import Game
+import cloaca.encode_binary as encode
+
+from action_latency import next_action
+
+
+def per_call(f, n_calls):
+    """Return the seconds per call of f()."""
+    t0 = time.time()
+    for _ in xrange(n_calls):
+        f()
+    return (time.time() - t0) / n_calls
+
+
+def play(n_actions):
+    """Return a new game after `n_actions` Thinker actions."""
+    game = Game(game_id=1, host='p1')
+    game.add_player(1, 'p1')
+    game.add_player(2, 'p2')
+    game.start()
+
+    for _ in range(n_actions):
+        if game.finished:
+            break
+        game.handle(next_action(game))
+
+    return game
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--actions', default=[0, 100, 200], type=int,
+            nargs='+', help='Numbers of actions to play before timing')
+    parser.add_argument('--calls', default=500, type=int)
+    args = parser.parse_args()
+
+    for n_actions in args.actions:
+        game = play(n_actions)
+        target = copy.deepcopy(game)
+        snapshot = game.snapshot()
+        binary = game.snapshot(binary=True)
+        s = encode.game_to_str(game)
+
+        timings = [
+            ('deepcopy', lambda: copy.deepcopy(game)),
+            ('copy', game._copy),
+            ('snapshot', game.snapshot),
+            ('restore', lambda: target.restore(snapshot)),
+            ('snapshot binary', lambda: game.snapshot(binary=True)),
+            ('restore binary', lambda: target.restore(binary)),
+            ('game_to_str', lambda: encode.game_to_str(game)),
+            ('str_to_game', lambda: encode.str_to_game(s)),
+            ]
+
+        print 'After {0:d} actions ({1:d} log messages, {2:d} byte binary snapshot):'.format(
+                game.action_number, len(game.game_log), len(binary._state))
+
+        t_deepcopy = None
+        for name, f in timings:
+            t = per_call(f, args.calls)
+            if t_deepcopy is None:
+                t_deepcopy = t
+            print '{0:>20} {1:10.1f} us {2:8.1f}x'.format(
+                    name, 1e6*t, t_deepcopy/t)
+        print
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Measure the cost of turn timers for many idle games.
+
+--games timers are kept in a cloaca.turn_timer.TimerWheel with deadlines
+spread over --timeout seconds. The following are timed, per timer:
+
+    add : start a timer for a new game
+    restart : start it again after an action, replacing the old one
+    cancel : remove it when the game finishes
+    expire : advance the wheel past every deadline, one tick at a time
+
+The cost of one tick with no timers due is also reported. For reference,
+the same games are given one IOLoop timeout each with add_timeout() and
+remove_timeout(), which is what the wheel avoids.
+
+Usage:
+    python benchmarks/turn_timer.py [--games N] [--timeout SECONDS]
+"""
+import argparse
+import random
+import time
+
+import tornado.ioloop
+
+from cloaca.turn_timer import TimerWheel, DEFAULT_TICK, DEFAULT_SLOTS
+
+
+def per_op(f, keys):
+    """Return the seconds per key of calling f(key) for each key."""
+    t0 = time.time()
+    for key in keys:
+        f(key)
+    return (time.time() - t0) / len(keys)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--games', default=100000, type=int)
+    parser.add_argument('--timeout', default=300.0, type=float)
+    args = parser.parse_args()
+
+    now = 1000.0
+    rng = random.Random(0)
+    deadlines = dict((game_id, now + rng.uniform(0, args.timeout))
+            for game_id in xrange(args.games))
+    keys = deadlines.keys()
+    rng.shuffle(keys)
+
+    wheel = TimerWheel(DEFAULT_TICK, DEFAULT_SLOTS, now)
+    timings = [
+        ('add', per_op(lambda k: wheel.add(k, deadlines[k], 0), keys)),
+        ('restart', per_op(lambda k: wheel.add(k, deadlines[k], 1), keys)),
+        ('cancel', per_op(wheel.cancel, keys)),
+        ]
+
+    for k in keys:
+        wheel.add(k, deadlines[k], 0)
+
+    t0 = time.time()
+    wheel.advance(now)
+    t_idle = time.time() - t0
+
+    t0 = time.time()
+    n_expired = 0
+    for t in xrange(int(args.timeout / DEFAULT_TICK) + 2):
+        n_expired += len(wheel.advance(now + t * DEFAULT_TICK))
+    timings.append(('expire', (time.time() - t0) / n_expired))
+    assert n_expired == args.games and not len(wheel)
+
+    io_loop = tornado.ioloop.IOLoop.current()
+    handles = {}
+    callback = lambda: None
+    def add_timeout(k):
+        handles[k] = io_loop.add_timeout(deadlines[k], callback)
+    def restart_timeout(k):
+        io_loop.remove_timeout(handles[k])
+        handles[k] = io_loop.add_timeout(deadlines[k], callback)
+    def remove_timeout(k):
+        io_loop.remove_timeout(handles.pop(k))
+
+    timings.extend([
+        ('IOLoop add', per_op(add_timeout, keys)),
+        ('IOLoop restart', per_op(restart_timeout, keys)),
+        ('IOLoop remove', per_op(remove_timeout, keys)),
+        ])
+
+    print '{0:d} games, timeout {1:.0f}s, {2:d} slots of {3:.0f}s:'.format(
+            args.games, args.timeout, DEFAULT_SLOTS, DEFAULT_TICK)
+    for name, t in timings:
+        print '{0:>16} {1:8.2f} us/timer'.format(name, 1e6*t)
+    print '{0:>16} {1:8.2f} us'.format('idle tick', 1e6*t_idle)
+
+
+if __name__ == '__main__':
+    main()
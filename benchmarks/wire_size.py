@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""Measure websocket bytes-on-wire and frames per action.
+
+Plays a two-player game by having each player think until the deck runs
+out. After each action, every player is sent the GAMESTATE and GAMELOG
+commands that GTRServer.handle_game_actions() would send. The total
+payload size and number of websocket messages are reported for:
+
+    json : one JSON text message per command, uncompressed (the old format)
+    binary : one binary message per action with all commands batched
+    binary+deflate : the same, with permessage-deflate using the settings
+        from GameWSHandler and a compression context per connection.
+
+Usage:
+    python benchmarks/wire_size.py
+"""
+import zlib
+
+from cloaca.game import Game
+from cloaca.message import GameAction, Command
+import cloaca.message as message
+import cloaca.encode_binary as encode
+from cloaca.handlers import GameWSHandler
+
+
+def play_thinker_game():
+    """Yield the game after each action in a game where every
+    player thinks for Orders cards until the game ends.
+    """
+    game = Game(game_id=1, host='p0')
+    game.add_player(1, 'p0')
+    game.add_player(2, 'p1')
+    game.start()
+
+    while not game.finished:
+        game.game_log = []
+        expected = game.expected_action
+        if expected == message.THINKERORLEAD:
+            a = GameAction(expected, True)
+        elif expected == message.THINKERTYPE:
+            a = GameAction(expected, False)
+        elif expected == message.SKIPTHINKER:
+            a = GameAction(expected, False)
+        else:
+            break
+
+        try:
+            game.handle(a)
+        except Exception:
+            break
+
+        yield game
+
+
+def commands_for_player(game, player):
+    gs = encode.game_to_str(game.privatized_game_state_copy(player.name))
+    log = '\n'.join(game.game_log)
+    return [
+        Command(game.game_id, None, GameAction(message.GAMESTATE, gs)),
+        Command(game.game_id, None, GameAction(message.GAMELOG,
+            game.log_length, game.log_length-len(game.game_log), log)),
+        ]
+
+
+def deflate_message(compressor, data):
+    # permessage-deflate strips the trailing 0x00 0x00 0xff 0xff
+    return (compressor.compress(data) +
+            compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+
+
+def main():
+    json_bytes = json_frames = 0
+    binary_bytes = binary_frames = 0
+    deflate_bytes = 0
+    n_actions = 0
+
+    compressors = {}
+    for game in play_thinker_game():
+        n_actions += 1
+        for p in game.players:
+            commands = commands_for_player(game, p)
+
+            for c in commands:
+                json_bytes += len(c.to_json())
+                json_frames += 1
+
+            batch = message.commands_to_binary(commands)
+            binary_bytes += len(batch)
+            binary_frames += 1
+
+            try:
+                compressor = compressors[p.uid]
+            except KeyError:
+                compressor = zlib.compressobj(
+                        GameWSHandler.COMPRESSION_LEVEL, zlib.DEFLATED,
+                        -zlib.MAX_WBITS, GameWSHandler.COMPRESSION_MEM_LEVEL)
+                compressors[p.uid] = compressor
+
+            deflate_bytes += len(deflate_message(compressor, batch))
+
+    fmt = '{0:16s} {1:>10.1f} {2:>10.2f}'
+    print '{0} actions, {1} players'.format(n_actions, 2)
+    print '{0:16s} {1:>10s} {2:>10s}'.format('', 'bytes/act', 'frames/act')
+    print fmt.format('json', float(json_bytes)/n_actions, float(json_frames)/n_actions)
+    print fmt.format('binary', float(binary_bytes)/n_actions, float(binary_frames)/n_actions)
+    print fmt.format('binary+deflate', float(deflate_bytes)/n_actions, float(binary_frames)/n_actions)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""Compressed archives of finished games.
+
+A finished game no longer changes, so its state, action logs and game
+log are bundled into one compressed record and the separate Redis keys are
+deleted (see GTRDBTornadis.archive_game()).
+
+    bundle = encode_archive(game_data, action_log, log_messages,
+            legacy_actions=legacy_actions)
+
+Each section is compressed separately so that readers only decompress
+what they need:
+
+    - decode_archive_game(bundle) : the encoded game state
+    - decode_archive_actions(bundle) : the binary action log, or None
+    - decode_archive_log(bundle) : (<first message index>, <messages>)
+    - decode_archive_legacy_actions(bundle) : dict of encoded actions
+
+Archive format
+==============
+    <version> : (1 byte) ARCHIVE_VERSION
+    <codec> : (1 byte) ZLIB or LZMA
+    <log_first> : (4 byte integer) index of the first log message kept.
+        Messages before it were dropped by the log retention limit.
+    <lengths> : (4 x 4 byte integers) compressed length of each section
+    <game> : compressed encoded game, as stored by GTRDBTornadis.store_game()
+    <actions> : compressed action log (see encode_action.decode_action_log())
+    <log> : compressed log messages, separated by newlines
+    <legacy_actions> : compressed actions from the per-game hash of
+        actions (see GTRDBTornadis.set_game_action()). Each is stored as
+        its action number and length (2 x 4 byte integers) followed by the
+        encoded action, in order of action number.
+
+Version 1 archives have no <legacy_actions> section, and only 3 lengths in
+the header. They can still be read.
+
+lzma isn't in the Python 2 standard library. LZMA is only available if the
+backports.lzma package is installed.
+"""
+import struct
+import zlib
+
+try:
+    from backports import lzma
+except ImportError:
+    lzma = None
+
+from cloaca.encode_binary import GTREncodingError
+
+ARCHIVE_VERSION = 2
+
+ZLIB = 0
+LZMA = 1
+
+_HEADER_FMT = '!BBIIIII'
+_HEADER_FMTS = {1: '!BBIIII', 2: _HEADER_FMT}
+
+_LEGACY_ACTION_FMT = '!II'
+_LEGACY_ACTION_LENGTH = struct.calcsize(_LEGACY_ACTION_FMT)
+
+_ZLIB_LEVEL = 9
+
+
+def _compress(codec, data):
+    if codec == ZLIB:
+        return zlib.compress(data, _ZLIB_LEVEL)
+    elif codec == LZMA and lzma is not None:
+        return lzma.compress(data)
+    else:
+        raise GTREncodingError('Compression codec {0!s} is not available.'
+                .format(codec))
+
+
+def _decompress(codec, data):
+    try:
+        if codec == ZLIB:
+            return zlib.decompress(data)
+        elif codec == LZMA and lzma is not None:
+            return lzma.decompress(data)
+    except (zlib.error, EnvironmentError, ValueError) as e:
+        raise GTREncodingError('Corrupted archive section: {0!s}'.format(e))
+
+    raise GTREncodingError('Compression codec {0!s} is not available.'
+            .format(codec))
+
+
+def _encode_legacy_actions(actions):
+    """Return the dict {<action number>: <encoded action>} as a string."""
+    return ''.join(struct.pack(_LEGACY_ACTION_FMT, int(n), len(actions[n]))
+            + actions[n] for n in sorted(actions, key=int))
+
+
+def _decode_legacy_actions(data):
+    """Inverse of _encode_legacy_actions()."""
+    actions = {}
+    offset = 0
+    while offset < len(data):
+        try:
+            n, length = struct.unpack_from(_LEGACY_ACTION_FMT, data, offset)
+        except struct.error:
+            raise GTREncodingError('Truncated legacy action in archive.')
+
+        offset += _LEGACY_ACTION_LENGTH
+        if offset + length > len(data):
+            raise GTREncodingError('Truncated legacy action in archive.')
+
+        actions[n] = data[offset:offset+length]
+        offset += length
+
+    return actions
+
+
+def encode_archive(game_data, action_log, log_messages, log_first=0,
+        codec=ZLIB, legacy_actions=None):
+    """Return a compressed bundle of the encoded game `game_data`, the
+    binary action log `action_log` (or None) and the list of log
+    messages `log_messages`, the first of which has index `log_first`.
+
+    `legacy_actions` is a dict {<action number>: <encoded action>} of the
+    actions in the game's hash of actions, if it has any.
+    """
+    sections = [_compress(codec, s) for s in
+            (game_data, action_log or '', '\n'.join(log_messages),
+                _encode_legacy_actions(legacy_actions or {}))]
+
+    header = struct.pack(_HEADER_FMT, ARCHIVE_VERSION, codec, log_first,
+            *map(len, sections))
+
+    return header + ''.join(sections)
+
+
+def _read_header(bundle):
+    """Return (<codec>, <log_first>, <list of compressed sections>)."""
+    if not bundle:
+        raise GTREncodingError('Archive is too short for a header.')
+
+    version = ord(bundle[0])
+    if version not in _HEADER_FMTS:
+        raise GTREncodingError('Unknown archive version {0:d}'.format(version))
+
+    header_fmt = _HEADER_FMTS[version]
+    try:
+        header = struct.unpack_from(header_fmt, bundle)
+    except struct.error:
+        raise GTREncodingError('Archive is too short for a header.')
+
+    codec, log_first, lengths = header[1], header[2], header[3:]
+
+    offset = struct.calcsize(header_fmt)
+    if offset + sum(lengths) != len(bundle):
+        raise GTREncodingError('Archive length doesn\'t match its header.')
+
+    sections = []
+    for n in lengths:
+        sections.append(buffer(bundle, offset, n))
+        offset += n
+
+    return codec, log_first, sections
+
+
+def decode_archive_game(bundle):
+    """Return the encoded game stored in an archive."""
+    codec, _, sections = _read_header(bundle)
+    return _decompress(codec, sections[0])
+
+
+def decode_archive_actions(bundle):
+    """Return the binary action log stored in an archive, or None if the
+    game had no actions.
+    """
+    codec, _, sections = _read_header(bundle)
+    return _decompress(codec, sections[1]) or None
+
+
+def decode_archive_log(bundle):
+    """Return a tuple (<log_first>, <messages>) with the list of log
+    messages stored in an archive, the first of which has index
+    <log_first>.
+    """
+    codec, log_first, sections = _read_header(bundle)
+    log = _decompress(codec, sections[2])
+    return log_first, (log.split('\n') if log else [])
+
+
+def decode_archive_legacy_actions(bundle):
+    """Return a dict {<action number>: <encoded action>} of the actions
+    that were in the game's hash of actions when it was archived.
+    """
+    codec, _, sections = _read_header(bundle)
+    if len(sections) < 4:
+        return {}
+
+    return _decode_legacy_actions(_decompress(codec, sections[3]))
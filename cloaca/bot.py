@@ -0,0 +1,604 @@
+"""A computer player using information set Monte Carlo tree search
+(ISMCTS).
+
+The bot only sees the game as its user would, through
+Game.privatized_game_state_copy(). Each search iteration samples a
+determinization of the hidden cards (the library, the other players'
+hands and everyone's vault) consistent with that view, descends the tree
+through the actions that are legal in it, and plays random actions to the
+end of the game or for at most `max_rollout_actions` actions. The result
+is scored as a win for the player(s) ahead at that point.
+
+    bot = MCTSBot(time_budget=2.0, n_processes=4)
+    action = yield bot.choose_action(game, 'p1')
+
+The search runs in a pool of `n_processes` processes. With more than one,
+independent searches run for the whole time budget (root parallelization)
+and their statistics are merged to choose the action. With `n_processes`
+0, the search runs in the calling thread and blocks it for the time
+budget, which is only useful outside the server.
+
+A BotPlayer plays a user's games on a GTRServer as a pseudo-user. The
+server hands it the commands that would be sent to that user, and the bot
+submits an action with GTRServer.handle_game_actions() whenever a game
+state shows that it's the active player. Its MCTSBot must search in a pool
+so that the IOLoop isn't blocked.
+
+Legal actions are found by generating candidates for the expected action
+and trying each one on a copy of the game, since the game engine doesn't
+enumerate them. The candidates cover the usual choices but not every
+combination of cards, eg. Petitions and Palace leads aren't generated.
+"""
+
+from cloaca.card import Card
+from cloaca.error import GTRError, GameOver
+from cloaca.message import GameAction
+import cloaca.card_manager as cm
+import cloaca.encode_binary as encode
+import cloaca.message as message
+
+import tornado.ioloop
+from tornado import gen
+
+from concurrent.futures import ProcessPoolExecutor
+
+import logging
+import math
+import random
+import time
+
+lg = logging.getLogger(__name__)
+
+DEFAULT_TIME_BUDGET = 1.0
+DEFAULT_EXPLORATION = 0.7
+DEFAULT_MAX_ROLLOUT_ACTIONS = 60
+
+
+def action_key(action):
+    """Return a hashable key for a GameAction that identifies cards by
+    name, so that the same choice is recognized in different
+    determinizations.
+    """
+    return (action.action,) + tuple(
+            a.name if isinstance(a, Card) else a for a in action.args)
+
+
+def _distinct(cards):
+    """Return one card of each name in `cards`."""
+    seen = set()
+    out = []
+    for c in cards:
+        if c.name not in seen:
+            seen.add(c.name)
+            out.append(c)
+    return out
+
+
+def _matching_cards(demanded, zone):
+    """Return cards from `zone` matching the materials of the `demanded`
+    cards one-for-one, as many as there are.
+    """
+    remaining = list(zone)
+    out = []
+    for d in demanded:
+        c = next((c for c in remaining if c.material == d.material), None)
+        if c is not None:
+            remaining.remove(c)
+            out.append(c)
+    return out
+
+
+def candidate_actions(game):
+    """Return a list of GameActions to try for the active player of `game`.
+    Some of them might be illegal. See legal_actions().
+    """
+    p = game.active_player
+    expected = game.expected_action
+    has = lambda building: game._player_has_active_building(p, building)
+
+    hand = _distinct([c for c in p.hand if c.name != 'Jack'])
+    jack = next((c for c in p.hand if c.name == 'Jack'), None)
+
+    def construct(action, material_cards):
+        """Skip, start a building from hand, or add a material."""
+        args = [(None, None, None)]
+        args.extend((c, None, c.material) for c in hand)
+        for b in p.incomplete_buildings:
+            args.extend((b.foundation, c, None) for c in material_cards)
+        return [GameAction(action, *a) for a in args]
+
+    if expected == message.THINKERORLEAD:
+        # The engine lets a player lead with an empty hand, but then
+        # there's no legal LEADROLE.
+        if len(p.hand):
+            return [GameAction(expected, True), GameAction(expected, False)]
+        return [GameAction(expected, True)]
+
+    elif expected in (message.THINKERTYPE, message.SKIPTHINKER, message.USEVOMITORIUM,
+            message.USEFOUNTAIN, message.BARORAQUEDUCT,
+            message.PATRONFROMDECK):
+        return [GameAction(expected, True), GameAction(expected, False)]
+
+    elif expected == message.LEADROLE:
+        actions = [GameAction(expected, c.role, 1, c) for c in hand]
+        if jack is not None:
+            actions.extend(GameAction(expected, role, 1, jack)
+                    for role in cm.get_all_roles())
+        return actions
+
+    elif expected == message.FOLLOWROLE:
+        actions = [GameAction(expected, 0)]
+        actions.extend(GameAction(expected, 1, c) for c in hand
+                if c.role == game.role_led)
+        if jack is not None:
+            actions.append(GameAction(expected, 1, jack))
+        return actions
+
+    elif expected in (message.USELATRINE, message.PATRONFROMHAND):
+        return [GameAction(expected, None)] + [
+                GameAction(expected, c) for c in hand]
+
+    elif expected == message.PATRONFROMPOOL:
+        return [GameAction(expected, None)] + [
+                GameAction(expected, c) for c in _distinct(game.pool)]
+
+    elif expected == message.LABORER:
+        actions = [GameAction(expected)]
+        actions.extend(GameAction(expected, c) for c in _distinct(game.pool))
+        if has('Dock'):
+            actions.extend(GameAction(expected, c) for c in hand)
+        return actions
+
+    elif expected == message.ARCHITECT:
+        return construct(expected, _distinct(list(p.stockpile)+list(game.pool)))
+
+    elif expected == message.CRAFTSMAN:
+        return construct(expected, hand)
+
+    elif expected == message.FOUNTAIN:
+        f = p.fountain_card
+        actions = [GameAction(expected, None, None, None),
+                GameAction(expected, f, None, f.material)]
+        actions.extend(GameAction(expected, b.foundation, f, None)
+                for b in p.incomplete_buildings)
+        return actions
+
+    elif expected == message.STAIRWAY:
+        actions = [GameAction(expected, None, None)]
+        materials = _distinct(list(p.stockpile)+list(game.pool))
+        for pl in game.players:
+            for b in pl.complete_buildings:
+                actions.extend(GameAction(expected, b.foundation, c)
+                        for c in materials if b.composed_of(c.material))
+        return actions
+
+    elif expected == message.MERCHANT:
+        actions = [GameAction(expected, False)]
+        actions.extend(GameAction(expected, False, c)
+                for c in _distinct(p.stockpile))
+        if has('Atrium'):
+            actions.append(GameAction(expected, True))
+        if has('Basilica'):
+            actions.extend(GameAction(expected, False, c) for c in hand)
+        return actions
+
+    elif expected == message.LEGIONARY:
+        return [GameAction(expected)] + [
+                GameAction(expected, c) for c in hand]
+
+    elif expected == message.GIVECARDS:
+        leg_p = game.legionary_player
+        demanded = leg_p.revealed
+        cards = _matching_cards(demanded, p.hand)
+        if game._player_has_active_building(leg_p, 'Bridge'):
+            cards += _matching_cards(demanded, p.stockpile)
+        if game._player_has_active_building(leg_p, 'Coliseum'):
+            cards += _matching_cards(demanded, p.clientele)
+        return [GameAction(expected, *cards), GameAction(expected)]
+
+    elif expected == message.TAKEPOOLCARDS:
+        return [GameAction(expected, *_matching_cards(p.revealed, game.pool))]
+
+    elif expected == message.TAKECLIENTS:
+        victim = next(pl for pl in game.players if len(pl.clients_given))
+        n = game._vault_limit(p) - len(p.vault)
+        return [GameAction(expected, *victim.clients_given.cards[:n])]
+
+    elif expected == message.USESENATE:
+        jacks = [c for pl in game.players if pl is not p
+                for c in pl.camp if c.name == 'Jack']
+        return [GameAction(expected, *jacks), GameAction(expected)]
+
+    elif expected == message.USESEWER:
+        cards = [c for c in p.camp if c.name != 'Jack']
+        return [GameAction(expected, *cards), GameAction(expected)]
+
+    elif expected == message.PRISON:
+        actions = [GameAction(expected, None)]
+        for pl in game.players:
+            if pl is not p:
+                actions.extend(GameAction(expected, b.foundation)
+                        for b in pl.complete_buildings)
+        return actions
+
+    raise GTRError('No candidate actions for expected action {0!s}.'
+            .format(expected))
+
+
+def try_action(game, action):
+    """Return a copy of `game` after handling `action`, or None if the
+    action is illegal. `game` isn't modified.
+    """
+    gs = game._copy()
+    try:
+        gs.handle(action)
+    except GameOver:
+        pass
+    except GTRError:
+        return None
+    return gs
+
+
+def legal_actions(game):
+    """Return a list of (<action>, <game after action>) tuples for the
+    legal actions of the active player among candidate_actions().
+    """
+    out = []
+    for a in candidate_actions(game):
+        gs = try_action(game, a)
+        if gs is not None:
+            out.append((a, gs))
+    return out
+
+
+def determinize(game, rng=random):
+    """Return a copy of `game` with each anonymous card, Card(-1), replaced
+    by a card that isn't visible anywhere else, chosen at random with
+    `rng`. `game` is a copy as seen by one player, from
+    privatized_game_state_copy(). The game log of the copy is empty.
+
+    Raise GTRError if the number of hidden cards doesn't match the number
+    of cards that aren't visible.
+    """
+    gs = game._copy()
+    gs.game_log = []
+
+    seen = set()
+    slots = [] # (zone, index) of each anonymous card
+
+    def scan(zone):
+        for i, c in enumerate(zone.cards):
+            if c.ident < 0:
+                slots.append((zone, i))
+            else:
+                seen.add(c.ident)
+
+    # Revealed cards are copies of cards in hand, and the privatized copy
+    # replaces the other players' with arbitrary cards of the same name,
+    # so they're skipped. Clients given are still in the clientele.
+    fountain_players = []
+    for zone in (gs.jacks, gs.library, gs.pool):
+        scan(zone)
+
+    for p in gs.players:
+        for zone in (p.hand, p.stockpile, p.clientele, p.vault, p.camp):
+            scan(zone)
+
+        for b in p.buildings:
+            seen.add(b.foundation.ident)
+            seen.update(c.ident for c in b.materials)
+            seen.update(c.ident for c in b.stairway_materials)
+
+        if p.fountain_card is not None:
+            if p.fountain_card.ident < 0:
+                fountain_players.append(p)
+            else:
+                seen.add(p.fountain_card.ident)
+
+    deck = cm.standard_deck()
+    unseen = [i for i in xrange(len(deck))
+            if i not in seen and deck[i] != 'Jack']
+
+    if len(unseen) != len(slots) + len(fountain_players):
+        raise GTRError('Cannot determinize game {0:d}: {1:d} hidden cards '
+                'but {2:d} unseen.'.format(game.game_id,
+                    len(slots) + len(fountain_players), len(unseen)))
+
+    rng.shuffle(unseen)
+    for zone, i in slots:
+        zone.cards[i] = Card(unseen.pop())
+
+    for p in fountain_players:
+        p.fountain_card = Card(unseen.pop())
+
+    return gs
+
+
+def rewards(game):
+    """Return the list of rewards for each player of `game`. If the game
+    isn't finished, the players that would win if it ended now are
+    counted as winners. Tied winners share a reward of 1.
+    """
+    winners = game.winners if game.finished else game._calc_winners()
+    reward = 1.0/len(winners)
+    return [reward if any(p is w for w in winners) else 0.0
+            for p in game.players]
+
+
+def rollout(game, rng=random, max_actions=DEFAULT_MAX_ROLLOUT_ACTIONS):
+    """Play random legal actions from `game` until it's finished or for
+    `max_actions` actions, and return the resulting game. `game` isn't
+    modified.
+    """
+    for _ in xrange(max_actions):
+        if game.finished:
+            break
+
+        candidates = candidate_actions(game)
+        rng.shuffle(candidates)
+        for a in candidates:
+            gs = try_action(game, a)
+            if gs is not None:
+                game = gs
+                break
+        else:
+            lg.warning('No legal action found in rollout of game %d, '
+                    'expected action %s.', game.game_id, game.expected_action)
+            break
+
+    return game
+
+
+class _Node(object):
+    """Node of the search tree. The `player_index` is the index of the
+    player that took `action` to reach this node, and `reward` is the
+    sum of that player's rewards.
+    """
+
+    def __init__(self, parent=None, action=None, player_index=None):
+        self.parent = parent
+        self.action = action
+        self.player_index = player_index
+        self.children = {}
+        self.visits = 0
+        self.availability = 0
+        self.reward = 0.0
+
+    def ucb(self, exploration):
+        return (self.reward / self.visits + exploration *
+                math.sqrt(math.log(self.availability) / self.visits))
+
+
+def search(game, player_name, time_budget=DEFAULT_TIME_BUDGET,
+        max_iterations=None, exploration=DEFAULT_EXPLORATION,
+        max_rollout_actions=DEFAULT_MAX_ROLLOUT_ACTIONS, seed=None):
+    """Search from the point of view of `player_name` for `time_budget`
+    seconds or `max_iterations` iterations, whichever comes first, and at
+    least one iteration.
+
+    Return a tuple (<stats>, <n_playouts>) where <stats> is a list of
+    (<action>, <visits>, <reward>) for the actions of the root.
+    """
+    rng = random.Random(seed)
+    view = game.privatized_game_state_copy(player_name)
+    root = _Node()
+    deadline = time.time() + time_budget
+
+    n_playouts = 0
+    while True:
+        state = determinize(view, rng)
+        node = root
+
+        # Select through the actions legal in this determinization and
+        # expand the first one that hasn't been tried.
+        while not state.finished:
+            player_index = state.active_player_index
+            available = []
+            untried = []
+            for a, gs in legal_actions(state):
+                child = node.children.get(action_key(a))
+                if child is None:
+                    untried.append((a, gs))
+                else:
+                    available.append((child, gs))
+
+            for child, _ in available:
+                child.availability += 1
+
+            if untried:
+                a, state = rng.choice(untried)
+                child = _Node(node, a, player_index)
+                child.availability = 1
+                node.children[action_key(a)] = child
+                node = child
+                break
+
+            if not available:
+                break
+
+            node, state = max(available,
+                    key=lambda t: t[0].ucb(exploration))
+
+        state = rollout(state, rng, max_rollout_actions)
+        result = rewards(state)
+        n_playouts += 1
+
+        while node is not root:
+            node.visits += 1
+            node.reward += result[node.player_index]
+            node = node.parent
+        root.visits += 1
+
+        if max_iterations is not None and n_playouts >= max_iterations:
+            break
+        if time.time() >= deadline:
+            break
+
+    stats = [(child.action, child.visits, child.reward)
+            for child in root.children.values()]
+    return stats, n_playouts
+
+
+def _search_encoded(game_encoded, player_name, time_budget, max_iterations,
+        exploration, max_rollout_actions, seed):
+    """search() for a game encoded with game_to_str(), for running in
+    another process.
+    """
+    game = encode.str_to_game(game_encoded)
+    return search(game, player_name, time_budget, max_iterations,
+            exploration, max_rollout_actions, seed)
+
+
+def best_action(stats):
+    """Return the most visited action from one or more lists of search()
+    statistics for the same game state, merged by action_key().
+    """
+    visits = {}
+    actions = {}
+    for action, n, _ in (s for stat_list in stats for s in stat_list):
+        key = action_key(action)
+        visits[key] = visits.get(key, 0) + n
+        actions.setdefault(key, action)
+
+    if not visits:
+        raise GTRError('No actions were searched.')
+
+    return actions[max(visits, key=visits.get)]
+
+
+class MCTSBot(object):
+    """Choose actions with ISMCTS. See the module documentation.
+
+    Each call to choose_action() searches for `time_budget` seconds, or
+    `max_iterations` iterations. With `n_processes` > 0, that many
+    searches run in parallel in a ProcessPoolExecutor. With 0, the search
+    runs in the calling thread.
+
+    The number of playouts and the time spent searching are totalled in
+    `n_playouts` and `search_time`.
+    """
+
+    def __init__(self, time_budget=DEFAULT_TIME_BUDGET, n_processes=1,
+            max_iterations=None, exploration=DEFAULT_EXPLORATION,
+            max_rollout_actions=DEFAULT_MAX_ROLLOUT_ACTIONS, seed=None):
+        self.time_budget = time_budget
+        self.n_processes = n_processes
+        self.max_iterations = max_iterations
+        self.exploration = exploration
+        self.max_rollout_actions = max_rollout_actions
+        self.rng = random.Random(seed)
+
+        self.n_playouts = 0
+        self.search_time = 0.0
+
+        # The executor forks its workers on the first submit.
+        if n_processes > 0:
+            self.executor = ProcessPoolExecutor(n_processes)
+        else:
+            self.executor = None
+
+
+    @gen.coroutine
+    def choose_action(self, game, player_name):
+        """Return a future for the GameAction chosen for `player_name`,
+        who must be the active player of `game`.
+        """
+        if game.active_player.name != player_name:
+            raise GTRError('{0} is not the active player of game {1:d}.'
+                    .format(player_name, game.game_id))
+
+        t0 = time.time()
+        args = (self.time_budget, self.max_iterations, self.exploration,
+                self.max_rollout_actions)
+
+        if self.executor is None:
+            results = [search(game, player_name, *args,
+                    seed=self.rng.getrandbits(32))]
+        else:
+            game_encoded = encode.game_to_str(game)
+            results = yield [self.executor.submit(_search_encoded,
+                    game_encoded, player_name, *(args +
+                        (self.rng.getrandbits(32),)))
+                    for _ in range(self.n_processes)]
+
+        self.n_playouts += sum(n for _, n in results)
+        self.search_time += time.time() - t0
+
+        raise gen.Return(best_action([stats for stats, _ in results]))
+
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+
+class BotPlayer(object):
+    """Pseudo-user that plays the games of user `user_id` on a GTRServer
+    with `bot`, an MCTSBot. Register it with GTRServer.add_bot().
+
+    The server passes it every command for the user. When a GAMESTATE
+    shows that it's the user's turn, the bot chooses an action and
+    submits it with GTRServer.handle_game_actions(). Errors from the
+    server are logged.
+
+    Raise ValueError if `bot` searches in the calling thread
+    (n_processes=0), which would block the server's IOLoop.
+    """
+
+    def __init__(self, server, user_id, username, bot):
+        if bot.executor is None:
+            raise ValueError('BotPlayer needs an MCTSBot that searches in '
+                    'a process pool.')
+
+        self.server = server
+        self.user_id = user_id
+        self.username = username
+        self.bot = bot
+
+        # Game ID -> action number of the state an action is being chosen
+        # for. A new state for the game can arrive before the action is
+        # submitted, so the entry is only removed by its own _play().
+        self._thinking = {}
+
+
+    def receive_commands(self, commands):
+        for command in commands:
+            action = command.action
+            if action.action == message.GAMESTATE and action.args[0]:
+                game = encode.str_to_game(action.args[0])
+                if self._should_play(game):
+                    self._thinking[game.game_id] = game.action_number
+                    tornado.ioloop.IOLoop.current().spawn_callback(
+                            self._play, game)
+
+            elif action.action == message.SERVERERROR:
+                lg.debug('Bot %s received error: %s', self.username,
+                        action.args[0])
+
+
+    def _should_play(self, game):
+        return (game.started and not game.finished and
+                self._thinking.get(game.game_id) != game.action_number and
+                game.expected_action is not None and
+                game.active_player.name == self.username)
+
+
+    @gen.coroutine
+    def _play(self, game):
+        try:
+            action = yield self.bot.choose_action(game, self.username)
+        except GTRError as e:
+            lg.warning('Bot {0} failed to choose an action in game '
+                    '{1:d}: {2}'.format(self.username, game.game_id,
+                        e.message))
+            return
+        finally:
+            # The server sends the next state while handling the action.
+            if self._thinking.get(game.game_id) == game.action_number:
+                del self._thinking[game.game_id]
+
+        lg.debug('Bot %s plays %r in game %d', self.username, action,
+                game.game_id)
+
+        yield self.server.handle_game_actions(game.game_id, self.user_id,
+                [[game.action_number, action]])
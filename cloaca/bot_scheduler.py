@@ -0,0 +1,290 @@
+"""Compute the moves of bot users in worker processes.
+
+An MCTS search (see cloaca.bot) keeps a CPU busy for its whole time
+budget, so searching in the server process would stall every websocket
+and human game on the IOLoop. A BotPlayer searches in a process pool of
+its own, but there's one per bot user and nothing bounds how many
+searches run at once. BotScheduler plays as any number of bot users
+instead and runs their searches in one shared ProcessPoolExecutor:
+
+    scheduler = BotScheduler(server, max_workers=2, deadline=5.0)
+    scheduler.add_user(user_id, 'bot1')
+
+The server hands the scheduler every command sent to a bot user. When a
+game state shows that a bot is the active player, a move is queued for
+that game. At most `max_concurrent` moves are computed at once and the
+others wait in FIFO order. A newer state for a game that is waiting
+replaces the older one and keeps its place.
+
+Each move is searched for `time_budget` seconds in a worker and submitted
+with GTRServer.handle_game_actions(). If the result doesn't arrive within
+`deadline` seconds of the dispatch, or the search fails, the first legal
+action is played instead so that the game isn't held up. A worker that
+missed its deadline still counts against `max_concurrent` until it
+finishes, so late searches can't pile up in the pool.
+
+Workers lower their scheduling priority by `niceness` so that the server
+process keeps the CPU when they share one.
+
+The time from a game state arriving to its move being dispatched is
+recorded in the cloaca_bot_schedule_seconds histogram, and the moves
+played in cloaca_bot_moves_total by outcome (see cloaca.metrics).
+"""
+
+from cloaca.bot import (candidate_actions, try_action, legal_actions,
+        search, best_action, DEFAULT_MAX_ROLLOUT_ACTIONS)
+from cloaca.error import GTRError
+from cloaca.metrics import BOT_SCHEDULE_SECONDS, BOT_MOVES
+import cloaca.encode_binary as encode
+import cloaca.message as message
+
+from tornado import gen
+from tornado.process import cpu_count
+import tornado.ioloop
+
+from concurrent.futures import ProcessPoolExecutor
+
+import collections
+import datetime
+import logging
+import os
+import random
+import time
+
+lg = logging.getLogger(__name__)
+
+DEFAULT_DEADLINE = 5.0
+DEFAULT_TIME_BUDGET = 2.0
+DEFAULT_NICENESS = 10
+
+# Set in each worker process once its priority has been lowered.
+_reniced = False
+
+
+def _choose_action_encoded(game_encoded, player_name, time_budget,
+        max_rollout_actions, seed, niceness):
+    """Return a tuple (<action>, <forced>) for `player_name`, the active
+    player of the game encoded with game_to_str(). <forced> is True if the
+    action is the only legal one, which is returned without searching.
+
+    This runs in a worker process.
+    """
+    global _reniced
+    if not _reniced:
+        os.nice(niceness)
+        _reniced = True
+
+    game = encode.str_to_game(game_encoded)
+    legal = legal_actions(game)
+    if len(legal) == 1:
+        return legal[0][0], True
+
+    stats, _ = search(game, player_name, time_budget,
+            max_rollout_actions=max_rollout_actions, seed=seed)
+    return best_action([stats]), False
+
+
+def _first_legal_action(game):
+    """Return the first legal action of candidate_actions(), or None."""
+    for action in candidate_actions(game):
+        if try_action(game, action) is not None:
+            return action
+    return None
+
+
+class _Move(object):
+    """A move to compute for bot user `user_id` in a game state."""
+
+    __slots__ = ('user_id', 'username', 'game', 'game_encoded', 'received')
+
+    def __init__(self, user_id, username, game, game_encoded, received):
+        self.user_id = user_id
+        self.username = username
+        self.game = game
+        self.game_encoded = game_encoded
+        self.received = received
+
+
+class _BotUser(object):
+    """Pseudo-user registered with GTRServer.add_bot() for each bot user,
+    passing its commands on to the scheduler.
+    """
+
+    def __init__(self, scheduler, user_id, username):
+        self.scheduler = scheduler
+        self.user_id = user_id
+        self.username = username
+
+    def receive_commands(self, commands):
+        self.scheduler.receive_commands(self.user_id, commands)
+
+
+class BotScheduler(object):
+    """Play the games of the bot users added with add_user() on
+    `server`, a GTRServer. See the module documentation.
+
+    The pool has `max_workers` processes, one per CPU by default, and
+    `max_concurrent` moves (default `max_workers`) are computed at once.
+    """
+
+    def __init__(self, server, max_workers=None, max_concurrent=None,
+            deadline=DEFAULT_DEADLINE, time_budget=DEFAULT_TIME_BUDGET,
+            max_rollout_actions=DEFAULT_MAX_ROLLOUT_ACTIONS,
+            niceness=DEFAULT_NICENESS, seed=None, clock=time.time):
+        self.server = server
+        self.max_workers = max_workers or cpu_count()
+        self.max_concurrent = max_concurrent or self.max_workers
+        self.deadline = deadline
+        self.time_budget = time_budget
+        self.max_rollout_actions = max_rollout_actions
+        self.niceness = niceness
+        self.rng = random.Random(seed)
+        self.clock = clock
+
+        self.usernames = {} # user_id -> username of the bot users
+
+        self._waiting = collections.OrderedDict() # game_id -> _Move
+        self._running = {} # game_id -> action number being computed
+        self.n_running = 0 # includes workers past their deadline
+        self._shut_down = False
+
+        self.n_moves = 0
+        self.n_timeouts = 0
+        self.n_errors = 0
+
+        # The executor forks its workers on the first submit.
+        self.executor = ProcessPoolExecutor(self.max_workers)
+
+
+    def add_user(self, user_id, username):
+        """Play the games of user `user_id`, who must be registered in the
+        database and join games like any other user.
+        """
+        self.usernames[user_id] = username
+        self.server.add_bot(_BotUser(self, user_id, username))
+
+
+    def receive_commands(self, user_id, commands):
+        """Queue a move for each game state in `commands`, which were sent
+        to bot user `user_id`, if it's that user's turn.
+        """
+        username = self.usernames[user_id]
+        for command in commands:
+            action = command.action
+            if action.action == message.GAMESTATE and action.args[0]:
+                game = encode.str_to_game(action.args[0])
+                if self._should_play(game, username):
+                    self._waiting[game.game_id] = _Move(user_id, username,
+                            game, action.args[0], self.clock())
+
+            elif action.action == message.SERVERERROR:
+                lg.debug('Bot %s received error: %s', username,
+                        action.args[0])
+
+        self._dispatch()
+
+
+    def _should_play(self, game, username):
+        if (not game.started or game.finished or
+                game.expected_action is None or
+                game.active_player.name != username):
+            return False
+
+        # Game states are sent to every player, so the same one can
+        # arrive more than once.
+        game_id = game.game_id
+        if self._running.get(game_id) == game.action_number:
+            return False
+
+        waiting = self._waiting.get(game_id)
+        return waiting is None or waiting.game.action_number < game.action_number
+
+
+    def _dispatch(self):
+        """Start the waiting moves, oldest first, while there are free
+        slots.
+        """
+        while (self._waiting and self.n_running < self.max_concurrent and
+                not self._shut_down):
+            game_id, move = self._waiting.popitem(last=False)
+            self._running[game_id] = move.game.action_number
+            self.n_running += 1
+
+            BOT_SCHEDULE_SECONDS.observe(self.clock() - move.received)
+            tornado.ioloop.IOLoop.current().spawn_callback(self._play, move)
+
+
+    def _release(self, future):
+        self.n_running -= 1
+        self._dispatch()
+
+
+    @gen.coroutine
+    def _play(self, move):
+        game = move.game
+        game_id = game.game_id
+
+        future = self.executor.submit(_choose_action_encoded,
+                move.game_encoded, move.username, self.time_budget,
+                self.max_rollout_actions, self.rng.getrandbits(32),
+                self.niceness)
+        tornado.ioloop.IOLoop.current().add_future(future, self._release)
+
+        try:
+            action, forced = yield gen.with_timeout(
+                    datetime.timedelta(seconds=self.deadline), future,
+                    quiet_exceptions=(Exception,))
+        except gen.TimeoutError:
+            lg.warning('Bot {0} missed the deadline in game {1:d}.'
+                    .format(move.username, game_id))
+            self.n_timeouts += 1
+            outcome = 'timeout'
+            action = _first_legal_action(game)
+        except Exception:
+            lg.exception('Bot {0} failed to search in game {1:d}.'
+                    .format(move.username, game_id))
+            self.n_errors += 1
+            outcome = 'error'
+            action = _first_legal_action(game)
+        else:
+            outcome = 'forced' if forced else 'search'
+        finally:
+            # The server sends the next state while handling the action.
+            if self._running.get(game_id) == game.action_number:
+                del self._running[game_id]
+
+        if action is None:
+            lg.warning('Bot {0} has no legal action in game {1:d}.'
+                    .format(move.username, game_id))
+            return
+
+        self.n_moves += 1
+        BOT_MOVES.labels(outcome).inc()
+        lg.debug('Bot %s plays %r in game %d (%s)', move.username, action,
+                game_id, outcome)
+
+        try:
+            yield self.server.handle_game_actions(game_id, move.user_id,
+                    [[game.action_number, action]])
+        except GTRError as e:
+            lg.warning('Failed to play bot {0} in game {1:d}: {2}'
+                    .format(move.username, game_id, e.message))
+
+
+    def stats(self):
+        return {
+                'n_waiting': len(self._waiting),
+                'n_running': self.n_running,
+                'n_moves': self.n_moves,
+                'n_timeouts': self.n_timeouts,
+                'n_errors': self.n_errors,
+                }
+
+
+    def shutdown(self):
+        """Drop the waiting moves and stop the workers. Moves that are
+        being computed are still played.
+        """
+        self._shut_down = True
+        self._waiting.clear()
+        self.executor.shutdown(wait=False)
@@ -59,6 +59,16 @@ class Building(object):
     def __eq__(self, other):
         return self.__dict__ == other.__dict__
 
+    def copy(self):
+        """Return a copy of this building with copies of the material
+        zones, sharing the Card objects.
+        """
+        b = Building.__new__(Building)
+        b.__dict__.update(self.__dict__)
+        b.materials = self.materials.copy()
+        b.stairway_materials = self.stairway_materials.copy()
+        return b
+
     @property
     def is_stairwayed(self):
         """Return True if a material has been added by the Stairway."""
@@ -12,6 +12,7 @@ from collections import Counter
 from cloaca.error import GTRError
 
 _deck = ()
+_cards_dict = None
 
 # Dictionary of {material name : ordinal rank} in the order
 # None, Marble, Rubble, Concrete, Wood, Brick, Stone
@@ -112,13 +113,20 @@ def get_orders_card_set():
         
 
 def get_cards_dict_from_json_file():
-    """ Return dict of data for ALL cards from the json file.  """
-    # json should be in the GTR directory, with this module
-    gtr_dir = path.dirname(__file__)
-    json_file = file(path.join(gtr_dir,'GTR_cards.json'), 'r')
-    cards_dict = json.load(json_file)
-    json_file.close()
-    return cards_dict
+    """ Return dict of data for ALL cards from the json file.
+
+    The file is read once and the same dict is returned afterwards,
+    so it must not be modified.
+    """
+    global _cards_dict
+    if _cards_dict is None:
+        # json should be in the GTR directory, with this module
+        gtr_dir = path.dirname(__file__)
+        json_file = file(path.join(gtr_dir,'GTR_cards.json'), 'r')
+        _cards_dict = json.load(json_file)
+        json_file.close()
+
+    return _cards_dict
 
 def get_card_dict(card_name):
     """ Return dict of data for ONE card. """
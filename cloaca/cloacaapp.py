@@ -5,6 +5,8 @@ from tornado.web import StaticFileHandler
 from tornado.websocket import WebSocketHandler
 from tornado import gen, escape
 import tornado.httpserver
+import tornado.netutil
+import tornado.process
 
 import os
 import os.path
@@ -13,16 +15,28 @@ import logging.config
 import json
 import re
 import argparse
+import atexit
+import signal
 import sys
 
 from cloaca.server import GTRServer
+from cloaca.shard import ShardMap
+from cloaca.user_cache import UserCache
+from cloaca.passwords import PasswordHasher
+from cloaca.bot_scheduler import BotScheduler
+from cloaca.turn_timer import TurnTimer
+from cloaca.log_queue import start_queue_logging
+from cloaca.profiling import profiler
+from cloaca.metrics import FunctionMetric
+from cloaca.error import GTRDBError, ParsingError
+import cloaca.message
 import cloaca.db
 import cloaca.handlers
 from cloaca.handlers import (
         BaseHandler, CreateGameHandler, JoinGameHandler,
         StartGameHandler, GameHandler, GameListHandler,
         LoginPageHandler, RegisterHandler, AuthenticateHandler,
-        LogoutHandler, GameWSHandler,
+        LogoutHandler, GameWSHandler, MetricsHandler,
         )
 
 lg = logging.getLogger('cloacaapp')
@@ -79,31 +93,235 @@ def setup_logging(path):
     logging.basicConfig(level=logging.WARNING)
 
 
-def make_app(database):
+def install_profiling_signals(out_dir):
+    """Toggle the game engine profiler (cloaca.profiling.profiler) with
+    SIGUSR1 and write its timings to `out_dir` with SIGUSR2, as
+    profile-<pid>.json and profile-<pid>.folded.
+    """
+    ioloop = tornado.ioloop.IOLoop.current()
+
+    def toggle():
+        if profiler.enabled:
+            profiler.disable()
+        else:
+            profiler.enable()
+        lg.info('Game engine profiling {0}.'.format(
+                'enabled' if profiler.enabled else 'disabled'))
+
+    def dump():
+        prefix = os.path.join(out_dir, 'profile-{0:d}'.format(os.getpid()))
+        try:
+            profiler.dump(prefix)
+        except IOError as e:
+            lg.error('Failed to write profile: {0!s}'.format(e))
+        else:
+            lg.info('Wrote profile to {0}.json/.folded'.format(prefix))
+
+    # Toggle between IOLoop callbacks, never in the middle of a game action.
+    signal.signal(signal.SIGUSR1,
+            lambda sig, frame: ioloop.add_callback_from_signal(toggle))
+    signal.signal(signal.SIGUSR2,
+            lambda sig, frame: ioloop.add_callback_from_signal(dump))
+
+
+def unregistered_users(host, port, prefix, selected_db, usernames,
+        timeout=cloaca.db.DEFAULT_CALL_TIMEOUT):
+    """Return the names in `usernames` that aren't registered in the
+    database. Uses a connection and an IOLoop of its own that are closed
+    afterwards, so it can be called before forking server processes.
+
+    Raise tornado.ioloop.TimeoutError if the database doesn't answer
+    within `timeout` seconds.
+    """
+    io_loop = tornado.ioloop.IOLoop()
+    database = cloaca.db.GTRDBTornadis(host, port, prefix, selected_db)
+
+    @gen.coroutine
+    def find():
+        user_ids = yield [database.retrieve_user_id_from_username(u)
+                for u in usernames]
+        raise gen.Return([u for u, user_id in zip(usernames, user_ids)
+                if user_id is None])
+
+    try:
+        return io_loop.run_sync(find, timeout=timeout)
+    finally:
+        database.pool.destroy()
+        io_loop.clear_current()
+        io_loop.close(all_fds=True)
+
+
+def _deliver_commands(user_id, commands):
+    """Send commands to a user connected to this process."""
+    try:
+        cxn = GameWSHandler.client_cxn_by_user_id[user_id]
+    except KeyError:
+        lg.debug('User ID %s is not connected.', user_id)
+        return
+
+    cxn.send_commands(commands)
+
+
+@gen.coroutine
+def _listen_user_channels(database):
+    """Deliver commands published on the user channels to users connected
+    to this process. Runs forever, re-subscribing if the pub/sub
+    connection fails.
+
+    Every process receives the messages for all users, so messages for
+    users connected to other processes are dropped before decoding.
+    Subscribing to each connected user's channel instead isn't possible
+    with tornadis, which can mistake a message arriving during a SUBSCRIBE
+    for the reply to it.
+    """
+    RETRY_SECONDS = 1
+
+    while True:
+        try:
+            yield database.subscribe_user_channels()
+            while True:
+                user_id, data = yield database.pop_user_message()
+                if user_id not in GameWSHandler.client_cxn_by_user_id:
+                    continue
+
+                try:
+                    commands = cloaca.message.commands_from_binary(data)
+                except ParsingError as e:
+                    lg.warning('Bad message on channel for user {0!s}: {1}'
+                            .format(user_id, e.message))
+                    continue
+
+                _deliver_commands(user_id, commands)
+
+        except GTRDBError as e:
+            lg.error('User channel listener failed: {0}'.format(e.message))
+            yield gen.sleep(RETRY_SECONDS)
+
+
+def make_app(database, multiprocess=False, shard_map=None,
+        password_hasher=None, archive_finished_games=False, bot_users=(),
+        bot_settings=None, turn_timeout=0, turn_timeout_action='default'):
+    """Create the tornado Application.
+
+    If `multiprocess` is True, the app is set up to run alongside other
+    server processes sharing the same database. Game locks are held in the
+    database and commands for users are published on the users' channels,
+    to be delivered by whichever process holds the user's websocket.
+
+    If `shard_map` (a cloaca.shard.ShardMap) is provided, this process is
+    one shard of a sharded deployment. Requests for games owned by other
+    shards are redirected to them, and game locks stay in this process.
+
+    Passwords are hashed with `password_hasher` (a
+    cloaca.passwords.PasswordHasher), or one with the default settings.
+
+    If `archive_finished_games` is True, finished games are compressed
+    into an archive in the database. See GTRDBTornadis.archive_game().
+
+    The registered users named in `bot_users` are played by a
+    cloaca.bot_scheduler.BotScheduler, created with the keyword arguments
+    in the dictionary `bot_settings`. Raise ValueError if one of them
+    isn't registered.
+
+    If `turn_timeout` is positive, a player who doesn't act for that many
+    seconds gets a default action played for them, or with
+    `turn_timeout_action` 'abandon', the game is abandoned. See
+    cloaca.turn_timer.
+    """
     app_path = cloaca.handlers.APPDIR
     site_path = os.path.join(app_path, 'site')
     js_path = os.path.join(site_path, 'js')
     ioloop = tornado.ioloop.IOLoop.current()
     ioloop.run_sync(database.load_scripts)
 
-    server = GTRServer(database)
+    if password_hasher is None:
+        password_hasher = PasswordHasher()
 
-    def send_command(user_id, command):
-        try:
-            cxn = GameWSHandler.client_cxn_by_user_id[user_id]
-        except KeyError:
-            lg.debug('User ID {0!s} is not connected.'.format(user_id))
-            return
+    user_cache = UserCache(database,
+            shared=multiprocess or shard_map is not None)
+    user_cache.start()
+
+    def user_cache_lookups():
+        stats = user_cache.stats()
+        return {
+                ('session', 'hit'): stats['n_hits'],
+                ('session', 'miss'): stats['n_misses'],
+                ('user', 'hit'): stats['n_user_hits'],
+                ('user', 'miss'): stats['n_user_misses'],
+                }
+
+    FunctionMetric('cloaca_user_cache_lookups_total',
+            'Lookups in the user cache of sessions and user hashes, '
+            'by result.',
+            user_cache_lookups, type_name='counter',
+            labelnames=['cache', 'result'])
 
-        cxn.send_command(command)
+    server = GTRServer(database, distributed_locks=multiprocess,
+            user_cache=user_cache,
+            archive_finished_games=archive_finished_games)
 
-    server.send_command = send_command
+    if multiprocess:
+        def send_commands(user_id, commands):
+            data = cloaca.message.commands_to_binary(commands)
+            ioloop.spawn_callback(database.publish_to_user, user_id, data)
+
+        ioloop.spawn_callback(_listen_user_channels, database)
+
+    else:
+        send_commands = _deliver_commands
+
+    server.send_command = lambda user_id, command: send_commands(user_id, [command])
+    server.send_commands = send_commands
+
+    if bot_users:
+        bot_scheduler = BotScheduler(server, **(bot_settings or {}))
+        for username in bot_users:
+            user_id = ioloop.run_sync(lambda:
+                    database.retrieve_user_id_from_username(username))
+            if user_id is None:
+                bot_scheduler.shutdown()
+                raise ValueError('Bot user {0} is not registered.'
+                        .format(username))
+
+            bot_scheduler.add_user(user_id, username)
+            lg.info('Playing user {0} ({1!s}) with a bot'.format(
+                    username, user_id))
+
+        def bot_moves_pending():
+            stats = bot_scheduler.stats()
+            return {('waiting',): stats['n_waiting'],
+                    ('running',): stats['n_running']}
+
+        FunctionMetric('cloaca_bot_moves_pending',
+                'Bot moves waiting for a worker or being computed.',
+                bot_moves_pending, labelnames=['state'])
+
+    if turn_timeout > 0:
+        turn_timer = TurnTimer(server, timeout=turn_timeout,
+                on_expiry=turn_timeout_action)
+        server.turn_timer = turn_timer
+        turn_timer.start()
+
+        def turn_timer_expiries():
+            stats = turn_timer.stats()
+            return {('default',): stats['n_default_actions'],
+                    ('abandon',): stats['n_abandoned']}
+
+        FunctionMetric('cloaca_turn_timers',
+                'Games waiting for an action with a turn timer running.',
+                lambda: len(turn_timer.wheel))
+        FunctionMetric('cloaca_turn_timer_expiries_total',
+                'Turns that ran out of time, by what was done.',
+                turn_timer_expiries, type_name='counter',
+                labelnames=['outcome'])
 
     settings = dict(
             cookie_secret='__TODO:_GENERATE_COOKIE_SECRET__',
             login_url='/login',
             xsrf_cookies=True,
-
+            shard_map=shard_map,
+            user_cache=user_cache,
+            password_hasher=password_hasher,
             )
     # WEBSOCKET_URI = '/ws/'
     WEBSOCKET_URI = '/ws'
@@ -142,6 +360,16 @@ def make_app(database):
         ],
         **settings)
 
+
+def make_metrics_app():
+    """Create the tornado Application that serves the metrics of this
+    process at /metrics. It's served on its own port, apart from the
+    public app (see --metrics-port).
+    """
+    return tornado.web.Application([
+        (r'/metrics', MetricsHandler),
+        ])
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser('Run Cloaca server')
@@ -153,21 +381,98 @@ if __name__ == '__main__':
             help=('Redis host'))
     parser.add_argument('--redis-db', default=0, type=int,
             help=('Redis database'))
+    parser.add_argument('--redis-pool-size', default=cloaca.db.DEFAULT_POOL_SIZE,
+            type=int,
+            help=('Maximum number of Redis connections per server process'))
+    parser.add_argument('--redis-timeout', default=cloaca.db.DEFAULT_CALL_TIMEOUT,
+            type=float,
+            help=('Seconds to wait for the reply to a Redis command before '
+                  'closing the connection. Reads are retried once.'))
     parser.add_argument('--no-ssl', default=False, action='store_true',
             help=('Run server without SSL'))
     parser.add_argument('--ssl-cert', default=None,
             help=('SSL Certificate path'))
     parser.add_argument('--ssl-key', default=None,
             help=('SSL Key path'))
-    # This doesn't work with tornadis.
-    #parser.add_argument('--redis-prefix', default='',
-    #        help=('Custom prefix to redis keys'))
+    parser.add_argument('--processes', default=1, type=int,
+            help=('Number of server processes to fork. Use 0 for one per '
+                  'CPU. With more than one process, games are locked in '
+                  'Redis and commands are delivered via Redis pub/sub.'))
+    parser.add_argument('--shards', default=1, type=int,
+            help=('Number of server processes to fork, with each game '
+                  'owned by one of them. Shard i listens on --port + i. '
+                  'Use 0 for one per CPU. Cannot be combined with '
+                  '--processes.'))
+    parser.add_argument('--metrics-port', default=0, type=int,
+            help=('Serve the Prometheus metrics of each server process at '
+                  '/metrics on its own port: process i of --processes or '
+                  '--shards listens on --metrics-port + i. Use 0 to not '
+                  'serve metrics.'))
+    parser.add_argument('--metrics-address', default='127.0.0.1',
+            help=('Address the metrics ports are bound to. The metrics '
+                  'aren\'t authenticated, so only expose them to the '
+                  'network the scraper is on.'))
+    parser.add_argument('--bcrypt-work-factor', default=12, type=int,
+            help=('bcrypt work factor (log2 of the rounds) for new '
+                  'password hashes'))
+    parser.add_argument('--bcrypt-processes', default=0, type=int,
+            help=('Number of processes for password hashing. Use 0 for '
+                  'one per CPU.'))
+    parser.add_argument('--bcrypt-max-pending', default=64, type=int,
+            help=('Maximum number of password hashes queued or running. '
+                  'Further logins get a 503 response.'))
+    parser.add_argument('--bot-users', default=[], nargs='+',
+            metavar='USERNAME',
+            help=('Registered users whose games are played by the server '
+                  'with the MCTS bot.'))
+    parser.add_argument('--bot-processes', default=0, type=int,
+            help=('Number of processes computing bot moves, shared out '
+                  'among the server processes of --processes or --shards. '
+                  'Use 0 for one per CPU.'))
+    parser.add_argument('--bot-max-concurrent', default=0, type=int,
+            help=('Maximum number of bot moves computed at once, shared '
+                  'out like --bot-processes. Use 0 for one per bot '
+                  'process.'))
+    parser.add_argument('--bot-time-budget', default=2.0, type=float,
+            help=('Seconds of search per bot move.'))
+    parser.add_argument('--bot-deadline', default=5.0, type=float,
+            help=('Seconds after which a bot move that hasn\'t been '
+                  'computed is replaced by the first legal action.'))
+    parser.add_argument('--turn-timeout', default=0, type=float,
+            help=('Seconds a player has for each action before it is '
+                  'taken for them. Use 0 to wait forever.'))
+    parser.add_argument('--turn-timeout-action', default='default',
+            choices=['default', 'abandon'],
+            help=('What to do when a turn times out: play a default '
+                  'action, eg. Thinker, or abandon the game.'))
+    parser.add_argument('--log-retention-blocks', default=0, type=int,
+            help=('Number of compacted blocks of {0:d} game log messages '
+                  'kept per game. Older messages are dropped. Use 0 to '
+                  'keep all messages.'.format(cloaca.db.LOG_BLOCK_SIZE)))
+    parser.add_argument('--archive-finished-games', default=False,
+            action='store_true',
+            help=('Compress the state, actions and log of each game into '
+                  'one archive when it finishes, and delete the separate '
+                  'keys.'))
+    parser.add_argument('--redis-prefix', default='',
+            help=('Prefix for all Redis keys, so that several servers '
+                  'can share a Redis database, eg. "cloaca1:"'))
     parser.add_argument('--log-config',
             help=('Path to logging config file. See --log-create-config.'))
     parser.add_argument('--log-level',
             help=('Globally set the log level for all modules. Valid settings '
                   'are the same as the Python logging module (eg. DEBUG). '
                   'Overrides configuration in --log-config.'))
+    parser.add_argument('--log-queue', default=False, action='store_true',
+            help=('Write log records from a background thread, so that '
+                  'console and file output don\'t block the server.'))
+    parser.add_argument('--profile-dir',
+            help=('Enable game engine profiling signals. SIGUSR1 toggles '
+                  'profiling and SIGUSR2 writes the timings to this '
+                  'directory.'))
+    parser.add_argument('--profile', default=False, action='store_true',
+            help=('Start with game engine profiling enabled. Requires '
+                  '--profile-dir.'))
     parser.add_argument('--log-create-config', nargs='?',
             help=('Generate a logging config file in the current directory '
                   'and exit. A file name can be specified or '
@@ -231,20 +536,106 @@ if __name__ == '__main__':
         sys.exit(1)
 
 
+    if args.profile and args.profile_dir is None:
+        sys.stderr.write('--profile requires --profile-dir.\n')
+        sys.exit(1)
+
+    if args.processes != 1 and args.shards != 1:
+        sys.stderr.write('--processes and --shards cannot be combined.\n')
+        sys.exit(1)
+
+    # Checked before forking, since a worker that exits is restarted.
+    if args.bot_users:
+        try:
+            missing = unregistered_users(args.redis_host, args.redis_port,
+                    args.redis_prefix, args.redis_db, args.bot_users)
+        except (GTRDBError, tornado.ioloop.TimeoutError) as e:
+            sys.stderr.write('Failed to look up --bot-users: {0!s}\n'
+                    .format(e))
+            sys.exit(1)
+
+        if missing:
+            sys.stderr.write('--bot-users are not registered: {0}\n'
+                    .format(', '.join(missing)))
+            sys.exit(1)
+
+    # Fork before any IOLoop or database connection is created.
+    task_id = 0
+    n_server_processes = 1
+    multiprocess = args.processes != 1
+    if multiprocess:
+        n_server_processes = args.processes or tornado.process.cpu_count()
+        sockets = tornado.netutil.bind_sockets(args.port)
+        task_id = tornado.process.fork_processes(args.processes)
+        lg.info('Started server process {0:d}'.format(task_id))
+
+    shard_map = None
+    port = args.port
+    if args.shards != 1:
+        n_shards = args.shards if args.shards > 0 else tornado.process.cpu_count()
+        n_server_processes = n_shards
+
+        # Restarted processes keep their task id, so they own the same games.
+        task_id = tornado.process.fork_processes(n_shards)
+        shard_map = ShardMap(n_shards, args.port, task_id)
+        port = shard_map.port_for_shard(task_id)
+        lg.info('Started shard {0:d} on port {1:d}'.format(task_id, port))
+
+    # The listener thread doesn't survive a fork, so start it in each process.
+    if args.log_queue:
+        log_listener = start_queue_logging()
+        atexit.register(log_listener.stop)
+
+    if args.profile_dir is not None:
+        install_profiling_signals(args.profile_dir)
+        if args.profile:
+            profiler.enable()
+
     # Connect to database
     lg.info('Connecting to Redis database at {0}:{1!s}'.format(args.redis_host, args.redis_port))
     database = cloaca.db.connect(
             host=args.redis_host,
             port=args.redis_port,
-            prefix='') # prefix doesn't work with Lua scripts yet.
+            prefix=args.redis_prefix,
+            selected_db=args.redis_db,
+            pool_size=args.redis_pool_size,
+            call_timeout=args.redis_timeout)
 
-    ioloop = tornado.ioloop.IOLoop.current()
-    ioloop.run_sync(lambda: database.select(args.redis_db))
+    database.log_retention_blocks = args.log_retention_blocks
 
 
     # Start server
-    lg.info('Starting Cloaca server on port {0}'.format(args.port))
-    app = make_app(database)
+    lg.info('Starting Cloaca server on port {0}'.format(port))
+    password_hasher = PasswordHasher(
+            work_factor=args.bcrypt_work_factor,
+            max_workers=args.bcrypt_processes or None,
+            max_pending=args.bcrypt_max_pending)
+
+    # Each server process has its own bot scheduler, so the bot processes
+    # are shared out among them rather than each taking every CPU.
+    n_bot_processes = args.bot_processes or tornado.process.cpu_count()
+    bot_max_workers = max(1, n_bot_processes // n_server_processes)
+    bot_max_concurrent = None
+    if args.bot_max_concurrent:
+        bot_max_concurrent = max(1,
+                args.bot_max_concurrent // n_server_processes)
+
+    try:
+        app = make_app(database, multiprocess=multiprocess,
+                shard_map=shard_map,
+                password_hasher=password_hasher,
+                archive_finished_games=args.archive_finished_games,
+                bot_users=args.bot_users,
+                bot_settings=dict(
+                    max_workers=bot_max_workers,
+                    max_concurrent=bot_max_concurrent,
+                    time_budget=args.bot_time_budget,
+                    deadline=args.bot_deadline),
+                turn_timeout=args.turn_timeout,
+                turn_timeout_action=args.turn_timeout_action)
+    except ValueError as e:
+        sys.stderr.write('{0}\n'.format(e))
+        sys.exit(1)
 
     settings = {}
     if not args.no_ssl:
@@ -255,5 +646,17 @@ if __name__ == '__main__':
 
     httpserver = tornado.httpserver.HTTPServer(app, **settings)
 
-    httpserver.listen(args.port)
+    if multiprocess:
+        httpserver.add_sockets(sockets)
+    else:
+        httpserver.listen(port)
+
+    # Each process has its own metrics, so each gets its own port rather
+    # than sharing the server's sockets.
+    if args.metrics_port:
+        metrics_port = args.metrics_port + task_id
+        make_metrics_app().listen(metrics_port, address=args.metrics_address)
+        lg.info('Serving metrics on {0}:{1:d}'.format(args.metrics_address,
+                metrics_port))
+
     tornado.ioloop.IOLoop.current().start()
@@ -41,12 +41,13 @@ Users are created with:
 
     add_user()
 
-which calls `register_user()` to evaluate the Lua script that registers a user.
+which calls `register_user()` to claim the username and a new user ID.
 The method `register_user()` should not be called directly.
 
 User info is modified with:
 
     update_user_last_login()
+    update_users_last_login() : several users in one pipeline
     update_user_session()
 
 Usernames
@@ -86,9 +87,10 @@ Games are created via the function:
 
     create_game_with_host()
 
-which calls the `create_game` Lua script. This script also pushes the game ID
-onto the list of games and the list of games hosted by that particular user.
-Also, the user ID is pushed onto the list of game_hosts.
+which creates the game hash, then pushes the game ID onto the list of games
+and the list of games hosted by that particular user. Also, the user ID is
+pushed onto the list of game_hosts. See "Key layout" for why these aren't
+done atomically.
 
 Games are retrieved and stored with the functions:
 
@@ -107,47 +109,176 @@ They are accessed and modified using the following functions:
 
     retrieve_log_length()
     retrieve_log_messages()
+    retrieve_log_range()
     append_log_messages()
 
-Logs are stored as Redis Lists, with the key "game_log:<game_id>".
-The most common use cases are loading the last ~50 messages when a game
-is loaded, and appending the new messages as a game is modified.
-Occasionally, when the user reconnects, and scrolls up to see
-old messages, the entire list may need to be traversed, which has
-time complexity O(N).
+The most recent messages (the tail) are stored as a Redis List, with the
+key "{game:<game_id>}:log", newest first. When the tail grows past
+LOG_TAIL_MAX_LENGTH messages, the oldest LOG_BLOCK_SIZE messages are
+compacted into a block: a single string of newline-separated messages,
+stored in the hash "{game:<game_id>}:log_blocks" with the block index as the
+field. Block i holds messages i*LOG_BLOCK_SIZE up to (i+1)*LOG_BLOCK_SIZE.
+The number of compacted messages is the field "compacted" of the hash
+"{game:<game_id>}:log_info".
+
+Appending and reading are done with the `append_log` and `read_log` Lua
+scripts. Reading a range of messages only touches the blocks and the part
+of the tail in the range, so it's O(range).
+
+If GTRDBTornadis.log_retention_blocks is non-zero, only that many of the
+most recent blocks are kept, bounding the memory used by each game's log.
+Reading a range that starts in a dropped block returns the messages from
+the first one retained.
+
+Archived games
+==============
+A finished game can be archived with:
+
+    archive_game()
+
+which bundles the game data, the action log, any actions in the legacy
+hash of actions and the game log into one compressed record (see the archive module), stores it in the field
+"archive" of the game hash, and deletes the "game_data" field and the
+action and log keys. This is done with the `archive_game` Lua script.
+
+Archives are read transparently: retrieve_game(), retrieve_games(),
+retrieve_game_actions(), retrieve_game_action_log() and the game log
+functions fall back on the archive if the game has no "game_data" field,
+no actions or no log.
 
 Game actions
 ============
-Actions are recorded with the function:
+Actions used to be recorded with the function:
 
     set_game_action()
 
-Actions are encoded in the encode_action module to a JSON string after converting
-roles and materials (sites) to integers.
-In Redis, the encoded actions are pushed to a hash of actions for each game, with
-the index of the action as the field name.
+which encodes them in the encode_action module to a JSON string after
+converting roles and materials (sites) to integers, and stores them in a
+hash of actions for each game, with the index of the action as the field
+name. The server no longer records actions there, but older games still
+have them.
+
+Each game has an action log, a string with the key
+"{game:<game_id>}:action_log" holding the binary encoding of every action
+in order (see encode_action.decode_action_log()). New actions are appended
+with:
+
+    append_game_actions()
+    store_game_actions()
+
+The latter also stores the game state resulting from the actions, in the
+same step (the `store_game_actions` Lua script), so the log always matches
+the stored state: a failed write leaves neither changed.
+
+and the whole history is loaded in one read with:
+
+    retrieve_game_action_log()
+
+Game locks
+==========
+When several server processes share the database, modifying a game is
+protected by a lock key "{game:<game_id>}:lock" holding a random token, set
+with an expiry so a crashed process can't hold a lock forever. Locks are
+manipulated with:
+
+    acquire_game_lock()
+    release_game_lock()
+
+The lock is only released if it is still held with the same token. This
+is done with the `release_lock` Lua script.
+
+Key layout
+==========
+All of the keys of a game start with the hash tag "{game:<game_id>}":
+
+    {game:<game_id>} : the game hash
+    {game:<game_id>}:actions : actions by index
+    {game:<game_id>}:action_log
+    {game:<game_id>}:log, :log_blocks, :log_info : the game log
+    {game:<game_id>}:lock
+
+In a Redis Cluster, only the part of a key in braces is hashed, so all of
+a game's keys are in the same slot and the Lua scripts and pipelines that
+touch several of them work with games spread across shards.
+
+The global indexes (games, games_hosted:<user_id>, game_hosts) are in
+other slots. They're updated in separate commands after the game hash is
+created, not in the same transaction. If an update fails, the game exists
+but isn't listed.
+
+Likewise, the user keys (userid, usernames, user:<user_id>) are in
+different slots, so register_user() writes them one at a time. The
+username is claimed with HSETNX, so two registrations of the same name
+can't both succeed. If creating the user hash fails, the username is
+taken but the user has no hash.
+
+Data stored with the earlier layout ("game:<game_id>",
+"game_log:<game_id>", ...) is converted by cloaca.migrate_keys.
+
+Connections
+===========
+Commands are sent on a pool of connections with a timeout on each reply.
+Reads are retried once on a new connection if the connection fails. Lua
+scripts are called with _eval_script(), which falls back from EVALSHA to
+EVAL if Redis doesn't have the script cached. See GTRDBTornadis.
+
+User channels
+=============
+Commands for a user are published on the channel "user_channel:<user_id>"
+so that whichever process holds that user's websocket can deliver them.
+
+    publish_to_user()
+
+Each process listens to all user channels with a separate pub/sub
+connection:
+
+    subscribe_user_channels()
+    pop_user_message()
+
+When a user's session is replaced, the user ID is published on the channel
+"session_invalidations" so that every process can drop its cached session
+(see cloaca.user_cache). It's read with its own pub/sub connection:
+
+    publish_session_invalidation()
+    subscribe_session_invalidations()
+    pop_session_invalidation()
 """
+import datetime
 import time
 
 from tornado import gen
 import tornadis
-from tornadis.exceptions import TornadisException
+from tornadis.exceptions import TornadisException, ConnectionError
 
 from cloaca.error import GTRDBError
+from cloaca.metrics import REDIS_CALL_SECONDS
 
 from cloaca import lua_scripts
+from cloaca import archive
 
 GAMEID = 'gameid'
-GAMEPREFIX = 'game:'
 GAMES = 'games'
 GAMES_HOSTED_PREFIX = 'games_hosted:'
 GAMES_JOINED_PREFIX = 'games_joined:'
 GAME_HOSTS = 'game_hosts'
 GAME_DATA_KEY = 'game_data'
+GAME_ARCHIVE_KEY = 'archive'
+
+# Keys of each game, formatted with the game ID. See "Key layout".
+GAME_KEY = '{{game:{0}}}'
+GAME_MOVES_KEY = GAME_KEY + ':actions'
+GAME_ACTION_LOG_KEY = GAME_KEY + ':action_log'
 
-GAME_MOVE_PREFIX = 'game_actions:'
+LOG_KEY = GAME_KEY + ':log'
+LOG_BLOCKS_KEY = GAME_KEY + ':log_blocks'
+LOG_INFO_KEY = GAME_KEY + ':log_info'
 
-LOG_PREFIX = 'game_log:'
+LOG_BLOCK_SIZE = 50
+LOG_TAIL_MAX_LENGTH = 2*LOG_BLOCK_SIZE
+
+GAME_LOCK_KEY = GAME_KEY + ':lock'
+USER_CHANNEL_PREFIX = 'user_channel:'
+SESSION_CHANNEL = 'session_invalidations'
 
 USERID = 'userid'
 USERPREFIX='user:'
@@ -156,76 +287,332 @@ USERNAMES='usernames'
 SESSIONS='sessions'
 SESSION_AUTH_LENGTH_BYTES=16
 
+# Settings for the connection pool. See GTRDBTornadis.
+DEFAULT_POOL_SIZE = 8
+DEFAULT_CALL_TIMEOUT = 2.0
+
+# Commands that only read, so they can be sent again if the connection
+# fails. Scripts are listed by name in READ_ONLY_SCRIPTS.
+READ_COMMANDS = frozenset([
+        'GET', 'HGET', 'HMGET', 'HGETALL', 'HEXISTS', 'HLEN', 'LRANGE',
+        'LLEN', 'EXISTS', 'TTL', 'PTTL',
+        ])
+
+SCRIPTS = {
+        'release_lock': lua_scripts.RELEASE_LOCK,
+        'append_log': lua_scripts.APPEND_LOG,
+        'read_log': lua_scripts.READ_LOG,
+        'archive_game': lua_scripts.ARCHIVE_GAME,
+        'store_game_actions': lua_scripts.STORE_GAME_ACTIONS,
+        }
+
+READ_ONLY_SCRIPTS = frozenset(['read_log'])
+
 db = None
 
-def connect(host, port, prefix):
+def assemble_log_range(reply, n_messages, n_start):
+    """Convert the reply of the `read_log` Lua script for a request of
+    <n_messages> messages starting at <n_start> into a tuple
+    (<n_total>, <n_first>, <messages>). See retrieve_log_range().
+    """
+    n_total, compacted, first_block, n_blocks = map(int, reply[:4])
+    blocks = reply[4:4+n_blocks]
+    tail = reply[4+n_blocks:]
+    tail.reverse()
+
+    stop = min(n_start + n_messages, n_total)
+
+    n_first = None
+    messages = []
+    for i, block in enumerate(blocks):
+        if block is None:
+            # Dropped by the retention limit
+            continue
+
+        block_start = (first_block + i) * LOG_BLOCK_SIZE
+        lo = max(n_start - block_start, 0)
+        hi = min(stop - block_start, LOG_BLOCK_SIZE)
+
+        if n_first is None:
+            n_first = block_start + lo
+        messages.extend(block.split('\n')[lo:hi])
+
+    if tail and n_first is None:
+        n_first = max(n_start, compacted)
+    messages.extend(tail)
+
+    if n_first is None:
+        n_first = max(min(n_start, n_total), stop)
+
+    return (n_total, n_first, messages)
+
+
+def _game_data_or_archived(game_data, bundle):
+    """Return the game data from the "game_data" field of a game hash, or
+    from the archive if the game has been archived.
+    """
+    if game_data is None and bundle is not None:
+        return archive.decode_archive_game(bundle)
+    return game_data
+
+
+def connect(host, port, prefix, selected_db=0, pool_size=DEFAULT_POOL_SIZE,
+        call_timeout=DEFAULT_CALL_TIMEOUT):
     global db
     if db is None:
-        db = GTRDBTornadis(host, port, prefix)
+        db = GTRDBTornadis(host, port, prefix, selected_db, pool_size,
+                call_timeout)
     return db
 
 
 class GTRDBTornadis(object):
-
-    def __init__(self, host='localhost', port=6379, prefix=''):
-        self.r = tornadis.Client(host=host, port=port, autoconnect=True)
+    """Connection to the Redis database.
+
+    Commands are sent on a pool of up to `pool_size` connections, each
+    used by one command at a time, so a slow command only holds up the
+    coroutines waiting for a connection rather than every command in the
+    process.
+
+    If a reply takes longer than `call_timeout` seconds, the connection
+    is closed, since the late reply would otherwise be read as the reply
+    to the next command, and GTRDBError is raised. Commands in
+    READ_COMMANDS and the scripts in READ_ONLY_SCRIPTS are sent once more
+    on a new connection if the connection fails or times out. Other
+    commands might have been executed, so they aren't repeated.
+
+    Every key starts with `prefix`, including the keys built inside Lua
+    scripts, so several servers can share one Redis database.
+    """
+
+    def __init__(self, host='localhost', port=6379, prefix='', selected_db=0,
+            pool_size=DEFAULT_POOL_SIZE, call_timeout=DEFAULT_CALL_TIMEOUT):
         self.prefix = prefix
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.call_timeout = datetime.timedelta(seconds=call_timeout)
+
+        self.pool = None
+        self._make_pool(selected_db)
 
         self.scripts_sha = {}
 
+        # Number of compacted log blocks kept per game. 0 keeps them all.
+        self.log_retention_blocks = 0
+
+        # Created by subscribe_user_channels()
+        self.pubsub = None
+
+        # Created by subscribe_session_invalidations()
+        self.session_pubsub = None
+
+
+    def _make_pool(self, selected_db):
+        if self.pool is not None:
+            self.pool.destroy()
+
+        self.selected_db = selected_db
+        self.pool = tornadis.ClientPool(max_size=self.pool_size,
+                host=self.host, port=self.port, db=selected_db,
+                autoconnect=True)
+
+
+    @gen.coroutine
+    def _call(self, *args, **kwargs):
+        """Call a Redis command (or a tornadis.Pipeline) on a connection
+        from the pool and return the reply, recording the latency of the
+        call. Errors in the reply are returned as TornadisException.
+
+        Raise GTRDBError if the reply times out. Reads are retried once
+        (see GTRDBTornadis). Pass read_only=True to retry other commands,
+        like read-only scripts.
+        """
+        if isinstance(args[0], tornadis.Pipeline):
+            command = 'PIPELINE'
+        else:
+            command = args[0].upper()
+
+        read_only = kwargs.get('read_only', command in READ_COMMANDS)
+        histogram = REDIS_CALL_SECONDS.labels(command)
+
+        attempts = 2 if read_only else 1
+        for attempt in range(attempts):
+            client = yield self.pool.get_connected_client()
+            if not isinstance(client, tornadis.Client):
+                # Couldn't connect. The error releases the pool slot.
+                self.pool.release_client(client)
+                res = client
+                continue
+
+            start = time.time()
+            timed_out = False
+            try:
+                res = yield gen.with_timeout(self.call_timeout,
+                        client.call(*args))
+            except gen.TimeoutError:
+                timed_out = True
+                client.disconnect()
+            finally:
+                histogram.observe(time.time() - start)
+                self.pool.release_client(client)
+
+            if timed_out:
+                if attempt + 1 < attempts:
+                    continue
+                raise GTRDBError('Redis command {0} timed out after {1}s.'
+                        .format(command, self.call_timeout.total_seconds()))
+
+            if not isinstance(res, ConnectionError):
+                break
+
+        raise gen.Return(res)
+
 
     @gen.coroutine
     def load_scripts(self):
-        sha = yield self.r.call("SCRIPT", "LOAD", lua_scripts.REGISTER_USER)
-        self.scripts_sha['register'] = sha
+        for name, script in SCRIPTS.items():
+            sha = yield self._call("SCRIPT", "LOAD", script)
+            if isinstance(sha, TornadisException):
+                raise GTRDBError('Failed to load script {0}: {1}'
+                        .format(name, sha.message))
+            self.scripts_sha[name] = sha
+
+
+    @gen.coroutine
+    def _eval_script(self, name, keys, args):
+        """Evaluate the Lua script `name` (a key of SCRIPTS) with the
+        sequences `keys` and `args`. Return the reply, which is a
+        TornadisException if the script fails.
+
+        The script is called by its SHA1 digest. If Redis doesn't have it
+        (NOSCRIPT), eg. because Redis restarted or the script cache was
+        flushed since load_scripts(), it's sent in full with EVAL, which
+        also caches it again.
+        """
+        keys = tuple(keys)
+        args = tuple(args)
+        sha = self.scripts_sha.get(name)
+
+        read_only = name in READ_ONLY_SCRIPTS
 
-        sha = yield self.r.call("SCRIPT", "LOAD", lua_scripts.CREATE_GAME)
-        self.scripts_sha['create_game'] = sha
+        if sha is not None:
+            res = yield self._call('EVALSHA', sha, len(keys), *(keys + args),
+                    read_only=read_only)
+            if not (isinstance(res, TornadisException)
+                    and res.message.startswith('NOSCRIPT')):
+                raise gen.Return(res)
+
+        res = yield self._call('EVAL', SCRIPTS[name], len(keys),
+                *(keys + args), read_only=read_only)
+        raise gen.Return(res)
 
 
     @gen.coroutine
     def select(self, selected_db):
-        yield self.r.call('SELECT', selected_db)
+        """Use database number `selected_db` for all further commands.
+        Connections in the pool are replaced by ones that select it when
+        they connect.
+        """
+        self._make_pool(selected_db)
+        res = yield self._call('PING')
+        if isinstance(res, TornadisException):
+            raise GTRDBError('Failed to select database {0!s}: {1}'
+                    .format(selected_db, res.message))
+
+
+    def _game_key(self, key_format, game_id):
+        """Return the key for game `game_id` with the format `key_format`,
+        eg. GAME_KEY.
+        """
+        return self.prefix + key_format.format(game_id)
+
+
+    def _log_keys(self, game_id):
+        return (self._game_key(LOG_KEY, game_id),
+                self._game_key(LOG_BLOCKS_KEY, game_id),
+                self._game_key(LOG_INFO_KEY, game_id))
 
 
     @gen.coroutine
     def append_log_messages(self, game_id, messages):
         """Append IN ORDER the iterable of <messages> to the log for game
-        specifed by <game_id>. Return the updated length of the list.
+        specifed by <game_id>. Return the updated length of the log.
 
-        Messages are arbitrary strings.
+        Messages are arbitrary strings without newlines.
 
         Messages should be in chronological order. That is, the first element
         of <messages> will be the oldest log message.
         """
-        # The messages are passed through function arguments, so
-        # we should limit how many are passed at once, since Python
-        # limits the number of function args. (But what about *args?)
-        # Break messages up into 30-message chunks.
-        def chunks(l, n):
-            """Yield successive n-sized chunks from l."""
-            for i in xrange(0, len(l), n):
-                yield l[i:i + n]
-
-        log_length = None
-        if len(messages) == 0:
-            log_length = yield self.r.call('LLEN',
-                    self.prefix+LOG_PREFIX+str(game_id))
-        else:
-            for chunk in chunks(messages, 30):
-                log_length = yield self.r.call('LPUSH',
-                        self.prefix+LOG_PREFIX+str(game_id), *chunk)
+        keys = self._log_keys(game_id)
+        args = [LOG_BLOCK_SIZE, LOG_TAIL_MAX_LENGTH,
+                self.log_retention_blocks] + list(messages)
+
+        res = yield self._eval_script('append_log', keys, args)
+
+        if isinstance(res, TornadisException):
+            raise GTRDBError('Failed to append log for game {0!s}: {1}'
+                    .format(game_id, res.message))
 
-        # List lengths are longs as returned by Tornadis/Redis. Convert to int.
-        raise gen.Return(int(log_length))
+        # Integers are longs as returned by Tornadis/Redis. Convert to int.
+        raise gen.Return(int(res))
 
 
     @gen.coroutine
     def retrieve_log_length(self, game_id):
-        log_length = yield self.r.call('LLEN',
-                self.prefix+LOG_PREFIX+str(game_id))
-        # List lengths are longs as returned by Tornadis/Redis. Convert to int.
-        raise gen.Return(int(log_length))
+        tail_key, _, info_key = self._log_keys(game_id)
+
+        pipeline = tornadis.Pipeline()
+        pipeline.stack_call('LLEN', tail_key)
+        pipeline.stack_call('HGET', info_key, 'compacted')
+        res = yield self._call(pipeline, read_only=True)
+
+        if isinstance(res, TornadisException):
+            raise GTRDBError('Failed to retrieve log length for game {0!s}: {1}'
+                    .format(game_id, res.message))
+
+        tail_length, compacted = res
+        n_total = int(tail_length) + int(compacted or 0)
+
+        if n_total == 0:
+            bundle = yield self._retrieve_archive(game_id)
+            if bundle is not None:
+                log_first, messages = archive.decode_archive_log(bundle)
+                n_total = log_first + len(messages)
+
+        raise gen.Return(n_total)
+
+
+    @gen.coroutine
+    def retrieve_log_range(self, game_id, n_messages, n_start):
+        """Return a tuple (<n_total>, <n_first>, <messages>) with up to
+        <n_messages> log messages from game with ID <game_id>, starting
+        at the <n_start>'th message. The list <messages> starts with the
+        <n_first>'th message, which is later than <n_start> if the
+        messages before it have been dropped. <n_total> is the total
+        number of messages in the log.
+        """
+        keys = self._log_keys(game_id)
+        args = (n_start, n_messages, LOG_BLOCK_SIZE)
+
+        res = yield self._eval_script('read_log', keys, args)
+
+        if isinstance(res, TornadisException):
+            raise GTRDBError('Failed to read log for game {0!s}: {1}'
+                    .format(game_id, res.message))
+
+        log_range = assemble_log_range(res, n_messages, n_start)
+
+        # An empty log might have been archived.
+        if log_range[0] == 0:
+            bundle = yield self._retrieve_archive(game_id)
+            if bundle is not None:
+                log_first, messages = archive.decode_archive_log(bundle)
+                n_first = max(n_start, log_first)
+                stop = max(n_start + n_messages, n_first)
+                log_range = (log_first + len(messages), n_first,
+                        messages[n_first-log_first:stop-log_first])
+
+        raise gen.Return(log_range)
 
 
     @gen.coroutine
@@ -235,27 +622,11 @@ class GTRDBTornadis(object):
 
         If n_messages larger than the list, all messages are returned.
         If n_start is >= than the length, an empty list is returned.
+        Messages that have been dropped are omitted.
         """
-        # LRANGE includes the last element requested, so
-        #   LRANGE list 0 10
-        # returns 11 elements.
-        # Since we're adding by LPUSH, if we want to start at S
-        # and get N messages:
-        #
-        # S=2, N=3
-        # Message # :
-        # 5  4  3  2  1  0
-        #    <----->
-        #-6 -5 -4 -3 -2 -1
-        #
-        # we need to issue command LRANGE <list> -N-S -S-1
-        #
-        # These messages will still be in the wrong order.
-        # 
-        messages = yield self.r.call('LRANGE',
-                self.prefix+LOG_PREFIX+str(game_id),
-                -(n_start+n_messages), -n_start-1)
-        raise gen.Return(reversed(messages))
+        _, _, messages = yield self.retrieve_log_range(
+                game_id, n_messages, n_start)
+        raise gen.Return(messages)
 
 
     @gen.coroutine
@@ -263,26 +634,39 @@ class GTRDBTornadis(object):
         """Create a new game hosted by user with ID host_user_id.
         Return the new game ID.
         
-        First verifies that the host user exists.
+        First verifies that the host user exists. The game is added to the
+        global indexes after it's created (see "Key layout").
         """
-        game_id = yield self.r.call('EVALSHA', self.scripts_sha['create_game'],
-                5,
-                self.prefix+GAMEID,
-                self.prefix+USERPREFIX+str(host_user_id),
-                self.prefix+GAMES_HOSTED_PREFIX+str(host_user_id),
-                self.prefix+GAMES,
-                self.prefix+GAME_HOSTS,
-                host_user_id)
-
-
-        if not game_id:
+        exists = yield self._call('EXISTS',
+                self.prefix+USERPREFIX+str(host_user_id))
+        if isinstance(exists, TornadisException):
+            raise GTRDBError('Failed to create game for host {0!s}: {1}'
+                    .format(host_user_id, exists.message))
+        elif not exists:
             raise GTRDBError('Host user (ID {0:d}) does not exist.'.format(host_user_id))
 
+        game_id = yield self._call('INCR', self.prefix+GAMEID)
+        if isinstance(game_id, TornadisException):
+            raise GTRDBError('Failed to create game for host {0!s}: {1}'
+                    .format(host_user_id, game_id.message))
+
         now = int(time.mktime(time.gmtime()))
-        yield self.r.call('HMSET', self.prefix+GAMEPREFIX+str(game_id),
-                'date_created', now, GAME_DATA_KEY, '')
+        res = yield self._call('HMSET', self._game_key(GAME_KEY, game_id),
+                'host', host_user_id, 'date_created', now, GAME_DATA_KEY, '')
+        if isinstance(res, TornadisException):
+            raise GTRDBError('Failed to create game {0!s}: {1}'
+                    .format(game_id, res.message))
+
+        pipeline = tornadis.Pipeline()
+        pipeline.stack_call('LPUSH',
+                self.prefix+GAMES_HOSTED_PREFIX+str(host_user_id), game_id)
+        pipeline.stack_call('LPUSH', self.prefix+GAMES, game_id)
+        pipeline.stack_call('LPUSH', self.prefix+GAME_HOSTS, host_user_id)
+        res = yield self._call(pipeline)
+        if isinstance(res, TornadisException):
+            raise GTRDBError('Failed to list game {0!s}: {1}'
+                    .format(game_id, res.message))
 
-        # Redis stores the id as a string, so we have to convert to an int
         raise gen.Return(int(game_id))
 
 
@@ -290,7 +674,7 @@ class GTRDBTornadis(object):
     def store_game(self, game_id, encoded_game):
         """Store a Game object encoded as a string. Raise GTRDBError if an error occurs.
         """
-        res = yield self.r.call('HSET', self.prefix+GAMEPREFIX+str(game_id),
+        res = yield self._call('HSET', self._game_key(GAME_KEY, game_id),
                 GAME_DATA_KEY, encoded_game)
 
         if isinstance(res, TornadisException):
@@ -305,17 +689,83 @@ class GTRDBTornadis(object):
         Raise GTRDBError if the game does not exist or if there is an error
         communicating with the database.
         """
-        encoded_game = yield self.r.call('HGET',
-                self.prefix+GAMEPREFIX+str(game_id), GAME_DATA_KEY)
-        if isinstance(encoded_game, TornadisException):
+        res = yield self._call('HMGET', self._game_key(GAME_KEY, game_id),
+                GAME_DATA_KEY, GAME_ARCHIVE_KEY)
+        if isinstance(res, TornadisException):
             raise GTRDBError('Failed to retrieve game {0!s}: "{1}"'
-                    .format(encoded_game.message))
-        elif encoded_game is None:
+                    .format(game_id, res.message))
+
+        encoded_game = _game_data_or_archived(*res)
+        if encoded_game is None:
             raise GTRDBError('Game {0!s} does not exist.'.format(game_id))
 
         raise gen.Return(encoded_game)
 
 
+    @gen.coroutine
+    def _retrieve_archive(self, game_id):
+        """Return the archive of a game, or None if it hasn't been
+        archived.
+        """
+        res = yield self._call('HGET', self._game_key(GAME_KEY, game_id),
+                GAME_ARCHIVE_KEY)
+        if isinstance(res, TornadisException):
+            raise GTRDBError('Failed to retrieve archive of game {0!s}: {1}'
+                    .format(game_id, res.message))
+
+        raise gen.Return(res)
+
+
+    @gen.coroutine
+    def archive_game(self, game_id, codec=archive.ZLIB):
+        """Replace the game data, action log and game log of the game
+        with ID `game_id` with a compressed archive. The game should be
+        finished, since it won't be modified any more.
+
+        Return the size of the archive in bytes, or None if the game has
+        already been archived or was modified while it was being read.
+        """
+        game_key = self._game_key(GAME_KEY, game_id)
+        actions_key = self._game_key(GAME_ACTION_LOG_KEY, game_id)
+        moves_key = self._game_key(GAME_MOVES_KEY, game_id)
+
+        pipeline = tornadis.Pipeline()
+        pipeline.stack_call('HGET', game_key, GAME_DATA_KEY)
+        pipeline.stack_call('GET', actions_key)
+        pipeline.stack_call('HGETALL', moves_key)
+        res = yield self._call(pipeline, read_only=True)
+
+        if isinstance(res, TornadisException):
+            raise GTRDBError('Failed to read game {0!s} for archiving: {1}'
+                    .format(game_id, res.message))
+
+        game_data, action_log, legacy_actions = res
+        if game_data is None:
+            raise gen.Return(None)
+
+        n_total = yield self.retrieve_log_length(game_id)
+        _, log_first, messages = yield self.retrieve_log_range(
+                game_id, n_total, 0)
+
+        # tornadis gives us hashes as lists, with alternating
+        # key1, value1, key2, value2, etc.
+        legacy_actions = dict(zip(legacy_actions[::2], legacy_actions[1::2]))
+
+        bundle = archive.encode_archive(game_data, action_log, messages,
+                log_first, codec, legacy_actions)
+
+        keys = (game_key, moves_key, actions_key) + self._log_keys(game_id)
+        args = (game_data, bundle)
+
+        res = yield self._eval_script('archive_game', keys, args)
+
+        if isinstance(res, TornadisException):
+            raise GTRDBError('Failed to archive game {0!s}: {1}'
+                    .format(game_id, res.message))
+
+        raise gen.Return(len(bundle) if res == 1 else None)
+
+
     @gen.coroutine
     def retrieve_games(self, game_ids):
         """Return a list of games as the JSON-encoding of the Game object.
@@ -328,19 +778,24 @@ class GTRDBTornadis(object):
             pipeline = tornadis.Pipeline()
 
             for game_id in game_ids:
-                pipeline.stack_call('HGET',
-                        self.prefix+GAMEPREFIX+str(game_id), GAME_DATA_KEY)
+                pipeline.stack_call('HMGET',
+                        self._game_key(GAME_KEY, game_id),
+                        GAME_DATA_KEY, GAME_ARCHIVE_KEY)
 
-            pipeline = yield self.r.call(pipeline)
+            res = yield self._call(pipeline, read_only=True)
 
-            raise gen.Return(pipeline)
+            if isinstance(res, TornadisException):
+                raise GTRDBError('Failed to retrieve games: {0}'
+                        .format(res.message))
+
+            raise gen.Return([_game_data_or_archived(*r) for r in res])
 
 
     @gen.coroutine
     def retrieve_games_hosted_by_user(self, user_id):
         """Get list of game_ids hosted by user with ID user_id.
         """
-        game_ids = yield self.r.call('LRANGE', self.prefix+GAMES_HOSTED_PREFIX+str(user_id), 0, -1)
+        game_ids = yield self._call('LRANGE', self.prefix+GAMES_HOSTED_PREFIX+str(user_id), 0, -1)
         if isinstance(game_ids, TornadisException):
             raise GTRDBError('Failed to retrieve games hosted by user: {0}'
                     .format(user_id))
@@ -352,7 +807,7 @@ class GTRDBTornadis(object):
     def retrieve_latest_games(self, n_games):
         """Get the n_games most recently-created games.
         """
-        game_ids = yield self.r.call('LRANGE', self.prefix+GAMES, 0, n_games)
+        game_ids = yield self._call('LRANGE', self.prefix+GAMES, 0, n_games)
         raise gen.Return(map(int,game_ids))
 
     
@@ -365,12 +820,12 @@ class GTRDBTornadis(object):
         # This check leaves open the possibility that the user is separately
         # registered between the check and the registration, but the register
         # function checks this atomically.
-        exists = yield self.r.call('HEXISTS', self.prefix+USERNAMES, username)
+        exists = yield self._call('HEXISTS', self.prefix+USERNAMES, username)
         if isinstance(exists, TornadisException):
             raise GTRDBError('Error communicating with database: {0}'
                     .format(exists.message))
         elif exists:
-            user_id = yield self.r.call('HGET', self.prefix+USERNAMES, username)
+            user_id = yield self._call('HGET', self.prefix+USERNAMES, username)
             if user_id is not None:
                 raise GTRDBError('User {0} already exists with user ID {1}'
                         .format(username, user_id))
@@ -381,7 +836,7 @@ class GTRDBTornadis(object):
         user_id = yield self.register_user(username)
         unix_time_utc = int(time.mktime(time.gmtime()))
 
-        result = yield self.r.call('HMSET', self.prefix+USERPREFIX+str(user_id),
+        result = yield self._call('HMSET', self.prefix+USERPREFIX+str(user_id),
                 'date_added', unix_time_utc,
                 'last_login', unix_time_utc,
                 'auth', auth_token)
@@ -395,43 +850,45 @@ class GTRDBTornadis(object):
 
     @gen.coroutine
     def register_user(self, username):
-        """Evaluate the register_user lua script. Return the new user ID as an
-        integer.
+        """Register a new user. Return the new user ID as an integer.
 
-        The register_user script does the following:
-            1) Check if the username exists and return None if it does.
-            2) Increment the last-used user ID. Set this as the new user's ID.
+        This does the following:
+            1) Increment the last-used user ID. Set this as the new user's ID.
+            2) Set the reverse-mapping from username to user ID, only if
+            the username doesn't exist yet (HSETNX).
             3) Set a hash for the user ID with one field "username" equal to
             <username>.
-            4) Set the reverse-mapping from username to user ID.
-            5) Return the user id.
 
-        This function calls the script and checks the return/exception, 
-        raising a GTRDBError if the username exists or if registering
-        fails for another reason.
+        These keys are in different slots of a Redis Cluster, so they're
+        written in separate commands (see "Key layout"). A user ID taken
+        in 1) is skipped if the username exists. Raise GTRDBError if the
+        username exists or if registering fails for another reason.
         """
-        result = yield self.r.call('EVALSHA', self.scripts_sha['register'],
-                2, self.prefix+USERID, self.prefix+USERNAMES, username)
+        user_id = yield self._call('INCR', self.prefix+USERID)
+        if isinstance(user_id, TornadisException):
+            raise GTRDBError('Failed to register new user {0}: {1}'
+                    .format(username, user_id.message))
 
-        if isinstance(result, TornadisException):
-            if result.message.startswith('NOSCRIPT'):
-                result = yield self.r.call('EVAL', lua_scripts.REGISTER_USER,
-                        2, self.prefix+USERID, self.prefix+USERNAMES, username)
-            else:
-                raise GTRDBError('Failed to register new user {0}: {1}'
-                        .format(username, result.message))
+        res = yield self._call('HSETNX', self.prefix+USERNAMES, username,
+                user_id)
+        if isinstance(res, TornadisException):
+            raise GTRDBError('Failed to register new user {0}: {1}'
+                    .format(username, res.message))
 
-        if result is None:
-            user_id = yield self.r.call('HGET', self.prefix+USERNAMES, username)
-            if user_id is not None:
-                raise GTRDBError('User {0} already exists with user ID {1}'
-                        .format(username, user_id))
+        if not res:
+            existing_id = yield self._call('HGET', self.prefix+USERNAMES,
+                    username)
+            raise GTRDBError('User {0} already exists with user ID {1}'
+                    .format(username, existing_id))
 
-            raise GTRDBError('Failed to register new user {0}'
-                    .format(username))
-        else:
-            # User ids should be integers
-            raise gen.Return(int(result))
+        res = yield self._call('HSET', self.prefix+USERPREFIX+str(user_id),
+                'username', username)
+        if isinstance(res, TornadisException):
+            raise GTRDBError('Failed to create user {0} ({1!s}): {2}'
+                    .format(username, user_id, res.message))
+
+        # User ids should be integers
+        raise gen.Return(int(user_id))
 
 
     @gen.coroutine
@@ -441,7 +898,24 @@ class GTRDBTornadis(object):
 
         Raise GTRDBError if user doesn't exist.
         """
-        yield self.r.call('HSET', self.prefix+USERPREFIX+str(user_id), 'last_login', last_login_time)
+        yield self._call('HSET', self.prefix+USERPREFIX+str(user_id), 'last_login', last_login_time)
+
+
+    @gen.coroutine
+    def update_users_last_login(self, last_login_by_user):
+        """Update the <last_login> fields of several users at once.
+        The argument `last_login_by_user` is a dict mapping user_id to
+        the last login time, in integer seconds since the UNIX epoch, UTC.
+        """
+        pipeline = tornadis.Pipeline()
+        for user_id, last_login_time in last_login_by_user.items():
+            pipeline.stack_call('HSET', self.prefix+USERPREFIX+str(user_id),
+                    'last_login', last_login_time)
+
+        res = yield self._call(pipeline)
+        if isinstance(res, TornadisException):
+            raise GTRDBError('Failed to update last login times: {0}'
+                    .format(res.message))
 
 
     @gen.coroutine
@@ -449,17 +923,19 @@ class GTRDBTornadis(object):
         """Get user_id from username by examining the "users" table.
         Return None if the username is not found.
         """
-        user_id = yield self.r.call('HGET', self.prefix+USERNAMES, username)
+        user_id = yield self._call('HGET', self.prefix+USERNAMES, username)
         if isinstance(user_id, TornadisException): 
             raise GTRDBError('Failed to get user ID for {0}: {1}'
                     .format(username, user_id.message))
+        elif user_id is None:
+            raise gen.Return(None)
         else:
             raise gen.Return(int(user_id))
 
 
     @gen.coroutine
     def retrieve_user_auth(self, user_id):
-        user_auth = yield self.r.call('HGET', self.prefix+USERPREFIX+str(user_id), 'auth')
+        user_auth = yield self._call('HGET', self.prefix+USERPREFIX+str(user_id), 'auth')
         if isinstance(user_auth, TornadisException):
             raise GTRDBError('Failed to get user auth for {0}: {1}'
                     .format(username, res.message))
@@ -469,7 +945,7 @@ class GTRDBTornadis(object):
 
     @gen.coroutine
     def retrieve_user_session_auth(self, user_id):
-        session_auth = yield self.r.call(
+        session_auth = yield self._call(
                 'HGET', self.prefix+USERPREFIX+str(user_id), 'session_auth')
         if isinstance(session_auth, TornadisException):
             raise GTRDBError('Failed to get session token for {0}: {1}'
@@ -480,7 +956,13 @@ class GTRDBTornadis(object):
 
     @gen.coroutine
     def retrieve_userid_from_session_auth(self, session_auth):
-        user_id = yield self.r.call('HGET', self.prefix+SESSIONS, session_auth)
+        """Return the user_id for a session token, or None if no user
+        has this session.
+        """
+        user_id = yield self._call('HGET', self.prefix+SESSIONS, session_auth)
+        if user_id is None:
+            raise gen.Return(None)
+
         # Redis values are strings, must convert to str
         raise gen.Return(int(user_id))
 
@@ -489,7 +971,7 @@ class GTRDBTornadis(object):
     def retrieve_user(self, user_id):
         """Return the entire User dictionary, formatted as a Python dict.
         """
-        res = yield self.r.call('HGETALL', self.prefix+USERPREFIX+str(user_id))
+        res = yield self._call('HGETALL', self.prefix+USERPREFIX+str(user_id))
         if isinstance(res, TornadisException):
             raise GTRDBError('Failed to retrieve user {0!s}: {1}'
                     .format(user_id, res.message))
@@ -505,7 +987,7 @@ class GTRDBTornadis(object):
     def update_user_session(self, user_id, session_auth):
         """Replaces a session token for user.
         """
-        old_session_auth = yield self.r.call(
+        old_session_auth = yield self._call(
                 'HGET', self.prefix+USERPREFIX+str(user_id), 'session_auth')
 
         pipeline = tornadis.Pipeline()
@@ -516,14 +998,14 @@ class GTRDBTornadis(object):
             pipeline.stack_call('HDEL', self.prefix+SESSIONS, old_session_auth)
 
         pipeline.stack_call('HSET', self.prefix+SESSIONS, session_auth, user_id)
-        res = yield self.r.call(pipeline)
+        res = yield self._call(pipeline)
 
     @gen.coroutine
     def set_game_action(self, game_id, action_number, action_encoded):
         """Set `action_encoded` for given action number for game with id
         `game_id`. This will overwrite another action if it exists.
         """
-        res = yield self.r.call('HSET', self.prefix+GAME_MOVE_PREFIX+str(game_id),
+        res = yield self._call('HSET', self._game_key(GAME_MOVES_KEY, game_id),
                 action_number, action_encoded)
 
         if isinstance(res, TornadisException):
@@ -537,11 +1019,229 @@ class GTRDBTornadis(object):
         each action number in the sequence `action_numbers`.
         """
         fields = map(str, action_numbers)
-        res = yield res.r.call('HMGET', self.prefix+GAME_MOVE_PREFIX+str(game_id),
+        res = yield self._call('HMGET', self._game_key(GAME_MOVES_KEY, game_id),
                 *fields)
 
         if isinstance(res, TornadisException):
             raise GTRDBError('Failed to retrieve game actions {0:d}:{1!s}'
                     .format(game_id, action_numbers))
+
+        # The hash of actions is deleted when a game is archived.
+        if res and all(a is None for a in res):
+            bundle = yield self._retrieve_archive(game_id)
+            if bundle is not None:
+                actions = archive.decode_archive_legacy_actions(bundle)
+                res = [actions.get(int(n)) for n in action_numbers]
+
+        raise gen.Return(res)
+
+
+    @gen.coroutine
+    def append_game_actions(self, game_id, log_header, actions_encoded):
+        """Append the binary-encoded actions `actions_encoded` to the action
+        log of the game with id `game_id`. If the log doesn't exist yet,
+        it's created starting with `log_header`, which must give the action
+        number of the first of these actions.
+
+        Return the length of the action log in bytes.
+        """
+        key = self._game_key(GAME_ACTION_LOG_KEY, game_id)
+
+        pipeline = tornadis.Pipeline()
+        pipeline.stack_call('SET', key, log_header, 'NX')
+        pipeline.stack_call('APPEND', key, actions_encoded)
+        res = yield self._call(pipeline)
+
+        if isinstance(res, TornadisException):
+            raise GTRDBError('Failed to append game actions for game {0:d}: {1}'
+                    .format(game_id, res.message))
         else:
-            raise gen.Return(res)
+            raise gen.Return(res[1])
+
+
+    @gen.coroutine
+    def store_game_actions(self, game_id, encoded_game, log_header,
+            actions_encoded):
+        """Append `actions_encoded` to the action log of the game with id
+        `game_id`, as append_game_actions() does, and store the encoded
+        game `encoded_game` resulting from them, in one atomic step.
+
+        Return the length of the action log in bytes.
+        """
+        keys = (self._game_key(GAME_KEY, game_id),
+                self._game_key(GAME_ACTION_LOG_KEY, game_id))
+        args = (encoded_game, log_header, actions_encoded)
+
+        res = yield self._eval_script('store_game_actions', keys, args)
+
+        if isinstance(res, TornadisException):
+            raise GTRDBError('Failed to store game {0!s} and actions: {1}'
+                    .format(game_id, res.message))
+
+        raise gen.Return(res)
+
+
+    @gen.coroutine
+    def retrieve_game_action_log(self, game_id):
+        """Return the binary action log of the game with id `game_id`,
+        or None if the game has no actions.
+        """
+        res = yield self._call('GET',
+                self._game_key(GAME_ACTION_LOG_KEY, game_id))
+
+        if isinstance(res, TornadisException):
+            raise GTRDBError('Failed to retrieve action log for game {0:d}: {1}'
+                    .format(game_id, res.message))
+
+        if res is None:
+            bundle = yield self._retrieve_archive(game_id)
+            if bundle is not None:
+                res = archive.decode_archive_actions(bundle)
+
+        raise gen.Return(res)
+
+
+    @gen.coroutine
+    def acquire_game_lock(self, game_id, token, ttl_ms):
+        """Try once to acquire the lock for game with ID `game_id`, storing
+        `token`. The lock expires after `ttl_ms` milliseconds.
+
+        Return True if the lock was acquired and False if it is held by
+        someone else.
+        """
+        res = yield self._call('SET', self._game_key(GAME_LOCK_KEY, game_id),
+                token, 'NX', 'PX', ttl_ms)
+
+        if isinstance(res, TornadisException):
+            raise GTRDBError('Failed to acquire lock for game {0!s}: {1}'
+                    .format(game_id, res.message))
+
+        raise gen.Return(res is not None)
+
+
+    @gen.coroutine
+    def release_game_lock(self, game_id, token):
+        """Release the lock for game with ID `game_id` if it is held with
+        `token`. Return True if the lock was released.
+        """
+        key = self._game_key(GAME_LOCK_KEY, game_id)
+        res = yield self._eval_script('release_lock', (key,), (token,))
+
+        if isinstance(res, TornadisException):
+            raise GTRDBError('Failed to release lock for game {0!s}: {1}'
+                    .format(game_id, res.message))
+
+        raise gen.Return(res == 1)
+
+
+    @gen.coroutine
+    def publish_to_user(self, user_id, data):
+        """Publish the bytestring `data` on the channel for user with ID
+        `user_id`. Return the number of subscribers that received it.
+        """
+        res = yield self._call('PUBLISH',
+                self.prefix+USER_CHANNEL_PREFIX+str(user_id), data)
+
+        if isinstance(res, TornadisException):
+            raise GTRDBError('Failed to publish to user {0!s}: {1}'
+                    .format(user_id, res.message))
+
+        raise gen.Return(res)
+
+
+    @gen.coroutine
+    def subscribe_user_channels(self):
+        """Subscribe to the channels for all users with a dedicated
+        pub/sub connection. Messages are retrieved with pop_user_message().
+        """
+        if self.pubsub is None:
+            self.pubsub = tornadis.PubSubClient(host=self.host, port=self.port,
+                    autoconnect=True)
+
+        ok = yield self.pubsub.pubsub_psubscribe(
+                self.prefix+USER_CHANNEL_PREFIX+'*')
+
+        if not ok:
+            raise GTRDBError('Failed to subscribe to user channels.')
+
+
+    @gen.coroutine
+    def pop_user_message(self):
+        """Wait for the next message published to a user channel and return
+        a tuple (user_id, data).
+
+        Raise GTRDBError if the pub/sub connection fails.
+        """
+        channel_prefix = self.prefix+USER_CHANNEL_PREFIX
+        while True:
+            reply = yield self.pubsub.pubsub_pop_message()
+
+            if isinstance(reply, TornadisException):
+                raise GTRDBError('Failed to receive user message: {0}'
+                        .format(reply.message))
+
+            # Pattern subscriptions reply with
+            # ['pmessage', <pattern>, <channel>, <data>]
+            if reply is None or len(reply) != 4 or reply[0] != 'pmessage':
+                continue
+
+            channel, data = reply[2], reply[3]
+            try:
+                user_id = int(channel[len(channel_prefix):])
+            except ValueError:
+                continue
+
+            raise gen.Return((user_id, data))
+
+
+    @gen.coroutine
+    def publish_session_invalidation(self, user_id):
+        """Publish that the session of user with ID `user_id` was replaced.
+        """
+        res = yield self._call('PUBLISH', self.prefix+SESSION_CHANNEL,
+                str(user_id))
+
+        if isinstance(res, TornadisException):
+            raise GTRDBError('Failed to publish session invalidation for '
+                    'user {0!s}: {1}'.format(user_id, res.message))
+
+        raise gen.Return(res)
+
+
+    @gen.coroutine
+    def subscribe_session_invalidations(self):
+        """Subscribe to session invalidations with a dedicated pub/sub
+        connection. They're retrieved with pop_session_invalidation().
+        """
+        if self.session_pubsub is None:
+            self.session_pubsub = tornadis.PubSubClient(host=self.host,
+                    port=self.port, autoconnect=True)
+
+        ok = yield self.session_pubsub.pubsub_subscribe(
+                self.prefix+SESSION_CHANNEL)
+
+        if not ok:
+            raise GTRDBError('Failed to subscribe to session invalidations.')
+
+
+    @gen.coroutine
+    def pop_session_invalidation(self):
+        """Wait for the next session invalidation and return the user ID.
+
+        Raise GTRDBError if the pub/sub connection fails.
+        """
+        while True:
+            reply = yield self.session_pubsub.pubsub_pop_message()
+
+            if isinstance(reply, TornadisException):
+                raise GTRDBError('Failed to receive session invalidation: {0}'
+                        .format(reply.message))
+
+            # Channel subscriptions reply with ['message', <channel>, <data>]
+            if reply is None or len(reply) != 3 or reply[0] != 'message':
+                continue
+
+            try:
+                raise gen.Return(int(reply[2]))
+            except ValueError:
+                continue
@@ -1,9 +1,65 @@
+"""Encode and decode GameAction objects for storage.
+
+Two encodings are provided. The original JSON encoding converts a GameAction
+to a JSON list of the action type and the arguments, with roles and
+materials replaced by integers:
+    - game_action_to_str(action)
+    - str_to_game_action(s)
+
+The binary encoding uses one byte for the action type and one byte for
+each card, role or material argument:
+    - encode_action(action)
+    - decode_action(buffer, offset)
+
+A game's history is stored as a versioned list of consecutive actions:
+    - encode_action_log_header(first_action_number)
+    - encode_actions(actions)
+    - decode_action_log(buffer)
+
+Binary action format
+====================
+    <action> : (1 byte) action type, eg. message.LEADROLE
+    <n_extra> : (1 byte) number of extra arguments. Only present if the
+        action type allows extra arguments (eg. cards for LEADROLE).
+    <args> : each argument encoded according to the type in the spec
+        for the action type (see message._action_args_dict):
+
+        Card : (1 byte) card ident, or 0xFF for None
+        bool : (1 byte) 0 or 1
+        role : (1 byte) role in canonical order, or 0xFF for None.
+            Used for the LEADROLE role argument.
+        material : (1 byte) material in canonical order, or 0xFF for None.
+            Used for the site argument of ARCHITECT, CRAFTSMAN and FOUNTAIN.
+        int : (4 byte signed integer), -2**31 for None
+        str : (4 byte length) followed by the UTF-8 encoded string. The
+            length is 0xFFFFFFFF for None.
+
+Roles and materials are numbered as in encode_binary.
+
+Action log format
+=================
+    <version> : (1 byte) ACTION_LOG_VERSION
+    <first_action_number> : (4 byte integer) action number of the
+        first action.
+    <actions> : binary-encoded actions, back-to-back.
+
+The actions are numbered consecutively from <first_action_number>. The
+log of a game ended by Game.abandon() ends with a message.ABANDON action.
+"""
 import json
+import struct
 
 from cloaca.card import Card
+from cloaca.error import GameActionError
 from cloaca import message
 from message import GameAction
-from encode_binary import GTREncodingError
+from encode_binary import (GTREncodingError, NULLCODE,
+        role_to_int, int_to_role, site_to_int, int_to_site)
+
+ACTION_LOG_VERSION = 1
+
+_ACTION_LOG_HEADER_FMT = '!BI'
+_ACTION_LOG_HEADER_LENGTH = struct.calcsize(_ACTION_LOG_HEADER_FMT)
 
 _CONVERT_STRINGS = {
         'Patron' : 0,
@@ -20,6 +76,43 @@ _CONVERT_STRINGS = {
         'Stone' : 5,
         }
 
+_ROLES = ['Patron', 'Laborer', 'Craftsman', 'Architect', 'Legionary',
+        'Merchant']
+
+_JSON_INT_TO_ROLE = dict((_CONVERT_STRINGS[r], r) for r in _ROLES)
+_JSON_INT_TO_MATERIAL = dict((v, k) for k, v in _CONVERT_STRINGS.items()
+        if k not in _ROLES)
+
+# Argument kinds for the binary encoding.
+_CARD, _BOOL, _ROLE, _MATERIAL, _INT, _STR = range(6)
+
+_INT_NONE = -2**31
+_STR_NONE = 0xFFFFFFFF
+
+
+def _arg_kind(type_, name):
+    if type_ is Card:
+        return _CARD
+    elif type_ is bool:
+        return _BOOL
+    elif type_ is int:
+        return _INT
+    elif name == 'role':
+        return _ROLE
+    elif name == 'site':
+        return _MATERIAL
+    else:
+        return _STR
+
+
+# Action type -> (list of required argument kinds, extra argument kind or None)
+_ARG_KINDS = {}
+for _action, _spec in message._action_args_dict.items():
+    _ARG_KINDS[_action] = (
+            [_arg_kind(t, n) for t, n in _spec.required_arg_specs],
+            _arg_kind(*_spec.extended_arg_spec) if _spec.has_extended else None)
+
+
 def game_action_to_str(action):
     """Serialize a GameAction as a string."""
     def convert(o):
@@ -42,3 +135,178 @@ def game_action_to_str(action):
     action_list = [action.action] + map(convert, action.args)
 
     return json.dumps(action_list, separators=(',',':'))
+
+
+def str_to_game_action(s):
+    """Return the GameAction serialized with game_action_to_str().
+
+    Roles and materials are converted back to strings and bools from ints.
+
+    Raises GTREncodingError if s isn't a valid encoded action.
+    """
+    try:
+        action_list = json.loads(s)
+        action, args = action_list[0], action_list[1:]
+        req_kinds, extra_kind = _ARG_KINDS[action]
+    except (ValueError, TypeError, IndexError, KeyError):
+        raise GTREncodingError('Invalid encoded action: {0!r}'.format(s))
+
+    def convert(kind, o):
+        if o is None:
+            return None
+        elif kind == _BOOL:
+            return bool(o)
+        elif kind == _ROLE:
+            return _JSON_INT_TO_ROLE[o]
+        elif kind == _MATERIAL:
+            return _JSON_INT_TO_MATERIAL[o]
+        else:
+            return o
+
+    kinds = req_kinds + [extra_kind]*(len(args)-len(req_kinds))
+    try:
+        args = [convert(kind, o) for kind, o in zip(kinds, args)]
+        return GameAction(action, *args)
+    except (KeyError, GameActionError) as e:
+        raise GTREncodingError('Invalid encoded action: {0!r}'.format(s))
+
+
+def _encode_arg(kind, arg):
+    if kind == _CARD:
+        return chr(NULLCODE if arg is None else arg.ident)
+    elif kind == _BOOL:
+        return chr(int(arg))
+    elif kind == _ROLE:
+        return chr(role_to_int(arg))
+    elif kind == _MATERIAL:
+        return chr(site_to_int(arg))
+    elif kind == _INT:
+        return struct.pack('!i', _INT_NONE if arg is None else arg)
+    elif arg is None:
+        return struct.pack('!I', _STR_NONE)
+    else:
+        if isinstance(arg, unicode):
+            arg = arg.encode('utf-8')
+        return struct.pack('!I', len(arg)) + arg
+
+
+def encode_action(action):
+    """Encode a GameAction object and return a bytestring.
+
+    See module documentation for format specification.
+    """
+    req_kinds, extra_kind = _ARG_KINDS[action.action]
+    n_req = len(req_kinds)
+
+    chunks = [chr(action.action)]
+    if extra_kind is not None:
+        chunks.append(chr(len(action.args) - n_req))
+
+    for kind, arg in zip(req_kinds, action.args):
+        chunks.append(_encode_arg(kind, arg))
+
+    for arg in action.args[n_req:]:
+        chunks.append(_encode_arg(extra_kind, arg))
+
+    return ''.join(chunks)
+
+
+def _decode_arg(kind, buffer, offset):
+    """Return a tuple (<bytes>, <arg>) for an argument of type `kind`."""
+    if kind == _INT:
+        i = struct.unpack_from('!i', buffer, offset)[0]
+        return (4, None if i == _INT_NONE else i)
+
+    elif kind == _STR:
+        length = struct.unpack_from('!I', buffer, offset)[0]
+        if length == _STR_NONE:
+            return (4, None)
+
+        if offset + 4 + length > len(buffer):
+            raise GTREncodingError('String argument exceeds buffer length.')
+
+        return (4+length, buffer[offset+4:offset+4+length].decode('utf-8'))
+
+    i = ord(buffer[offset])
+    if kind == _CARD:
+        return (1, None if i == NULLCODE else i)
+    elif kind == _BOOL:
+        return (1, bool(i))
+    elif kind == _ROLE:
+        return (1, int_to_role(i))
+    else:
+        return (1, int_to_site(i))
+
+
+def decode_action(buffer, offset):
+    """Decode a GameAction object from `buffer` starting at `offset` and
+    return a tuple (<bytes>, <action>) where <bytes> is the number of
+    bytes consumed.
+
+    Raises GTREncodingError if the buffer doesn't contain a valid action.
+    """
+    start = offset
+    try:
+        action = ord(buffer[offset])
+        offset += 1
+        req_kinds, extra_kind = _ARG_KINDS[action]
+
+        kinds = req_kinds
+        if extra_kind is not None:
+            n_extra = ord(buffer[offset])
+            offset += 1
+            kinds = req_kinds + [extra_kind]*n_extra
+
+        args = []
+        for kind in kinds:
+            n, arg = _decode_arg(kind, buffer, offset)
+            offset += n
+            args.append(arg)
+
+        return (offset-start, GameAction(action, *args))
+
+    except (IndexError, KeyError, struct.error, UnicodeDecodeError,
+            GameActionError, TypeError) as e:
+        raise GTREncodingError('Failed to decode action at offset {0:d}: {1!s}'
+                .format(start, e))
+
+
+def encode_action_log_header(first_action_number):
+    """Return the header for an action log starting with action number
+    `first_action_number`.
+    """
+    return struct.pack(_ACTION_LOG_HEADER_FMT, ACTION_LOG_VERSION,
+            first_action_number)
+
+
+def encode_actions(actions):
+    """Return the binary encodings of a sequence of GameAction objects,
+    concatenated. Append this to an action log.
+    """
+    return ''.join(encode_action(a) for a in actions)
+
+
+def decode_action_log(buffer):
+    """Decode an action log and return a tuple
+    (<first_action_number>, <list of GameActions>).
+
+    Raises GTREncodingError if the version is unknown or the log is
+    corrupted.
+    """
+    try:
+        version, first_action_number = struct.unpack_from(
+                _ACTION_LOG_HEADER_FMT, buffer)
+    except struct.error:
+        raise GTREncodingError('Action log is too short for a header.')
+
+    if version != ACTION_LOG_VERSION:
+        raise GTREncodingError('Unknown action log version {0:d}'.format(version))
+
+    actions = []
+    offset = _ACTION_LOG_HEADER_LENGTH
+    while offset < len(buffer):
+        n, action = decode_action(buffer, offset)
+        offset += n
+        actions.append(action)
+
+    return (first_action_number, actions)
@@ -7,6 +7,7 @@ into a base64-encoded bytestring and vice versa.
 
 Objects are encoded with the functions:
     - encode_game(game)
+    - encode_game_body(game)
     - encode_zone(zone)
     - encode_player(player)
     - encode_frame(frame, players)
@@ -22,7 +23,17 @@ and decoded by passing the binary buffer to these:
     - decode_stack(buffer, offset)
 
 where the offset into the buffer is used to decode more efficiently
-using struct.unpack_from().
+using struct.unpack_from(). encode_game_body() omits the header, which
+decode_game() doesn't read anyway, for in-memory copies that don't need
+a checksum.
+
+When only a few properties of the game are needed (eg. for a game list
+or for checking that a user is a player in the game), the full decode
+can be avoided with:
+    - peek_game_metadata(buffer)
+
+which reads the fixed-size Game properties and the player names, skipping
+zones and buildings by their length prefixes. The checksum is not verified.
 
 Additionally, the encoding header that includes a checksum and encoding
 version is manipulated with:
@@ -828,6 +839,23 @@ def encode_game(obj):
 
     See module documentation for format specification.
     """
+    game_bytes = encode_game_body(obj)
+    checksum = crc32(game_bytes)
+    version = 1
+
+    # crc32 returns an unsigned integer
+    header = struct.pack('!IIi', MAGIC_NUMBER, version, checksum)
+
+    return ''.join([header, game_bytes])
+
+
+def encode_game_body(obj):
+    """Encode the game object without the header and return a bytestring.
+
+    The result is decoded with decode_game(). Without the header there's
+    no checksum to compute or verify, so this is only suitable for data
+    that stays in memory, such as Game.snapshot().
+    """
     chunks = []
 
     fmt = '!III21pBBBBBBBBI'
@@ -867,15 +895,7 @@ def encode_game(obj):
     chunks.append(encode_frame(obj._current_frame, obj.players))
     chunks.append(encode_stack(obj.stack, obj.players))
 
-
-    game_bytes = ''.join(chunks)
-    checksum = crc32(game_bytes)
-    version = 1
-
-    # crc32 returns an unsigned integer
-    header = struct.pack('!IIi', MAGIC_NUMBER, version, checksum)
-
-    return ''.join([header, game_bytes])
+    return ''.join(chunks)
 
 
 def game_to_str(game):
@@ -889,7 +909,128 @@ def game_to_str(game):
 
 def decode_header(buffer):
     """Decode the header and return a tuple (magic_number, version, checksum).
+
+    Raise GTREncodingError if the buffer is too short to contain a header,
+    if the magic number doesn't match, or if the version is unsupported.
+    """
+    fmt = '!IIi'
+    try:
+        magic_number, version, checksum = struct.unpack_from(fmt, buffer, 0)
+    except struct.error as e:
+        raise GTREncodingError('Error unpacking header: ' + e.message)
+
+    if magic_number != MAGIC_NUMBER:
+        raise GTREncodingError('Decoding error: invalid record format')
+
+    if version != 1:
+        raise GTREncodingError('Decoding error: format version {0:d} unsupported'.format(version))
+
+    return (magic_number, version, checksum)
+
+
+def _zone_length(buffer, offset):
+    """Return the number of bytes used by the Zone encoded in `buffer`
+    at `offset` without decoding it.
     """
+    length = struct.unpack_from('!B', buffer, offset)[0]
+    if length and struct.unpack_from('!B', buffer, offset+1)[0] == NULLCODE:
+        return 2
+    else:
+        return length+1
+
+
+def _player_length(buffer, offset):
+    """Return the number of bytes used by the Player encoded in `buffer`
+    at `offset` without decoding it.
+    """
+    offset_orig = offset
+    offset += struct.calcsize('!21pIBBB6B')
+
+    # camp, jack_hand, non_jack_hand, stockpile, clientele, revealed,
+    # prev_revealed, clients_given, vault
+    for i in range(9):
+        offset += _zone_length(buffer, offset)
+
+    n_buildings = struct.unpack_from('!B', buffer, offset)[0]
+    offset += 1
+
+    for i in range(n_buildings):
+        offset += struct.unpack_from('!B', buffer, offset)[0] + 1
+
+    return offset-offset_orig
+
+
+def peek_game_metadata(s):
+    """Read a few properties of the game encoded in the base64 string `s`
+    without decoding the whole Game. Return a dictionary with the keys:
+
+        game_id : (int)
+        turn_number : (int)
+        action_number : (int)
+        host : (str) user name of game host
+        players : (list of str) player names, in order
+        player_uids : (list of int) player user IDs, in order
+        winners : (list of str) names of winning players or empty list
+        started : (bool) equivalent to Game.started
+        finished : (bool) equivalent to Game.finished
+
+    The checksum is not verified, so a corrupted record might not be
+    detected. Use str_to_game() if the full Game object is required.
+
+    Raise GTREncodingError if the header is invalid or if the record is
+    too short.
+    """
+    try:
+        bytestring = base64.b64decode(s)
+    except TypeError as e:
+        raise GTREncodingError('Invalid base64.')
+
+    decode_header(bytestring)
+    offset = struct.calcsize('!IIi')
+
+    try:
+        fmt = '!III21p'
+        game_id, turn_number, action_number, hostname = \
+                struct.unpack_from(fmt, bytestring, offset)
+
+        # Skip the remaining fixed-size game properties and the sites.
+        offset += struct.calcsize('!III21pBBBBBBBBI6B6B')
+
+        fmt = '!5B'
+        winner_flags = struct.unpack_from(fmt, bytestring, offset)
+        offset += struct.calcsize(fmt)
+
+        # jacks, library, pool
+        for i in range(3):
+            offset += _zone_length(bytestring, offset)
+
+        n_players = struct.unpack_from('!B', bytestring, offset)[0]
+        offset += 1
+
+        players = []
+        player_uids = []
+        for i in range(n_players):
+            name, uid = struct.unpack_from('!21pI', bytestring, offset)
+            players.append(name)
+            player_uids.append(uid)
+            offset += _player_length(bytestring, offset)
+
+    except struct.error as e:
+        raise GTREncodingError('Error unpacking game: ' + e.message)
+
+    winners = _decode_winners(winner_flags, players)
+
+    return {
+            'game_id' : game_id,
+            'turn_number' : turn_number,
+            'action_number' : action_number,
+            'host' : hostname,
+            'players' : players,
+            'player_uids' : player_uids,
+            'winners' : winners,
+            'started' : turn_number > 0,
+            'finished' : len(winners) > 0,
+            }
 
 
 def str_to_game(s):
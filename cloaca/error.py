@@ -13,5 +13,8 @@ class GameActionError(GTRError):
 class ParsingError(GTRError):
     pass
 
+class ServerBusyError(GTRError):
+    pass
+
 class GameOver(Exception):
     pass
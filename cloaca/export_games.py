@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+"""Export the games stored in Redis to columnar files for offline analysis,
+eg. win rates by building, role frequencies and game length.
+
+Games are read in chunks with one pipelined request per chunk, and decoded
+in a pool of processes while the next chunk is read. Archived games (see
+cloaca.archive) are read from the archive.
+
+Each run writes one part to the output directory with two tables:
+
+    games-<part>.npz (or .parquet) : one row per game, see GAME_COLUMNS
+    buildings-<part>.npz (or .parquet) : one row per building owned by each
+        player, see BUILDING_COLUMNS
+
+The file export_state.json in the output directory records a checksum of
+each game exported. Later runs skip games that haven't changed, and
+finished games are skipped without being read at all. A game can appear
+in several parts if it changed between runs, in which case the row from
+the latest part supersedes the others.
+
+numpy is required for the .npz format and pyarrow for Parquet.
+
+Usage:
+    python -m cloaca.export_games <output directory> [--format npz|parquet]
+            [--processes N] [--chunk-size N] [--redis-host H]
+            [--redis-port P] [--redis-db D] [--redis-prefix PREFIX]
+"""
+import argparse
+import json
+import os
+import os.path
+import zlib
+from collections import Counter, deque
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+import cloaca.archive as archive
+import cloaca.encode_action as encode_action
+import cloaca.encode_binary as encode
+import cloaca.message as message
+
+# Redis key names, as in cloaca.db
+GAMES = 'games'
+GAME_KEY = '{{game:{0}}}'
+GAME_DATA_KEY = 'game_data'
+GAME_ARCHIVE_KEY = 'archive'
+GAME_ACTION_LOG_KEY = GAME_KEY + ':action_log'
+
+STATE_FILE = 'export_state.json'
+
+ROLES = ['Patron', 'Laborer', 'Craftsman', 'Architect', 'Legionary',
+        'Merchant']
+
+GAME_COLUMNS = (
+        ['game_id', 'n_players', 'turn_number', 'action_number', 'finished',
+         'n_winners', 'n_thinker', 'n_followed']
+        + ['led_' + role.lower() for role in ROLES])
+
+BUILDING_COLUMNS = ['game_id', 'player_index', 'building', 'site',
+        'complete', 'winner', 'score']
+
+# Type of each column, so that empty tables get the same types as others.
+COLUMN_TYPES = dict([(name, 'int') for name in GAME_COLUMNS]
+        + [('finished', 'bool'), ('building', 'str'), ('site', 'str'),
+           ('complete', 'bool'), ('winner', 'bool'),
+           ('player_index', 'int'), ('score', 'int')])
+
+_NUMPY_TYPES = {'int': 'int64', 'bool': 'bool', 'str': 'S'}
+
+# Chunks submitted to the decoding processes and not collected yet, per
+# process. Bounds the rows held in memory while reading is ahead.
+MAX_PENDING_CHUNKS = 2
+
+
+def game_rows(game_id, game_data, action_log):
+    """Decode a game and return a tuple (<game row>, <building rows>) with
+    rows as tuples in the order of GAME_COLUMNS and BUILDING_COLUMNS.
+
+    Role frequencies are counted from the binary action log `action_log`,
+    and are zero if it's None.
+    """
+    game = encode.str_to_game(game_data)
+
+    actions = []
+    if action_log is not None:
+        _, actions = encode_action.decode_action_log(action_log)
+
+    led = Counter()
+    n_thinker = 0
+    n_followed = 0
+    for a in actions:
+        if a.action == message.LEADROLE:
+            led[a.args[0]] += 1
+        elif a.action == message.THINKERORLEAD and a.args[0]:
+            n_thinker += 1
+        elif a.action == message.FOLLOWROLE and a.args[0] > 0:
+            n_followed += 1
+
+    winners = set(p.name for p in game.winners)
+
+    game_row = ((game_id, len(game.players), game.turn_number,
+            game.action_number, game.finished, len(winners),
+            n_thinker, n_followed)
+            + tuple(led[role] for role in ROLES))
+
+    building_rows = []
+    for i, player in enumerate(game.players):
+        won = player.name in winners
+        score = game._player_score(player) if game.started else 0
+        for b in player.buildings:
+            building_rows.append((game_id, i, b.foundation.name, b.site,
+                    b.complete, won, score))
+
+    return game_row, building_rows
+
+
+def _decode_chunk(chunk):
+    """Decode a list of (game_id, game_data, action_log, bundle) tuples in
+    a worker process. Return (<game rows>, <building rows>, <failed ids>).
+    """
+    game_rows_out, building_rows_out, failed = [], [], []
+    for game_id, game_data, action_log, bundle in chunk:
+        try:
+            if game_data is None:
+                game_data = archive.decode_archive_game(bundle)
+                action_log = archive.decode_archive_actions(bundle)
+
+            game_row, building_rows = game_rows(game_id, game_data, action_log)
+        except Exception:
+            # Corrupted records raise GTREncodingError, but games that
+            # can't be reconstructed might raise anything.
+            failed.append(game_id)
+        else:
+            game_rows_out.append(game_row)
+            building_rows_out.extend(building_rows)
+
+    return game_rows_out, building_rows_out, failed
+
+
+def checksum(*values):
+    """CRC32 of the raw Redis values of a game, to detect changes."""
+    crc = 0
+    for v in values:
+        crc = zlib.crc32(v or '', crc)
+    return crc & 0xffffffff
+
+
+def load_state(out_dir):
+    """Return the export state from a previous run, or a new one."""
+    try:
+        with open(os.path.join(out_dir, STATE_FILE)) as f:
+            state = json.load(f)
+    except IOError:
+        return {'part': 0, 'checksums': {}, 'finished': []}
+
+    return state
+
+
+def save_state(out_dir, state):
+    path = os.path.join(out_dir, STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.rename(path + '.tmp', path)
+
+
+def read_chunks(r, game_ids, chunk_size, state, prefix=''):
+    """Read games from the redis-py client `r` with one pipeline per chunk
+    of `chunk_size` games, yielding lists of
+    (game_id, game_data, action_log, bundle) tuples for games that changed
+    since the last export. Updates the checksums in `state`. Keys start
+    with `prefix`, as with cloacaapp.py --redis-prefix.
+    """
+    finished = set(state['finished'])
+    checksums = state['checksums']
+
+    game_ids = [g for g in game_ids if g not in finished]
+
+    for i in xrange(0, len(game_ids), chunk_size):
+        ids = game_ids[i:i+chunk_size]
+
+        pipe = r.pipeline(transaction=False)
+        for game_id in ids:
+            pipe.hmget(prefix+GAME_KEY.format(game_id), GAME_DATA_KEY,
+                    GAME_ARCHIVE_KEY)
+            pipe.get(prefix+GAME_ACTION_LOG_KEY.format(game_id))
+        res = pipe.execute()
+
+        chunk = []
+        for game_id, (game_data, bundle), action_log in zip(
+                ids, res[::2], res[1::2]):
+            if not game_data and bundle is None:
+                continue
+
+            crc = checksum(game_data, action_log, bundle)
+            if checksums.get(str(game_id)) == crc:
+                continue
+
+            checksums[str(game_id)] = crc
+            chunk.append((game_id, game_data or None, action_log, bundle))
+
+        if chunk:
+            yield chunk
+
+
+def _columns(rows, names):
+    return dict((name, [row[i] for row in rows])
+            for i, name in enumerate(names))
+
+
+def write_table(path, rows, names, fmt):
+    """Write `rows` as a columnar table with column `names` to `path`,
+    with the extension for the format `fmt` ('npz' or 'parquet') appended.
+    """
+    columns = _columns(rows, names)
+
+    if fmt == 'parquet':
+        arrow_types = {'int': pyarrow.int64(), 'bool': pyarrow.bool_(),
+                'str': pyarrow.string()}
+        table = pyarrow.Table.from_arrays(
+                [pyarrow.array(columns[n], type=arrow_types[COLUMN_TYPES[n]])
+                    for n in names], names)
+        pyarrow.parquet.write_table(table, path + '.parquet')
+    else:
+        numpy.savez_compressed(path + '.npz',
+                **dict((n, numpy.array(columns[n],
+                    dtype=_NUMPY_TYPES[COLUMN_TYPES[n]])) for n in names))
+
+
+def export(r, out_dir, fmt='npz', processes=None, chunk_size=500,
+        prefix=''):
+    """Export the games changed since the last export to a new part in
+    `out_dir`. Return a tuple (<games exported>, <games that failed to
+    decode>).
+    """
+    state = load_state(out_dir)
+
+    game_ids = sorted(set(int(g) for g in r.lrange(prefix+GAMES, 0, -1)))
+
+    processes = processes or cpu_count()
+    executor = ProcessPoolExecutor(processes)
+    max_pending = MAX_PENDING_CHUNKS * processes
+
+    all_game_rows, all_building_rows, all_failed = [], [], []
+    def collect(future):
+        game_rows_out, building_rows_out, failed = future.result()
+        all_game_rows.extend(game_rows_out)
+        all_building_rows.extend(building_rows_out)
+        all_failed.extend(failed)
+
+    # Stop reading when the processes are behind, rather than reading
+    # every game into the executor's queue.
+    pending = deque()
+    for chunk in read_chunks(r, game_ids, chunk_size, state, prefix):
+        if len(pending) >= max_pending:
+            collect(pending.popleft())
+        pending.append(executor.submit(_decode_chunk, chunk))
+
+    while pending:
+        collect(pending.popleft())
+
+    executor.shutdown()
+
+    for game_id in all_failed:
+        state['checksums'].pop(str(game_id), None)
+
+    if all_game_rows:
+        state['part'] += 1
+        part = '{0:05d}'.format(state['part'])
+        write_table(os.path.join(out_dir, 'games-'+part),
+                all_game_rows, GAME_COLUMNS, fmt)
+        write_table(os.path.join(out_dir, 'buildings-'+part),
+                all_building_rows, BUILDING_COLUMNS, fmt)
+
+    i_finished = GAME_COLUMNS.index('finished')
+    state['finished'] = sorted(set(state['finished']) |
+            set(row[0] for row in all_game_rows if row[i_finished]))
+
+    save_state(out_dir, state)
+
+    return len(all_game_rows), all_failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('out_dir', help='Directory for exported tables')
+    parser.add_argument('--format', default='npz', choices=['npz', 'parquet'])
+    parser.add_argument('--processes', default=0, type=int,
+            help='Number of decoding processes. Use 0 for one per CPU.')
+    parser.add_argument('--chunk-size', default=500, type=int,
+            help='Number of games read per pipelined request')
+    parser.add_argument('--redis-host', default='localhost')
+    parser.add_argument('--redis-port', default=6379, type=int)
+    parser.add_argument('--redis-db', default=0, type=int)
+    parser.add_argument('--redis-prefix', default='',
+            help='Prefix of the Redis keys of the server')
+    args = parser.parse_args()
+
+    if args.format == 'npz' and numpy is None:
+        parser.error('numpy is required for the npz format.')
+    elif args.format == 'parquet' and pyarrow is None:
+        parser.error('pyarrow is required for the parquet format.')
+
+    import redis
+    r = redis.StrictRedis(host=args.redis_host, port=args.redis_port,
+            db=args.redis_db)
+
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+
+    n_games, failed = export(r, args.out_dir, args.format,
+            args.processes or None, args.chunk_size, args.redis_prefix)
+
+    print 'Exported {0:d} games to {1}.'.format(n_games, args.out_dir)
+    if failed:
+        print 'Failed to decode {0:d} games: {1}'.format(len(failed),
+                ', '.join(map(str, failed)))
+
+
+if __name__ == '__main__':
+    main()
@@ -12,11 +12,38 @@ import copy
 from collections import Counter
 import logging
 import message
-from datetime import datetime
+import time
 import itertools
 
 lg = logging.getLogger(__name__)
 
+
+class GameSnapshot(object):
+    """The state of a Game saved by Game.snapshot(), to be passed to
+    Game.restore(). Snapshots are never modified, so one can be restored
+    any number of times.
+
+    Attributes:
+        game_id -- (int) ID of the game the snapshot was taken of.
+        action_number -- (int) Game.action_number when it was taken.
+        binary -- (bool) True if the state is stored with
+            encode_binary.encode_game_body(), False if it's a copy of the
+            Game made with Game._copy().
+    """
+
+    def __init__(self, game_id, action_number, binary, state, game_log):
+        self.game_id = game_id
+        self.action_number = action_number
+        self.binary = binary
+        self._state = state
+        self._game_log = game_log
+
+    def __repr__(self):
+        return ('GameSnapshot(game_id={0!r}, action_number={1!r}, '
+                'binary={2!r})'.format(
+                self.game_id, self.action_number, self.binary))
+
+
 class Game(object):
     """Controls the operation of a single game.
 
@@ -36,6 +63,10 @@ class Game(object):
     Game.handle(game_action) takes a GameAction object as user input and executes
     the subsequent game rules. It raises a GTRError if there is any trouble
     performing the action.
+
+    Game.snapshot() saves the state of the game and Game.restore(snapshot)
+    returns the game to that state, eg. to take back an action or to
+    explore several continuations of a game.
     
     """
     _initial_jack_count = 6
@@ -212,15 +243,37 @@ class Game(object):
             raise GTRError('Maximum players reached for this game {0}/{0}'
                     .format(n))
 
-        lg.debug('Adding player {0}.'.format(name))
+        lg.debug('Adding player %s.', name)
 
         self.players.append(Player(uid, name))
         self._log('{0} has joined the game.'.format(name))
 
+    def abandon(self):
+        """End the game because the active player stopped responding.
+        The other players win, or the only player in a solo game.
+
+        Return a GameAction of type message.ABANDON to record in the
+        action log in place of the action that was expected. The action
+        number is incremented as if that action had been handled.
+        """
+        if not self.started:
+            raise GTRError('Cannot abandon a game that hasn\'t started.')
+
+        if self.finished:
+            raise GTRError('Game has already finished.')
+
+        p = self.active_player
+        self._log('{0} ran out of time. The game is abandoned.'
+                .format(p.name))
+        self.winners = [q for q in self.players if q is not p] or [p]
+        self.action_number += 1
+
+        return message.GameAction(message.ABANDON)
+
     def handle(self, a):
         """ Switchyard to handle game actions.
         """
-        lg.debug('Handling action: ' + repr(a))
+        lg.debug('Handling action: %r', a)
         if a.action != self.expected_action:
             raise GTRError('Expected GameAction type: ' + str(self.expected_action)
                 + ', got: ' + repr(a))
@@ -237,7 +290,7 @@ class Game(object):
             try:
                 method(a)
             except GTRError as e:
-                lg.debug('Error handling action: '+e.message)
+                lg.debug('Error handling action: %s', e.message)
                 raise
 
 
@@ -252,7 +305,7 @@ class Game(object):
 
         Return a new game state object
         """
-        gs = copy.deepcopy(self)
+        gs = self._copy()
 
         if self.winners is None or not len(self.winners):
 
@@ -272,6 +325,86 @@ class Game(object):
 
         return gs
 
+    def snapshot(self, binary=False):
+        """Return a GameSnapshot of the current state of the game.
+
+        By default the snapshot holds a copy of the game made with
+        _copy(), which shares the Card objects and other immutable values
+        with the game, and only copies the zones, players, buildings and
+        stack frames. With binary=True, the game is encoded with
+        encode_binary.encode_game_body() instead, without the header,
+        checksum and base64 encoding used for storage. That is a few times
+        slower to take and restore, but the state is only a few hundred
+        bytes, for keeping a long history of snapshots.
+        """
+        if binary:
+            # encode_binary imports this module.
+            import cloaca.encode_binary as encode_binary
+            state = encode_binary.encode_game_body(self)
+        else:
+            state = self._copy()
+
+        return GameSnapshot(self.game_id, self.action_number, binary, state,
+                tuple(self.game_log))
+
+    def restore(self, snapshot):
+        """Return this game to the state saved in `snapshot`, a
+        GameSnapshot from snapshot(). The snapshot can be restored again
+        later. Raise GTRError if it is a snapshot of another game.
+
+        The players, zones and stack are replaced, so references to the
+        previous objects (eg. a player from game.players) must be looked
+        up again after restoring.
+        """
+        if snapshot.game_id != self.game_id:
+            raise GTRError('Cannot restore a snapshot of game {0} to game {1}.'
+                    .format(snapshot.game_id, self.game_id))
+
+        if snapshot.binary:
+            import cloaca.encode_binary as encode_binary
+            gs = encode_binary.decode_game(snapshot._state)
+        else:
+            gs = snapshot._state._copy()
+
+        gs.game_log = list(snapshot._game_log)
+
+        self.__dict__.clear()
+        self.__dict__.update(gs.__dict__)
+
+    def _copy(self):
+        """Return a copy of this game that shares the Card objects and
+        other immutable values with it, but none of the zones, players,
+        buildings or stack frames. Modifying either game doesn't affect
+        the other. This is much faster than copy.deepcopy().
+        """
+        gs = Game.__new__(Game)
+        gs.__dict__.update(self.__dict__)
+
+        gs.players = [p.copy() for p in self.players]
+        players = dict(zip(map(id, self.players), gs.players))
+
+        def copy_frame(frame):
+            if frame is None:
+                return None
+            args = [players.get(id(a), a) if isinstance(a, Player) else a
+                    for a in frame.args]
+            return cloaca.stack.Frame(frame.function_name, args=args,
+                    executed=frame.executed)
+
+        gs.jacks = self.jacks.copy()
+        gs.library = self.library.copy()
+        gs.pool = self.pool.copy()
+        gs.in_town_sites = list(self.in_town_sites)
+        gs.out_of_town_sites = list(self.out_of_town_sites)
+        gs.stack = cloaca.stack.Stack([copy_frame(f) for f in self.stack.stack])
+        gs._current_frame = copy_frame(self._current_frame)
+        gs.game_log = list(self.game_log)
+
+        if self.winners is not None:
+            gs.winners = [players[id(p)] for p in self.winners]
+
+        return gs
+
     def find_player_index(self, player_name):
         """Finds the index of a named player.
         """
@@ -304,8 +437,8 @@ class Game(object):
         self.leader_index = self.leader_index + 1
         if self.leader_index >= len(self.players):
             self.leader_index = 0
-        lg.debug('Leader index changed from {0} to {1}'.format(prev_index,
-        self.leader_index))
+        lg.debug('Leader index changed from %s to %s', prev_index,
+                self.leader_index)
 
     def _following_players_in_order(self):
         """Return a list of players in turn order starting with
@@ -333,7 +466,7 @@ class Game(object):
 
         self.active_player = self.players[first_player_index]
         self.leader_index = first_player_index
-        self.jacks = Zone([Card(i) for i in range(Game._initial_jack_count)])
+        self.jacks = Zone([Card(i) for i in range(Game._initial_jack_count)], name='jacks')
         self._init_sites(n_players)
 
     def _init_pool(self, n_players):
@@ -544,8 +677,7 @@ class Game(object):
     def _thinker_for_cards(self, player, max_hand_size):
         n_cards = max_hand_size - len(player.hand)
         if n_cards < 1: n_cards = 1
-        lg.debug(
-            'Adding {0} cards to {1}\'s hand'.format(n_cards, player.name))
+        lg.debug('Adding %d cards to %s\'s hand', n_cards, player.name)
         drawn_cards = self._draw_cards(n_cards)
         player.hand.extend(drawn_cards)
         return len(drawn_cards)
@@ -588,11 +720,13 @@ class Game(object):
 
     def _log(self, msg):
         """Logs the message in the GameState log roll.
+
+        The message is prefixed with the time as integer seconds since
+        the UNIX epoch, which the client formats for display.
         """
-        time = datetime.now().time().strftime('%H:%M:%S ')
-        self.game_log.append(time+msg)
+        self.game_log.append('{0:d} {1}'.format(int(time.time()), msg))
         self.log_length += 1
-        lg.debug(time+msg)
+        lg.debug(msg)
 
     def _pump(self):
         """Pop the top frame from the stack into self._current_frame
@@ -605,7 +739,7 @@ class Game(object):
                 lg.warning('Tried to pop from empty stack!')
                 raise
 
-            lg.debug('Execute next stack frame: ' + repr(self._current_frame))
+            lg.debug('Execute next stack frame: %r', self._current_frame)
 
             func = getattr(self, self._current_frame.function_name)
             func.__call__(*self._current_frame.args)
@@ -1540,7 +1674,7 @@ class Game(object):
             self._log_construct(p, foundation, material, site, ' from hand')
 
             if b.complete:
-                lg.debug('{0} completes {1!s}'.format(p.name, b))
+                lg.debug('%s completes %s', p.name, b)
                 self._log('{0} completed.'.format(str(b)))
                 self._resolve_building(p, b)
 
@@ -1835,11 +1969,11 @@ class Game(object):
             ungiven_mats = unmatched_mats & remaining_mats # intersection
 
             if len(extra_mats):
-                lg.debug('Too many cards given : ' + str(extra_mats))
+                lg.debug('Too many cards given : %s', extra_mats)
                 raise GTRError('Extra cards given for Legionary.')
 
             if len(ungiven_mats) and not immune:
-                lg.debug('Require more cards : ' + str(ungiven_mats))
+                lg.debug('Require more cards : %s', ungiven_mats)
                 raise GTRError('Not enough cards given for Legionary.')
 
             return given
@@ -15,7 +15,7 @@ def get_card_from_zone(card, zone):
     find a non-existent card in a list. Prints an error and
     re-raises the exception.
     """
-    lg.debug('getting card {0!s} from zone {1!s}'.format(card, zone))
+    lg.debug('getting card %s from zone %s', card, zone)
     try:
         return zone.pop(zone.index(card))
     except ValueError as e:
@@ -24,7 +24,7 @@ def get_card_from_zone(card, zone):
 def add_card_to_zone(card, zone):
     """
     """
-    lg.debug('adding card {0!s} to zone {1!s}'.format(card, zone))
+    lg.debug('adding card %s to zone %s', card, zone)
     zone.append(card)
 
 def check_petition_combos(
@@ -1,8 +1,11 @@
 import cloaca.message
 from cloaca.message import Command, GameAction
-from cloaca.error import ParsingError, GTRDBError, GTRError
+from cloaca.error import ParsingError, GTRDBError, GTRError, ServerBusyError
 from cloaca.server import GTRServer
 from cloaca.game_record import GameRecord
+from cloaca.metrics import (WS_CONNECTIONS, WS_OPEN_CONNECTIONS,
+        WS_MESSAGES_IN, WS_MESSAGES_OUT)
+import cloaca.metrics
 import cloaca.db
 import cloaca.encode_binary as encode
 
@@ -10,17 +13,13 @@ import tornado
 from tornado.web import RequestHandler
 from tornado.websocket import WebSocketHandler
 from tornado import gen, escape
-from tornado.process import cpu_count
-
-from concurrent.futures import ThreadPoolExecutor
+from tornado.httputil import split_host_and_port
 
 import os
 import os.path
 import logging
-import time
 import json
 import binascii
-import bcrypt
 import re
 
 SESSION_AUTH_LENGTH_BYTES = 16
@@ -28,8 +27,6 @@ SESSION_MAX_AGE_DAYS = 1
 
 lg = logging.getLogger(__name__)
 
-pool = ThreadPoolExecutor(cpu_count())
-
 APPDIR = os.path.dirname(__file__)
 
 class BaseHandler(RequestHandler):
@@ -44,9 +41,9 @@ class BaseHandler(RequestHandler):
     # Session expiration is handled via expiring Tornado secure cookies.
     @gen.coroutine
     def prepare(self):
-        lg.info('Current user: ' + str(self.current_user))
+        lg.debug('Current user: %s', self.current_user)
         if self.current_user is not None:
-            lg.debug('Current user logged in {0}'.format(self.current_user['username']))
+            lg.debug('Current user logged in %s', self.current_user['username'])
             return
         else:
             lg.debug('Not logged in.')
@@ -56,23 +53,31 @@ class BaseHandler(RequestHandler):
                 lg.debug('No cookie available')
                 return
 
-            user_id = yield self.db.retrieve_userid_from_session_auth(cookie_session_auth)
-            if user_id is not None:
-                lg.debug('User id from cookie session: {0}'.format(user_id))
-                user_session_auth = yield self.db.retrieve_user_session_auth(user_id)
-                if cookie_session_auth == user_session_auth:
-                    # Cookie matches stored session - load user info
-                    user_dict = yield self.db.retrieve_user(user_id)
-                    self.current_user = user_dict
-                    self.current_user['user_id'] = user_id
-                    lg.debug('Set current user {0}'.format(self.current_user['username']))
-
-                    # Update login time.
-                    yield self.db.update_user_last_login(
-                            user_id,
-                            int(time.mktime(time.gmtime()))
-                            )
-                    return
+            # The cache checks that the cookie matches the stored session
+            # and records the login time.
+            user_dict = yield self.settings['user_cache'].user_from_session(
+                    cookie_session_auth)
+            if user_dict is not None:
+                self.current_user = user_dict
+                lg.debug('Set current user %s', self.current_user['username'])
+                return
+
+
+    def redirect_to_game_owner(self, game_id):
+        """In a sharded deployment (see cloaca.shard), redirect the request
+        to the process that owns the game with ID `game_id`.
+
+        Return True if the request was redirected, and False if this
+        process owns the game or the deployment isn't sharded.
+        """
+        shard_map = self.settings.get('shard_map')
+        if shard_map is None or shard_map.owns(game_id):
+            return False
+
+        host, _ = split_host_and_port(self.request.host)
+        self.redirect('{0}://{1}:{2:d}{3}'.format(self.request.protocol,
+                host, shard_map.port_for_game(game_id), self.request.uri))
+        return True
 
 
 class CreateGameHandler(BaseHandler):
@@ -100,6 +105,9 @@ class JoinGameHandler(BaseHandler):
     @tornado.web.authenticated
     @gen.coroutine
     def get(self, game_id):
+        if self.redirect_to_game_owner(game_id):
+            return
+
         user_id = self.current_user['user_id']
         game_id = yield self.server.join_game(user_id, game_id)
 
@@ -116,18 +124,16 @@ class StartGameHandler(BaseHandler):
     @tornado.web.authenticated
     @gen.coroutine
     def get(self, game_id):
+        if self.redirect_to_game_owner(game_id):
+            return
+
         user_id = self.current_user['user_id']
 
         game = yield self.server.start_game(user_id, game_id)
 
         for p in game.players:
-            try:
-                client_cxn = GameWSHandler.client_cxn_by_user_id[p.uid]
-            except KeyError:
-                pass
-            else:
-                resp = Command(game_id, None, GameAction(cloaca.message.STARTGAME))
-                client_cxn.send_command(resp)
+            resp = Command(game_id, None, GameAction(cloaca.message.STARTGAME))
+            self.server.send_command(p.uid, resp)
 
         self.redirect('/')
         return
@@ -151,6 +157,9 @@ class GameHandler(BaseHandler):
     @tornado.web.authenticated
     @gen.coroutine
     def get(self, game_id):
+        if self.redirect_to_game_owner(game_id):
+            return
+
         user_id = self.current_user['user_id']
 
         # Render with ws-uri so that a proxy will re-write the websocket URI.
@@ -177,15 +186,13 @@ class GameListHandler(BaseHandler):
             if game_encoded is None:
                 continue
             try:
-                game = encode.str_to_game(game_encoded)
+                metadata = encode.peek_game_metadata(game_encoded)
             except encode.GTREncodingError as e:
-                lg.debug('Error decoding game JSON.')
+                lg.debug('Error decoding game metadata.')
                 continue
 
-            players = [p.name for p in game.players]
-            started = game.started
-            host = game.host
-            records.append(GameRecord(game.game_id, players, started, host))
+            records.append(GameRecord(metadata['game_id'], metadata['players'],
+                    metadata['started'], metadata['host']))
 
         self.render('site/templates/game_list.html',
                 username=self.current_user['username'],
@@ -233,8 +240,13 @@ class RegisterHandler(BaseHandler):
                             .format(username))))
             return
         else:
-            hashed_auth = yield pool.submit(
-                    bcrypt.hashpw, auth.encode('utf-8'), bcrypt.gensalt())
+            try:
+                hashed_auth = yield self.settings['password_hasher'].hash_password(
+                        auth.encode('utf-8'))
+            except ServerBusyError:
+                self.set_status(503)
+                self.finish('Server busy, please try again.')
+                return
 
             user_id = yield self.db.add_user(username, hashed_auth)
             if user_id is None:
@@ -243,7 +255,8 @@ class RegisterHandler(BaseHandler):
                                 .format(username))))
             else:
                 session_auth = generate_session_token()
-                yield self.db.update_user_session(user_id, session_auth)
+                yield self.settings['user_cache'].update_user_session(
+                        user_id, session_auth)
                 self.set_secure_cookie('session_auth', session_auth,
                         expires_days=SESSION_MAX_AGE_DAYS)
                 self.redirect('/')
@@ -267,10 +280,15 @@ class AuthenticateHandler(BaseHandler):
                     .format(escape.url_escape('Unknown username or password.')))
         else:
             user_auth = yield self.db.retrieve_user_auth(user_id)
-            hashed_auth = yield pool.submit(
-                    bcrypt.hashpw, auth.encode('utf-8'), user_auth.encode('utf-8'))
+            try:
+                auth_ok = yield self.settings['password_hasher'].check_password(
+                        auth.encode('utf-8'), user_auth.encode('utf-8'))
+            except ServerBusyError:
+                self.set_status(503)
+                self.finish('Server busy, please try again.')
+                return
 
-            if user_auth == hashed_auth:
+            if auth_ok:
                 session_auth = yield self.db.retrieve_user_session_auth(user_id)
                 self.set_secure_cookie('session_auth', session_auth,
                         expires_days=SESSION_MAX_AGE_DAYS)
@@ -287,7 +305,7 @@ class LogoutHandler(BaseHandler):
     def get(self):
         if self.current_user is not None:
             new_session_auth = generate_session_token()
-            yield self.db.update_user_session(
+            yield self.settings['user_cache'].update_user_session(
                     self.current_user['user_id'], new_session_auth)
 
         self.redirect('/')
@@ -300,6 +318,13 @@ def generate_session_token():
 class GameWSHandler(WebSocketHandler):
     MESSAGE_ERROR_THRESHOLD = 5
 
+    # permessage-deflate settings. Game states are small and mostly
+    # repeat the previous one, so the shared compression context does most
+    # of the work. A lower mem_level reduces the per-connection memory for
+    # compression with little effect on the ratio for messages this size.
+    COMPRESSION_LEVEL = 6
+    COMPRESSION_MEM_LEVEL = 5
+
     # Mapping user ID to instance of this class.
     client_cxn_by_user_id = {}
 
@@ -313,7 +338,7 @@ class GameWSHandler(WebSocketHandler):
     @gen.coroutine
     def prepare(self):
         if self.current_user is not None:
-            lg.debug('Current user logged in {0}'.format(self.current_user['username']))
+            lg.debug('Current user logged in %s', self.current_user['username'])
             return
         else:
             lg.debug('Not logged in.')
@@ -323,23 +348,14 @@ class GameWSHandler(WebSocketHandler):
                 lg.debug('No cookie available')
                 return
 
-            user_id = yield self.db.retrieve_userid_from_session_auth(cookie_session_auth)
-            if user_id is not None:
-                lg.debug('User id from cookie session: {0}'.format(user_id))
-                user_session_auth = yield self.db.retrieve_user_session_auth(user_id)
-                if cookie_session_auth == user_session_auth:
-                    # Cookie matches stored session - load user info
-                    user_dict = yield self.db.retrieve_user(user_id)
-                    self.current_user = user_dict
-                    self.current_user['user_id'] = user_id
-                    lg.debug('Set current user {0}'.format(self.current_user['username']))
-
-                    # Update login time.
-                    yield self.db.update_user_last_login(
-                            user_id,
-                            int(time.mktime(time.gmtime()))
-                            )
-                    return
+            # The cache checks that the cookie matches the stored session
+            # and records the login time.
+            user_dict = yield self.settings['user_cache'].user_from_session(
+                    cookie_session_auth)
+            if user_dict is not None:
+                self.current_user = user_dict
+                lg.debug('Set current user %s', self.current_user['username'])
+                return
 
 
     @tornado.web.asynchronous
@@ -355,24 +371,49 @@ class GameWSHandler(WebSocketHandler):
         self.message_error_count = 0
         self.server = server
         self.db = database
+        self.binary_protocol = False
+
+
+    def get_compression_options(self):
+        return {
+                'compression_level': self.COMPRESSION_LEVEL,
+                'mem_level': self.COMPRESSION_MEM_LEVEL,
+                }
+
+
+    def select_subprotocol(self, subprotocols):
+        """Use binary messages if the client supports them, falling
+        back to JSON messages.
+        """
+        if cloaca.message.BINARY_PROTOCOL in subprotocols:
+            self.binary_protocol = True
+            return cloaca.message.BINARY_PROTOCOL
+        elif cloaca.message.JSON_PROTOCOL in subprotocols:
+            return cloaca.message.JSON_PROTOCOL
+        else:
+            return None
 
 
     def open(self):
         user_id = self.current_user['user_id']
         GameWSHandler.client_cxn_by_user_id[user_id] = self
+        WS_CONNECTIONS.inc()
+        WS_OPEN_CONNECTIONS.inc()
 
 
     def on_close(self):
         user_id = self.current_user['user_id']
         del GameWSHandler.client_cxn_by_user_id[user_id]
+        WS_OPEN_CONNECTIONS.dec()
 
 
     @gen.coroutine
     def on_message(self, message):
-        lg.debug('WS handler received message: '+str(message))
+        lg.debug('WS handler received message: %s', message)
         try:
             commands = Command.from_json(message)
         except ParsingError as e:
+            WS_MESSAGES_IN.labels('invalid').inc()
             self.message_error_count += 1
             if self.message_error_count >= self.MESSAGE_ERROR_THRESHOLD:
                 self.close()
@@ -382,12 +423,23 @@ class GameWSHandler(WebSocketHandler):
                                 'Error parsing message: '+e.message)))
             return
         else:
+            for c in commands:
+                WS_MESSAGES_IN.labels(str(c.action)).inc()
+
             user_id = self.current_user['user_id']
             game_id = commands[0].game
+
+            shard_map = self.settings.get('shard_map')
+            if (shard_map is not None and game_id is not None
+                    and not shard_map.owns(game_id)):
+                self.send_error('Game {0:d} is handled by another server '
+                        'process.'.format(game_id))
+                return
+
             if commands[0].action.action == cloaca.message.LOGIN:
                 lg.debug('Ignoring deprecated LOGIN message.')
             elif commands[0].action.action == cloaca.message.REQGAMESTATE:
-                lg.debug('Received request for game {0!s}.'.format(game_id))
+                lg.debug('Received request for game %s.', game_id)
                 try:
                     game_encoded = yield self.server.get_game_data(user_id, game_id)
                 except GTRError as e:
@@ -395,10 +447,10 @@ class GameWSHandler(WebSocketHandler):
                     self.send_error(e.message)
                 else:
                     resp = Command(game_id, None, GameAction(cloaca.message.GAMESTATE, game_encoded))
-                    lg.debug('Sending game '+str(game_id))
+                    lg.debug('Sending game %s', game_id)
                     self.send_command(resp)
             elif commands[0].action.action == cloaca.message.REQGAMELOG:
-                lg.debug('Received request for log game {0!s}.'.format(game_id))
+                lg.debug('Received request for log game %s.', game_id)
                 n_messages, n_start = commands[0].action.args
                 yield self.server.retrieve_and_send_log_messages(
                         user_id, game_id, n_messages, n_start)
@@ -408,8 +460,35 @@ class GameWSHandler(WebSocketHandler):
 
 
     def send_command(self, command):
-        self.write_message(command.to_json())
+        self.send_commands([command])
+
+    def send_commands(self, commands):
+        """Send a list of commands in a single websocket message."""
+        for c in commands:
+            WS_MESSAGES_OUT.labels(str(c.action)).inc()
+
+        if self.binary_protocol:
+            self.write_message(cloaca.message.commands_to_binary(commands),
+                    binary=True)
+        else:
+            self.write_message(cloaca.message.commands_to_json(commands))
 
     def send_error(self, msg):
         resp = Command(None, None, GameAction(cloaca.message.SERVERERROR, msg))
         self.send_command(resp)
+
+
+class MetricsHandler(RequestHandler):
+    """Serve the metrics of this process in the Prometheus text format.
+    See cloaca.metrics. It isn't authenticated, so it's served by the
+    separate app from cloacaapp.make_metrics_app().
+    """
+
+    def initialize(self, registry=None):
+        if registry is None:
+            registry = cloaca.metrics.REGISTRY
+        self.registry = registry
+
+    def get(self):
+        self.set_header('Content-Type', cloaca.metrics.CONTENT_TYPE)
+        self.write(self.registry.exposition())
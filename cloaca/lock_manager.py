@@ -0,0 +1,132 @@
+"""Per-game locks for the game server.
+
+GTRServer serializes modifications to each game with a lock keyed by the
+game ID. GameLockManager creates these locks on demand and drops them as
+soon as nobody holds or waits on them, so the table only contains the games
+that currently have work in progress, no matter how many games have been
+played.
+
+    lock_manager = GameLockManager()
+
+    with (yield lock_manager.acquire(game_id, timeout)):
+        ...
+
+Contention metrics are accumulated and reported by GameLockManager.stats().
+"""
+
+from tornado import gen, locks
+import tornado.ioloop
+
+
+class _LockEntry(object):
+    """A lock and the number of coroutines holding or waiting on it."""
+
+    __slots__ = ('lock', 'refs')
+
+    def __init__(self):
+        self.lock = locks.Lock()
+        self.refs = 0
+
+
+class _Releaser(object):
+    """Context manager returned by GameLockManager.acquire()."""
+
+    __slots__ = ('manager', 'game_id', 'entry')
+
+    def __init__(self, manager, game_id, entry):
+        self.manager = manager
+        self.game_id = game_id
+        self.entry = entry
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.manager._release(self.game_id, self.entry)
+
+
+class GameLockManager(object):
+    """Table of tornado.locks.Lock objects by game ID, with reference
+    counting so that idle locks are evicted.
+    """
+
+    def __init__(self):
+        self._locks = {}
+
+        self.n_acquired = 0
+        self.n_contended = 0
+        self.n_timeouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def __len__(self):
+        """Number of games with a lock held or awaited."""
+        return len(self._locks)
+
+    @gen.coroutine
+    def acquire(self, game_id, timeout=None):
+        """Acquire the lock for `game_id`, waiting at most `timeout`
+        (a datetime.timedelta, or None to wait forever).
+
+        Return a context manager that releases the lock on exit. Raise
+        gen.TimeoutError if the lock isn't acquired in time.
+        """
+        try:
+            entry = self._locks[game_id]
+        except KeyError:
+            entry = _LockEntry()
+            self._locks[game_id] = entry
+
+        contended = entry.refs > 0
+        entry.refs += 1
+
+        if not contended:
+            # Uncontended fast path. The lock is free, so this doesn't wait.
+            yield entry.lock.acquire()
+            self.n_acquired += 1
+            raise gen.Return(_Releaser(self, game_id, entry))
+
+        ioloop = tornado.ioloop.IOLoop.current()
+        start = ioloop.time()
+        try:
+            yield entry.lock.acquire(timeout)
+        except gen.TimeoutError:
+            self.n_timeouts += 1
+            self._unref(game_id, entry)
+            raise
+        finally:
+            wait_time = ioloop.time() - start
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+
+        self.n_acquired += 1
+        self.n_contended += 1
+        raise gen.Return(_Releaser(self, game_id, entry))
+
+    def _release(self, game_id, entry):
+        entry.lock.release()
+        self._unref(game_id, entry)
+
+    def _unref(self, game_id, entry):
+        entry.refs -= 1
+        if entry.refs == 0:
+            del self._locks[game_id]
+
+    def stats(self):
+        """Return a dictionary of contention metrics:
+
+            n_locks : number of games with a lock held or awaited
+            n_acquired : total number of locks acquired
+            n_contended : number of acquisitions that had to wait
+            n_timeouts : number of acquisitions that timed out
+            wait_time_total : total seconds spent waiting on held locks
+            wait_time_max : longest wait in seconds
+        """
+        return {
+                'n_locks' : len(self._locks),
+                'n_acquired' : self.n_acquired,
+                'n_contended' : self.n_contended,
+                'n_timeouts' : self.n_timeouts,
+                'wait_time_total' : self.wait_time_total,
+                'wait_time_max' : self.wait_time_max,
+                }
@@ -0,0 +1,104 @@
+"""Write log records from a background thread.
+
+Log handlers write to the console or to files synchronously, which blocks
+the IOLoop thread for every record. With start_queue_logging(), the
+handlers of a logger are moved behind a queue that a separate thread
+drains:
+
+    listener = start_queue_logging()
+    ...
+    listener.stop()
+
+Records are formatted into their final message before being queued, so
+arguments that are changed later (eg. a Game) are logged as they were.
+
+Python 2 doesn't have logging.handlers.QueueHandler and QueueListener,
+so minimal versions of them are provided here.
+"""
+import copy
+import logging
+import threading
+import Queue
+
+
+class QueueHandler(logging.Handler):
+    """Put log records on a queue for a QueueListener."""
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def prepare(self, record):
+        """Return a copy of the record with the message, including any
+        exception text, merged in so that it can be handled later.
+        """
+        msg = self.format(record)
+        record = copy.copy(record)
+        record.message = msg
+        record.msg = msg
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """Pass the records from a queue to `handlers` in a separate thread."""
+
+    _sentinel = None
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._monitor,
+                name='log_queue_listener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                break
+            self.handle(record)
+
+    def stop(self):
+        """Handle the records already queued, then stop the thread."""
+        if self._thread is not None:
+            self.queue.put_nowait(self._sentinel)
+            self._thread.join()
+            self._thread = None
+
+
+def start_queue_logging(logger=None):
+    """Move the handlers of `logger` (the root logger by default) to a
+    QueueListener and replace them with a QueueHandler. Return the
+    started QueueListener.
+    """
+    if logger is None:
+        logger = logging.getLogger()
+
+    queue = Queue.Queue()
+    handlers = list(logger.handlers)
+    for handler in handlers:
+        logger.removeHandler(handler)
+
+    logger.addHandler(QueueHandler(queue))
+
+    listener = QueueListener(queue, *handlers)
+    listener.start()
+    return listener
@@ -1,45 +1,162 @@
-# Atomically checks if username is available, increments user id,
-# and registers username with the new user_id.
-#
-# KEYS[1] is "userid"
-# KEYS[2] is the "users" list of user_ids by username
-# ARGV[1] is the requested username
-#
-# Returns the new user_id if username is available, false otherwise.
-#
-# Note, because this dynamically generates the user_id, it technically
-# doesn't comply with the rule that all keys be passed in via the KEYS
-# table. This should only be a problem if running in Redis Cluster in
-# the future.
-REGISTER_USER="""
-if redis.call("HEXISTS", KEYS[2], ARGV[1]) == 1 then
-    return false
+# Releases a lock only if it is still held with the given token, so that
+# a lock that expired and was acquired by another process isn't released.
+#
+# KEYS[1] is '{game:<game_id>}:lock'
+# ARGV[1] is the token used to acquire the lock
+#
+# Returns 1 if the lock was released, 0 otherwise.
+RELEASE_LOCK="""
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
 else
-    local user_id = redis.call("INCR", KEYS[1])
-    redis.call("HSET", "user:"..user_id, "username", ARGV[1])
-    redis.call("HSET", KEYS[2], ARGV[1], user_id)
-    return user_id
+    return 0
 end
 """
 
-# Creates a new game with given host user ID. Sets the 'host' field,
-# but not the 'date_created' or 'game_data' fields.
-#
-# KEYS[1] is 'gameid'
-# KEYS[2] is 'user:<host_user_id>'
-# KEYS[3] is 'games_hosted:<host_user_id>'
-# KEYS[4] is 'games'
-# KEYS[5] is 'game_hosts'
-# ARGV[1] is host_user_id
-CREATE_GAME="""
-if redis.call("EXISTS", KEYS[2]) == 0 then
-    return false
-else
-    local game_id = redis.call("INCR", KEYS[1])
-    redis.call("HMSET", "game:"..game_id, "host", ARGV[1])
-    redis.call("LPUSH", KEYS[3], game_id)
-    redis.call("LPUSH", KEYS[4], game_id)
-    redis.call("LPUSH", KEYS[5], ARGV[1])
-    return game_id
+# Appends messages to a game log and compacts the oldest messages of the
+# tail into blocks once the tail is too long. The tail is a list with the
+# newest message first. Blocks are the messages joined by newlines, stored
+# in a hash by block index. The info hash holds the number of compacted
+# messages in the field 'compacted'.
+#
+# KEYS[1] is '{game:<game_id>}:log'
+# KEYS[2] is '{game:<game_id>}:log_blocks'
+# KEYS[3] is '{game:<game_id>}:log_info'
+# ARGV[1] is the number of messages per block
+# ARGV[2] is the maximum length of the tail
+# ARGV[3] is the number of blocks to retain, or 0 to keep all of them
+# ARGV[4...] are the messages, oldest first
+#
+# Returns the total number of messages in the log, including those in
+# blocks that have been dropped.
+APPEND_LOG="""
+local block_size = tonumber(ARGV[1])
+local tail_max = tonumber(ARGV[2])
+local max_blocks = tonumber(ARGV[3])
+
+for i = 4, #ARGV do
+    redis.call("LPUSH", KEYS[1], ARGV[i])
+end
+
+local tail_length = redis.call("LLEN", KEYS[1])
+local compacted = tonumber(redis.call("HGET", KEYS[3], "compacted") or 0)
+
+while tail_length > tail_max do
+    local oldest = redis.call("LRANGE", KEYS[1], -block_size, -1)
+    local block = {}
+    for j = #oldest, 1, -1 do
+        block[#block+1] = oldest[j]
+    end
+
+    local index = math.floor(compacted / block_size)
+    redis.call("HSET", KEYS[2], index, table.concat(block, "\\n"))
+    redis.call("LTRIM", KEYS[1], 0, -block_size-1)
+
+    if max_blocks > 0 and index >= max_blocks then
+        redis.call("HDEL", KEYS[2], index - max_blocks)
+    end
+
+    compacted = compacted + block_size
+    tail_length = tail_length - block_size
+end
+
+redis.call("HSET", KEYS[3], "compacted", compacted)
+return compacted + tail_length
+"""
+
+# Reads a range of messages from a game log stored by APPEND_LOG.
+#
+# KEYS[1] is '{game:<game_id>}:log'
+# KEYS[2] is '{game:<game_id>}:log_blocks'
+# KEYS[3] is '{game:<game_id>}:log_info'
+# ARGV[1] is the index of the first message requested
+# ARGV[2] is the number of messages requested
+# ARGV[3] is the number of messages per block
+#
+# Returns a list:
+#   <total>, <compacted>, <first_block>, <n_blocks>,
+#   <n_blocks blocks, false if dropped>, <tail messages, newest first>
+READ_LOG="""
+local n_start = tonumber(ARGV[1])
+local n_messages = tonumber(ARGV[2])
+local block_size = tonumber(ARGV[3])
+
+local compacted = tonumber(redis.call("HGET", KEYS[3], "compacted") or 0)
+local total = compacted + redis.call("LLEN", KEYS[1])
+local stop = math.min(n_start + n_messages, total)
+local first_block = math.floor(n_start / block_size)
+
+local result = {total, compacted, first_block, 0}
+if n_start >= stop then
+    return result
 end
+
+if n_start < compacted then
+    local last_block = math.floor((math.min(stop, compacted) - 1) / block_size)
+    local fields = {}
+    for b = first_block, last_block do
+        fields[#fields+1] = b
+    end
+
+    local blocks = redis.call("HMGET", KEYS[2], unpack(fields))
+    result[4] = #blocks
+    for i = 1, #blocks do
+        result[#result+1] = blocks[i]
+    end
+end
+
+if stop > compacted then
+    local a = math.max(n_start, compacted) - compacted
+    local b = stop - compacted - 1
+    local messages = redis.call("LRANGE", KEYS[1], -(b+1), -(a+1))
+    for i = 1, #messages do
+        result[#result+1] = messages[i]
+    end
+end
+
+return result
+"""
+
+# Replaces the state, actions and log of a game with a compressed archive.
+# The archive is only stored if the game data hasn't changed since it was
+# read to build the archive.
+#
+# KEYS[1] is '{game:<game_id>}'
+# KEYS[2...] are the keys to delete, eg. '{game:<game_id>}:log'
+# ARGV[1] is the game data the archive was built from
+# ARGV[2] is the archive
+#
+# Returns 1 if the game was archived and 0 otherwise.
+ARCHIVE_GAME="""
+if redis.call("HGET", KEYS[1], "game_data") ~= ARGV[1] then
+    return 0
+end
+
+redis.call("HSET", KEYS[1], "archive", ARGV[2])
+redis.call("HDEL", KEYS[1], "game_data")
+
+for i = 2, #KEYS do
+    redis.call("DEL", KEYS[i])
+end
+
+return 1
+"""
+
+# Appends actions to a game's action log and stores the game state that
+# results from them in one step, so the log can't get ahead of or fall
+# behind the stored state.
+#
+# KEYS[1] is '{game:<game_id>}'
+# KEYS[2] is '{game:<game_id>}:action_log'
+# ARGV[1] is the encoded game
+# ARGV[2] is the action log header, used if the log doesn't exist yet
+# ARGV[3] is the binary-encoded actions
+#
+# Returns the length of the action log in bytes.
+STORE_GAME_ACTIONS="""
+redis.call("SET", KEYS[2], ARGV[2], "NX")
+local n_bytes = redis.call("APPEND", KEYS[2], ARGV[3])
+redis.call("HSET", KEYS[1], "game_data", ARGV[1])
+
+return n_bytes
 """
@@ -1,8 +1,22 @@
 from cloaca.card import Card
 from cloaca.error import GameActionError, ParsingError
 
-from itertools import izip, izip_longest, count
+from itertools import izip, izip_longest
 import json
+import struct
+import base64
+
+# ujson is used to decode messages from clients if it's installed.
+# Anything it rejects is decoded again with json, so valid messages give
+# the same results with either backend. ujson is more lenient, though:
+# it accepts leading zeros ("[01]") and trailing commas in objects
+# ('{"a":1,}'), and decodes lone surrogates ("\ud800") to u''. This is
+# accepted on purpose, since every argument is checked against the
+# action's spec after decoding anyway.
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
 THINKERORLEAD   =  0
 USELATRINE      =  1
@@ -44,6 +58,7 @@ TAKEPOOLCARDS   = 36
 TAKECLIENTS     = 37
 REQGAMELOG      = 38
 GAMELOG         = 39
+ABANDON         = 40
 
 # A dictionary of the number of arguments for each action type
 # and their signature.
@@ -164,9 +179,223 @@ _action_args_dict = {
 
     GAMELOG        : GTRActionSpec('gamelog',
         ( (int, 'n_total'), (int, 'n_start'), (str, 'log_messages') ), () ),
+
+    # Only in action logs, for a game ended by Game.abandon().
+    ABANDON        : GTRActionSpec('abandon',        (), () ),
     }
 
 
+def _json_loads(s):
+    """Decode the JSON string s, raising ValueError if it's invalid.
+    See the note on ujson above for the inputs where the backends differ.
+    """
+    if ujson is not None:
+        try:
+            return ujson.loads(s)
+        except ValueError:
+            pass
+
+    return json.loads(s)
+
+
+def _accepted_types(type_):
+    """Return the set of types allowed without any check for an argument
+    of type type_. Cards may be given as ints, and str and unicode are
+    interchangeable.
+    """
+    accepted = set([type_])
+    if type_ is Card:
+        accepted.add(int)
+    elif type_ is str:
+        accepted.add(unicode)
+    elif type_ is unicode:
+        accepted.add(str)
+
+    return accepted
+
+
+def _arg_checker(type_, name, extended):
+    """Return a function check(i, arg) that raises GameActionError if arg
+    isn't allowed for an argument of type type_, given its index i.
+
+    In addition to the _accepted_types(), None is allowed for everything
+    except bool. The errors are the ones documented in
+    GameAction.check_args().
+    """
+    accepted = _accepted_types(type_)
+
+    def type_error(i, arg):
+        return GameActionError(
+            'Argument {0} ("{1}"), {2} doesn\'t match type ({3} != {4})'
+            .format(i, name, str(arg), str(type_), str(type(arg))))
+
+    if type_ is bool:
+        def check(i, arg):
+            if type(arg) is not bool:
+                if arg is not None and not extended:
+                    raise type_error(i, arg)
+
+                raise GameActionError(
+                    'Argument {0} ("{1}") must be boolean (received {2})'
+                    .format(i, name, str(arg)))
+    else:
+        def check(i, arg):
+            if type(arg) not in accepted and arg is not None:
+                raise type_error(i, arg)
+
+    return check
+
+
+def _arg_converter(type_, name):
+    """Return a function convert(arg) for arguments of type type_, or None
+    if no conversion is needed. Cards transmitted as ints are converted to
+    Card objects.
+    """
+    if type_ is not Card:
+        return None
+
+    def convert(token):
+        if token is not None and type(token) is not Card:
+            try:
+                return Card(int(token))
+            except ValueError:
+                raise GameActionError(
+                    'Error converting "{0}" argument: {1} token: "{2}"'
+                    .format(name, str(type_), token))
+        else:
+            return token
+
+    return convert
+
+
+class _ArgParser(object):
+    """Validates and converts the arguments for one action type.
+
+    The checks and conversions from a GTRActionSpec are built once, when
+    this module is imported, so parsing a GameAction doesn't walk the spec.
+    See GameAction.check_args() and GameAction.convert_args().
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.n_req_args = spec.n_req_args
+        self.has_extended = spec.has_extended
+
+        # The checker for each argument is only called if the type
+        # isn't one of the accepted types.
+        self.required_checkers = [
+                (_accepted_types(type_), _arg_checker(type_, name, False))
+                for type_, name in spec.required_arg_specs]
+        self.required_converters = [_arg_converter(type_, name)
+                for type_, name in spec.required_arg_specs]
+
+        if spec.has_extended:
+            type_, name = spec.extended_arg_spec
+            self.extended_checker = (_accepted_types(type_),
+                    _arg_checker(type_, name, True))
+            self.extended_converter = _arg_converter(type_, name)
+        else:
+            self.extended_checker = None
+            self.extended_converter = None
+
+        self.needs_conversion = (self.extended_converter is not None
+                or any(c is not None for c in self.required_converters))
+
+    def check(self, args):
+        n_req_args = self.n_req_args
+        n_args = len(args)
+
+        if not self.has_extended:
+            if n_args != n_req_args:
+                raise GameActionError(
+                    'Number of args for {0} doesn\'t match (args={1}, n_args must be {2})'
+                    .format(self.spec.name, args, n_req_args))
+
+        elif n_args < n_req_args:
+            raise GameActionError(
+                'Number of args for {0} doesn\'t match (args={1}, n_args must be >= {2})'
+                .format(self.spec.name, args, n_req_args))
+
+        for i, (accepted, check) in enumerate(self.required_checkers):
+            arg = args[i]
+            if type(arg) not in accepted:
+                check(i, arg)
+
+        if n_args > n_req_args:
+            accepted, check = self.extended_checker
+            for i in xrange(n_req_args, n_args):
+                arg = args[i]
+                if type(arg) not in accepted:
+                    check(i, arg)
+
+    def convert(self, args):
+        # The only conversion is from int to Card, which is done inline
+        # for ints since int(token) is a no-op for them.
+        if not self.needs_conversion:
+            return args
+
+        n_req_args = self.n_req_args
+        converted = list(args)
+
+        for i, convert in enumerate(self.required_converters):
+            if convert is not None:
+                tok = args[i]
+                if type(tok) is int:
+                    converted[i] = Card(tok)
+                else:
+                    converted[i] = convert(tok)
+
+        convert = self.extended_converter
+        if convert is not None:
+            for i in xrange(n_req_args, len(args)):
+                tok = args[i]
+                if type(tok) is int:
+                    converted[i] = Card(tok)
+                    continue
+
+                try:
+                    converted[i] = convert(tok)
+                except GameActionError as e:
+                    raise GameActionError(
+                        'Could not convert argument {0}. '.format(i) + e.message)
+
+        return converted
+
+
+_arg_parsers = dict((action, _ArgParser(spec))
+        for action, spec in _action_args_dict.items())
+
+
+# Websocket subprotocols. Clients that request BINARY_PROTOCOL receive
+# each Command as a binary message (see Command.to_binary()). Otherwise,
+# Commands are sent as JSON text messages. Messages sent by the client are
+# always JSON.
+BINARY_PROTOCOL = 'cloaca.binary.v1'
+JSON_PROTOCOL = 'cloaca.json'
+
+# Binary Command envelope:
+#
+#     <game_id> : (4 byte signed integer) -1 for None
+#     <number> : (4 byte signed integer) -1 for None
+#     <action> : (1 byte) action type
+#     <args> : (remaining bytes)
+#
+# For GAMESTATE, <args> is the raw game encoding from
+# encode_binary.encode_game(), or empty if there is no game state.
+# For all other actions, <args> is the JSON array of arguments.
+#
+# A binary websocket message is a list of one or more envelopes,
+# each prefixed by its length:
+#
+#     <length> : (4 byte integer) length of the envelope
+#     <envelope>
+#     ...
+#
+# See commands_to_binary() and commands_from_binary().
+_ENVELOPE_FMT = '!iiB'
+_ENVELOPE_LENGTH = struct.calcsize(_ENVELOPE_FMT)
+
+
 class Command(object):
     """Command passed to the game server or client.
 
@@ -201,6 +430,58 @@ class Command(object):
 
         return json.dumps(self, default=convert)
 
+    def to_binary(self):
+        """Return this command as a bytestring using the binary envelope
+        format for websocket binary messages.
+
+        The base64-encoded game in a GAMESTATE command is sent as the raw
+        bytes, avoiding the size overhead of base64 and JSON escaping.
+        """
+        def convert(o):
+            if type(o) is Card:
+                return o.ident
+            else:
+                return o.__dict__
+
+        envelope = struct.pack(_ENVELOPE_FMT,
+                -1 if self.game is None else self.game,
+                -1 if self.number is None else self.number,
+                self.action.action)
+
+        if self.action.action == GAMESTATE:
+            args = base64.b64decode(self.action.args[0] or '')
+        else:
+            args = json.dumps(self.action.args, default=convert,
+                    separators=(',',':'))
+
+        return envelope + args
+
+    @staticmethod
+    def from_binary(s):
+        """Parse a bytestring in the binary envelope format and return
+        a Command object. See Command.to_binary().
+
+        Raises ParsingError if s is too short or the arguments are
+        not valid JSON.
+        """
+        try:
+            game, number, action = struct.unpack_from(_ENVELOPE_FMT, s)
+        except struct.error:
+            raise ParsingError('Failed to decode Command envelope.')
+
+        game = None if game == -1 else game
+        number = None if number == -1 else number
+
+        if action == GAMESTATE:
+            args = [base64.b64encode(s[_ENVELOPE_LENGTH:])]
+        else:
+            try:
+                args = _json_loads(s[_ENVELOPE_LENGTH:])
+            except ValueError:
+                raise ParsingError('Failed to parse Command arguments.')
+
+        return Command(game, number, GameAction(action, *args))
+
     @staticmethod
     def from_json(s):
         """Parse a JSON string and return a list of Command objects.
@@ -209,7 +490,7 @@ class Command(object):
         or is invalid JSON.
         """
         try:
-            commands = json.loads(s)
+            commands = _json_loads(s)
         except ValueError:
             raise ParsingError('Failed to parse JSON: ' + s)
 
@@ -270,6 +551,52 @@ class Command(object):
         return Command(game, number, GameAction(action, *args))
 
 
+def commands_to_binary(commands):
+    """Return the list of Command objects as a single binary message
+    of length-prefixed envelopes.
+    """
+    chunks = []
+    for c in commands:
+        envelope = c.to_binary()
+        chunks.append(struct.pack('!I', len(envelope)))
+        chunks.append(envelope)
+
+    return ''.join(chunks)
+
+
+def commands_from_binary(s):
+    """Parse a binary message of length-prefixed envelopes and return
+    a list of Command objects.
+
+    Raises ParsingError if the message is malformed.
+    """
+    commands = []
+    offset = 0
+    while offset < len(s):
+        try:
+            length = struct.unpack_from('!I', s, offset)[0]
+        except struct.error:
+            raise ParsingError('Failed to decode Command length.')
+        offset += 4
+
+        if offset + length > len(s):
+            raise ParsingError('Command length exceeds message length.')
+
+        commands.append(Command.from_binary(s[offset:offset+length]))
+        offset += length
+
+    return commands
+
+
+def commands_to_json(commands):
+    """Return the list of Command objects as a JSON array.
+    """
+    if len(commands) == 1:
+        return commands[0].to_json()
+    else:
+        return '[' + ','.join(c.to_json() for c in commands) + ']'
+
+
 class GameAction(object):
     """ Class that represents a game action that the client submits
     to the game server. Consists of an action type, action number,
@@ -289,8 +616,9 @@ class GameAction(object):
         self.args = list(args)
 
         self.check_type()
-        self.check_args()
-        self.convert_args()
+        parser = _arg_parsers[self.action]
+        parser.check(self.args)
+        self.args = parser.convert(self.args)
 
     def check_type(self):
         """ Raises an InvalidGameActionError if this is not a valid game
@@ -302,62 +630,13 @@ class GameAction(object):
     def check_args(self):
         """ Raises an GameActionError if there's a problem
         with the arguments.
-        """
-        spec = _action_args_dict[self.action]
-        
-        if not spec.has_extended and len(self.args) != spec.n_req_args:
-            raise GameActionError(
-                'Number of args for {0} doesn\'t match (args={1}, n_args must be {2})'
-                .format(spec.name, self.args, spec.n_req_args))
-
-        elif spec.has_extended and len(self.args) < spec.n_req_args:
-            raise GameActionError(
-                'Number of args for {0} doesn\'t match (args={1}, n_args must be >= {2})'
-                .format(spec.name, self.args, n_args))
-
-        # Regular args
-        for i, arg, (_type,name) in izip(count(), self.args, spec.required_arg_specs):
-            card_arg_match = _type is Card and type(arg) is int
-            bad_arg_match = type(arg) is not _type
-            arg_is_none = arg is None
-            arg_invalid_bool = type(arg) is not bool and _type is bool
-            str_unicode_error = type(arg) is str and _type is unicode \
-                    or type(arg) is unicode and _type is str
-
-            if bad_arg_match and not arg_is_none and not\
-                    str_unicode_error and not card_arg_match:
-                raise GameActionError(
-                    'Argument {0} ("{1}"), {2} doesn\'t match type ({3} != {4})'
-                    .format(i, name, str(arg), str(_type), str(type(arg))))
-
-            if arg_invalid_bool:
-                raise GameActionError(
-                    'Argument {0} ("{1}") must be boolean (received {2})'
-                    .format(i, name, str(arg)))
-
-        # Extended args
-        for i, arg in izip(count(spec.n_req_args), self.args[spec.n_req_args:]):
-            _type, name = spec.extended_arg_spec
-
-            card_arg_match = _type is Card and type(arg) is int
-            bad_arg_match = type(arg) is not _type
-            arg_is_none = arg is None
-            arg_invalid_bool = type(arg) is not bool and _type is bool
-            str_unicode_error = type(arg) is str and _type is unicode \
-                    or type(arg) is unicode and _type is str
-
-            if bad_arg_match and not arg_is_none and not\
-                    str_unicode_error and not card_arg_match\
-                    and not arg_invalid_bool:
-                raise GameActionError(
-                    'Argument {0} ("{1}"), {2} doesn\'t match type ({3} != {4})'
-                    .format(i, name, str(arg), str(_type), str(type(arg))))
-
-            if arg_invalid_bool:
-                raise GameActionError(
-                    'Argument {0} ("{1}") must be boolean (received {2})'
-                    .format(i, name, str(arg)))
 
+        The number of arguments must match the spec in _action_args_dict.
+        Each argument must have the type in the spec, or be None, except
+        that bool arguments can't be None. Card arguments may be ints,
+        and str and unicode are interchangeable.
+        """
+        _arg_parsers[self.action].check(self.args)
 
     def convert_args(self):
         """Convert the args that are represented by other types.
@@ -365,67 +644,8 @@ class GameAction(object):
         Card objects are transmited as ints.
 
         Raise GameActionError if the argument can't be converted.
-
-        Args:
-        action -- int, with symbolic representation found in message.py.
-        args -- sequence, with type of items found in message.py
         """
-        try:
-            spec = _action_args_dict[self.action]
-        except KeyError:
-            raise Exception('Invalid action: ' + str(action))
-
-        def parse_arg(type_, token, name):
-            """Converts token to type type_.
-            
-            This includes special cases for some argument types,
-            such as Card, bool, and NoneType.
-            """
-            if type_ is Card and token is not None and type(token) is not Card:
-                try:
-                    arg = Card(int(token))
-                except ValueError:
-                    raise GameActionError(
-                        'Error converting "{0}" argument: {1} token: "{2}"'
-                        .format(name, str(type_), token))
-
-                return arg
-
-            else:
-                return token
-
-
-        req_tokens = self.args[:spec.n_req_args]
-        req_args = []
-
-        for i, tok, (typ, name) in izip(count(), req_tokens, spec.required_arg_specs):
-            try:
-                arg = parse_arg(typ, tok, name)
-            except GameActionError, e:
-                # If we failed in parse_arg, message can be appended for details
-                raise
-                #raise GameActionError(
-                #    'Could not convert argument {0}. '.format(i) + e.message)
-
-            req_args.append(arg)
-
-
-        extended_tokens = self.args[spec.n_req_args:]
-        extended_args = []
-        
-        for i, tok in izip(count(spec.n_req_args), extended_tokens):
-            typ, name = spec.extended_arg_spec
-            try:
-                arg = parse_arg(typ, tok, name)
-            except GameActionError, e:
-                # If we failed in parse_arg, message can be appended for details
-                raise GameActionError(
-                    'Could not convert argument {0}. '.format(i) + e.message)
-
-            extended_args.append(arg)
-
-        self.args = req_args + extended_args
-
+        self.args = _arg_parsers[self.action].convert(self.args)
 
     def __str__(self):
         """ Convert to string, eg. str(THINKERORLEAD) -> 'THINKERORLEAD'
@@ -460,7 +680,7 @@ class GameAction(object):
         an invalid GameAction object.
         """
         try:
-            d = json.loads(s)
+            d = _json_loads(s)
         except ValueError:
             raise ParsingError('Failed to parse JSON: ' + s)
 
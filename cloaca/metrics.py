@@ -0,0 +1,326 @@
+"""Operational metrics in the Prometheus text exposition format.
+
+Counters, gauges and histograms are registered in a Registry, and
+MetricsHandler (see handlers.py) serves Registry.exposition() at /metrics
+on a separate port given with --metrics-port (see cloacaapp.py). It isn't
+part of the public app, since it's not authenticated.
+
+    REQUESTS = Counter('cloaca_requests_total', 'Requests handled.', ['kind'])
+    REQUESTS.labels('join').inc()
+
+    LATENCY = Histogram('cloaca_latency_seconds', 'Latency.')
+    LATENCY.observe(0.012)
+
+Recording is meant to be cheap enough to leave on: a label lookup in a
+dictionary, and for histograms a bisection over a fixed list of bucket
+bounds. Nothing is allocated per observation once a set of label values
+has been seen, and the label values used here come from small fixed sets
+(action types, Redis commands, phases), so memory stays bounded.
+benchmarks/metrics_overhead.py measures the cost per action.
+
+Values that are already counted elsewhere, like the hits of the user
+cache, are read when the metrics are rendered with FunctionMetric.
+
+The metrics below are the ones recorded by the server. Each server process
+has its own, so with --processes or --shards each process serves them on
+its own port, --metrics-port + <task id>, and each must be scraped.
+"""
+import bisect
+import math
+
+# Upper bounds in seconds. Game actions and Redis calls take from tens of
+# microseconds to tens of milliseconds.
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+        0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(v):
+    if v == float('inf'):
+        return '+Inf'
+    if isinstance(v, float) and not math.isnan(v) and v == int(v):
+        return repr(int(v))
+    return repr(v)
+
+
+def _escape_label(value):
+    return (str(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = ['{0}="{1}"'.format(n, _escape_label(v))
+            for n, v in list(zip(names, values)) + list(extra)]
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+class Registry(object):
+    """A set of metrics, rendered together by exposition()."""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        """Add `metric`, replacing any metric with the same name."""
+        self._metrics[metric.name] = metric
+
+    def unregister(self, name):
+        self._metrics.pop(name, None)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def exposition(self):
+        """Return all metrics in the text exposition format, sorted by
+        name.
+        """
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].lines())
+        return ''.join(l + '\n' for l in lines)
+
+
+REGISTRY = Registry()
+
+
+class _Metric(object):
+    """Base class of the metric types. A metric without labels records
+    values itself. A metric with labels records them in the child returned
+    by labels() for each combination of label values.
+    """
+
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+        if registry is not None:
+            registry.register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """Return the child for these label values, creating it the first
+        time they're used.
+        """
+        try:
+            return self._children[values]
+        except KeyError:
+            if len(values) != len(self.labelnames):
+                raise ValueError('{0} has labels {1!r}, got {2!r}'.format(
+                        self.name, self.labelnames, values))
+            child = self._children[values] = self._new_child()
+            return child
+
+    def _child_lines(self, values, child):
+        raise NotImplementedError
+
+    def lines(self):
+        lines = ['# HELP {0} {1}'.format(self.name,
+                    self.documentation.replace('\\', '\\\\').replace('\n', '\\n')),
+                '# TYPE {0} {1}'.format(self.name, self.type_name)]
+        for values in sorted(self._children):
+            lines.extend(self._child_lines(values, self._children[values]))
+        return lines
+
+
+class _Value(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = float(value)
+
+
+class Counter(_Metric):
+    """A count that only goes up, eg. the number of messages received."""
+
+    type_name = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._children[()].value += amount
+
+    def _child_lines(self, values, child):
+        return ['{0}{1} {2}'.format(self.name,
+                _format_labels(self.labelnames, values),
+                _format_value(child.value))]
+
+
+class Gauge(Counter):
+    """A value that goes up and down, eg. the number of open connections."""
+
+    type_name = 'gauge'
+
+    def dec(self, amount=1):
+        self._children[()].value -= amount
+
+    def set(self, value):
+        self._children[()].set(value)
+
+
+class _HistogramValue(object):
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(_Metric):
+    """Observations counted in buckets with fixed upper bounds, eg.
+    latencies. Rendered with cumulative bucket counts, as Prometheus
+    expects.
+    """
+
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+            buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.bounds = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, documentation, labelnames,
+                registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.bounds)
+
+    def observe(self, value):
+        self._children[()].observe(value)
+
+    def _child_lines(self, values, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), child.counts):
+            cumulative += count
+            lines.append('{0}_bucket{1} {2:d}'.format(self.name,
+                    _format_labels(self.labelnames, values,
+                        [('le', _format_value(bound))]),
+                    cumulative))
+
+        labels = _format_labels(self.labelnames, values)
+        lines.append('{0}_sum{1} {2}'.format(self.name, labels,
+                _format_value(child.sum)))
+        lines.append('{0}_count{1} {2:d}'.format(self.name, labels,
+                cumulative))
+        return lines
+
+
+class FunctionMetric(_Metric):
+    """A counter or gauge whose value is read from a function when the
+    metrics are rendered, for values kept elsewhere.
+
+    `function` returns a number, or for a metric with labels, a dictionary
+    of numbers keyed by tuples of label values.
+    """
+
+    def __init__(self, name, documentation, function, type_name='gauge',
+            labelnames=(), registry=REGISTRY):
+        self.function = function
+        self.type_name = type_name
+        super(FunctionMetric, self).__init__(name, documentation, labelnames,
+                registry)
+
+    def _new_child(self):
+        return None
+
+    def lines(self):
+        values = self.function()
+        if not self.labelnames:
+            values = {(): values}
+
+        self._children = dict(values)
+        return super(FunctionMetric, self).lines()
+
+    def _child_lines(self, values, value):
+        return ['{0}{1} {2}'.format(self.name,
+                _format_labels(self.labelnames, values),
+                _format_value(float(value)))]
+
+
+class PhaseTimer(object):
+    """Time consecutive phases of a task and record each one in a
+    Histogram labeled by phase.
+
+    mark(phase) attributes the time since the previous mark (or since the
+    timer was created) to `phase`. A phase can be marked several times and
+    its durations are added up. observe() records one observation per
+    phase.
+    """
+
+    __slots__ = ('histogram', 'clock', 'last', 'durations')
+
+    def __init__(self, histogram, clock):
+        self.histogram = histogram
+        self.clock = clock
+        self.last = clock()
+        self.durations = {}
+
+    def mark(self, phase):
+        now = self.clock()
+        self.durations[phase] = (self.durations.get(phase, 0.0) +
+                now - self.last)
+        self.last = now
+
+    def observe(self):
+        for phase, duration in self.durations.iteritems():
+            self.histogram.labels(phase).observe(duration)
+        self.durations = {}
+
+
+WS_CONNECTIONS = Counter('cloaca_websocket_connections_total',
+        'Websocket connections opened.')
+
+WS_OPEN_CONNECTIONS = Gauge('cloaca_websocket_open_connections',
+        'Websocket connections currently open.')
+
+WS_MESSAGES_IN = Counter('cloaca_websocket_messages_received_total',
+        'Commands received on websockets, by action type.', ['action'])
+
+WS_MESSAGES_OUT = Counter('cloaca_websocket_messages_sent_total',
+        'Commands sent on websockets, by action type.', ['action'])
+
+GAME_ACTION_PHASE_SECONDS = Histogram('cloaca_game_action_phase_seconds',
+        'Time spent handling game actions, by phase: lock_wait, db_read, '
+        'decode, engine, encode, db_write and fan_out. One observation '
+        'per phase per batch of queued actions.', ['phase'])
+
+REDIS_CALL_SECONDS = Histogram('cloaca_redis_call_seconds',
+        'Latency of Redis calls, by command. Pipelines are labeled '
+        'PIPELINE.', ['command'])
+
+GAME_LOCK_TIMEOUTS = Counter('cloaca_game_lock_timeouts_total',
+        'Game lock acquisitions that timed out.')
+
+BOT_SCHEDULE_SECONDS = Histogram('cloaca_bot_schedule_seconds',
+        'Time from a game state reaching a bot user to its move being '
+        'dispatched to a worker process.',
+        buckets=(0.001, 0.01, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+
+BOT_MOVES = Counter('cloaca_bot_moves_total',
+        'Moves played by bots, by how they were chosen: search, forced '
+        '(the only legal action), timeout or error.', ['outcome'])
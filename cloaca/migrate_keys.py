@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""Rename the per-game Redis keys from the earlier layout to the layout
+with a hash tag per game (see "Key layout" in cloaca.db):
+
+    game:<id>            -> {game:<id>}
+    game_actions:<id>    -> {game:<id>}:actions
+    game_action_log:<id> -> {game:<id>}:action_log
+    game_log:<id>        -> {game:<id>}:log
+    game_log_blocks:<id> -> {game:<id>}:log_blocks
+    game_log_info:<id>   -> {game:<id>}:log_info
+
+Games are found in the "games" list and by scanning for "game:<id>" keys.
+Keys are renamed with RENAMENX, so running the tool again is harmless. If
+a key already exists under the new name, the old one is left in place and
+reported. Game locks expire on their own and aren't renamed. Global keys
+(users, sessions, game lists) are unchanged.
+
+Stop the servers before migrating. The tool runs against a single Redis
+server, before the data is moved to a cluster.
+
+redis-py is required.
+
+Usage:
+    python -m cloaca.migrate_keys [--dry-run] [--redis-host H]
+            [--redis-port P] [--redis-db D] [--redis-prefix PREFIX]
+"""
+import argparse
+import re
+
+# Redis key names, as in cloaca.db
+GAMES = 'games'
+GAME_KEY = '{{game:{0}}}'
+
+# (earlier format, current format) of each key of a game
+GAME_KEY_RENAMES = [
+        ('game:{0}', GAME_KEY),
+        ('game_actions:{0}', GAME_KEY + ':actions'),
+        ('game_action_log:{0}', GAME_KEY + ':action_log'),
+        ('game_log:{0}', GAME_KEY + ':log'),
+        ('game_log_blocks:{0}', GAME_KEY + ':log_blocks'),
+        ('game_log_info:{0}', GAME_KEY + ':log_info'),
+        ]
+
+_LEGACY_GAME_KEY_RE = re.compile(r'^game:([0-9]+)$')
+
+
+def key_renames(game_id, prefix=''):
+    """Return the list of (old key, new key) pairs for game `game_id`."""
+    return [(prefix + old.format(game_id), prefix + new.format(game_id))
+            for old, new in GAME_KEY_RENAMES]
+
+
+def legacy_game_id(key, prefix=''):
+    """Return the game ID of a game hash key in the earlier layout, eg.
+    "game:12", or None if `key` isn't one.
+    """
+    if not key.startswith(prefix):
+        return None
+
+    m = _LEGACY_GAME_KEY_RE.match(key[len(prefix):])
+    return int(m.group(1)) if m else None
+
+
+def game_ids(r, prefix=''):
+    """Return the sorted IDs of the games listed in the games list or
+    with a game hash in the earlier layout.
+    """
+    ids = set(int(g) for g in r.lrange(prefix+GAMES, 0, -1))
+
+    for key in r.scan_iter(match=prefix+'game:*', count=1000):
+        game_id = legacy_game_id(key, prefix)
+        if game_id is not None:
+            ids.add(game_id)
+
+    return sorted(ids)
+
+
+def migrate_game(r, game_id, prefix='', dry_run=False):
+    """Rename the keys of game `game_id` that are in the earlier layout.
+    Return a tuple (<renamed>, <conflicts>) of lists of
+    (old key, new key) pairs. Conflicts are keys that exist under both
+    names, which are left alone.
+    """
+    renames = key_renames(game_id, prefix)
+
+    pipe = r.pipeline(transaction=False)
+    for old, new in renames:
+        pipe.exists(old)
+        pipe.exists(new)
+    res = pipe.execute()
+
+    to_rename, conflicts = [], []
+    for (old, new), old_exists, new_exists in zip(renames, res[::2], res[1::2]):
+        if not old_exists:
+            continue
+        elif new_exists:
+            conflicts.append((old, new))
+        else:
+            to_rename.append((old, new))
+
+    if to_rename and not dry_run:
+        pipe = r.pipeline(transaction=False)
+        for old, new in to_rename:
+            pipe.renamenx(old, new)
+        res = pipe.execute()
+
+        for (old, new), ok in zip(list(to_rename), res):
+            if not ok:
+                to_rename.remove((old, new))
+                conflicts.append((old, new))
+
+    return to_rename, conflicts
+
+
+def migrate(r, prefix='', dry_run=False):
+    """Migrate every game. Return a tuple (<games>, <keys renamed>,
+    <conflicts>).
+    """
+    ids = game_ids(r, prefix)
+
+    n_renamed = 0
+    all_conflicts = []
+    for game_id in ids:
+        renamed, conflicts = migrate_game(r, game_id, prefix, dry_run)
+        n_renamed += len(renamed)
+        all_conflicts.extend(conflicts)
+
+    return len(ids), n_renamed, all_conflicts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--dry-run', default=False, action='store_true',
+            help='Report the keys that would be renamed without renaming')
+    parser.add_argument('--redis-host', default='localhost')
+    parser.add_argument('--redis-port', default=6379, type=int)
+    parser.add_argument('--redis-db', default=0, type=int)
+    parser.add_argument('--redis-prefix', default='',
+            help='Prefix of the Redis keys of the server')
+    args = parser.parse_args()
+
+    import redis
+    r = redis.StrictRedis(host=args.redis_host, port=args.redis_port,
+            db=args.redis_db)
+
+    n_games, n_renamed, conflicts = migrate(r, args.redis_prefix,
+            args.dry_run)
+
+    print '{0} {1:d} keys of {2:d} games.'.format(
+            'Would rename' if args.dry_run else 'Renamed', n_renamed, n_games)
+    for old, new in conflicts:
+        print 'Not renamed, {0} already exists: {1}'.format(new, old)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Password hashing for the login handlers.
+
+bcrypt is deliberately slow, and hashing in a thread still holds the GIL
+for part of the work, so a burst of logins delays the IOLoop and every game
+being played on it. PasswordHasher runs bcrypt in a separate pool of
+processes instead.
+
+    hasher = PasswordHasher(work_factor=12, max_pending=64)
+
+    hashed = yield hasher.hash_password(auth)
+    ok = yield hasher.check_password(auth, hashed)
+
+At most `max_pending` hashes may be queued or running at once. Beyond that,
+ServerBusyError is raised immediately so that the handler can shed the
+request rather than queue it behind work it can't finish in time.
+"""
+
+from cloaca.error import ServerBusyError
+
+from tornado import gen
+from tornado.process import cpu_count
+
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+import hmac
+
+
+def _hash_password(auth, work_factor):
+    return bcrypt.hashpw(auth, bcrypt.gensalt(work_factor))
+
+
+def _check_password(auth, hashed):
+    return hmac.compare_digest(bcrypt.hashpw(auth, hashed), hashed)
+
+
+class PasswordHasher(object):
+    """Hash and verify passwords with bcrypt in a ProcessPoolExecutor.
+
+    The `work_factor` is the log2 of the number of bcrypt rounds used for
+    new hashes. Existing hashes are verified with the work factor they
+    were created with.
+    """
+
+    def __init__(self, work_factor=12, max_workers=None, max_pending=64):
+        self.work_factor = work_factor
+        self.max_workers = max_workers or cpu_count()
+        self.max_pending = max_pending
+
+        self.n_pending = 0
+        self.n_rejected = 0
+
+        # The executor forks its workers on the first submit.
+        self.executor = ProcessPoolExecutor(self.max_workers)
+
+
+    @gen.coroutine
+    def _submit(self, fn, *args):
+        if self.n_pending >= self.max_pending:
+            self.n_rejected += 1
+            raise ServerBusyError('Too many password checks in progress.')
+
+        self.n_pending += 1
+        try:
+            result = yield self.executor.submit(fn, *args)
+        finally:
+            self.n_pending -= 1
+
+        raise gen.Return(result)
+
+
+    def hash_password(self, auth):
+        """Return a future for the bcrypt hash of the byte string `auth`,
+        using a new salt.
+        """
+        return self._submit(_hash_password, auth, self.work_factor)
+
+
+    def check_password(self, auth, hashed):
+        """Return a future that is True if the byte string `auth` matches
+        the bcrypt hash `hashed`.
+        """
+        return self._submit(_check_password, auth, hashed)
+
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -67,6 +67,22 @@ class Player(object):
     def __ne__(self, other):
         return not self == other
 
+    def copy(self):
+        """Return a copy of this player with copies of every zone,
+        building and the influence list. The Card objects are shared.
+        This is much faster than copy.deepcopy().
+        """
+        p = Player.__new__(Player)
+        p.__dict__.update(self.__dict__)
+
+        for k, v in self.__dict__.iteritems():
+            if isinstance(v, Zone):
+                setattr(p, k, v.copy())
+
+        p.buildings = [b.copy() for b in self.buildings]
+        p.influence = list(self.influence)
+        return p
+
     def owns_building(self, building):
         """Whether this player owns a building, complete or otherwise.
         The parameter building is a string.
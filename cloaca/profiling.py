@@ -0,0 +1,205 @@
+"""Opt-in timing of the game engine.
+
+When a Profiler is enabled, it replaces methods of Game with wrappers that
+time each call:
+
+    - every _handle_<action> method
+    - _pump, labeled with the function of the frame it executes,
+      eg. "_pump:_take_turn_stacked"
+    - the helpers listed in HELPERS, eg. _active_buildings
+
+Disabling it puts the original methods back, so it costs nothing when off.
+
+Calls nest: a _pump frame calls handlers and helpers, which may pump
+further frames. The time of each call, minus the time of the calls it
+makes, is its self time. Timings accumulate in the profiler until reset()
+and are exported as a dictionary (see stats()), JSON, or collapsed stacks
+for flame graph tools such as flamegraph.pl:
+
+    profiler = Profiler()
+    profiler.enable()
+    ...
+    profiler.disable()
+    profiler.dump('/tmp/profile') # writes profile.json and profile.folded
+
+The module-level `profiler` is the one toggled by the server (see
+cloacaapp.py --profile-dir).
+"""
+import json
+import time
+
+from cloaca.game import Game
+
+HELPERS = [
+        'handle',
+        '_active_buildings',
+        '_active_building_names',
+        '_player_has_active_building',
+        '_check_action_units',
+        '_player_score',
+        '_vault_score',
+        '_buildings_score',
+        '_clientele_limit',
+        '_vault_limit',
+        '_calc_winners',
+        'privatized_game_state_copy',
+        ]
+
+
+class Profiler(object):
+    """Time calls to the methods of `cls` (Game by default).
+
+    Not thread-safe. The game engine is synchronous, so calls only nest
+    within one game action.
+    """
+
+    def __init__(self, cls=Game, helpers=HELPERS):
+        self.cls = cls
+        self.helpers = list(helpers)
+        self.enabled = False
+
+        self._originals = {}
+
+        # Frames of calls in progress: [label, time spent in children]
+        self._frames = []
+
+        self.reset()
+
+
+    def reset(self):
+        """Discard all timings."""
+        # label -> [calls, total seconds, self seconds, max seconds]
+        self._functions = {}
+
+        # 'outer;inner' -> self seconds
+        self._stacks = {}
+
+
+    def _method_names(self):
+        names = [n for n in dir(self.cls) if n.startswith('_handle_')]
+        names.extend(n for n in self.helpers + ['_pump']
+                if hasattr(self.cls, n))
+        return names
+
+
+    def enable(self):
+        """Start timing by wrapping the methods of the class."""
+        if self.enabled:
+            return
+
+        for name in self._method_names():
+            method = self.cls.__dict__.get(name)
+            if method is None:
+                continue
+
+            self._originals[name] = method
+            if name == '_pump':
+                setattr(self.cls, name, self._wrap_pump(method))
+            else:
+                setattr(self.cls, name, self._wrap(name, method))
+
+        self.enabled = True
+
+
+    def disable(self):
+        """Stop timing and restore the original methods. Timings are kept."""
+        for name, method in self._originals.items():
+            setattr(self.cls, name, method)
+
+        self._originals = {}
+        self._frames = []
+        self.enabled = False
+
+
+    def _wrap(self, label, method):
+        profiler = self
+
+        def wrapper(*args, **kwargs):
+            return profiler._call(label, method, args, kwargs)
+
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+
+
+    def _wrap_pump(self, method):
+        profiler = self
+
+        def wrapper(game):
+            frames = game.stack.stack
+            label = '_pump:' + frames[-1].function_name if frames else '_pump'
+            return profiler._call(label, method, (game,), {})
+
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+
+
+    def _call(self, label, method, args, kwargs):
+        frame = [label, 0.0]
+        self._frames.append(frame)
+        t0 = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            elapsed = time.time() - t0
+            self._frames.pop()
+            self._record(label, elapsed, elapsed - frame[1])
+
+
+    def _record(self, label, elapsed, self_time):
+        if self._frames:
+            self._frames[-1][1] += elapsed
+
+        try:
+            f = self._functions[label]
+        except KeyError:
+            f = self._functions[label] = [0, 0.0, 0.0, 0.0]
+
+        f[0] += 1
+        f[1] += elapsed
+        f[2] += self_time
+        if elapsed > f[3]:
+            f[3] = elapsed
+
+        path = ';'.join([fr[0] for fr in self._frames] + [label])
+        self._stacks[path] = self._stacks.get(path, 0.0) + self_time
+
+
+    def stats(self):
+        """Return a dictionary of timings by label, each a dictionary with
+        the number of calls and the total, self and maximum time in
+        seconds. The total time of a recursive function, like _pump,
+        includes its nested calls more than once.
+        """
+        return dict((label, {
+                    'calls': f[0],
+                    'total': f[1],
+                    'self': f[2],
+                    'max': f[3],
+                    }) for label, f in self._functions.items())
+
+
+    def to_json(self):
+        return json.dumps({'enabled': self.enabled, 'functions': self.stats()},
+                sort_keys=True, indent=1)
+
+
+    def collapsed_stacks(self):
+        """Return the self time of each call stack in the collapsed-stack
+        format, one line per stack: "outer;inner <microseconds>".
+        """
+        return ''.join('{0} {1:d}\n'.format(path, int(round(t*1e6)))
+                for path, t in sorted(self._stacks.items()))
+
+
+    def dump(self, prefix):
+        """Write the timings to <prefix>.json and <prefix>.folded."""
+        with open(prefix + '.json', 'w') as f:
+            f.write(self.to_json())
+
+        with open(prefix + '.folded', 'w') as f:
+            f.write(self.collapsed_stacks())
+
+
+profiler = Profiler()
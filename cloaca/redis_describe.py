@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 GAMEID = 'gameid'
-GAMEPREFIX = 'game:'
+GAME_KEY = '{{game:{0}}}'
 GAMES = 'games'
 GAMES_HOSTED_PREFIX = 'games_hosted:'
 GAME_HOSTS = 'game_hosts'
@@ -97,7 +97,7 @@ def describe():
         print '{0:>8}    {1:>8}    {2:>15}    {3:>10}'.format(
                 'Game ID', 'Host ID', 'Date created', 'JSON')
         for game_id in games_list:
-            game_dict = r.hgetall(GAMEPREFIX+str(game_id))
+            game_dict = r.hgetall(GAME_KEY.format(game_id))
             info_str='{0:>8}    {1:>8}    {2:>15}    {3:>10}'.format(
                     game_id,
                     game_dict.get('host', '<MISSING>'),
@@ -153,7 +153,7 @@ def clear_games():
 
     games_list = r.lrange(GAMES, 0, -1)
     for game_id in games_list:
-        r.delete(GAMEPREFIX+str(game_id))
+        r.delete(GAME_KEY.format(game_id))
     
     r.delete(GAMES)
     r.set(GAMEID, 0)
@@ -166,7 +166,7 @@ def add_game(user_id):
 
     game_id = r.incr(GAMEID)
     now = int(time.mktime(time.gmtime()))
-    r.hmset(GAMEPREFIX+str(game_id), {'host':user_id, 'date_created' : now, 'game_data' : ''})
+    r.hmset(GAME_KEY.format(game_id), {'host':user_id, 'date_created' : now, 'game_data' : ''})
     r.lpush(GAMES_HOSTED_PREFIX+str(user_id), game_id)
     r.lpush(GAME_HOSTS, user_id)
     r.lpush(GAMES, game_id)
@@ -1,24 +1,98 @@
 from cloaca.game import Game
 from cloaca.message import GameAction, Command
 import cloaca.message as message
-from cloaca.error import GTRError, GameOver, GTRDBError
+from cloaca.error import GTRError, GameOver
 import cloaca.encode_binary as encode
 import cloaca.encode_action as encode_action
+from cloaca.lock_manager import GameLockManager
+from cloaca.metrics import PhaseTimer, GAME_ACTION_PHASE_SECONDS, GAME_LOCK_TIMEOUTS
 
 import logging
 import datetime
+import os
+import binascii
+import time
 
-from tornado import gen, locks
+from tornado import gen
+from tornado.concurrent import Future
 import tornado.ioloop
 
 lg = logging.getLogger(__name__)
 
+
+class CommandBatch(object):
+    """Collects Commands by recipient so that all of the Commands produced
+    while handling one request can be sent to each user together.
+
+    Commands are kept in the order they were added.
+    """
+
+    def __init__(self):
+        self.commands_by_user = {}
+        self._users = []
+
+    def add(self, user_id, command):
+        try:
+            self.commands_by_user[user_id].append(command)
+        except KeyError:
+            self.commands_by_user[user_id] = [command]
+            self._users.append(user_id)
+
+    def items(self):
+        """Return a list of (user_id, commands) tuples in the order
+        the users were first added.
+        """
+        return [(u, self.commands_by_user[u]) for u in self._users]
+
+    def clear(self):
+        self.commands_by_user = {}
+        self._users = []
+
+
+class _PendingActions(object):
+    """A list of actions submitted by a user, waiting in a game's action
+    queue. The future is resolved when the actions have been handled.
+
+    `error` is set to an exception that only concerns this list, eg. if
+    the user can't be retrieved or the game engine fails on one of the
+    actions. It's raised from the future instead of any error of the
+    cycle that handled the list.
+    """
+
+    def __init__(self, user_id, actions):
+        self.user_id = user_id
+        self.actions = actions
+        self.future = Future()
+        self.error = None
+
+
+class _RedisLockReleaser(object):
+    """Context manager that releases a game lock held in the database
+    when the block exits. The release is scheduled on the IOLoop since
+    it can't be yielded from __exit__.
+    """
+
+    def __init__(self, database, game_id, token):
+        self.db = database
+        self.game_id = game_id
+        self.token = token
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        tornado.ioloop.IOLoop.current().spawn_callback(
+                self.db.release_game_lock, self.game_id, self.token)
+
+
 class GTRServer(object):
     """Manages multiple Game objects including non-game actions related to
     connecting players and starting games.
 
     The send_command(user, command) method must be assigned to an appropriate
-    handle when this object is created.
+    handle when this object is created. Optionally, send_commands(user,
+    commands) can also be assigned to send a list of commands in a single
+    message. By default, it calls send_command() for each command.
 
     GTRServer doesn't handle any user authentication. It assumes
     the <user> parameter to any GameAction commands is uniquely
@@ -99,6 +173,11 @@ class GTRServer(object):
             are returned.
             If <n_start> + <n_messages> is greater than the total number in the game,
             then the latest messages since <n_start> are returned.
+            If the messages starting at <n_start> have been dropped from the
+            log, the response starts with the oldest message retained, and
+            its <n_start> says which message that is.
+            Each message starts with the time it was logged, as integer
+            seconds since the UNIX epoch, followed by a space.
 
         Errors
         Game ID isn't a valid game.
@@ -162,14 +241,132 @@ class GTRServer(object):
 
     GAME_WAIT_TIMEOUT = datetime.timedelta(seconds=1)
 
+    # Settings for game locks held in the database. See
+    # _acquire_game_lock().
+    GAME_LOCK_TTL_MS = 10000
+    GAME_LOCK_RETRY_INTERVAL = datetime.timedelta(milliseconds=5)
 
-    def __init__(self, database):
+
+    def __init__(self, database, distributed_locks=False, user_cache=None,
+            archive_finished_games=False):
+        """Create a server using `database` for storage.
+
+        If `distributed_locks` is True, games are locked in the database
+        rather than in this process, so that several server processes can
+        handle the same games.
+
+        If `user_cache` (a cloaca.user_cache.UserCache) is provided, user
+        hashes are read through it instead of from the database.
+
+        If `archive_finished_games` is True, games are compressed into an
+        archive as soon as they finish. See GTRDBTornadis.archive_game().
+        """
         self.games = []
         self._users = {} # User database
-        self._game_locks = {}
+        self._game_locks = GameLockManager()
+        self._action_queues = {} # game_id -> list of _PendingActions
+        self.distributed_locks = distributed_locks
+        self.user_cache = user_cache
+        self.archive_finished_games = archive_finished_games
 
         self.db = database
         self.send_command = lambda _ : None
+        self.send_commands = self._send_commands_individually
+
+        # user_id -> pseudo-user that receives that user's commands
+        self.bots = {}
+
+        # A cloaca.turn_timer.TurnTimer, restarted for each game stored.
+        self.turn_timer = None
+
+
+    def add_bot(self, bot):
+        """Deliver the commands for user `bot.user_id` to
+        bot.receive_commands(commands) instead of sending them, eg. for a
+        cloaca.bot.BotPlayer. The user must be registered in the database
+        and join games like any other user.
+        """
+        self.bots[bot.user_id] = bot
+
+
+    def _retrieve_user(self, user_id):
+        """Return a future for the user hash of `user_id`, from the user
+        cache if there is one.
+        """
+        if self.user_cache is not None:
+            return self.user_cache.retrieve_user(user_id)
+        else:
+            return self.db.retrieve_user(user_id)
+
+
+    def _send_commands_individually(self, user_id, commands):
+        for command in commands:
+            self.send_command(user_id, command)
+
+
+    def _send_batch(self, batch):
+        """Send all of the commands collected in a CommandBatch, one
+        send_commands() call per user.
+        """
+        for user_id, commands in batch.items():
+            if user_id in self.bots:
+                self.bots[user_id].receive_commands(commands)
+            else:
+                self.send_commands(user_id, commands)
+
+
+    def _send(self, user_id, command, batch=None):
+        """Send the command immediately, or add it to the CommandBatch
+        if one is provided.
+        """
+        if batch is not None:
+            batch.add(user_id, command)
+        elif user_id in self.bots:
+            self.bots[user_id].receive_commands([command])
+        else:
+            self.send_command(user_id, command)
+
+
+    def game_lock_stats(self):
+        """Return the contention metrics for the in-process game locks.
+        See GameLockManager.stats().
+        """
+        return self._game_locks.stats()
+
+
+    @gen.coroutine
+    def _acquire_game_lock(self, game_id):
+        """Acquire the lock for game `game_id`, waiting at most
+        GAME_WAIT_TIMEOUT. Return a context manager that releases the
+        lock on exit. Raise gen.TimeoutError if the lock isn't acquired.
+
+            with (yield self._acquire_game_lock(game_id)):
+                ...
+        """
+        if not self.distributed_locks:
+            try:
+                releaser = yield self._game_locks.acquire(game_id,
+                        GTRServer.GAME_WAIT_TIMEOUT)
+            except gen.TimeoutError:
+                GAME_LOCK_TIMEOUTS.inc()
+                raise
+            raise gen.Return(releaser)
+
+        token = binascii.hexlify(os.urandom(16))
+        deadline = (tornado.ioloop.IOLoop.current().time() +
+                GTRServer.GAME_WAIT_TIMEOUT.total_seconds())
+
+        while True:
+            acquired = yield self.db.acquire_game_lock(game_id, token,
+                    GTRServer.GAME_LOCK_TTL_MS)
+            if acquired:
+                raise gen.Return(_RedisLockReleaser(self.db, game_id, token))
+
+            if tornado.ioloop.IOLoop.current().time() >= deadline:
+                GAME_LOCK_TIMEOUTS.inc()
+                raise gen.TimeoutError()
+
+            yield gen.sleep(GTRServer.GAME_LOCK_RETRY_INTERVAL.total_seconds())
 
 
     @gen.coroutine
@@ -196,130 +393,339 @@ class GTRServer(object):
         The ability to process multiple actions at once avoids the overhead
         of acquiring a lock on the game and retrieving it from the database.
         No yield of program flow occurs while actions are being processed.
+
+        Action lists for the same game are queued and handled by a single
+        consumer per game (see _drain_action_queue()). Everything that is
+        queued while the consumer is busy is applied in one cycle, with one
+        load and store of the game. This coroutine finishes when the
+        cycle containing these actions is done.
+
+        All of the commands generated (game states, logs, and errors) are
+        collected and sent to each user together with send_commands()
+        at the end of the cycle.
         """
-        userdict = yield self.db.retrieve_user(user_id)
+        pending = _PendingActions(user_id, actions)
 
-        # Check the lock to see if the game is in use.
         try:
-            lock = self._game_locks[game_id]
+            self._action_queues[game_id].append(pending)
         except KeyError:
-            lock = locks.Lock()
-            self._game_locks[game_id] = lock
-        
+            self._action_queues[game_id] = [pending]
+            tornado.ioloop.IOLoop.current().spawn_callback(
+                    self._drain_action_queue, game_id)
+
+        yield pending.future
+
+
+    @gen.coroutine
+    def _drain_action_queue(self, game_id):
+        """Handle the queued action lists for game `game_id` until the
+        queue is empty, then remove it. Each cycle takes every action list
+        queued so far.
+
+        An error loading, locking or storing the game is raised from the
+        future of every action list in the cycle. An error that concerns
+        one action list is only raised from its own future (see
+        _PendingActions), and lists that had to be put back in the queue
+        are handled again in the next cycle.
+        """
+        while True:
+            queued = self._action_queues[game_id]
+            if not queued:
+                del self._action_queues[game_id]
+                return
+
+            self._action_queues[game_id] = []
+
+            batch = CommandBatch()
+            timer = PhaseTimer(GAME_ACTION_PHASE_SECONDS, time.time)
+            retry = []
+            try:
+                retry = yield self._handle_queued_actions(game_id, queued,
+                        batch, timer)
+            except Exception as e:
+                error = e
+            else:
+                error = None
+            finally:
+                self._send_batch(batch)
+                timer.mark('fan_out')
+                timer.observe()
+
+            self._action_queues[game_id][:0] = retry
+
+            for pending in queued:
+                if pending in retry:
+                    continue
+                elif pending.error is not None:
+                    pending.future.set_exception(pending.error)
+                elif error is not None:
+                    pending.future.set_exception(error)
+                else:
+                    pending.future.set_result(None)
+
+
+    @gen.coroutine
+    def _handle_queued_actions(self, game_id, queued, batch, timer):
+        """Load the game, apply each of the queued _PendingActions in order,
+        and store and distribute the game if any actions succeeded.
+        Commands are added to the CommandBatch `batch` rather than sent.
+
+        If the user of an action list can't be retrieved, the list is
+        skipped. If the game engine raises anything but a GTRError, the
+        game may have been left half-changed, so nothing is stored, and
+        the list of _PendingActions to handle again is returned.
+
+        The time spent in each phase is marked on the PhaseTimer `timer`.
+        """
+        @gen.coroutine
+        def retrieve_user(pending):
+            try:
+                userdict = yield self._retrieve_user(pending.user_id)
+                if not userdict:
+                    raise GTRError('Unknown user {0!s}.'
+                            .format(pending.user_id))
+            except Exception as e:
+                pending.error = e
+                userdict = None
+            raise gen.Return(userdict)
+
+        userdicts = yield [retrieve_user(p) for p in queued]
+        timer.mark('db_read')
+
         try:
-            with (yield lock.acquire(GTRServer.GAME_WAIT_TIMEOUT)):
+            with (yield self._acquire_game_lock(game_id)):
+                timer.mark('lock_wait')
                 game_encoded = yield self.db.retrieve_game(game_id)
-
-                username = userdict['username']
+                timer.mark('db_read')
 
                 if game_encoded is None:
                     msg = 'Invalid game id: ' + str(game_id)
                     lg.warning(msg)
-                    return
+                    raise gen.Return([])
 
                 game = encode.str_to_game(game_encoded)
-
-                player_index = game.find_player_index(username)
-                if player_index is None:
-                    msg = ('User {0} is not part of game {1:d}, players: {2!s}'
-                            ).format(name, game_id,
-                                [p.name for p in game.players])
-                    lg.warning(msg)
-                    self._send_error(user_id, msg)
-                    return
-
-                # Ignore actions if they're old, with too-low action_number.
-                # It's probably the client re-sending a list of actions.
-                # However, if no actions are applicable, send an error.
-                if(game.action_number > actions[-1][0]):
-                    msg = ('Received latest action_number {0:d}, but require {1:d}.'
-                            ).format(actions[-1][0], game.action_number)
-                    self._send_error(user_id, msg)
-                    return
+                timer.mark('decode')
 
                 actions_executed = []
-                initial_action_number = game.action_number
-                for action_number, action in actions:
-                    if action_number > game.action_number:
-                        msg = ('Received action_number {0:d}, but require {1:d}.'
-                                ).format(action_number, game.action_number)
-                        lg.warning(msg)
-                        self._send_error(user_id, msg)
-                        return
-                    elif action_number < game.action_number:
-                        lg.debug('Skipping action {0:d}, {1}. (Game.action_number'
-                                ' = {2}): '.format(action_number, repr(action),
-                                        game.action_number))
+                for pending, userdict in zip(queued, userdicts):
+                    if pending.error is not None:
                         continue
 
-                    lg.debug('Handling action: {0}'.format(repr(action)))
+                    try:
+                        actions_executed.extend(self._apply_actions(
+                                game, pending.user_id, userdict['username'],
+                                pending.actions, batch))
+                    except Exception as e:
+                        lg.exception('Failed to handle actions of user {0!s} '
+                                'in game {1:d}.'.format(pending.user_id,
+                                    game_id))
+                        pending.error = e
+
+                        # The errors for the other lists are sent when
+                        # they're handled again.
+                        batch.clear()
+                        timer.mark('engine')
+                        raise gen.Return([p for p in queued
+                                if p.error is None])
+                timer.mark('engine')
+
+                # Store game, actions, and log only if some actions succeeded
+                if len(actions_executed):
+                    # Executed actions are consecutive, so they're appended
+                    # to the action log together.
+                    log_header = encode_action.encode_action_log_header(
+                            actions_executed[0][0])
+                    actions_encoded = encode_action.encode_actions(
+                            [action for _, action in actions_executed])
+                    game_encoded = encode.game_to_str(game)
+                    timer.mark('encode')
+
+                    # The actions and the state are written together, so
+                    # the action log can't get out of step with the state.
+                    # The game log is only appended once they're stored: if
+                    # that fails, its messages are missing, but a retry of
+                    # the actions can't add them twice.
+                    yield self.db.store_game_actions(game_id, game_encoded,
+                            log_header, actions_encoded)
+                    n_total = yield self.db.append_log_messages(game_id,
+                            game.game_log)
+                    timer.mark('db_write')
+
+                    yield self._distribute_game(game, n_total, batch)
+
+        except gen.TimeoutError:
+            timer.mark('lock_wait')
+            raise GTRError('Timeout acquiring lock to handle game action.')
 
-                    if game.finished:
-                        msg = 'Game {0:d} has finished.'.format(game_id)
-                        lg.debug(msg)
-                        self._send_error(user_id, msg)
+        raise gen.Return([])
 
-                    i_active_p = game.active_player_index
 
-                    if i_active_p != player_index:
-                        msg = ('Received action for player {0!s} ({1}), '
-                            'but waiting on player {2!s} ({3}).'
-                            ).format(player_index, game.players[player_index].name,
-                                    i_active_p, game.players[i_active_p].name)
+    @gen.coroutine
+    def _distribute_game(self, game, n_total, batch):
+        """Send the stored state of `game` and its new log messages to
+        each player, after the game has been stored and the log appended
+        to make `n_total` messages. Restart its turn timer and archive it
+        if it has finished.
+        """
+        game_id = game.game_id
+        n_start = n_total - len(game.game_log)
 
-                        lg.warning(msg)
-                        self._send_error(user_id, msg)
-                        break
+        new_log_messages_combined = '\n'.join(game.game_log)
+        for u in [p.uid for p in game.players]:
+            yield self._retrieve_and_send_game(u, game_id, batch)
+            self._send_log(game_id, u, new_log_messages_combined,
+                    n_total, n_start, batch)
 
-                    try:
-                        game.handle(action)
-                    except GTRError as e:
-                        lg.warning(e.message)
-                        self._send_error(user_id, e.message)
-                        break
-                    except GameOver:
-                        lg.info('Game {0:d} has ended.'.format(game_id))
-                        actions_executed.append(action)
-                    else:
-                        actions_executed.append(action)
+        if self.turn_timer is not None:
+            self.turn_timer.update(game)
 
-                # Store game, actions, and log only if some actions succeeded
-                if len(actions_executed):
-                    for i, action in enumerate(actions_executed):
-                        n = i + initial_action_number
-                        move_encoded = encode_action.game_action_to_str(action)
-                        try:
-                            yield self.db.set_game_action(game_id, n, move_encoded)
-                        except GTRDBError as e:
-                            lg.warn(e.message)
+        if game.finished and self.archive_finished_games:
+            tornado.ioloop.IOLoop.current().spawn_callback(
+                    self._archive_game, game_id)
 
-                    n_total = yield self.db.append_log_messages(game_id, game.game_log)
-                    n_start = n_total - len(game.game_log)
 
-                    yield self._store_game(game)
+    @gen.coroutine
+    def abandon_game(self, game_id, action_number):
+        """End game `game_id` with Game.abandon() if it's still waiting
+        for action `action_number`, eg. when the player's turn timer
+        expires. Return a future that is True if the game was abandoned.
+        """
+        batch = CommandBatch()
+        try:
+            with (yield self._acquire_game_lock(game_id)):
+                game_encoded = yield self.db.retrieve_game(game_id)
+                if game_encoded is None:
+                    raise gen.Return(False)
 
-                    new_log_messages_combined = '\n'.join(game.game_log)
-                    for u in [p.uid for p in game.players]:
-                        yield self._retrieve_and_send_game(u, game_id)
-                        self._send_log(game_id, u, new_log_messages_combined, n_total, n_start)
+                game = encode.str_to_game(game_encoded)
+                if game.finished or game.action_number != action_number:
+                    raise gen.Return(False)
+
+                marker = game.abandon()
+                lg.info('Abandoned game {0:d} waiting for {1}.'.format(
+                        game_id, game.active_player.name))
+
+                # The marker takes the place of the expected action, so
+                # the action log still reproduces the final state.
+                log_header = encode_action.encode_action_log_header(
+                        action_number)
+                actions_encoded = encode_action.encode_actions([marker])
+
+                yield self.db.store_game_actions(game_id,
+                        encode.game_to_str(game), log_header, actions_encoded)
+                n_total = yield self.db.append_log_messages(game_id,
+                        game.game_log)
+                yield self._distribute_game(game, n_total, batch)
 
         except gen.TimeoutError:
-            raise GTRError('Timeout acquiring lock to handle game action.')
+            raise GTRError('Timeout acquiring lock to abandon game.')
+        finally:
+            self._send_batch(batch)
+
+        raise gen.Return(True)
+
+
+    @gen.coroutine
+    def _archive_game(self, game_id):
+        """Archive the finished game `game_id`, once the players have been
+        sent the final game state.
+        """
+        try:
+            with (yield self._acquire_game_lock(game_id)):
+                n_bytes = yield self.db.archive_game(game_id)
+        except gen.TimeoutError:
+            lg.warning('Timeout acquiring lock to archive game {0:d}.'
+                    .format(game_id))
+        except (GTRError, encode.GTREncodingError) as e:
+            lg.warning('Failed to archive game {0:d}: {1}'
+                    .format(game_id, e.message))
+        else:
+            if n_bytes is not None:
+                lg.info('Archived game {0:d} ({1:d} bytes).'
+                        .format(game_id, n_bytes))
+
+
+    def _apply_actions(self, game, user_id, username, actions, batch):
+        """Apply the list of [action_number, GameAction] pairs submitted by
+        a user to `game`. See handle_game_actions().
+
+        Errors are added to the CommandBatch `batch`. Return the list of
+        (action_number, GameAction) tuples that were executed.
+        """
+        game_id = game.game_id
+        actions_executed = []
+
+        player_index = game.find_player_index(username)
+        if player_index is None:
+            msg = ('User {0} is not part of game {1:d}, players: {2!s}'
+                    ).format(username, game_id,
+                        [p.name for p in game.players])
+            lg.warning(msg)
+            self._send_error(user_id, msg, batch)
+            return actions_executed
+
+        # Ignore actions if they're old, with too-low action_number.
+        # It's probably the client re-sending a list of actions.
+        # However, if no actions are applicable, send an error.
+        if(game.action_number > actions[-1][0]):
+            msg = ('Received latest action_number {0:d}, but require {1:d}.'
+                    ).format(actions[-1][0], game.action_number)
+            self._send_error(user_id, msg, batch)
+            return actions_executed
+
+        for action_number, action in actions:
+            if action_number > game.action_number:
+                msg = ('Received action_number {0:d}, but require {1:d}.'
+                        ).format(action_number, game.action_number)
+                lg.warning(msg)
+                self._send_error(user_id, msg, batch)
+                break
+            elif action_number < game.action_number:
+                lg.debug('Skipping action %d, %r. (Game.action_number'
+                        ' = %d)', action_number, action, game.action_number)
+                continue
+
+            lg.debug('Handling action: %r', action)
+
+            if game.finished:
+                msg = 'Game {0:d} has finished.'.format(game_id)
+                lg.debug(msg)
+                self._send_error(user_id, msg, batch)
+                break
+
+            i_active_p = game.active_player_index
+
+            if i_active_p != player_index:
+                msg = ('Received action for player {0!s} ({1}), '
+                    'but waiting on player {2!s} ({3}).'
+                    ).format(player_index, game.players[player_index].name,
+                            i_active_p, game.players[i_active_p].name)
+
+                lg.warning(msg)
+                self._send_error(user_id, msg, batch)
+                break
+
+            try:
+                game.handle(action)
+            except GTRError as e:
+                lg.warning(e.message)
+                self._send_error(user_id, e.message, batch)
+                break
+            except GameOver:
+                lg.info('Game %d has ended.', game_id)
+                actions_executed.append((action_number, action))
+            else:
+                actions_executed.append((action_number, action))
+
+        return actions_executed
 
 
     @gen.coroutine
     def join_game(self, user_id, game_id):
         """Joins an existing game"""
-        userdict = yield self.db.retrieve_user(user_id)
-        # Check the lock to see if the game is in use.
-        try:
-            lock = self._game_locks[game_id]
-        except KeyError:
-            lock = locks.Lock()
-            self._game_locks[game_id] = lock
-        
+        userdict = yield self._retrieve_user(user_id)
         try:
-            with (yield lock.acquire(GTRServer.GAME_WAIT_TIMEOUT)):
+            with (yield self._acquire_game_lock(game_id)):
                 game_encoded = yield self.db.retrieve_game(game_id)
 
                 username = userdict['username']
@@ -331,7 +737,7 @@ class GTRServer(object):
 
                 game = encode.str_to_game(game_encoded)
 
-                lg.debug('Adding player {0!s} with ID {1!s}'.format(username, user_id))
+                lg.debug('Adding player %s with ID %s', username, user_id)
 
                 player_index = game.add_player(user_id, username)
 
@@ -347,7 +753,7 @@ class GTRServer(object):
 
     @gen.coroutine
     def get_game(self, user_id, game_id):
-        userdict = yield self.db.retrieve_user(user_id)
+        userdict = yield self._retrieve_user(user_id)
         game_encoded = yield self.db.retrieve_game(game_id)
 
         username = userdict['username']
@@ -376,7 +782,7 @@ class GTRServer(object):
 
     @gen.coroutine
     def get_game_data(self, user_id, game_id):
-        lg.debug('User {0!s} requests game {1!s}'.format(user_id, game_id))
+        lg.debug('User %s requests game %s', user_id, game_id)
         game = yield self.get_game(user_id, game_id)
         if game is None:
             game_encoded = ''
@@ -388,12 +794,16 @@ class GTRServer(object):
 
     @gen.coroutine
     def get_game_log_messages(self, user_id, game_id, n_messages, n_start):
-        """Return <n_messages> messages from game with ID <game_id> starting
-        at the <n_start>'th message as a new-line delimited string.
+        """Return a tuple (<n_total>, <n_first>, <messages>) with
+        <n_messages> messages from game with ID <game_id> starting at the
+        <n_start>'th message as a new-line delimited string. If older
+        messages have been dropped from the log, <n_first> is the index
+        of the first message returned. <n_total> is the number of messages
+        in the log.
 
         If the user is not a part of the game, an error is raised.
         """
-        userdict = yield self.db.retrieve_user(user_id)
+        userdict = yield self._retrieve_user(user_id)
         game_encoded = yield self.db.retrieve_game(game_id)
 
         username = userdict['username']
@@ -402,27 +812,27 @@ class GTRServer(object):
             msg = 'Invalid game id: ' + str(game_id)
             lg.warning(msg)
             raise GTRError(msg)
-            
-        game = encode.str_to_game(game_encoded)
 
-        player_index = game.find_player_index(username)
-        if player_index is None:
+        # Only the player names are needed, so skip decoding the full game.
+        metadata = encode.peek_game_metadata(game_encoded)
+
+        if username not in metadata['players']:
             msg = 'User {0:s} is not part of game {1:d}'.format(username, game_id)
             lg.warning(msg)
             raise GTRError(msg)
 
-        messages = yield self.db.retrieve_log_messages(
+        n_total, n_first, messages = yield self.db.retrieve_log_range(
                 game_id, n_messages, n_start)
 
         combined = '\n'.join(messages)
-        raise gen.Return(combined)
+        raise gen.Return((n_total, n_first, combined))
 
 
-    def _send_log(self, game_id, user_id, messages, n_total, n_start):
+    def _send_log(self, game_id, user_id, messages, n_total, n_start, batch=None):
         """Send the log messages as a GAMELOG command."""
         resp = Command(game_id, None, GameAction(message.GAMELOG, n_total,
             n_start, messages))
-        self.send_command(user_id, resp)
+        self._send(user_id, resp, batch)
 
 
     @gen.coroutine
@@ -430,20 +840,20 @@ class GTRServer(object):
             self, user_id, game_id, n_messages, n_start):
         """If 0 messages are requested, just return the number of log messages.
         """
-        n_total = yield self.db.retrieve_log_length(game_id)
         if n_messages == 0:
+            n_total = yield self.db.retrieve_log_length(game_id)
             self._send_log(game_id, user_id, None, n_total, 0)
         else:
             try:
-                messages = yield self.get_game_log_messages(
+                n_total, n_first, messages = yield self.get_game_log_messages(
                         user_id, game_id, n_messages, n_start)
             except GTRError as e:
-                self._send_error(user, e.message)
+                self._send_error(user_id, e.message)
             else:
-                self._send_log(game_id, user_id, messages, n_total, n_start)
+                self._send_log(game_id, user_id, messages, n_total, n_first)
 
 
-    def _send_game(self, user_id, game):
+    def _send_game(self, user_id, game, batch=None):
         """Sends the game to the user as a GAMESTATE command."""
         if game is None:
             gs_encoded = ''
@@ -451,32 +861,32 @@ class GTRServer(object):
             gs_encoded = encode.game_to_str(game)
 
         resp = Command(game.game_id, None, GameAction(message.GAMESTATE, gs_encoded))
-        self.send_command(user_id, resp)
+        self._send(user_id, resp, batch)
         
 
     @gen.coroutine
-    def _retrieve_and_send_game(self, user, game_id):
+    def _retrieve_and_send_game(self, user, game_id, batch=None):
         """Retrieves the game from the database using game_id and 
         sends the game to the user in a GAMESTATE command.
         """
         try:
             game = yield self.get_game(user, game_id)
         except GTRError as e:
-            self._send_error(user, e.message)
+            self._send_error(user, e.message, batch)
         else:
-            self._send_game(user, game)
+            self._send_game(user, game, batch)
 
 
-    def _send_error(self, user, msg):
+    def _send_error(self, user, msg, batch=None):
         """Send error message to user."""
         resp = Command(None, None, GameAction(message.SERVERERROR, msg))
-        self.send_command(user, resp)
+        self._send(user, resp, batch)
         
 
     @gen.coroutine
     def create_game(self, user_id):
         """Create a new game, return the new game ID."""
-        userdict = yield self.db.retrieve_user(user_id)
+        userdict = yield self._retrieve_user(user_id)
 
         game_id = yield self.db.create_game_with_host(user_id)
         # If another coroutine locks this game between getting the id from
@@ -484,13 +894,7 @@ class GTRServer(object):
         # times out, we raise an exception and the game never gets stored.
         # The DB will contain an empty stub for this game ID.
         try:
-            lock = self._game_locks[game_id]
-        except KeyError:
-            lock = locks.Lock()
-            self._game_locks[game_id] = lock
-        
-        try:
-            with (yield lock.acquire(GTRServer.GAME_WAIT_TIMEOUT)):
+            with (yield self._acquire_game_lock(game_id)):
                 username = userdict['username']
 
                 lg.info('Creating new game {0:d} with host {1}'.format(
@@ -500,7 +904,7 @@ class GTRServer(object):
                 game.game_id = game_id
                 game.host = username
 
-                lg.debug('Adding player {0!s} with ID {1!s}'.format(username, user_id))
+                lg.debug('Adding player %s with ID %s', username, user_id)
 
                 player_index = game.add_player(user_id, username)
 
@@ -532,16 +936,10 @@ class GTRServer(object):
 
     @gen.coroutine
     def start_game(self, user_id, game_id):
-        userdict = yield self.db.retrieve_user(user_id)
+        userdict = yield self._retrieve_user(user_id)
 
         try:
-            lock = self._game_locks[game_id]
-        except KeyError:
-            lock = locks.Lock()
-            self._game_locks[game_id] = lock
-
-        try:
-            with (yield lock.acquire(GTRServer.GAME_WAIT_TIMEOUT)):
+            with (yield self._acquire_game_lock(game_id)):
                 game_encoded = yield self.db.retrieve_game(game_id)
 
                 username = userdict['username']
@@ -572,6 +970,15 @@ class GTRServer(object):
                 yield self.db.append_log_messages(game_id, game.game_log)
                 yield self._store_game(game)
 
+                if self.turn_timer is not None:
+                    self.turn_timer.update(game)
+
+                # Other players request the game state when they're told
+                # that the game started, so bots are sent it directly.
+                for p in game.players:
+                    if p.uid in self.bots:
+                        yield self._retrieve_and_send_game(p.uid, game_id)
+
                 raise gen.Return(game)
 
         except gen.TimeoutError:
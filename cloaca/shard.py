@@ -0,0 +1,71 @@
+"""Assignment of games to server processes for sharded deployments.
+
+In a sharded deployment, each game is owned by exactly one server process
+(a shard), chosen by consistently hashing the game ID. The owning process
+holds the game's locks in memory and handles all of the requests that
+modify the game, so no coordination between processes is needed.
+
+Shard i listens on port <base_port> + i. Requests for a game that arrive at
+another shard are redirected to the owner, so the game page, and the
+websocket it opens, are always served by the owning shard.
+
+Jump consistent hashing is used so that when the number of shards is
+increased from N to N+1, only about 1/(N+1) of the games change owner.
+
+    shard_map = ShardMap(4, 8080)
+    shard_map.shard_for_game(12)   # -> 0 <= shard < 4
+    shard_map.port_for_game(12)    # -> 8080 + shard
+"""
+
+_MASK_64 = 0xFFFFFFFFFFFFFFFF
+
+
+def jump_consistent_hash(key, n_buckets):
+    """Return the bucket in range(n_buckets) for the integer `key`.
+
+    This is the algorithm from Lamping and Veach, "A Fast, Minimal Memory,
+    Consistent Hash Algorithm" (2014).
+    """
+    if n_buckets < 1:
+        raise ValueError('Number of buckets must be positive: {0!s}'
+                .format(n_buckets))
+
+    key &= _MASK_64
+    b, j = -1, 0
+    while j < n_buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & _MASK_64
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+
+    return b
+
+
+class ShardMap(object):
+    """Maps game IDs to shards and shards to ports.
+    """
+
+    def __init__(self, n_shards, base_port, shard_index=None):
+        """Create a map for `n_shards` processes listening on consecutive
+        ports starting with `base_port`. The `shard_index` is the shard
+        of the current process, or None if it isn't a shard.
+        """
+        if n_shards < 1:
+            raise ValueError('Number of shards must be positive: {0!s}'
+                    .format(n_shards))
+
+        self.n_shards = n_shards
+        self.base_port = base_port
+        self.shard_index = shard_index
+
+    def shard_for_game(self, game_id):
+        return jump_consistent_hash(int(game_id), self.n_shards)
+
+    def port_for_shard(self, shard):
+        return self.base_port + shard
+
+    def port_for_game(self, game_id):
+        return self.port_for_shard(self.shard_for_game(game_id))
+
+    def owns(self, game_id):
+        """Return True if the game is owned by the current process."""
+        return self.shard_for_game(game_id) == self.shard_index
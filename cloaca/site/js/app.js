@@ -37,8 +37,8 @@ function($, Util, Display, Games, FSM, Game, Net, Encode){
         function handleCommand(game_id, action, args) {
             
             if (action == Util.Action.GAMESTATE) {
-                var game_encoded_base64 = args[0];
-                game = Encode.decode_game(game_encoded_base64);
+                var game_encoded = args[0];
+                game = Encode.decode_game(game_encoded);
                 update_game_state(game_id, game);
 
             } else if (action == Util.Action.GAMELOG) {
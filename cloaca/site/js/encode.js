@@ -240,10 +240,9 @@ function() {
         };
     }
 
-    function decode_game(game_encoded_base64) {
+    function decode_game(array) {
         // Returns object {header, game} with basically the same structure
         // as the server-side game.
-        var array = _base64ToArrayBuffer(game_encoded_base64);
         var data = new DataView(array);
         var offset = 0;
         var magic_number = data.getUint32(offset);
@@ -375,9 +374,12 @@ function() {
     }
 
 
-    // Decode a binary-encoded game encoded with base64
-    Encode.decode_game = function(game_encoded_base64) {
-        var game_header = decode_game(game_encoded_base64);
+    // Decode a binary-encoded game, either as an ArrayBuffer from a
+    // binary websocket message or encoded with base64.
+    Encode.decode_game = function(game_encoded) {
+        var array = game_encoded instanceof ArrayBuffer ?
+            game_encoded : _base64ToArrayBuffer(game_encoded);
+        var game_header = decode_game(array);
         header = game_header.header;
         game = game_header.game;
 
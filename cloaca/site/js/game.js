@@ -5,6 +5,21 @@ function($, _, AB, Games, Display, Net, Util) {
         this.display = new Display(id, Games.user, players);
         this.game_log = [];
         this.requested_log_messages = false;
+        this.requested_log_start = 0;
+    };
+
+    // Log messages start with the time as integer seconds since the
+    // UNIX epoch. Replace it with the local time, eg. "13:05:59 ".
+    function formatLogMessage(message) {
+        var match = /^(\d+) (.*)$/.exec(message);
+        if(match === null) {
+            return message;
+        }
+
+        var time = new Date(parseInt(match[1], 10) * 1000);
+        function pad(n) { return (n < 10 ? '0' : '') + n; }
+        return pad(time.getHours()) + ':' + pad(time.getMinutes()) + ':'
+            + pad(time.getSeconds()) + ' ' + match[2];
     };
 
     // Build the game state HTML
@@ -54,6 +69,15 @@ function($, _, AB, Games, Display, Net, Util) {
         for(var i=this.game_log.length; i<n_total; i++) {
             this.game_log.push(null);
         }
+        // If the response starts later than requested, the older messages
+        // have been dropped by the server. Mark them so they aren't
+        // requested again.
+        if(this.requested_log_messages && messages.length > 0 &&
+                n_start > this.requested_log_start) {
+            for(var i=this.requested_log_start; i<n_start; i++) {
+                this.game_log[i] = undefined;
+            }
+        }
         // Set new messages to received values.
         for(var i=0; i<messages.length; i++) {
             this.game_log[i+n_start] = messages[i];
@@ -73,13 +97,15 @@ function($, _, AB, Games, Display, Net, Util) {
         console.log('Requesting more ', n_messages, 'more log messages, starting at', n_start);
         Net.sendAction(this.id, null, Util.Action.REQGAMELOG, [n_messages, n_start]);
         this.requested_log_messages = true;
+        this.requested_log_start = n_start;
     };
 
     Game.prototype.drawLog = function() {
         var els = [];
         var first_missing = this.game_log.lastIndexOf(null);
         for(var i=first_missing+1; i<this.game_log.length; i++) {
-            els.push($('<li />').text(this.game_log[i]));
+            if(this.game_log[i] === undefined) continue;
+            els.push($('<li />').text(formatLogMessage(this.game_log[i])));
         }
         this.display.gameLog.empty();
         this.display.gameLog.append(els);
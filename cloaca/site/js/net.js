@@ -5,8 +5,14 @@ function(Util, FSM) {
         user: null
     }
 
+    // Websocket subprotocols, in order of preference. The server sends
+    // binary messages if it selects BINARY_PROTOCOL and JSON otherwise.
+    var BINARY_PROTOCOL = 'cloaca.binary.v1';
+    var JSON_PROTOCOL = 'cloaca.json';
+
     Net.connect = function(url, onopen, onmessage) {
-        Net.socket = new WebSocket(url);
+        Net.socket = new WebSocket(url, [BINARY_PROTOCOL, JSON_PROTOCOL]);
+        Net.socket.binaryType = 'arraybuffer';
 
         // Handle any errors that occur.
         Net.socket.onerror = function(error) {
@@ -31,21 +37,103 @@ function(Util, FSM) {
           return result;
         };
 
+        // The JSON arguments are ASCII (the server escapes anything else),
+        // so any decoder gives the same string. Without TextDecoder, the
+        // bytes are converted in chunks, since apply() is limited in the
+        // number of arguments it can pass.
+        var textDecoder = typeof TextDecoder === 'undefined' ? null : new TextDecoder();
+        var DECODE_CHUNK = 8192;
+
+        function decodeText(buffer) {
+            if(textDecoder !== null) {
+                return textDecoder.decode(buffer);
+            }
+
+            var bytes = new Uint8Array(buffer);
+            var chunks = [];
+            for(var i=0; i<bytes.length; i+=DECODE_CHUNK) {
+                chunks.push(String.fromCharCode.apply(null,
+                        bytes.subarray(i, i+DECODE_CHUNK)));
+            }
+            return chunks.join('');
+        };
+
+        // Decode a binary command envelope:
+        //     <game_id> (int32, -1 for null)
+        //     <number> (int32, -1 for null)
+        //     <action> (uint8)
+        //     <args> (rest) Raw encoded game for GAMESTATE, or
+        //         a JSON array of arguments otherwise.
+        function decodeEnvelope(buffer) {
+            var data = new DataView(buffer);
+            var game = data.getInt32(0);
+            var number = data.getInt32(4);
+            var action = data.getUint8(8);
+            var payload = buffer.slice(9);
+
+            var args;
+            if(action === Util.Action.GAMESTATE) {
+                args = [payload];
+            } else {
+                args = JSON.parse(decodeText(payload));
+            }
+
+            return {
+                game: game === -1 ? null : game,
+                number: number === -1 ? null : number,
+                action: action,
+                args: args
+            };
+        };
+
+        // A binary message is a list of envelopes, each prefixed
+        // with its length as a uint32.
+        function decodeEnvelopes(buffer) {
+            var data = new DataView(buffer);
+            var commands = [];
+            var offset = 0;
+            while(offset < buffer.byteLength) {
+                var length = data.getUint32(offset);
+                offset+=4;
+                commands.push(decodeEnvelope(buffer.slice(offset, offset+length)));
+                offset+=length;
+            }
+            return commands;
+        };
+
         Net.socket.onmessage = function(event) {
             var message = event.data;
 
+            if(message instanceof ArrayBuffer) {
+                var commands = decodeEnvelopes(message);
+                for(var i=0; i<commands.length; i++) {
+                    var command = commands[i];
+                    console.log('Received', command);
+                    onmessage(command.game, command.action, command.args);
+                }
+                return;
+            }
+
             // Parse NetString : <length>:<str>,
             //var msg = (splitWithTail(message, ':', 1)[1]).slice(0,-1);
             var msg = message;
 
-            var dict = JSON.parse(msg);
-            console.log('Received', dict);
+            // A JSON message is either a single command or a list of them.
+            var dicts = JSON.parse(msg);
+            if(!Array.isArray(dicts)) {
+                dicts = [dicts];
+            }
+
+            for(var i=0; i<dicts.length; i++) {
+                var dict = dicts[i];
+                console.log('Received', dict);
 
-            var game = dict['game']
-            var action = dict['action']['action'];
-            var args = dict['action']['args'];
+                var game = dict['game']
+                var action = dict['action']['action'];
+                var args = dict['action']['args'];
 
-            onmessage(game, action, args);
+                onmessage(game, action, args);
+            }
         };
         
         // Show a disconnected message when the WebSocket is closed.
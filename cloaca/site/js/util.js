@@ -303,7 +303,8 @@ function($){
         TAKEPOOLCARDS   : 36,
         TAKECLIENTS     : 37,
         REQGAMELOG      : 38,
-        GAMELOG         : 39
+        GAMELOG         : 39,
+        ABANDON         : 40
     };
 
     util._cardDictionary = {
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+from cloaca.game import Game
+from cloaca.message import GameAction
+import cloaca.message as message
+import cloaca.archive as archive
+import cloaca.encode_binary as encode
+import cloaca.encode_action as encode_action
+from cloaca.encode_binary import GTREncodingError
+
+import unittest
+import struct
+import zlib
+
+
+class TestArchive(unittest.TestCase):
+    """Test encoding and decoding compressed game archives.
+    """
+
+    def setUp(self):
+        game = Game(game_id=1, host='p1')
+        game.add_player(1, 'p1')
+        game.add_player(2, 'p2')
+        game.start()
+
+        self.game_data = encode.game_to_str(game)
+        self.action_log = (encode_action.encode_action_log_header(1)
+                + encode_action.encode_actions([
+                    GameAction(message.THINKERORLEAD, True),
+                    GameAction(message.THINKERTYPE, False)]))
+        self.messages = ['1500000000 message {0:d}'.format(i)
+                for i in range(200)]
+
+    def test_round_trip(self):
+        bundle = archive.encode_archive(self.game_data, self.action_log,
+                self.messages, 50)
+
+        self.assertEqual(archive.decode_archive_game(bundle), self.game_data)
+        self.assertEqual(archive.decode_archive_actions(bundle), self.action_log)
+        self.assertEqual(archive.decode_archive_log(bundle), (50, self.messages))
+
+    def test_compressed(self):
+        bundle = archive.encode_archive(self.game_data, self.action_log,
+                self.messages)
+
+        raw_length = (len(self.game_data) + len(self.action_log)
+                + len('\n'.join(self.messages)))
+        self.assertLess(len(bundle), raw_length)
+
+    def test_empty(self):
+        bundle = archive.encode_archive(self.game_data, None, [])
+
+        self.assertIsNone(archive.decode_archive_actions(bundle))
+        self.assertEqual(archive.decode_archive_log(bundle), (0, []))
+        self.assertEqual(archive.decode_archive_legacy_actions(bundle), {})
+
+    def test_legacy_actions(self):
+        legacy_actions = {'1': '[0, [true]]', '2': '', '10': 'x\n' * 100}
+        bundle = archive.encode_archive(self.game_data, None, self.messages,
+                legacy_actions=legacy_actions)
+
+        self.assertIsNone(archive.decode_archive_actions(bundle))
+        self.assertEqual(archive.decode_archive_legacy_actions(bundle),
+                {1: '[0, [true]]', 2: '', 10: 'x\n' * 100})
+
+    def test_version_1(self):
+        sections = [zlib.compress(s) for s in
+                (self.game_data, self.action_log, '\n'.join(self.messages))]
+        bundle = (struct.pack('!BBIIII', 1, archive.ZLIB, 5,
+                *map(len, sections)) + ''.join(sections))
+
+        self.assertEqual(archive.decode_archive_game(bundle), self.game_data)
+        self.assertEqual(archive.decode_archive_actions(bundle), self.action_log)
+        self.assertEqual(archive.decode_archive_log(bundle), (5, self.messages))
+        self.assertEqual(archive.decode_archive_legacy_actions(bundle), {})
+
+    @unittest.skipIf(archive.lzma is None, 'lzma is not installed')
+    def test_lzma(self):
+        bundle = archive.encode_archive(self.game_data, self.action_log,
+                self.messages, codec=archive.LZMA)
+
+        self.assertEqual(archive.decode_archive_game(bundle), self.game_data)
+        self.assertEqual(archive.decode_archive_log(bundle), (0, self.messages))
+
+    def test_bad_version(self):
+        bundle = archive.encode_archive(self.game_data, None, [])
+        bundle = chr(archive.ARCHIVE_VERSION+1) + bundle[1:]
+
+        with self.assertRaises(GTREncodingError):
+            archive.decode_archive_game(bundle)
+
+    def test_truncated(self):
+        bundle = archive.encode_archive(self.game_data, None, self.messages)
+
+        with self.assertRaises(GTREncodingError):
+            archive.decode_archive_log(bundle[:-1])
+
+        with self.assertRaises(GTREncodingError):
+            archive.decode_archive_game(bundle[:5])
+
+
+if __name__ == '__main__':
+    unittest.main()
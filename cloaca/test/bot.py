@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+from cloaca.bot import (MCTSBot, BotPlayer, candidate_actions, legal_actions,
+        determinize, rollout, rewards, search, action_key)
+from cloaca.game import Game
+from cloaca.card import Card
+from cloaca.server import GTRServer
+from cloaca.error import GTRError
+import cloaca.encode_binary as encode
+import cloaca.message as message
+
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+
+from server import MemoryDatabase
+
+import unittest
+import random
+
+
+def all_cards(game):
+    """Return the list of cards in every zone of `game` except the
+    revealed cards, which are copies.
+    """
+    cards = game.jacks.cards + game.library.cards + game.pool.cards
+    for p in game.players:
+        for zone in (p.hand, p.stockpile, p.clientele, p.vault, p.camp):
+            cards.extend(zone.cards)
+        for b in p.buildings:
+            cards.append(b.foundation)
+            cards.extend(b.materials.cards + b.stairway_materials.cards)
+        if p.fountain_card is not None:
+            cards.append(p.fountain_card)
+    return cards
+
+
+def random_game(n_actions, seed):
+    """Return a three-player game after `n_actions` random legal actions."""
+    rng = random.Random(seed)
+    game = Game(game_id=1, host='p1')
+    for i in range(1, 4):
+        game.add_player(i, 'p{0:d}'.format(i))
+
+    # Game.start() shuffles the deck with the random module, so seed it
+    # for the shuffle only.
+    state = random.getstate()
+    random.seed(seed)
+    try:
+        game.start()
+    finally:
+        random.setstate(state)
+
+    for _ in range(n_actions):
+        game = rng.choice(legal_actions(game))[1]
+    return game
+
+
+class TestLegalActions(unittest.TestCase):
+    """Test generating legal actions and playing random games with them.
+    """
+
+    def test_start(self):
+        game = random_game(0, 0)
+        keys = [action_key(a) for a, _ in legal_actions(game)]
+
+        self.assertEqual(keys, [(message.THINKERORLEAD, True),
+                (message.THINKERORLEAD, False)])
+
+    def test_lead_requires_cards(self):
+        game = random_game(0, 0)
+        game.active_player.hand.set_content([])
+
+        self.assertEqual([a.args for a in candidate_actions(game)], [[True]])
+
+    def test_legal_action_not_applied(self):
+        game = random_game(5, 1)
+        before = encode.game_to_str(game)
+
+        for a, gs in legal_actions(game):
+            self.assertEqual(gs.action_number, game.action_number + 1)
+
+        self.assertEqual(encode.game_to_str(game), before)
+
+    def test_random_game_finishes(self):
+        game = rollout(random_game(0, 2), random.Random(2), max_actions=2000)
+
+        self.assertTrue(game.finished)
+        self.assertEqual(sum(rewards(game)), 1.0)
+
+
+class TestDeterminize(unittest.TestCase):
+    """Test sampling the hidden cards of a player's view of the game.
+    """
+
+    def setUp(self):
+        self.game = random_game(60, 3)
+        self.view = self.game.privatized_game_state_copy('p1')
+
+    def test_hidden_cards_filled(self):
+        gs = determinize(self.view, random.Random(0))
+        cards = all_cards(gs)
+
+        self.assertTrue(any(c.ident < 0 for c in all_cards(self.view)))
+        self.assertFalse(any(c.ident < 0 for c in cards))
+        self.assertEqual(len(set(c.ident for c in cards)), len(cards))
+        self.assertEqual(len(cards), len(all_cards(self.game)))
+
+    def test_visible_cards_kept(self):
+        gs = determinize(self.view, random.Random(0))
+
+        p1 = gs.players[0]
+        self.assertEqual(p1.hand.cards, self.view.players[0].hand.cards)
+        self.assertEqual(gs.pool.cards, self.view.pool.cards)
+        self.assertEqual(len(gs.library), len(self.view.library))
+        self.assertEqual(gs.game_log, [])
+
+    def test_samples_differ(self):
+        a = determinize(self.view, random.Random(0))
+        b = determinize(self.view, random.Random(1))
+
+        self.assertNotEqual(a.library.cards, b.library.cards)
+
+    def test_inconsistent_view(self):
+        self.view.pool.append(Card(-1))
+
+        with self.assertRaises(GTRError):
+            determinize(self.view)
+
+
+class TestSearch(unittest.TestCase):
+    """Test the tree search.
+    """
+
+    def test_search(self):
+        game = random_game(20, 4)
+        name = game.active_player.name
+
+        stats, n_playouts = search(game, name, time_budget=10,
+                max_iterations=20, seed=0)
+
+        self.assertEqual(n_playouts, 20)
+        self.assertEqual(sum(n for _, n, _ in stats), 20)
+
+        legal = set(action_key(a) for a, _ in legal_actions(game))
+        for a, _, _ in stats:
+            self.assertIn(action_key(a), legal)
+
+    def test_choose_action_not_active(self):
+        game = random_game(0, 0)
+        other = next(p for p in game.players if p is not game.active_player)
+        bot = MCTSBot(max_iterations=1, n_processes=0)
+
+        with self.assertRaises(GTRError):
+            bot.choose_action(game, other.name).result()
+
+
+class TestBotPlayer(AsyncTestCase):
+    """Test a bot playing its turns on a GTRServer.
+    """
+
+    def setUp(self):
+        super(TestBotPlayer, self).setUp()
+        self.db = MemoryDatabase()
+        self.db.users = {1: {'username': 'bot'}, 2: {'username': 'p2'}}
+
+        # The first player starts with an empty hand, so it must think.
+        game = Game(game_id=1, host='bot')
+        game.add_player(1, 'bot')
+        game.add_player(2, 'p2')
+        game.controlled_start()
+        self.db.games[1] = encode.game_to_str(game)
+
+        self.server = GTRServer(self.db)
+        self.server.send_commands = lambda u, commands: None
+
+        self.bot = MCTSBot(max_iterations=2, max_rollout_actions=5, seed=0)
+        self.server.add_bot(BotPlayer(self.server, 1, 'bot', self.bot))
+
+    def tearDown(self):
+        self.bot.shutdown()
+        super(TestBotPlayer, self).tearDown()
+
+    def game(self):
+        return encode.str_to_game(self.db.games[1])
+
+    @gen_test(timeout=30)
+    def test_bot_plays_turn(self):
+        yield self.server._retrieve_and_send_game(1, 1)
+
+        # Wait until the server has also finished sending the new state.
+        while (self.game().active_player.uid != 2
+                or self.server._action_queues):
+            yield gen.sleep(0.01)
+
+        game = self.game()
+        self.assertEqual(game.active_player.uid, 2)
+        self.assertEqual(game.action_number, 3)
+        self.assertEqual(self.bot.n_playouts, 4)
+
+    @gen_test
+    def test_bot_waits_for_turn(self):
+        game = self.game()
+        game.active_player_index = 1
+        self.db.games[1] = encode.game_to_str(game)
+
+        yield self.server._retrieve_and_send_game(1, 1)
+
+        # The bot would have started thinking when it received the state.
+        self.assertEqual(self.server.bots[1]._thinking, {})
+        self.assertEqual(self.game().action_number, 1)
+        self.assertEqual(self.bot.n_playouts, 0)
+
+    def test_inline_bot_rejected(self):
+        with self.assertRaises(ValueError):
+            BotPlayer(self.server, 1, 'bot', MCTSBot(n_processes=0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+from cloaca.bot_scheduler import BotScheduler
+from cloaca.game import Game
+from cloaca.server import GTRServer
+import cloaca.encode_binary as encode
+
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+
+from server import MemoryDatabase
+
+import unittest
+
+
+class TestBotScheduler(AsyncTestCase):
+    """Test computing bot moves in the worker processes.
+    """
+
+    def setUp(self):
+        super(TestBotScheduler, self).setUp()
+        self.db = MemoryDatabase()
+        self.db.users = {1: {'username': 'bot'}, 2: {'username': 'p2'}}
+
+        # The first player starts with an empty hand, so it must think,
+        # then choose what to think for.
+        for game_id in range(1, 4):
+            game = Game(game_id=game_id, host='bot')
+            game.add_player(1, 'bot')
+            game.add_player(2, 'p2')
+            game.controlled_start()
+            self.db.games[game_id] = encode.game_to_str(game)
+
+        self.server = GTRServer(self.db)
+        self.server.send_commands = lambda u, commands: None
+
+        self.scheduler = BotScheduler(self.server, max_workers=1,
+                time_budget=0.05, max_rollout_actions=5, seed=0)
+        self.scheduler.add_user(1, 'bot')
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+        super(TestBotScheduler, self).tearDown()
+
+    def game(self, game_id=1):
+        return encode.str_to_game(self.db.games[game_id])
+
+    @gen.coroutine
+    def wait_for_turn(self, user_id, game_ids=(1,)):
+        for _ in range(1000):
+            if all(self.game(i).active_player.uid == user_id
+                    for i in game_ids):
+                break
+            yield gen.sleep(0.01)
+
+    @gen_test(timeout=30)
+    def test_plays_turn(self):
+        yield self.server._retrieve_and_send_game(1, 1)
+        yield self.wait_for_turn(2)
+
+        game = self.game()
+        self.assertEqual(game.active_player.uid, 2)
+        self.assertEqual(game.action_number, 3)
+        self.assertEqual(self.scheduler.stats(), {'n_waiting': 0,
+                'n_running': 0, 'n_moves': 2, 'n_timeouts': 0,
+                'n_errors': 0})
+
+    @gen_test(timeout=30)
+    def test_max_concurrent(self):
+        for game_id in range(1, 4):
+            yield self.server._retrieve_and_send_game(1, game_id)
+
+        stats = self.scheduler.stats()
+        self.assertEqual(stats['n_running'], 1)
+        self.assertEqual(stats['n_waiting'], 2)
+
+        yield self.wait_for_turn(2, range(1, 4))
+
+        self.assertEqual([self.game(i).action_number for i in range(1, 4)],
+                [3, 3, 3])
+        self.assertEqual(self.scheduler.stats()['n_moves'], 6)
+
+    @gen_test
+    def test_duplicate_state(self):
+        self.scheduler.max_concurrent = 0
+        for _ in range(3):
+            yield self.server._retrieve_and_send_game(1, 1)
+
+        self.assertEqual(self.scheduler.stats()['n_waiting'], 1)
+
+    @gen_test
+    def test_not_bot_turn(self):
+        game = self.game()
+        game.active_player_index = 1
+        self.db.games[1] = encode.game_to_str(game)
+
+        yield self.server._retrieve_and_send_game(1, 1)
+
+        self.assertEqual(self.scheduler.stats()['n_waiting'], 0)
+        self.assertEqual(self.scheduler.stats()['n_running'], 0)
+
+    @gen_test(timeout=30)
+    def test_deadline(self):
+        """A move that misses the deadline is replaced by a legal one."""
+        self.scheduler.deadline = 0
+
+        yield self.server._retrieve_and_send_game(1, 1)
+        yield self.wait_for_turn(2)
+
+        self.assertEqual(self.game().active_player.uid, 2)
+        self.assertEqual(self.scheduler.n_timeouts, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
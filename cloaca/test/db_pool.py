@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+from cloaca.db import GTRDBTornadis
+import cloaca.db as db
+from cloaca.error import GTRDBError
+from cloaca import lua_scripts
+import cloaca.archive as archive
+
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+import tornadis
+from tornadis.exceptions import ClientError, ConnectionError
+
+import unittest
+
+
+class FakeClient(tornadis.Client):
+    """Client that replies with the next item of `replies` instead of
+    connecting to Redis. A reply of None never arrives.
+    """
+
+    def __init__(self, replies, calls):
+        super(FakeClient, self).__init__()
+        self.replies = replies
+        self.calls = calls
+        self.connected = True
+
+    def is_connected(self):
+        return self.connected
+
+    def disconnect(self):
+        self.connected = False
+
+    def call(self, *args):
+        self.calls.append(args)
+        reply = self.replies.pop(0)
+        if reply is None:
+            return gen.Future()
+        return gen.maybe_future(reply)
+
+
+class FakePool(object):
+    """Stands in for tornadis.ClientPool, handing out FakeClients."""
+
+    def __init__(self, replies):
+        self.replies = replies
+        self.calls = []
+        self.clients = []
+        self.n_released = 0
+
+    @gen.coroutine
+    def get_connected_client(self):
+        client = FakeClient(self.replies, self.calls)
+        self.clients.append(client)
+        raise gen.Return(client)
+
+    def release_client(self, client):
+        self.n_released += 1
+
+    def destroy(self):
+        pass
+
+
+class TestConnectionPool(AsyncTestCase):
+    """Test timeouts, retries and script fallback of database calls.
+    """
+
+    def setUp(self):
+        super(TestConnectionPool, self).setUp()
+        self.db = GTRDBTornadis(call_timeout=0.01)
+
+    def use_replies(self, *replies):
+        self.db.pool = FakePool(list(replies))
+        return self.db.pool
+
+    @gen_test
+    def test_reply(self):
+        pool = self.use_replies('data')
+
+        res = yield self.db._call('GET', 'key')
+
+        self.assertEqual(res, 'data')
+        self.assertEqual(pool.calls, [('GET', 'key')])
+        self.assertEqual(pool.n_released, 1)
+
+    @gen_test
+    def test_read_retried_after_timeout(self):
+        pool = self.use_replies(None, 'data')
+
+        res = yield self.db._call('GET', 'key')
+
+        self.assertEqual(res, 'data')
+        self.assertEqual(len(pool.calls), 2)
+        self.assertFalse(pool.clients[0].is_connected())
+        self.assertEqual(pool.n_released, 2)
+
+    @gen_test
+    def test_read_retried_after_connection_error(self):
+        pool = self.use_replies(ConnectionError('closed'), 'data')
+
+        res = yield self.db._call('HGET', 'key', 'field')
+
+        self.assertEqual(res, 'data')
+        self.assertEqual(len(pool.calls), 2)
+
+    @gen_test
+    def test_write_not_retried(self):
+        pool = self.use_replies(None, 'OK')
+
+        with self.assertRaises(GTRDBError):
+            yield self.db._call('SET', 'key', 'value')
+
+        self.assertEqual(len(pool.calls), 1)
+        self.assertFalse(pool.clients[0].is_connected())
+
+    @gen_test
+    def test_write_connection_error_returned(self):
+        self.use_replies(ConnectionError('closed'), 'OK')
+
+        res = yield self.db._call('SET', 'key', 'value')
+
+        self.assertIsInstance(res, ConnectionError)
+
+    @gen_test
+    def test_read_timeout_raised_after_retry(self):
+        self.use_replies(None, None)
+
+        with self.assertRaises(GTRDBError):
+            yield self.db._call('GET', 'key')
+
+    @gen_test
+    def test_noscript_falls_back_to_eval(self):
+        self.db.scripts_sha['release_lock'] = 'abc'
+        pool = self.use_replies(ClientError('NOSCRIPT No matching script.'), 1)
+
+        res = yield self.db._eval_script('release_lock', ('lock',), ('t',))
+
+        self.assertEqual(res, 1)
+        self.assertEqual(pool.calls, [
+                ('EVALSHA', 'abc', 1, 'lock', 't'),
+                ('EVAL', lua_scripts.RELEASE_LOCK, 1, 'lock', 't'),
+                ])
+
+    @gen_test
+    def test_script_error_returned(self):
+        self.db.scripts_sha['release_lock'] = 'abc'
+        pool = self.use_replies(ClientError('ERR bad'))
+
+        res = yield self.db._eval_script('release_lock', ('lock',), ('t',))
+
+        self.assertIsInstance(res, ClientError)
+        self.assertEqual(len(pool.calls), 1)
+
+
+class TestKeyPrefix(AsyncTestCase):
+    """Test the key layout and that Lua scripts are given the key prefix
+    for the keys they generate.
+    """
+
+    def setUp(self):
+        super(TestKeyPrefix, self).setUp()
+        self.db = GTRDBTornadis(prefix='t1:')
+
+    def test_game_keys_share_hash_tag(self):
+        keys = (self.db._log_keys(7) + (
+                self.db._game_key(db.GAME_KEY, 7),
+                self.db._game_key(db.GAME_MOVES_KEY, 7),
+                self.db._game_key(db.GAME_ACTION_LOG_KEY, 7),
+                self.db._game_key(db.GAME_LOCK_KEY, 7)))
+
+        self.assertEqual(len(set(keys)), len(keys))
+        for k in keys:
+            self.assertTrue(k.startswith('t1:{game:7}'), k)
+
+    @gen_test
+    def test_create_game(self):
+        self.db.pool = pool = FakePool([1, 7, 'OK', [1, 1, 1]])
+
+        game_id = yield self.db.create_game_with_host(1)
+
+        self.assertEqual(game_id, 7)
+        self.assertEqual(pool.calls[0], ('EXISTS', 't1:user:1'))
+        self.assertEqual(pool.calls[1], ('INCR', 't1:gameid'))
+        self.assertEqual(pool.calls[2][:4], ('HMSET', 't1:{game:7}', 'host', 1))
+        self.assertEqual(pool.calls[3][0].pipelined_args, [
+                ('LPUSH', 't1:games_hosted:1', 7),
+                ('LPUSH', 't1:games', 7),
+                ('LPUSH', 't1:game_hosts', 1),
+                ])
+
+    @gen_test
+    def test_create_game_without_host(self):
+        self.db.pool = pool = FakePool([0])
+
+        with self.assertRaises(GTRDBError):
+            yield self.db.create_game_with_host(1)
+
+        self.assertEqual(len(pool.calls), 1)
+
+    @gen_test
+    def test_store_game_actions(self):
+        self.db.pool = pool = FakePool([12])
+
+        n_bytes = yield self.db.store_game_actions(7, 'game', 'h', 'actions')
+
+        self.assertEqual(n_bytes, 12)
+        self.assertEqual(pool.calls[0], ('EVAL',
+                lua_scripts.STORE_GAME_ACTIONS, 2, 't1:{game:7}',
+                't1:{game:7}:action_log', 'game', 'h', 'actions'))
+
+    @gen_test
+    def test_register_user(self):
+        self.db.pool = pool = FakePool([3, 1, 1])
+
+        user_id = yield self.db.register_user('p1')
+
+        self.assertEqual(user_id, 3)
+        self.assertEqual(pool.calls, [
+                ('INCR', 't1:userid'),
+                ('HSETNX', 't1:usernames', 'p1', 3),
+                ('HSET', 't1:user:3', 'username', 'p1'),
+                ])
+
+    @gen_test
+    def test_register_existing_user(self):
+        self.db.pool = pool = FakePool([4, 0, '3'])
+
+        with self.assertRaises(GTRDBError):
+            yield self.db.register_user('p1')
+
+        self.assertEqual(pool.calls[2], ('HGET', 't1:usernames', 'p1'))
+        self.assertEqual(len(pool.calls), 3)
+
+    @gen_test
+    def test_unknown_username(self):
+        # A reply of None never arrives, so send it as a future.
+        nil = gen.Future()
+        nil.set_result(None)
+        self.db.pool = FakePool([nil, '5'])
+
+        user_id = yield self.db.retrieve_user_id_from_username('p1')
+        self.assertIsNone(user_id)
+        user_id = yield self.db.retrieve_user_id_from_username('p2')
+        self.assertEqual(user_id, 5)
+
+
+class TestArchiveGame(AsyncTestCase):
+    """Test archiving a game and reading it back from the archive.
+    """
+
+    def setUp(self):
+        super(TestArchiveGame, self).setUp()
+        self.db = GTRDBTornadis()
+
+    @gen_test
+    def test_hash_actions_archived(self):
+        """Actions only in the legacy hash of actions are kept."""
+        self.db.pool = pool = FakePool([
+                ['game data', None, ['1', 'action 1', '2', 'action 2']],
+                [2, None],
+                [2, 0, 0, 0, 'm2', 'm1'],
+                1])
+
+        n_bytes = yield self.db.archive_game(7)
+
+        self.assertIsNotNone(n_bytes)
+        self.assertEqual(pool.calls[0][0].pipelined_args[2],
+                ('HGETALL', '{game:7}:actions'))
+
+        eval_args = pool.calls[3]
+        self.assertEqual(eval_args[:4], ('EVAL', lua_scripts.ARCHIVE_GAME, 6,
+                '{game:7}'))
+        self.assertIn('{game:7}:actions', eval_args[4:10])
+
+        bundle = eval_args[-1]
+        self.assertEqual(archive.decode_archive_game(bundle), 'game data')
+        self.assertEqual(archive.decode_archive_log(bundle), (0, ['m1', 'm2']))
+        self.assertEqual(archive.decode_archive_legacy_actions(bundle),
+                {1: 'action 1', 2: 'action 2'})
+
+        # The hash is deleted by the script, so reads use the archive.
+        self.db.pool = FakePool([[None, None, None], bundle])
+
+        actions = yield self.db.retrieve_game_actions(7, [1, 2, 3])
+        self.assertEqual(actions, ['action 1', 'action 2', None])
+
+
+if __name__ == '__main__':
+    unittest.main()
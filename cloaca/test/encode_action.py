@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+from cloaca.card import Card
+from cloaca.message import GameAction, _action_args_dict
+import cloaca.message as message
+import cloaca.encode_action as encode_action
+from cloaca.encode_binary import GTREncodingError
+
+import unittest
+
+def example_args(action):
+    """Return a list of valid arguments for the action type, with two
+    extra arguments if the action allows them.
+    """
+    spec = _action_args_dict[action]
+
+    def example(type_, name):
+        if type_ is Card:
+            return Card(42)
+        elif type_ is bool:
+            return True
+        elif type_ is int:
+            return 3
+        elif name == 'role':
+            return 'Legionary'
+        elif name == 'site':
+            return 'Brick'
+        else:
+            return u'some text \xe9'
+
+    args = [example(*s) for s in spec.required_arg_specs]
+    if spec.has_extended:
+        args += [example(*spec.extended_arg_spec)]*2
+
+    return args
+
+
+class TestBinaryActionEncoding(unittest.TestCase):
+    """Test encoding and decoding GameActions with the binary format.
+    """
+
+    def test_round_trip_all_actions(self):
+        for action in _action_args_dict:
+            a = GameAction(action, *example_args(action))
+            s = encode_action.encode_action(a)
+
+            n, decoded = encode_action.decode_action(s, 0)
+
+            self.assertEqual(n, len(s))
+            self.assertEqual(decoded, a)
+
+    def test_none_args(self):
+        a = GameAction(message.ARCHITECT, None, None, None)
+        n, decoded = encode_action.decode_action(
+                encode_action.encode_action(a), 0)
+        self.assertEqual(decoded, a)
+
+        a = GameAction(message.REQGAMELOG, None, 5)
+        n, decoded = encode_action.decode_action(
+                encode_action.encode_action(a), 0)
+        self.assertEqual(decoded, a)
+
+    def test_size(self):
+        """One byte for the action, count, role and each card."""
+        a = GameAction(message.LEADROLE, 'Laborer', 1, 3, 4)
+        self.assertEqual(len(encode_action.encode_action(a)), 1+1+1+4+2)
+
+        a = GameAction(message.ARCHITECT, 10, 20, 'Wood')
+        self.assertEqual(len(encode_action.encode_action(a)), 4)
+
+    def test_truncated(self):
+        a = GameAction(message.LEGIONARY, 3, 4)
+        s = encode_action.encode_action(a)
+
+        with self.assertRaises(GTREncodingError):
+            encode_action.decode_action(s[:-1], 0)
+
+    def test_invalid_action(self):
+        with self.assertRaises(GTREncodingError):
+            encode_action.decode_action(chr(200), 0)
+
+
+class TestActionLog(unittest.TestCase):
+    """Test the versioned action log.
+    """
+
+    def test_decode_log(self):
+        actions = [
+                GameAction(message.THINKERORLEAD, False),
+                GameAction(message.LEADROLE, 'Merchant', 1, 7),
+                GameAction(message.MERCHANT, False, 12),
+                ]
+
+        s = encode_action.encode_action_log_header(5)
+        s += encode_action.encode_actions(actions[:1])
+        s += encode_action.encode_actions(actions[1:])
+
+        first, decoded = encode_action.decode_action_log(s)
+
+        self.assertEqual(first, 5)
+        self.assertEqual(decoded, actions)
+
+    def test_empty_log(self):
+        s = encode_action.encode_action_log_header(1)
+        self.assertEqual(encode_action.decode_action_log(s), (1, []))
+
+    def test_bad_version(self):
+        s = encode_action.encode_action_log_header(1)
+        s = chr(encode_action.ACTION_LOG_VERSION+1) + s[1:]
+
+        with self.assertRaises(GTREncodingError):
+            encode_action.decode_action_log(s)
+
+
+class TestJSONActionEncoding(unittest.TestCase):
+    """Test decoding the JSON action format.
+    """
+
+    def test_round_trip(self):
+        actions = [
+                GameAction(message.THINKERORLEAD, True),
+                GameAction(message.LEADROLE, 'Craftsman', 1, 3, 4),
+                GameAction(message.CRAFTSMAN, 10, 20, 'Concrete'),
+                GameAction(message.LABORER, None, 8),
+                ]
+
+        for a in actions:
+            s = encode_action.game_action_to_str(a)
+            self.assertEqual(encode_action.str_to_game_action(s), a)
+
+    def test_invalid(self):
+        with self.assertRaises(GTREncodingError):
+            encode_action.str_to_game_action('[200]')
+
+        with self.assertRaises(GTREncodingError):
+            encode_action.str_to_game_action('not json')
+
+
+if __name__ == '__main__':
+    unittest.main()
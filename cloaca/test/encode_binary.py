@@ -604,6 +604,81 @@ class TestEncodingFormat(unittest.TestCase):
         bytes = bytearray([0,2,0,1,0,0])
         self.assertEqual(out_of_town_sites, str(bytes))
 
+
+
+class TestPeekGameMetadata(unittest.TestCase):
+    """Test reading game metadata without decoding the full game.
+    """
+
+    def setUp(self):
+        self.game = Game(game_id=7, host='p0')
+        self.game.add_player(0, 'p0')
+        self.game.add_player(1, 'p1')
+        self.game.start()
+
+    def assertMetadataMatches(self, game):
+        metadata = encode.peek_game_metadata(encode.game_to_str(game))
+
+        self.assertEqual(metadata['game_id'], game.game_id)
+        self.assertEqual(metadata['turn_number'], game.turn_number)
+        self.assertEqual(metadata['action_number'], game.action_number)
+        self.assertEqual(metadata['host'], game.host)
+        self.assertEqual(metadata['players'], [p.name for p in game.players])
+        self.assertEqual(metadata['player_uids'], [p.uid for p in game.players])
+        self.assertEqual(metadata['winners'], [p.name for p in game.winners])
+        self.assertEqual(metadata['started'], game.started)
+        self.assertEqual(metadata['finished'], game.finished)
+
+    def test_empty_game(self):
+        self.assertMetadataMatches(Game())
+
+    def test_unstarted_game(self):
+        game = Game(host='p0')
+        game.add_player(0, 'p0')
+        self.assertMetadataMatches(game)
+
+    def test_started_game(self):
+        self.assertMetadataMatches(self.game)
+
+    def test_privatized_game(self):
+        for p in self.game.players:
+            self.assertMetadataMatches(
+                    self.game.privatized_game_state_copy(p.name))
+
+    def test_buildings_and_clients(self):
+        d = TestDeck()
+        p0 = self.game.players[0]
+        p0.buildings.append(Building(d.temple0, 'Marble',
+                materials=[d.atrium0], stairway_materials=[d.road0]))
+        p0.clientele.set_content([d.dock0, d.wall0])
+        p0.vault.set_content([d.bridge0])
+        self.assertMetadataMatches(self.game)
+
+    def test_winners(self):
+        self.game.winners = [self.game.players[1]]
+        self.assertMetadataMatches(self.game)
+
+    def test_matches_full_decode(self):
+        game = encode.str_to_game(encode.game_to_str(self.game))
+        self.assertMetadataMatches(game)
+
+    def test_invalid_header(self):
+        game_encoded = base64.b64encode(struct.pack('!IIi', 0, 1, 0))
+
+        with self.assertRaises(encode.GTREncodingError):
+            encode.peek_game_metadata(game_encoded)
+
+    def test_truncated_record(self):
+        game_bytes = encode.encode_game(self.game)
+        game_encoded = base64.b64encode(game_bytes[:60])
+
+        with self.assertRaises(encode.GTREncodingError):
+            encode.peek_game_metadata(game_encoded)
+
+    def test_empty_record(self):
+        with self.assertRaises(encode.GTREncodingError):
+            encode.peek_game_metadata('')
+
     
 class TestEncodingErrors(unittest.TestCase):
 
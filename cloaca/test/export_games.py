@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+from cloaca.game import Game
+from cloaca.building import Building
+from cloaca.message import GameAction
+import cloaca.message as message
+import cloaca.archive as archive
+import cloaca.encode_binary as encode
+import cloaca.encode_action as encode_action
+import cloaca.export_games as export_games
+from cloaca.export_games import GAME_COLUMNS, BUILDING_COLUMNS, numpy
+
+from migrate_keys import FakeRedis
+
+import unittest
+import os
+import shutil
+import tempfile
+
+
+class TestExportRows(unittest.TestCase):
+    """Test the rows extracted from each game for the columnar export.
+    """
+
+    def setUp(self):
+        self.game = Game(game_id=7, host='p1')
+        self.game.add_player(1, 'p1')
+        self.game.add_player(2, 'p2')
+        self.game.start()
+
+        self.game_data = encode.game_to_str(self.game)
+        self.action_log = (encode_action.encode_action_log_header(1)
+                + encode_action.encode_actions([
+                    GameAction(message.THINKERORLEAD, False),
+                    GameAction(message.LEADROLE, 'Laborer', 1, 3),
+                    GameAction(message.FOLLOWROLE, 0),
+                    GameAction(message.THINKERORLEAD, True),
+                    ]))
+
+    def test_game_row(self):
+        game_row, building_rows = export_games.game_rows(
+                7, self.game_data, self.action_log)
+
+        row = dict(zip(GAME_COLUMNS, game_row))
+        self.assertEqual(row['game_id'], 7)
+        self.assertEqual(row['n_players'], 2)
+        self.assertEqual(row['turn_number'], self.game.turn_number)
+        self.assertFalse(row['finished'])
+        self.assertEqual(row['led_laborer'], 1)
+        self.assertEqual(row['led_patron'], 0)
+        self.assertEqual(row['n_thinker'], 1)
+        self.assertEqual(row['n_followed'], 0)
+
+        self.assertEqual(building_rows, [])
+
+    def test_building_rows(self):
+        p = self.game.players[1]
+        p.buildings.append(Building(
+            self.game.library.pop(), 'Wood', complete=True))
+        game_data = encode.game_to_str(self.game)
+
+        _, building_rows = export_games.game_rows(7, game_data, None)
+
+        self.assertEqual(len(building_rows), 1)
+        row = dict(zip(BUILDING_COLUMNS, building_rows[0]))
+        self.assertEqual(row['player_index'], 1)
+        self.assertEqual(row['site'], 'Wood')
+        self.assertTrue(row['complete'])
+        self.assertFalse(row['winner'])
+
+    def test_decode_chunk(self):
+        """Archived games are decoded from the bundle, and corrupted games
+        are reported as failed.
+        """
+        bundle = archive.encode_archive(self.game_data, self.action_log, [])
+        chunk = [
+                (1, self.game_data, self.action_log, None),
+                (2, None, None, bundle),
+                (3, 'not a game', None, None),
+                ]
+
+        game_rows, _, failed = export_games._decode_chunk(chunk)
+
+        self.assertEqual([r[0] for r in game_rows], [1, 2])
+        self.assertEqual(game_rows[0][1:], game_rows[1][1:])
+        self.assertEqual(failed, [3])
+
+    def test_checksum(self):
+        a = export_games.checksum(self.game_data, None, None)
+        b = export_games.checksum(self.game_data, self.action_log, None)
+        self.assertNotEqual(a, b)
+        self.assertEqual(a, export_games.checksum(self.game_data, '', None))
+
+
+class ExportRedis(FakeRedis):
+    """FakeRedis with the reads used by export_games."""
+
+    def hmget(self, key, *fields):
+        h = self.data.get(key, {})
+        return [h.get(f) for f in fields]
+
+    def get(self, key):
+        return self.data.get(key)
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestExport(unittest.TestCase):
+    """Test exporting games from a fake Redis client and loading the
+    tables back.
+    """
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+
+        game = Game(game_id=1, host='p1')
+        game.add_player(1, 'p1')
+        game.add_player(2, 'p2')
+        game.start()
+        self.game_data = encode.game_to_str(game)
+
+        game.players[0].buildings.append(Building(
+            game.library.pop(), 'Rubble', complete=False))
+        bundle = archive.encode_archive(encode.game_to_str(game), None, [])
+
+        self.r = ExportRedis({
+                'p:games': ['2', '1'],
+                'p:{game:1}': {'game_data': self.game_data},
+                'p:{game:2}': {'archive': bundle},
+                })
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def load(self, table, part=1):
+        path = os.path.join(self.out_dir, '{0}-{1:05d}.npz'.format(table, part))
+        with numpy.load(path) as f:
+            return dict(f.items())
+
+    def test_round_trip(self):
+        n_games, failed = export_games.export(self.r, self.out_dir,
+                processes=1, chunk_size=1, prefix='p:')
+
+        self.assertEqual((n_games, failed), (2, []))
+
+        games = self.load('games')
+        self.assertEqual(sorted(games), sorted(GAME_COLUMNS))
+        self.assertEqual(list(games['game_id']), [1, 2])
+        self.assertEqual(list(games['n_players']), [2, 2])
+        self.assertEqual(games['finished'].dtype, numpy.bool_)
+
+        buildings = self.load('buildings')
+        self.assertEqual(list(buildings['game_id']), [2])
+        self.assertEqual(list(buildings['site']), ['Rubble'])
+
+    def test_unchanged_games_skipped(self):
+        export_games.export(self.r, self.out_dir, processes=1, prefix='p:')
+        n_games, _ = export_games.export(self.r, self.out_dir, processes=1,
+                prefix='p:')
+
+        self.assertEqual(n_games, 0)
+        self.assertFalse(os.path.exists(
+                os.path.join(self.out_dir, 'games-00002.npz')))
+
+    def test_empty_table_types(self):
+        del self.r.data['p:{game:2}']
+
+        export_games.export(self.r, self.out_dir, processes=1, prefix='p:')
+
+        buildings = self.load('buildings')
+        self.assertEqual(len(buildings['game_id']), 0)
+        self.assertEqual(buildings['game_id'].dtype, numpy.int64)
+        self.assertEqual(buildings['complete'].dtype, numpy.bool_)
+        self.assertEqual(buildings['building'].dtype.kind, 'S')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,7 @@
 from cloaca.game import Game
 from cloaca.player import Player
 from cloaca.building import Building
+from cloaca.card import Card
 
 import cloaca.message as message
 from cloaca.message import GameAction, Command
@@ -13,6 +14,8 @@ import cloaca.test.test_setup as test_setup
 
 import json
 import unittest
+import struct
+import base64
 
 class TestGameActionJSON(unittest.TestCase):
     """Test GameAction conversion to and from JSON.
@@ -79,6 +82,87 @@ class TestGameActionJSON(unittest.TestCase):
             a = GameAction.from_json('{"action": 0, "args": [true, false]}')
 
 
+    def test_error_messages(self):
+        """Errors from argument validation are reported with the
+        argument index, name and types.
+        """
+        cases = [
+            (message.THINKERORLEAD, [],
+                'Number of args for thinkerorlead doesn\'t match '
+                '(args=[], n_args must be 1)'),
+            (message.LEADROLE, [u'Laborer'],
+                'Number of args for leadrole doesn\'t match '
+                '(args=[u\'Laborer\'], n_args must be >= 2)'),
+            (message.THINKERORLEAD, [None],
+                'Argument 0 ("do_thinker") must be boolean (received None)'),
+            (message.THINKERORLEAD, [1],
+                'Argument 0 ("do_thinker"), 1 doesn\'t match type '
+                '(<type \'bool\'> != <type \'int\'>)'),
+            (message.LEADROLE, [u'Laborer', 1, 3, u'x'],
+                'Argument 3 ("cards"), x doesn\'t match type '
+                '(<class \'cloaca.card_manager.Card\'> != <type \'unicode\'>)'),
+            (message.MERCHANT, [False, True],
+                'Argument 1 ("cards"), True doesn\'t match type '
+                '(<class \'cloaca.card_manager.Card\'> != <type \'bool\'>)'),
+            ]
+
+        for action, args, msg in cases:
+            with self.assertRaises(GameActionError) as cm:
+                GameAction(action, *args)
+
+            self.assertEqual(cm.exception.message, msg)
+
+    def test_convert_cards(self):
+        """Card arguments sent as ints are converted to Card objects.
+        Other arguments and None are unchanged.
+        """
+        a = GameAction(message.LEADROLE, u'Laborer', 1, 3, None, Card(5))
+
+        self.assertEqual(a.args[:2], [u'Laborer', 1])
+        self.assertEqual(type(a.args[2]), Card)
+        self.assertEqual(a.args[2].ident, 3)
+        self.assertIsNone(a.args[3])
+        self.assertEqual(a.args[4].ident, 5)
+
+    def test_json_backends_agree(self):
+        """Messages are decoded the same way with or without ujson."""
+        strings = [
+            '{"game":1, "number": 0, "action":{"action": 0, "args": [true]}}',
+            '{"game":1, "number": 0, "action":{"action": 0, "args": [1e400]}}',
+            '[1, 123456789012345678901234567890]',
+            '{"act]]]}',
+            ]
+
+        ujson = message.ujson
+        try:
+            for s in strings:
+                results = []
+                for backend in [ujson, None]:
+                    message.ujson = backend
+                    try:
+                        results.append(message._json_loads(s))
+                    except ValueError:
+                        results.append(ValueError)
+
+                self.assertEqual(results[0], results[1])
+        finally:
+            message.ujson = ujson
+
+    @unittest.skipIf(message.ujson is None, 'ujson is not installed')
+    def test_ujson_leniency(self):
+        """Inputs that ujson accepts although json rejects or decodes
+        them differently. See the note in cloaca.message.
+        """
+        self.assertEqual(message._json_loads('[01]'), [1])
+        self.assertEqual(message._json_loads('{"a":1,}'), {u'a': 1})
+        self.assertEqual(message._json_loads('["\\ud800"]'), [u''])
+
+        for s in ['[01]', '{"a":1,}']:
+            with self.assertRaises(ValueError):
+                json.loads(s)
+        self.assertEqual(json.loads('["\\ud800"]'), [u'\ud800'])
+
+
 class TestCommandJSON(unittest.TestCase):
     """Test Command conversion to and from JSON.
     """
@@ -186,6 +270,103 @@ class TestCommandJSON(unittest.TestCase):
             commands = Command.from_json(list_json)
 
 
+class TestCommandBinary(unittest.TestCase):
+    """Test Command conversion to and from the binary envelope format.
+    """
+
+    def test_round_trip(self):
+        a = GameAction(message.LEADROLE, 'Craftsman', 1, 106, 107)
+        c = Command(3, 12, a)
+
+        c2 = Command.from_binary(c.to_binary())
+
+        self.assertEqual(c2.game, 3)
+        self.assertEqual(c2.number, 12)
+        self.assertEqual(c2.action, a)
+
+    def test_none_game_and_number(self):
+        a = GameAction(message.SERVERERROR, 'Error message')
+        c = Command(None, None, a)
+
+        c2 = Command.from_binary(c.to_binary())
+
+        self.assertIsNone(c2.game)
+        self.assertIsNone(c2.number)
+        self.assertEqual(c2.action, a)
+
+    def test_gamestate_sent_as_raw_bytes(self):
+        raw = '\x89GtR\x00\x01\xff\xfe'
+        a = GameAction(message.GAMESTATE, base64.b64encode(raw))
+        c = Command(1, None, a)
+
+        c_binary = c.to_binary()
+
+        self.assertEqual(c_binary, struct.pack('!iiB', 1, -1, message.GAMESTATE) + raw)
+        self.assertEqual(Command.from_binary(c_binary).action, a)
+
+    def test_empty_gamestate(self):
+        a = GameAction(message.GAMESTATE, '')
+        c = Command(1, None, a)
+
+        c2 = Command.from_binary(c.to_binary())
+        self.assertEqual(c2.action.args, [''])
+
+    def test_smaller_than_json(self):
+        a = GameAction(message.GAMESTATE, base64.b64encode('\x00'*300))
+        c = Command(1, None, a)
+
+        self.assertLess(len(c.to_binary()), len(c.to_json()))
+
+    def test_from_bad_binary(self):
+        with self.assertRaises(ParsingError):
+            Command.from_binary('\x00\x01')
+
+        with self.assertRaises(ParsingError):
+            Command.from_binary(struct.pack('!iiB', 1, 1, message.LEGIONARY) + '[1,')
+
+
+class TestCommandBatchEncoding(unittest.TestCase):
+    """Test encoding several Commands in a single message.
+    """
+
+    def setUp(self):
+        self.commands = [
+                Command(1, None, GameAction(message.GAMESTATE,
+                    base64.b64encode('\x01\x02\x03'))),
+                Command(1, None, GameAction(message.GAMELOG, 10, 8,
+                    'message 1\nmessage 2')),
+                Command(None, None, GameAction(message.SERVERERROR, 'Error')),
+                ]
+
+    def test_binary_round_trip(self):
+        s = message.commands_to_binary(self.commands)
+        commands = message.commands_from_binary(s)
+
+        self.assertEqual(len(commands), 3)
+        for c, c_orig in zip(commands, self.commands):
+            self.assertEqual(c.game, c_orig.game)
+            self.assertEqual(c.number, c_orig.number)
+            self.assertEqual(c.action, c_orig.action)
+
+    def test_binary_truncated(self):
+        s = message.commands_to_binary(self.commands)
+
+        with self.assertRaises(ParsingError):
+            message.commands_from_binary(s[:-1])
+
+    def test_json_list(self):
+        s = message.commands_to_json(self.commands)
+        d = json.loads(s)
+
+        self.assertEqual(len(d), 3)
+        self.assertEqual([c['action']['action'] for c in d],
+                [message.GAMESTATE, message.GAMELOG, message.SERVERERROR])
+
+    def test_json_single_command(self):
+        s = message.commands_to_json(self.commands[:1])
+
+        self.assertEqual(s, self.commands[0].to_json())
+
 
 if __name__ == '__main__':
     unittest.main()
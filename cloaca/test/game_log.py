@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+
+from cloaca.db import (GTRDBTornadis, assemble_log_range, LOG_BLOCK_SIZE,
+        LOG_TAIL_MAX_LENGTH, SCRIPTS)
+
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+
+import binascii
+import os
+import socket
+import unittest
+
+try:
+    import lupa
+except ImportError:
+    lupa = None
+
+B = LOG_BLOCK_SIZE
+
+
+def redis_available(host='localhost', port=6379):
+    """Return True if a Redis server accepts connections at host:port."""
+    try:
+        socket.create_connection((host, port), 0.2).close()
+    except socket.error:
+        return False
+    return True
+
+
+def lua_script(lua, text):
+    """Return a function (redis, keys, args) that runs the Lua script
+    `text` on the lupa LuaRuntime `lua` the way Redis EVAL does. Commands
+    go to the ScriptRedis `redis` with their arguments as strings, and
+    the reply is converted like Redis replies: numbers to integers, false
+    to None and tables to lists.
+    """
+    lua.execute('unpack = unpack or table.unpack')
+    run = lua.eval('function(redis, KEYS, ARGV)\n' + text + '\nend')
+
+    def to_lua(value):
+        if isinstance(value, list):
+            return lua.table(*[False if v is None else to_lua(v)
+                    for v in value])
+        return value
+
+    def from_lua(value):
+        if lupa.lua_type(value) == 'table':
+            return [from_lua(value[i]) for i in range(1, len(value)+1)]
+        elif value is False:
+            return None
+        elif isinstance(value, (int, long, float)):
+            return int(value)
+        return value
+
+    def arg_to_str(arg):
+        if isinstance(arg, float):
+            return '%.17g' % arg
+        return unicode(arg)
+
+    def call(redis, keys, args):
+        redis_table = lua.table(call=lambda command, *args: to_lua(
+                redis.call(command, *map(arg_to_str, args))))
+        return from_lua(run(redis_table, lua.table(*keys),
+                lua.table(*map(arg_to_str, args))))
+
+    return call
+
+
+class ScriptRedis(object):
+    """The Redis commands used by the log scripts, on lists and hashes
+    kept in memory. Values are stored as strings, like Redis does.
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def _range(self, key, start, stop):
+        """Return the slice of list `key` that LRANGE and LTRIM use."""
+        n = len(self.data.get(key, []))
+        start = max(start + n if start < 0 else start, 0)
+        stop = min(stop + n if stop < 0 else stop, n - 1)
+        return slice(start, max(stop + 1, start))
+
+    def call(self, command, key, *args):
+        if command == 'LPUSH':
+            self.data.setdefault(key, []).insert(0, str(args[0]))
+        elif command == 'LLEN':
+            return len(self.data.get(key, []))
+        elif command == 'LRANGE':
+            return self.data.get(key, [])[self._range(key, *map(int, args))]
+        elif command == 'LTRIM':
+            self.data[key] = self.data.get(key,
+                    [])[self._range(key, *map(int, args))]
+        elif command == 'HSET':
+            self.data.setdefault(key, {})[str(args[0])] = str(args[1])
+        elif command == 'HGET':
+            return self.data.get(key, {}).get(str(args[0]))
+        elif command == 'HMGET':
+            return [self.data.get(key, {}).get(str(f)) for f in args]
+        elif command == 'HDEL':
+            self.data.get(key, {}).pop(str(args[0]), None)
+        else:
+            raise ValueError(command)
+
+
+# Line-by-line ports of lua_scripts.APPEND_LOG and READ_LOG, used by
+# TestLogScripts. Lua lists are 1-based and a missing value (false) is None.
+# TestLuaLogScripts and TestRedisLogScripts run the same tests on the
+# scripts themselves.
+
+def append_log(redis, KEYS, ARGV):
+    block_size = int(ARGV[0])
+    tail_max = int(ARGV[1])
+    max_blocks = int(ARGV[2])
+
+    for message in ARGV[3:]:
+        redis.call("LPUSH", KEYS[0], message)
+
+    tail_length = redis.call("LLEN", KEYS[0])
+    compacted = int(redis.call("HGET", KEYS[2], "compacted") or 0)
+
+    while tail_length > tail_max:
+        oldest = redis.call("LRANGE", KEYS[0], -block_size, -1)
+        block = list(reversed(oldest))
+
+        index = compacted // block_size
+        redis.call("HSET", KEYS[1], index, "\n".join(block))
+        redis.call("LTRIM", KEYS[0], 0, -block_size-1)
+
+        if max_blocks > 0 and index >= max_blocks:
+            redis.call("HDEL", KEYS[1], index - max_blocks)
+
+        compacted = compacted + block_size
+        tail_length = tail_length - block_size
+
+    redis.call("HSET", KEYS[2], "compacted", compacted)
+    return compacted + tail_length
+
+
+def read_log(redis, KEYS, ARGV):
+    n_start = int(ARGV[0])
+    n_messages = int(ARGV[1])
+    block_size = int(ARGV[2])
+
+    compacted = int(redis.call("HGET", KEYS[2], "compacted") or 0)
+    total = compacted + redis.call("LLEN", KEYS[0])
+    stop = min(n_start + n_messages, total)
+    first_block = n_start // block_size
+
+    result = [total, compacted, first_block, 0]
+    if n_start >= stop:
+        return result
+
+    if n_start < compacted:
+        last_block = (min(stop, compacted) - 1) // block_size
+        fields = range(first_block, last_block + 1)
+
+        blocks = redis.call("HMGET", KEYS[1], *fields)
+        result[3] = len(blocks)
+        result.extend(blocks)
+
+    if stop > compacted:
+        a = max(n_start, compacted) - compacted
+        b = stop - compacted - 1
+        result.extend(redis.call("LRANGE", KEYS[0], -(b+1), -(a+1)))
+
+    return result
+
+
+def messages(first, last):
+    return [str(i) for i in range(first, last)]
+
+
+def block(first, last):
+    """Compacted block of messages <first> to <last>-1."""
+    return '\n'.join(str(i) for i in range(first, last))
+
+
+def tail(first, last):
+    """Tail messages <first> to <last>-1, newest first, as LRANGE returns
+    them.
+    """
+    return [str(i) for i in reversed(range(first, last))]
+
+
+class TestAssembleLogRange(unittest.TestCase):
+    """Test combining blocks and the tail read by the read_log script.
+    """
+
+    def test_tail_only(self):
+        reply = [10, 0, 0, 0] + tail(3, 8)
+        n_total, n_first, messages = assemble_log_range(reply, 5, 3)
+
+        self.assertEqual(n_total, 10)
+        self.assertEqual(n_first, 3)
+        self.assertEqual(messages, [str(i) for i in range(3, 8)])
+
+    def test_blocks_and_tail(self):
+        total = 2*B + 20
+        n_start = B - 5
+        reply = ([total, 2*B, 0, 2, block(0, B), block(B, 2*B)]
+                + tail(2*B, 2*B+10))
+
+        n_total, n_first, messages = assemble_log_range(reply, B+15, n_start)
+
+        self.assertEqual(n_total, total)
+        self.assertEqual(n_first, n_start)
+        self.assertEqual(messages, [str(i) for i in range(n_start, 2*B+10)])
+
+    def test_within_block(self):
+        reply = [3*B, 2*B, 1, 1, block(B, 2*B)]
+        n_total, n_first, messages = assemble_log_range(reply, 4, B+2)
+
+        self.assertEqual(n_first, B+2)
+        self.assertEqual(messages, [str(i) for i in range(B+2, B+6)])
+
+    def test_dropped_blocks(self):
+        """Dropped blocks are skipped and n_first is the first message
+        actually returned.
+        """
+        total = 3*B + 5
+        reply = [total, 3*B, 0, 3, None, None, block(2*B, 3*B)] + tail(3*B, total)
+
+        n_total, n_first, messages = assemble_log_range(reply, total, 0)
+
+        self.assertEqual(n_total, total)
+        self.assertEqual(n_first, 2*B)
+        self.assertEqual(messages, [str(i) for i in range(2*B, total)])
+
+    def test_beyond_end(self):
+        reply = [10, 0, 20, 0]
+        n_total, n_first, messages = assemble_log_range(reply, 5, 20)
+
+        self.assertEqual(n_total, 10)
+        self.assertEqual(messages, [])
+        self.assertEqual(n_first, 10)
+
+
+class LogScriptTests(object):
+    """Tests of appending to and reading the log through GTRDBTornadis,
+    mixed into a test case for each way of running the scripts. Subclasses
+    set self.db and implement tail_length() and block_fields().
+    """
+
+    @gen.coroutine
+    def append(self, n_total, batch_size):
+        """Append messages in batches until there are `n_total`."""
+        for first in range(0, n_total, batch_size):
+            last = min(first + batch_size, n_total)
+            n = yield self.db.append_log_messages(1, messages(first, last))
+            self.assertEqual(n, last)
+
+            tail_length = yield self.tail_length()
+            self.assertLessEqual(tail_length, LOG_TAIL_MAX_LENGTH)
+
+    @gen_test
+    def test_read_ranges(self):
+        total = 4*B + 13
+        yield self.append(total, 7)
+        expected = messages(0, total)
+
+        for n_start in [0, 1, B-1, B, B+1, 2*B+3, 3*B+20, total-1, total,
+                total+5]:
+            for n_messages in [1, 5, B, 3*B, total]:
+                n_total, n_first, log = yield self.db.retrieve_log_range(
+                        1, n_messages, n_start)
+
+                self.assertEqual(n_total, total)
+                self.assertEqual(n_first, min(n_start, total))
+                self.assertEqual(log,
+                        expected[n_start:n_start+n_messages])
+
+    @gen_test
+    def test_large_batch(self):
+        """One append can compact several blocks."""
+        total = 5*B + 1
+        yield self.append(total, total)
+
+        log = yield self.db.retrieve_log_range(1, total, 0)
+        self.assertEqual(log, (total, 0, messages(0, total)))
+
+    @gen_test
+    def test_retention(self):
+        self.db.log_retention_blocks = 2
+        total = 6*B + 5
+        yield self.append(total, 11)
+
+        # Blocks 0 to 4 were compacted and only the last two kept.
+        fields = yield self.block_fields()
+        self.assertEqual(sorted(fields), ['3', '4'])
+
+        n_total, n_first, log = yield self.db.retrieve_log_range(1, total, 0)
+        self.assertEqual((n_total, n_first), (total, 3*B))
+        self.assertEqual(log, messages(3*B, total))
+
+        n_total, n_first, log = yield self.db.retrieve_log_range(1, 10, 4*B-5)
+        self.assertEqual((n_total, n_first), (total, 4*B-5))
+        self.assertEqual(log, messages(4*B-5, 4*B+5))
+
+
+
+
+class TestLogScripts(LogScriptTests, AsyncTestCase):
+    """Run the log tests with the Python ports of the scripts. These are
+    quick to debug, but only TestLuaLogScripts and TestRedisLogScripts
+    check the scripts themselves.
+    """
+
+    def setUp(self):
+        super(TestLogScripts, self).setUp()
+        self.redis = ScriptRedis()
+        self.scripts = {'append_log': append_log, 'read_log': read_log}
+
+        self.db = GTRDBTornadis()
+        self.db._eval_script = self.eval_script
+
+    @gen.coroutine
+    def eval_script(self, name, keys, args):
+        yield gen.moment
+        raise gen.Return(self.scripts[name](self.redis, keys, args))
+
+    @gen.coroutine
+    def tail_length(self):
+        yield gen.moment
+        raise gen.Return(len(self.redis.data[self.db._log_keys(1)[0]]))
+
+    @gen.coroutine
+    def block_fields(self):
+        yield gen.moment
+        raise gen.Return(self.redis.data[self.db._log_keys(1)[1]].keys())
+
+
+@unittest.skipIf(lupa is None, 'lupa is not installed')
+class TestLuaLogScripts(TestLogScripts):
+    """Run the log tests with the Lua scripts from cloaca.lua_scripts, on
+    a ScriptRedis.
+    """
+
+    def setUp(self):
+        super(TestLuaLogScripts, self).setUp()
+        self.lua = lupa.LuaRuntime()
+        self.scripts = dict((name, lua_script(self.lua, SCRIPTS[name]))
+                for name in ['append_log', 'read_log'])
+
+
+@unittest.skipIf(not redis_available(), 'No Redis server on localhost')
+class TestRedisLogScripts(LogScriptTests, AsyncTestCase):
+    """Run the log tests against a Redis server on localhost, under a
+    prefix of their own that is deleted afterwards.
+    """
+
+    def setUp(self):
+        super(TestRedisLogScripts, self).setUp()
+        prefix = 'cloaca_test_{0}:'.format(binascii.hexlify(os.urandom(4)))
+        self.db = GTRDBTornadis(prefix=prefix)
+
+    def tearDown(self):
+        @gen.coroutine
+        def delete():
+            yield self.db._call('DEL', *self.db._log_keys(1))
+        self.io_loop.run_sync(delete)
+        self.db.pool.destroy()
+        super(TestRedisLogScripts, self).tearDown()
+
+    @gen.coroutine
+    def tail_length(self):
+        n = yield self.db._call('LLEN', self.db._log_keys(1)[0])
+        raise gen.Return(n)
+
+    @gen.coroutine
+    def block_fields(self):
+        fields = yield self.db._call('HKEYS', self.db._log_keys(1)[1])
+        raise gen.Return(fields)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+from cloaca.handlers import JoinGameHandler, GameWSHandler
+from cloaca.shard import ShardMap
+from cloaca.message import Command, GameAction
+import cloaca.message as m
+
+import tornado.web
+import tornado.websocket
+from tornado import gen
+from tornado.httpclient import HTTPRequest
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado.web import create_signed_value
+
+import unittest
+
+COOKIE_SECRET = 'test secret'
+GAME_ID = 7
+
+
+class SessionCache(object):
+    """Stands in for cloaca.user_cache.UserCache, with one session."""
+
+    @gen.coroutine
+    def user_from_session(self, session_auth):
+        yield gen.moment
+        if session_auth == 'session':
+            raise gen.Return({'user_id': 1, 'username': 'p1'})
+        raise gen.Return(None)
+
+
+class JoinServer(object):
+    """Records the games joined and the game states requested."""
+
+    def __init__(self):
+        self.joined = []
+        self.requested = []
+
+    @gen.coroutine
+    def join_game(self, user_id, game_id):
+        self.joined.append(game_id)
+        raise gen.Return(game_id)
+
+    @gen.coroutine
+    def get_game_data(self, user_id, game_id):
+        self.requested.append(game_id)
+        raise gen.Return('')
+
+
+class ShardRoutingTest(AsyncHTTPTestCase):
+    """Base class that serves the join and websocket handlers with a
+    logged-in session. The shard map is set by each subclass.
+    """
+
+    shard_map = None
+
+    def get_app(self):
+        self.server = JoinServer()
+        handler_args = {'database': None, 'server': self.server}
+        return tornado.web.Application([
+                (r'/joingame/([0-9]+)', JoinGameHandler, handler_args),
+                (r'/ws', GameWSHandler, handler_args),
+                ],
+                cookie_secret=COOKIE_SECRET, login_url='/login',
+                user_cache=SessionCache(), shard_map=self.shard_map)
+
+    def session_cookie(self):
+        value = create_signed_value(COOKIE_SECRET, 'session_auth', 'session')
+        return {'Cookie': 'session_auth=' + value}
+
+    def fetch_join(self):
+        return self.fetch('/joingame/{0:d}?from=lobby'.format(GAME_ID),
+                headers=self.session_cookie(), follow_redirects=False)
+
+
+def game_owner(game_id):
+    return ShardMap(4, 9000).shard_for_game(game_id)
+
+
+class TestOtherShard(ShardRoutingTest):
+    """Test requests for a game owned by another shard.
+    """
+
+    shard_map = ShardMap(4, 9000, (game_owner(GAME_ID) + 1) % 4)
+
+    def test_redirect(self):
+        response = self.fetch_join()
+
+        self.assertEqual(response.code, 302)
+        self.assertEqual(response.headers['Location'],
+                'http://127.0.0.1:{0:d}/joingame/{1:d}?from=lobby'.format(
+                    self.shard_map.port_for_game(GAME_ID), GAME_ID))
+        self.assertEqual(self.server.joined, [])
+
+    @gen_test
+    def test_websocket_rejected(self):
+        request = HTTPRequest(
+                'ws://127.0.0.1:{0:d}/ws'.format(self.get_http_port()),
+                headers=self.session_cookie())
+        ws = yield tornado.websocket.websocket_connect(request)
+        try:
+            ws.write_message(Command(GAME_ID, None,
+                    GameAction(m.REQGAMESTATE)).to_json())
+            response = yield ws.read_message()
+        finally:
+            ws.close()
+
+        command = Command.from_json(response)[0]
+        self.assertEqual(command.action.action, m.SERVERERROR)
+        self.assertIn('handled by another server process',
+                command.action.args[0])
+        self.assertEqual(self.server.requested, [])
+
+
+class TestOwnShard(ShardRoutingTest):
+    """Test requests for a game owned by this shard.
+    """
+
+    shard_map = ShardMap(4, 9000, game_owner(GAME_ID))
+
+    def test_no_redirect(self):
+        response = self.fetch_join()
+
+        self.assertEqual(response.code, 302)
+        self.assertEqual(response.headers['Location'], '/')
+        self.assertEqual(self.server.joined, [str(GAME_ID)])
+
+
+class TestNotSharded(TestOwnShard):
+    """Test requests without a shard map.
+    """
+
+    shard_map = None
+
+
+if __name__ == '__main__':
+    unittest.main()
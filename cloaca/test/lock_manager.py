@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+from cloaca.lock_manager import GameLockManager
+
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+
+import unittest
+import datetime
+
+class TestGameLockManager(AsyncTestCase):
+    """Test acquiring and evicting game locks.
+    """
+
+    def setUp(self):
+        super(TestGameLockManager, self).setUp()
+        self.manager = GameLockManager()
+
+    @gen_test
+    def test_evicted_after_release(self):
+        with (yield self.manager.acquire(1)):
+            self.assertEqual(len(self.manager), 1)
+
+        self.assertEqual(len(self.manager), 0)
+
+    @gen_test
+    def test_evicted_after_exception(self):
+        try:
+            with (yield self.manager.acquire(1)):
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertEqual(len(self.manager), 0)
+
+    @gen_test
+    def test_mutual_exclusion(self):
+        """Coroutines for the same game run one at a time, in order."""
+        events = []
+
+        @gen.coroutine
+        def work(i):
+            with (yield self.manager.acquire(1)):
+                events.append(('start', i))
+                yield gen.moment
+                events.append(('end', i))
+
+        yield [work(i) for i in range(3)]
+
+        self.assertEqual(events, [('start', 0), ('end', 0), ('start', 1),
+                ('end', 1), ('start', 2), ('end', 2)])
+        self.assertEqual(len(self.manager), 0)
+
+        stats = self.manager.stats()
+        self.assertEqual(stats['n_acquired'], 3)
+        self.assertEqual(stats['n_contended'], 2)
+        self.assertEqual(stats['n_timeouts'], 0)
+
+    @gen_test
+    def test_different_games_independent(self):
+        with (yield self.manager.acquire(1)):
+            with (yield self.manager.acquire(2)):
+                self.assertEqual(len(self.manager), 2)
+
+        self.assertEqual(len(self.manager), 0)
+
+    @gen_test
+    def test_timeout(self):
+        timeout = datetime.timedelta(milliseconds=10)
+
+        with (yield self.manager.acquire(1)):
+            with self.assertRaises(gen.TimeoutError):
+                yield self.manager.acquire(1, timeout)
+
+            # The timed-out waiter no longer holds a reference.
+            self.assertEqual(self.manager._locks[1].refs, 1)
+
+        self.assertEqual(len(self.manager), 0)
+
+        stats = self.manager.stats()
+        self.assertEqual(stats['n_timeouts'], 1)
+        self.assertEqual(stats['n_acquired'], 1)
+        self.assertGreater(stats['wait_time_max'], 0)
+
+    @gen_test
+    def test_many_games(self):
+        """The table doesn't grow with the number of distinct games."""
+        for game_id in xrange(20000):
+            with (yield self.manager.acquire(game_id)):
+                pass
+
+        self.assertEqual(len(self.manager), 0)
+        self.assertEqual(self.manager.stats()['n_acquired'], 20000)
+
+
+if __name__ == '__main__':
+    unittest.main()
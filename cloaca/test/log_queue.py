@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+from cloaca.log_queue import QueueHandler, QueueListener, start_queue_logging
+
+import logging
+import Queue
+import unittest
+
+
+class ListHandler(logging.Handler):
+    """Collect formatted records in a list."""
+
+    def __init__(self, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+
+class TestLogQueue(unittest.TestCase):
+    """Test passing log records through a queue to another thread.
+    """
+
+    def setUp(self):
+        self.logger = logging.getLogger('cloaca.test.log_queue')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+
+        self.handler = ListHandler()
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        for h in list(self.logger.handlers):
+            self.logger.removeHandler(h)
+
+    def test_records_handled(self):
+        listener = start_queue_logging(self.logger)
+        self.assertIsInstance(self.logger.handlers[0], QueueHandler)
+
+        self.logger.info('message %d', 1)
+        self.logger.debug('message %d', 2)
+        listener.stop()
+
+        self.assertEqual(self.handler.messages, ['message 1', 'message 2'])
+
+    def test_arguments_formatted_when_logged(self):
+        """Arguments changed after logging aren't seen by the handler."""
+        listener = start_queue_logging(self.logger)
+
+        hand = ['Road']
+        self.logger.info('hand: %s', hand)
+        hand.append('Wall')
+        listener.stop()
+
+        self.assertEqual(self.handler.messages, ["hand: ['Road']"])
+
+    def test_handler_level(self):
+        errors = ListHandler(logging.ERROR)
+        queue = Queue.Queue()
+        listener = QueueListener(queue, self.handler, errors)
+        self.logger.removeHandler(self.handler)
+        self.logger.addHandler(QueueHandler(queue))
+        listener.start()
+
+        self.logger.info('info')
+        self.logger.error('error')
+        listener.stop()
+
+        self.assertEqual(self.handler.messages, ['info', 'error'])
+        self.assertEqual(errors.messages, ['error'])
+
+    def test_exception_text(self):
+        listener = start_queue_logging(self.logger)
+
+        try:
+            raise ValueError('bad value')
+        except ValueError:
+            self.logger.exception('failed')
+        listener.stop()
+
+        self.assertEqual(len(self.handler.messages), 1)
+        self.assertIn('failed', self.handler.messages[0])
+        self.assertIn('ValueError: bad value', self.handler.messages[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
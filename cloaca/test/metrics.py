@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+from cloaca.metrics import (Registry, Counter, Gauge, Histogram,
+        FunctionMetric, PhaseTimer, GAME_ACTION_PHASE_SECONDS)
+from cloaca.server import GTRServer
+from cloaca.message import GameAction
+from cloaca.game import Game
+import cloaca.message as m
+import cloaca.encode_binary as encode
+
+from cloaca.cloacaapp import make_metrics_app
+import cloaca.metrics
+
+from tornado.testing import AsyncTestCase, AsyncHTTPTestCase, gen_test
+
+from server import MemoryDatabase
+
+import unittest
+
+
+class TestMetrics(unittest.TestCase):
+    """Test recording metrics and rendering them in the text exposition
+    format.
+    """
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        c = Counter('requests_total', 'Requests.', registry=self.registry)
+        c.inc()
+        c.inc(2)
+
+        self.assertEqual(self.registry.exposition(),
+                '# HELP requests_total Requests.\n'
+                '# TYPE requests_total counter\n'
+                'requests_total 3\n')
+
+    def test_labels(self):
+        c = Counter('messages_total', 'Messages.', ['action'],
+                registry=self.registry)
+        c.labels('thinkerorlead').inc()
+        c.labels('laborer').inc()
+        c.labels('laborer').inc()
+
+        lines = self.registry.exposition().splitlines()
+        self.assertEqual(lines[2:], [
+                'messages_total{action="laborer"} 2',
+                'messages_total{action="thinkerorlead"} 1',
+                ])
+
+        self.assertRaises(ValueError, c.labels, 'a', 'b')
+
+    def test_label_escaping(self):
+        c = Counter('c', 'C.', ['l'], registry=self.registry)
+        c.labels('a"b\\c\n').inc()
+
+        self.assertEqual(self.registry.exposition().splitlines()[2],
+                'c{l="a\\"b\\\\c\\n"} 1')
+
+    def test_gauge(self):
+        g = Gauge('open', 'Open.', registry=self.registry)
+        g.inc()
+        g.inc()
+        g.dec()
+
+        self.assertEqual(self.registry.exposition().splitlines()[2], 'open 1')
+
+    def test_histogram(self):
+        h = Histogram('latency_seconds', 'Latency.', buckets=[0.1, 1.0],
+                registry=self.registry)
+        h.observe(0.05)
+        h.observe(0.1)
+        h.observe(0.5)
+        h.observe(5)
+
+        lines = self.registry.exposition().splitlines()
+        self.assertEqual(lines[1], '# TYPE latency_seconds histogram')
+        self.assertEqual(lines[2:], [
+                'latency_seconds_bucket{le="0.1"} 2',
+                'latency_seconds_bucket{le="1"} 3',
+                'latency_seconds_bucket{le="+Inf"} 4',
+                'latency_seconds_sum 5.65',
+                'latency_seconds_count 4',
+                ])
+
+    def test_histogram_labels(self):
+        h = Histogram('phase_seconds', 'Phases.', ['phase'], buckets=[1.0],
+                registry=self.registry)
+        h.labels('engine').observe(0.5)
+
+        lines = self.registry.exposition().splitlines()
+        self.assertEqual(lines[2:], [
+                'phase_seconds_bucket{phase="engine",le="1"} 1',
+                'phase_seconds_bucket{phase="engine",le="+Inf"} 1',
+                'phase_seconds_sum{phase="engine"} 0.5',
+                'phase_seconds_count{phase="engine"} 1',
+                ])
+
+    def test_function_metric(self):
+        stats = {'hits': 1}
+        FunctionMetric('hits_total', 'Hits.', lambda: stats['hits'],
+                type_name='counter', registry=self.registry)
+        FunctionMetric('lookups_total', 'Lookups.',
+                lambda: {('hit',): stats['hits'], ('miss',): 4},
+                type_name='counter', labelnames=['result'],
+                registry=self.registry)
+
+        stats['hits'] = 7
+        lines = self.registry.exposition().splitlines()
+        self.assertIn('hits_total 7', lines)
+        self.assertIn('lookups_total{result="hit"} 7', lines)
+        self.assertIn('lookups_total{result="miss"} 4', lines)
+
+    def test_register_replaces(self):
+        Counter('c', 'First.', registry=self.registry).inc()
+        Counter('c', 'Second.', registry=self.registry)
+
+        self.assertEqual(self.registry.exposition().splitlines()[2], 'c 0')
+
+    def test_phase_timer(self):
+        h = Histogram('phase_seconds', 'Phases.', ['phase'], buckets=[1.0],
+                registry=self.registry)
+        times = iter([0.0, 1.0, 1.5, 4.0])
+        timer = PhaseTimer(h, lambda: next(times))
+
+        timer.mark('db_read')
+        timer.mark('engine')
+        timer.mark('db_read')
+        timer.observe()
+
+        self.assertEqual(h.labels('db_read').counts, [0, 1])
+        self.assertEqual(h.labels('db_read').sum, 3.5)
+        self.assertEqual(h.labels('engine').counts, [1, 0])
+
+
+class TestServerMetrics(AsyncTestCase):
+    """Test the phases recorded while handling game actions.
+    """
+
+    def setUp(self):
+        super(TestServerMetrics, self).setUp()
+        self.db = MemoryDatabase()
+        self.db.users = {1: {'username': 'p1'}, 2: {'username': 'p2'}}
+
+        game = Game(game_id=1, host='p1')
+        game.add_player(1, 'p1')
+        game.add_player(2, 'p2')
+        game.start()
+        self.db.games[1] = encode.game_to_str(game)
+        self.active = game.active_player.uid
+
+        self.server = GTRServer(self.db)
+        self.server.send_commands = lambda u, commands: None
+
+    def count(self, phase):
+        return sum(GAME_ACTION_PHASE_SECONDS.labels(phase).counts)
+
+    @gen_test
+    def test_phases_observed(self):
+        phases = ['lock_wait', 'db_read', 'decode', 'engine', 'encode',
+                'db_write', 'fan_out']
+        before = dict((p, self.count(p)) for p in phases)
+
+        yield self.server.handle_game_actions(1, self.active,
+                [[1, GameAction(m.THINKERORLEAD, True)]])
+
+        for p in phases:
+            self.assertEqual(self.count(p), before[p] + 1, p)
+
+
+class TestMetricsApp(AsyncHTTPTestCase):
+    """Test serving the metrics on their own app.
+    """
+
+    def get_app(self):
+        return make_metrics_app()
+
+    def test_metrics(self):
+        response = self.fetch('/metrics')
+
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'],
+                cloaca.metrics.CONTENT_TYPE)
+        self.assertIn('# TYPE cloaca_', response.body)
+
+    def test_only_metrics(self):
+        self.assertEqual(self.fetch('/').code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+from cloaca.migrate_keys import (key_renames, legacy_game_id,
+        migrate_game, migrate)
+import cloaca.db as db
+
+import fnmatch
+import unittest
+
+
+class FakeRedis(object):
+    """Stands in for redis.StrictRedis with the commands used by
+    migrate_keys, on a dict of keys.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def exists(self, key):
+        return key in self.data
+
+    def renamenx(self, old, new):
+        if new in self.data:
+            return False
+        self.data[new] = self.data.pop(old)
+        return True
+
+    def lrange(self, key, start, stop):
+        return list(self.data.get(key, []))
+
+    def scan_iter(self, match, count):
+        return [k for k in self.data.keys() if fnmatch.fnmatchcase(k, match)]
+
+    def pipeline(self, transaction):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    """Queues calls on a FakeRedis until execute()."""
+
+    def __init__(self, r):
+        self.r = r
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.calls.append((name, args))
+
+    def execute(self):
+        return [getattr(self.r, name)(*args) for name, args in self.calls]
+
+
+class TestMigrateKeys(unittest.TestCase):
+    """Test the key names used to migrate to the hash-tagged layout.
+    """
+
+    def test_new_keys_match_db(self):
+        new_keys = [new for _, new in key_renames(12, 'p:')]
+
+        self.assertEqual(new_keys, [
+                'p:' + db.GAME_KEY.format(12),
+                'p:' + db.GAME_MOVES_KEY.format(12),
+                'p:' + db.GAME_ACTION_LOG_KEY.format(12),
+                'p:' + db.LOG_KEY.format(12),
+                'p:' + db.LOG_BLOCKS_KEY.format(12),
+                'p:' + db.LOG_INFO_KEY.format(12),
+                ])
+
+    def test_old_keys(self):
+        old_keys = [old for old, _ in key_renames(12)]
+
+        self.assertEqual(old_keys, ['game:12', 'game_actions:12',
+                'game_action_log:12', 'game_log:12', 'game_log_blocks:12',
+                'game_log_info:12'])
+
+    def test_legacy_game_id(self):
+        self.assertEqual(legacy_game_id('game:12'), 12)
+        self.assertEqual(legacy_game_id('p:game:12', 'p:'), 12)
+        self.assertIsNone(legacy_game_id('game:12', 'p:'))
+        self.assertIsNone(legacy_game_id('game:12:extra'))
+        self.assertIsNone(legacy_game_id('{game:12}'))
+        self.assertIsNone(legacy_game_id('game_log:12'))
+
+
+class TestMigrateGame(unittest.TestCase):
+    """Test renaming the keys of games on a fake Redis client.
+    """
+
+    def setUp(self):
+        self.r = FakeRedis({
+                'p:games': ['12'],
+                'p:game:12': 'game',
+                'p:game_log:12': 'log',
+                'p:game_actions:12': 'old actions',
+                'p:{game:12}:actions': 'new actions',
+                'p:game:13': 'unlisted game',
+                'p:users': 'not a game',
+                })
+
+    def test_migrate_game(self):
+        renamed, conflicts = migrate_game(self.r, 12, 'p:')
+
+        self.assertEqual(renamed, [('p:game:12', 'p:{game:12}'),
+                ('p:game_log:12', 'p:{game:12}:log')])
+        self.assertEqual(conflicts, [('p:game_actions:12',
+                'p:{game:12}:actions')])
+
+        self.assertEqual(self.r.data['p:{game:12}'], 'game')
+        self.assertEqual(self.r.data['p:{game:12}:log'], 'log')
+        self.assertEqual(self.r.data['p:{game:12}:actions'], 'new actions')
+        self.assertNotIn('p:game:12', self.r.data)
+        self.assertIn('p:game_actions:12', self.r.data)
+
+    def test_dry_run(self):
+        before = dict(self.r.data)
+
+        renamed, conflicts = migrate_game(self.r, 12, 'p:', dry_run=True)
+
+        self.assertEqual(len(renamed), 2)
+        self.assertEqual(len(conflicts), 1)
+        self.assertEqual(self.r.data, before)
+
+    def test_run_twice(self):
+        migrate_game(self.r, 12, 'p:')
+        renamed, conflicts = migrate_game(self.r, 12, 'p:')
+
+        self.assertEqual(renamed, [])
+        self.assertEqual(len(conflicts), 1)
+
+    def test_migrate_finds_unlisted_games(self):
+        n_games, n_renamed, conflicts = migrate(self.r, 'p:')
+
+        self.assertEqual(n_games, 2)
+        self.assertEqual(n_renamed, 3)
+        self.assertEqual(self.r.data['p:{game:13}'], 'unlisted game')
+
+
+if __name__ == '__main__':
+    unittest.main()
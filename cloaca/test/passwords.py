@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+from cloaca.passwords import PasswordHasher
+from cloaca.error import ServerBusyError
+
+from tornado.testing import AsyncTestCase, gen_test
+
+import unittest
+
+class TestPasswordHasher(AsyncTestCase):
+    """Test hashing and verifying passwords in the process pool.
+    """
+
+    def setUp(self):
+        super(TestPasswordHasher, self).setUp()
+        self.hasher = PasswordHasher(work_factor=4, max_workers=1)
+
+    def tearDown(self):
+        self.hasher.shutdown()
+        super(TestPasswordHasher, self).tearDown()
+
+    @gen_test(timeout=30)
+    def test_hash_and_check(self):
+        hashed = yield self.hasher.hash_password('secret')
+
+        self.assertTrue(hashed.startswith('$2'))
+        self.assertIn('$04$', hashed)
+
+        ok = yield self.hasher.check_password('secret', hashed)
+        self.assertTrue(ok)
+
+    @gen_test(timeout=30)
+    def test_wrong_password(self):
+        hashed = yield self.hasher.hash_password('secret')
+        ok = yield self.hasher.check_password('guess', hashed)
+        self.assertFalse(ok)
+
+    @gen_test
+    def test_saturated(self):
+        self.hasher.max_pending = 0
+
+        with self.assertRaises(ServerBusyError):
+            yield self.hasher.hash_password('secret')
+
+        self.assertEqual(self.hasher.n_rejected, 1)
+        self.assertEqual(self.hasher.n_pending, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+from cloaca.game import Game
+from cloaca.message import GameAction
+from cloaca.profiling import Profiler
+import cloaca.message as message
+
+import json
+import unittest
+
+
+class TestProfiler(unittest.TestCase):
+    """Test timing game engine methods with the Profiler.
+    """
+
+    def setUp(self):
+        self.original_pump = Game.__dict__['_pump']
+        self.original_handle = Game.__dict__['_handle_thinkerorlead']
+
+        self.profiler = Profiler()
+
+        self.game = Game(game_id=1, host='p1')
+        self.game.add_player(1, 'p1')
+        self.game.add_player(2, 'p2')
+        self.game.start()
+
+    def tearDown(self):
+        self.profiler.disable()
+
+    def play_thinker(self):
+        self.game.handle(GameAction(message.THINKERORLEAD, True))
+        self.game.handle(GameAction(message.THINKERTYPE, False))
+
+    def test_disabled_by_default(self):
+        self.play_thinker()
+
+        self.assertIs(Game.__dict__['_pump'], self.original_pump)
+        self.assertEqual(self.profiler.stats(), {})
+
+    def test_enable_disable(self):
+        self.profiler.enable()
+        self.assertIsNot(Game.__dict__['_pump'], self.original_pump)
+
+        self.profiler.disable()
+        self.assertIs(Game.__dict__['_pump'], self.original_pump)
+        self.assertIs(Game.__dict__['_handle_thinkerorlead'],
+                self.original_handle)
+
+    def test_stats(self):
+        self.profiler.enable()
+        self.play_thinker()
+
+        stats = self.profiler.stats()
+        self.assertEqual(stats['_handle_thinkerorlead']['calls'], 1)
+        self.assertEqual(stats['handle']['calls'], 2)
+        self.assertIn('_pump:_take_turn_stacked', stats)
+
+        for s in stats.values():
+            self.assertLessEqual(s['self'], s['total'] + 1e-9)
+            self.assertLessEqual(s['max'], s['total'] + 1e-9)
+
+        d = json.loads(self.profiler.to_json())
+        self.assertTrue(d['enabled'])
+        self.assertEqual(d['functions']['handle']['calls'], 2)
+
+    def test_collapsed_stacks(self):
+        self.profiler.enable()
+        self.play_thinker()
+
+        lines = self.profiler.collapsed_stacks().splitlines()
+        paths = [l.rsplit(' ', 1)[0] for l in lines]
+
+        self.assertIn('handle;_handle_thinkerorlead', paths)
+        for l in lines:
+            int(l.rsplit(' ', 1)[1])
+
+    def test_reset(self):
+        self.profiler.enable()
+        self.play_thinker()
+        self.profiler.reset()
+
+        self.assertEqual(self.profiler.stats(), {})
+        self.assertEqual(self.profiler.collapsed_stacks(), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
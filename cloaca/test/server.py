@@ -1,16 +1,24 @@
 #!/usr/bin/env python
 
-from cloaca.server import GTRServer
-from cloaca.error import GTRError
+from cloaca.server import GTRServer, CommandBatch
+from cloaca.error import GTRError, GTRDBError
 from cloaca.game_record import GameRecord
 from cloaca.message import GameAction, Command
 import cloaca.message as m
+from cloaca.game import Game
+import cloaca.encode_binary as encode
+import cloaca.encode_action as encode_action
+
+from tornado import gen
+import tornado.ioloop
+from tornado.testing import AsyncTestCase, gen_test
 
 from test_setup import simple_two_player
 
 import unittest
 from uuid import uuid4
 import json
+import datetime
 
 @unittest.skip("server API has changed")
 class TestServer(unittest.TestCase):
@@ -413,5 +421,318 @@ class TestServerCommands(unittest.TestCase):
             self.assertIsNone(game)
 
 
+class TestCommandBatch(unittest.TestCase):
+    """Test collecting commands by recipient.
+    """
+
+    def test_commands_grouped_by_user(self):
+        b = CommandBatch()
+        c0 = Command(1, None, GameAction(m.SERVERERROR, 'a'))
+        c1 = Command(1, None, GameAction(m.SERVERERROR, 'b'))
+        c2 = Command(1, None, GameAction(m.SERVERERROR, 'c'))
+
+        b.add(2, c0)
+        b.add(1, c1)
+        b.add(2, c2)
+
+        self.assertEqual(b.items(), [(2, [c0, c2]), (1, [c1])])
+
+    def test_empty(self):
+        self.assertEqual(CommandBatch().items(), [])
+
+    def test_send_batch(self):
+        s = GTRServer(None)
+        sent = []
+        s.send_commands = lambda u, commands: sent.append((u, commands))
+
+        b = CommandBatch()
+        c0 = Command(1, None, GameAction(m.SERVERERROR, 'a'))
+        c1 = Command(1, None, GameAction(m.SERVERERROR, 'b'))
+        b.add(1, c0)
+        b.add(1, c1)
+        s._send_batch(b)
+
+        self.assertEqual(sent, [(1, [c0, c1])])
+
+
+class MemoryDatabase(object):
+    """Minimal in-memory stand-in for cloaca.db.GTRDB with the methods
+    used by GTRServer.handle_game_actions(). Counts game loads and stores.
+    """
+
+    def __init__(self):
+        self.games = {}
+        self.users = {}
+        self.actions = {}
+        self.logs = {}
+        self.n_retrieve_game = 0
+        self.n_store_game = 0
+
+    @gen.coroutine
+    def retrieve_user(self, user_id):
+        # Like GTRDBTornadis, an unknown user is an empty dict.
+        yield gen.moment
+        raise gen.Return(self.users.get(user_id, {}))
+
+    @gen.coroutine
+    def retrieve_game(self, game_id):
+        yield gen.moment
+        self.n_retrieve_game += 1
+        raise gen.Return(self.games.get(game_id))
+
+    @gen.coroutine
+    def store_game(self, game_id, encoded_game):
+        yield gen.moment
+        self.n_store_game += 1
+        self.games[game_id] = encoded_game
+
+    @gen.coroutine
+    def append_game_actions(self, game_id, log_header, actions_encoded):
+        log = self.actions.setdefault(game_id, log_header)
+        self.actions[game_id] = log + actions_encoded
+        raise gen.Return(len(self.actions[game_id]))
+
+    @gen.coroutine
+    def store_game_actions(self, game_id, encoded_game, log_header,
+            actions_encoded):
+        yield self.store_game(game_id, encoded_game)
+        n_bytes = yield self.append_game_actions(game_id, log_header,
+                actions_encoded)
+        raise gen.Return(n_bytes)
+
+    @gen.coroutine
+    def append_log_messages(self, game_id, messages):
+        log = self.logs.setdefault(game_id, [])
+        log.extend(messages)
+        raise gen.Return(len(log))
+
+
+class LockDatabase(object):
+    """In-memory game locks with the GTRDB methods used by
+    GTRServer._acquire_game_lock(). Counts attempts to acquire and release.
+    """
+
+    def __init__(self):
+        self.locks = {}
+        self.n_acquire = 0
+        self.n_release = 0
+
+    @gen.coroutine
+    def acquire_game_lock(self, game_id, token, ttl_ms):
+        self.n_acquire += 1
+        if game_id in self.locks:
+            raise gen.Return(False)
+        self.locks[game_id] = token
+        raise gen.Return(True)
+
+    @gen.coroutine
+    def release_game_lock(self, game_id, token):
+        self.n_release += 1
+        if self.locks.get(game_id) != token:
+            raise gen.Return(False)
+        del self.locks[game_id]
+        raise gen.Return(True)
+
+
+class TestDistributedLock(AsyncTestCase):
+    """Test acquiring game locks held in the database.
+    """
+
+    def setUp(self):
+        super(TestDistributedLock, self).setUp()
+        self.db = LockDatabase()
+        self.server = GTRServer(self.db, distributed_locks=True)
+
+        self.wait_timeout = GTRServer.GAME_WAIT_TIMEOUT
+        GTRServer.GAME_WAIT_TIMEOUT = datetime.timedelta(milliseconds=50)
+
+    def tearDown(self):
+        GTRServer.GAME_WAIT_TIMEOUT = self.wait_timeout
+        super(TestDistributedLock, self).tearDown()
+
+    @gen.coroutine
+    def wait_for_release(self, n_release=1):
+        while self.db.n_release < n_release:
+            yield gen.moment
+
+    @gen_test
+    def test_acquire_and_release(self):
+        with (yield self.server._acquire_game_lock(1)):
+            self.assertIn(1, self.db.locks)
+
+        yield self.wait_for_release()
+        self.assertEqual(self.db.locks, {})
+        self.assertEqual(self.db.n_acquire, 1)
+
+    @gen_test
+    def test_retry(self):
+        self.db.locks[1] = 'other'
+        tornado.ioloop.IOLoop.current().call_later(0.02,
+                lambda: self.db.locks.pop(1))
+
+        with (yield self.server._acquire_game_lock(1)):
+            self.assertNotEqual(self.db.locks[1], 'other')
+
+        self.assertGreater(self.db.n_acquire, 1)
+
+    @gen_test
+    def test_timeout(self):
+        self.db.locks[1] = 'other'
+
+        with self.assertRaises(gen.TimeoutError):
+            yield self.server._acquire_game_lock(1)
+
+        self.assertEqual(self.db.locks, {1: 'other'})
+        self.assertEqual(self.db.n_release, 0)
+
+    @gen_test
+    def test_release_checks_token(self):
+        """A lock that expired and was taken by another process isn't
+        released.
+        """
+        with (yield self.server._acquire_game_lock(1)):
+            self.db.locks[1] = 'other'
+
+        yield self.wait_for_release()
+        self.assertEqual(self.db.locks, {1: 'other'})
+
+
+class TestActionQueue(AsyncTestCase):
+    """Test that concurrently submitted actions for a game are handled
+    in a single load/store cycle.
+    """
+
+    def setUp(self):
+        super(TestActionQueue, self).setUp()
+        self.db = MemoryDatabase()
+        self.db.users = {1: {'username': 'p1'}, 2: {'username': 'p2'}}
+
+        game = Game(game_id=1, host='p1')
+        game.add_player(1, 'p1')
+        game.add_player(2, 'p2')
+        game.start()
+        game.game_log = []
+        self.db.games[1] = encode.game_to_str(game)
+
+        self.active = game.active_player.uid
+        self.inactive = 3 - self.active
+
+        self.server = GTRServer(self.db)
+        self.sent = []
+        self.server.send_commands = (lambda u, commands:
+                self.sent.append((u, commands)))
+
+    def errors(self):
+        return [(u, c.action.args[0]) for u, commands in self.sent
+                for c in commands if c.action.action == m.SERVERERROR]
+
+    @gen_test
+    def test_queued_actions_batched(self):
+        yield [
+            self.server.handle_game_actions(1, self.active,
+                [[1, GameAction(m.THINKERORLEAD, True)]]),
+            self.server.handle_game_actions(1, self.active,
+                [[2, GameAction(m.THINKERTYPE, False)]]),
+            ]
+
+        self.assertEqual(self.errors(), [])
+        self.assertEqual(self.db.n_retrieve_game, 1 + 2) # +1 per player sent
+        self.assertEqual(self.db.n_store_game, 1)
+
+        first, actions = encode_action.decode_action_log(self.db.actions[1])
+        self.assertEqual(first, 1)
+        self.assertEqual(actions, [GameAction(m.THINKERORLEAD, True),
+                GameAction(m.THINKERTYPE, False)])
+
+        game = encode.str_to_game(self.db.games[1])
+        self.assertEqual(game.action_number, 3)
+        self.assertEqual(self.server._action_queues, {})
+
+    @gen_test
+    def test_error_only_sent_to_user(self):
+        yield [
+            self.server.handle_game_actions(1, self.inactive,
+                [[1, GameAction(m.THINKERORLEAD, True)]]),
+            self.server.handle_game_actions(1, self.active,
+                [[1, GameAction(m.THINKERORLEAD, True)]]),
+            ]
+
+        errors = self.errors()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0][0], self.inactive)
+
+        game = encode.str_to_game(self.db.games[1])
+        self.assertEqual(game.action_number, 2)
+
+    @gen_test
+    def test_failed_write_not_stored(self):
+        @gen.coroutine
+        def fail(*args):
+            raise GTRDBError('write failed')
+        self.db.store_game_actions = fail
+
+        with self.assertRaises(GTRDBError):
+            yield self.server.handle_game_actions(1, self.active,
+                    [[1, GameAction(m.THINKERORLEAD, True)]])
+
+        self.assertEqual(self.db.actions, {})
+        self.assertEqual(self.db.logs, {})
+        game = encode.str_to_game(self.db.games[1])
+        self.assertEqual(game.action_number, 1)
+
+    @gen_test
+    def test_unregistered_user(self):
+        """Actions of an unregistered user fail on their own, without
+        handling the other actions again.
+        """
+        unknown = self.server.handle_game_actions(1, 5,
+                [[1, GameAction(m.THINKERORLEAD, True)]])
+        valid = self.server.handle_game_actions(1, self.active,
+                [[1, GameAction(m.THINKERORLEAD, True)]])
+
+        yield valid
+        with self.assertRaises(GTRError):
+            yield unknown
+
+        game = encode.str_to_game(self.db.games[1])
+        self.assertEqual(game.action_number, 2)
+        self.assertEqual(self.db.n_retrieve_game, 1 + 2) # +1 per player sent
+
+    @gen_test
+    def test_engine_error_only_fails_own_actions(self):
+        """Actions applied before the engine failed on another user's
+        actions are handled again and stored.
+        """
+        apply_actions = self.server._apply_actions
+        def fail_inactive(game, user_id, *args):
+            if user_id == self.inactive:
+                raise RuntimeError('engine failed')
+            return apply_actions(game, user_id, *args)
+        self.server._apply_actions = fail_inactive
+
+        valid = self.server.handle_game_actions(1, self.active,
+                [[1, GameAction(m.THINKERORLEAD, True)]])
+        failed = self.server.handle_game_actions(1, self.inactive,
+                [[1, GameAction(m.THINKERORLEAD, True)]])
+
+        yield valid
+        with self.assertRaises(RuntimeError):
+            yield failed
+
+        self.assertEqual(self.errors(), [])
+        self.assertEqual(self.db.n_store_game, 1)
+        self.assertEqual(encode_action.decode_action_log(self.db.actions[1]),
+                (1, [GameAction(m.THINKERORLEAD, True)]))
+        self.assertEqual(self.server._action_queues, {})
+
+    @gen_test
+    def test_invalid_game(self):
+        yield self.server.handle_game_actions(2, 1,
+                [[1, GameAction(m.THINKERORLEAD, True)]])
+
+        self.assertEqual(self.db.n_store_game, 0)
+        self.assertEqual(self.server._action_queues, {})
+
+
 if __name__ == '__main__':
     unittest.main()
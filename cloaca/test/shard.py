@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+from cloaca.shard import jump_consistent_hash, ShardMap
+
+import unittest
+from collections import Counter
+
+class TestJumpConsistentHash(unittest.TestCase):
+    """Test the assignment of keys to buckets.
+    """
+
+    def test_one_bucket(self):
+        for key in range(100):
+            self.assertEqual(jump_consistent_hash(key, 1), 0)
+
+    def test_in_range(self):
+        for n in range(1, 20):
+            for key in range(200):
+                b = jump_consistent_hash(key, n)
+                self.assertTrue(0 <= b < n)
+
+    def test_deterministic(self):
+        for key in range(100):
+            self.assertEqual(jump_consistent_hash(key, 7),
+                    jump_consistent_hash(key, 7))
+
+    def test_balanced(self):
+        """Sequential game IDs are spread evenly over the buckets."""
+        n = 8
+        counts = Counter(jump_consistent_hash(key, n) for key in range(8000))
+
+        self.assertEqual(len(counts), n)
+        for c in counts.values():
+            self.assertTrue(800 < c < 1200)
+
+    def test_minimal_movement(self):
+        """Adding a bucket only moves keys into the new bucket."""
+        n_keys = 5000
+        for n in range(1, 10):
+            moved = 0
+            for key in range(n_keys):
+                b0 = jump_consistent_hash(key, n)
+                b1 = jump_consistent_hash(key, n+1)
+                if b0 != b1:
+                    self.assertEqual(b1, n)
+                    moved += 1
+
+            self.assertLess(moved, 1.5 * n_keys / (n+1))
+
+    def test_bad_bucket_count(self):
+        with self.assertRaises(ValueError):
+            jump_consistent_hash(1, 0)
+
+
+class TestShardMap(unittest.TestCase):
+
+    def test_ports(self):
+        shard_map = ShardMap(4, 8080)
+
+        for game_id in range(50):
+            shard = shard_map.shard_for_game(game_id)
+            self.assertEqual(shard_map.port_for_game(game_id), 8080+shard)
+
+    def test_owns(self):
+        shard_maps = [ShardMap(3, 8080, i) for i in range(3)]
+
+        for game_id in range(50):
+            owners = [m for m in shard_maps if m.owns(game_id)]
+            self.assertEqual(len(owners), 1)
+
+    def test_not_a_shard(self):
+        shard_map = ShardMap(3, 8080)
+        self.assertFalse(shard_map.owns(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
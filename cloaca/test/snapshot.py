@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+from cloaca.game import Game
+from cloaca.card_manager import Card
+from cloaca.player import Player
+from cloaca.error import GTRError
+import cloaca.encode_binary as encode
+
+import cloaca.message as message
+from cloaca.message import GameAction
+
+import cloaca.test.test_setup as test_setup
+
+import unittest
+import copy
+
+
+def thinker_action(game):
+    """Return an action that thinks for Jacks or cards, which every
+    player can always take.
+    """
+    if game.expected_action == message.THINKERORLEAD:
+        return GameAction(message.THINKERORLEAD, True)
+    elif game.expected_action == message.THINKERTYPE:
+        return GameAction(message.THINKERTYPE, False)
+    else:
+        return GameAction(message.SKIPTHINKER, False)
+
+
+class TestSnapshot(unittest.TestCase):
+    """Test Game.snapshot() and Game.restore() in both modes.
+    """
+
+    def setUp(self):
+        self.game = Game(game_id=3, host='p1')
+        self.game.add_player(1, 'p1')
+        self.game.add_player(2, 'p2')
+        self.game.start()
+
+        for _ in range(10):
+            self.game.handle(thinker_action(self.game))
+
+    def check_restore(self, binary):
+        expected = copy.deepcopy(self.game)
+        snapshot = self.game.snapshot(binary=binary)
+
+        for _ in range(5):
+            self.game.handle(thinker_action(self.game))
+        self.assertNotEqual(self.game.action_number, expected.action_number)
+
+        self.game.restore(snapshot)
+
+        self.assertEqual(self.game, expected)
+        self.assertEqual(self.game.game_log, expected.game_log)
+
+    def test_restore(self):
+        self.check_restore(binary=False)
+
+    def test_restore_binary(self):
+        self.check_restore(binary=True)
+
+    def test_restore_twice(self):
+        """A snapshot isn't changed by playing the restored game."""
+        for binary in (False, True):
+            expected = copy.deepcopy(self.game)
+            snapshot = self.game.snapshot(binary=binary)
+
+            for _ in range(2):
+                self.game.restore(snapshot)
+                self.game.handle(thinker_action(self.game))
+                self.game.players[0].hand.set_content([])
+
+            self.game.restore(snapshot)
+            self.assertEqual(self.game, expected)
+
+    def test_restore_other_game(self):
+        other = Game(game_id=4)
+
+        with self.assertRaises(GTRError):
+            other.restore(self.game.snapshot())
+
+    def test_snapshot_attributes(self):
+        snapshot = self.game.snapshot(binary=True)
+
+        self.assertEqual(snapshot.game_id, 3)
+        self.assertEqual(snapshot.action_number, self.game.action_number)
+        self.assertTrue(snapshot.binary)
+
+    def test_encode_game_body(self):
+        body = encode.encode_game_body(self.game)
+
+        self.assertEqual(encode.encode_game(self.game)[12:], body)
+        self.assertEqual(encode.decode_game(body),
+                encode.str_to_game(encode.game_to_str(self.game)))
+
+
+class TestCopy(unittest.TestCase):
+    """Test the copy of a Game used by snapshots and privatized copies.
+    """
+
+    def setUp(self):
+        self.game = test_setup.two_player_lead('Craftsman',
+                buildings=[['Temple', 'Wall'], ['Road']],
+                clientele=[['Fountain'],['Dock']])
+
+    def test_equal(self):
+        self.assertEqual(self.game._copy(), self.game)
+        self.assertEqual(self.game._copy(), copy.deepcopy(self.game))
+
+    def test_independent(self):
+        gs = self.game._copy()
+        expected = copy.deepcopy(self.game)
+
+        gs.players[0].hand.set_content([])
+        gs.players[0].buildings[0].materials.append(Card(100))
+        gs.players[1].influence.append('Wood')
+        gs.pool.append(Card(101))
+        gs.in_town_sites.pop()
+        gs.stack.stack.pop()
+
+        self.assertEqual(self.game, expected)
+
+    def test_frame_players(self):
+        """Player arguments of stack frames refer to the copied players."""
+        gs = self.game._copy()
+
+        players = [a for f in gs.stack.stack for a in f.args
+                if isinstance(a, Player)]
+        self.assertTrue(players)
+        for p in players:
+            self.assertTrue(any(p is q for q in gs.players))
+            self.assertFalse(any(p is q for q in self.game.players))
+
+
+if __name__ == '__main__':
+    unittest.main()
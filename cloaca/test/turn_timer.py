@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+from cloaca.turn_timer import (TimerWheel, TurnTimer, default_action,
+        RETRY_SECONDS)
+from cloaca.game import Game
+from cloaca.server import GTRServer
+from cloaca.message import GameAction
+from cloaca.error import GTRError
+import cloaca.encode_binary as encode
+import cloaca.encode_action as encode_action
+import cloaca.message as message
+
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+
+from server import MemoryDatabase
+
+import unittest
+
+
+class TestTimerWheel(unittest.TestCase):
+    """Test adding, cancelling and expiring timers.
+    """
+
+    def setUp(self):
+        self.wheel = TimerWheel(tick=1.0, n_slots=8, now=100.0)
+
+    def test_expire(self):
+        self.wheel.add('a', 102.5, 1)
+        self.wheel.add('b', 104.0, 2)
+
+        self.assertEqual(self.wheel.advance(102.9), [])
+        self.assertEqual(self.wheel.advance(103.0), [('a', 1)])
+        self.assertEqual(self.wheel.advance(103.5), [])
+        self.assertEqual(self.wheel.advance(104.0), [('b', 2)])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cancel(self):
+        self.wheel.add('a', 102.0)
+
+        self.assertTrue(self.wheel.cancel('a'))
+        self.assertFalse(self.wheel.cancel('a'))
+        self.assertNotIn('a', self.wheel)
+        self.assertEqual(self.wheel.advance(110.0), [])
+
+    def test_replace(self):
+        self.wheel.add('a', 102.0, 1)
+        self.wheel.add('a', 105.0, 2)
+
+        self.assertEqual(len(self.wheel), 1)
+        self.assertEqual(self.wheel.advance(104.0), [])
+        self.assertEqual(self.wheel.advance(105.0), [('a', 2)])
+
+    def test_later_rotation(self):
+        """Timers more than one rotation away stay in their slot."""
+        self.wheel.add('a', 103.0)
+        self.wheel.add('b', 103.0 + 8)
+        self.wheel.add('c', 103.0 + 16)
+
+        self.assertEqual(self.wheel.advance(103.0), [('a', None)])
+        self.assertEqual(self.wheel.advance(110.0), [])
+        self.assertEqual(self.wheel.advance(111.0), [('b', None)])
+        self.assertEqual(self.wheel.advance(119.0), [('c', None)])
+
+    def test_catch_up(self):
+        """Advancing past several rotations expires everything due."""
+        for i in range(20):
+            self.wheel.add(i, 101.0 + i)
+
+        expired = self.wheel.advance(115.0)
+        self.assertEqual(sorted(k for k, _ in expired), range(15))
+        self.assertEqual(len(self.wheel), 5)
+
+    def test_past_deadline(self):
+        self.wheel.advance(105.0)
+        self.wheel.add('a', 90.0)
+
+        self.assertEqual(self.wheel.advance(105.5), [])
+        self.assertEqual(self.wheel.advance(106.0), [('a', None)])
+
+
+class TestDefaultAction(unittest.TestCase):
+    """Test the actions played for players who run out of time.
+    """
+
+    def setUp(self):
+        self.game = Game(game_id=1, host='p1')
+        self.game.add_player(1, 'p1')
+        self.game.add_player(2, 'p2')
+        self.game.start()
+
+    def test_thinker(self):
+        self.assertEqual(default_action(self.game).args, [True])
+
+    def test_thinker_type(self):
+        self.game.handle(GameAction(message.THINKERORLEAD, True))
+
+        self.assertEqual(default_action(self.game),
+                GameAction(message.THINKERTYPE, False))
+
+    def test_configured(self):
+        lead = {message.THINKERORLEAD:
+                [GameAction(message.THINKERORLEAD, False)]}
+
+        self.assertEqual(default_action(self.game, lead).args, [False])
+
+    def test_abandon(self):
+        p2 = self.game.players[1]
+        self.game.active_player = self.game.players[0]
+        marker = self.game.abandon()
+
+        self.assertTrue(self.game.finished)
+        self.assertEqual(self.game.winners, [p2])
+        self.assertEqual(marker, GameAction(message.ABANDON))
+        self.assertEqual(self.game.action_number, 2)
+
+        with self.assertRaises(GTRError):
+            self.game.abandon()
+
+
+class TestTurnTimer(AsyncTestCase):
+    """Test expiring turns on a GTRServer.
+    """
+
+    def setUp(self):
+        super(TestTurnTimer, self).setUp()
+        self.db = MemoryDatabase()
+        self.db.users = {1: {'username': 'p1'}, 2: {'username': 'p2'}}
+
+        game = Game(game_id=1, host='p1')
+        game.add_player(1, 'p1')
+        game.add_player(2, 'p2')
+        game.controlled_start()
+        self.db.games[1] = encode.game_to_str(game)
+
+        self.server = GTRServer(self.db)
+        self.server.send_commands = lambda u, commands: None
+
+        self.now = 1000.0
+        self.timer = TurnTimer(self.server, timeout=60)
+        self.timer._now = lambda: self.now
+        self.timer.wheel = TimerWheel(1.0, 16, self.now)
+        self.server.turn_timer = self.timer
+
+    def game(self):
+        return encode.str_to_game(self.db.games[1])
+
+    @gen.coroutine
+    def expire(self, seconds):
+        self.now += seconds
+        self.timer._advance()
+        yield gen.sleep(0.01)
+
+    @gen_test
+    def test_default_action(self):
+        self.timer.update(self.game())
+
+        yield self.expire(59)
+        self.assertEqual(self.game().action_number, 1)
+
+        yield self.expire(1)
+        game = self.game()
+        self.assertEqual(game.action_number, 2)
+        self.assertEqual(game.expected_action, message.THINKERTYPE)
+
+        # Storing the new state restarted the timer.
+        self.assertIn(1, self.timer.wheel)
+        self.assertEqual(self.timer.stats()['n_default_actions'], 1)
+
+    @gen_test
+    def test_action_restarts_timer(self):
+        self.timer.update(self.game())
+
+        yield self.expire(30)
+        yield self.server.handle_game_actions(1, 1,
+                [[1, GameAction(message.THINKERORLEAD, True)]])
+
+        yield self.expire(40)
+        self.assertEqual(self.game().action_number, 2)
+
+        yield self.expire(20)
+        self.assertEqual(self.game().action_number, 3)
+
+    @gen_test
+    def test_stale_timer(self):
+        """A timer for an action that was already taken is ignored."""
+        self.timer.wheel.add(1, self.now + 1, 0)
+
+        yield self.expire(1)
+        self.assertEqual(self.game().action_number, 1)
+        self.assertEqual(self.timer.stats()['n_default_actions'], 0)
+
+    @gen_test
+    def test_abandon(self):
+        self.timer.on_expiry = 'abandon'
+        self.timer.update(self.game())
+
+        yield self.expire(60)
+        game = self.game()
+        self.assertTrue(game.finished)
+        self.assertEqual([p.name for p in game.winners], ['p2'])
+        self.assertEqual(game.action_number, 2)
+        self.assertIn('p1 ran out of time. The game is abandoned.',
+                self.db.logs[1][-1])
+        self.assertEqual(encode_action.decode_action_log(self.db.actions[1]),
+                (1, [GameAction(message.ABANDON)]))
+
+        self.assertNotIn(1, self.timer.wheel)
+        self.assertEqual(self.timer.stats()['n_abandoned'], 1)
+
+    @gen_test
+    def test_rejected_default_action(self):
+        """A game whose default action isn't taken is abandoned."""
+        @gen.coroutine
+        def reject(game_id, user_id, actions):
+            yield gen.moment
+        self.server.handle_game_actions = reject
+        self.timer.update(self.game())
+
+        yield self.expire(60)
+        self.assertTrue(self.game().finished)
+        self.assertEqual(self.timer.stats()['n_abandoned'], 1)
+
+    @gen_test
+    def test_retry_after_error(self):
+        @gen.coroutine
+        def fail(game_id, action_number):
+            raise GTRError('Timeout acquiring lock to abandon game.')
+        self.server.abandon_game = fail
+        self.timer.on_expiry = 'abandon'
+        self.timer.update(self.game())
+
+        yield self.expire(60)
+        self.assertIn(1, self.timer.wheel)
+
+        del self.server.abandon_game
+        yield self.expire(RETRY_SECONDS)
+        self.assertTrue(self.game().finished)
+        self.assertNotIn(1, self.timer.wheel)
+
+    @gen_test
+    def test_max_expiries_per_tick(self):
+        self.timer.max_expiries_per_tick = 0
+        self.timer.update(self.game())
+
+        yield self.expire(60)
+        self.assertEqual(self.game().action_number, 1)
+        self.assertIn(1, self.timer.wheel)
+
+        self.timer.max_expiries_per_tick = 1
+        yield self.expire(1)
+        self.assertEqual(self.game().action_number, 2)
+
+    def test_bad_on_expiry(self):
+        with self.assertRaises(ValueError):
+            TurnTimer(self.server, on_expiry='kick')
+
+
+if __name__ == '__main__':
+    unittest.main()
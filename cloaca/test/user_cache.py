@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+from cloaca.user_cache import UserCache
+from cloaca.error import GTRDBError
+
+from tornado import gen
+from tornado.queues import Queue
+from tornado.testing import AsyncTestCase, gen_test
+
+import unittest
+import time
+
+class CountingUserDatabase(object):
+    """In-memory users and sessions with the GTRDB methods used by
+    UserCache. Counts the calls made to it.
+    """
+
+    def __init__(self):
+        self.users = {1: {'username': 'p1'}, 2: {'username': 'p2'}}
+        self.sessions = {'s1': 1, 's2': 2}
+        self.last_login = {}
+        self.n_calls = 0
+
+    @gen.coroutine
+    def retrieve_userid_from_session_auth(self, session_auth):
+        self.n_calls += 1
+        raise gen.Return(self.sessions.get(session_auth))
+
+    @gen.coroutine
+    def retrieve_user_session_auth(self, user_id):
+        self.n_calls += 1
+        for session_auth, u in self.sessions.items():
+            if u == user_id:
+                raise gen.Return(session_auth)
+
+    @gen.coroutine
+    def retrieve_user(self, user_id):
+        self.n_calls += 1
+        raise gen.Return(dict(self.users[user_id]))
+
+    @gen.coroutine
+    def update_user_session(self, user_id, session_auth):
+        self.n_calls += 1
+        for s, u in self.sessions.items():
+            if u == user_id:
+                del self.sessions[s]
+        self.sessions[session_auth] = user_id
+
+    @gen.coroutine
+    def update_users_last_login(self, last_login_by_user):
+        self.n_calls += 1
+        self.last_login.update(last_login_by_user)
+
+
+class SharedUserDatabase(CountingUserDatabase):
+    """CountingUserDatabase for one of several processes, which share the
+    sessions and the list of subscribers to session invalidations.
+    """
+
+    def __init__(self, sessions, subscribers):
+        super(SharedUserDatabase, self).__init__()
+        self.sessions = sessions
+        self.subscribers = subscribers
+        self.invalidations = None
+
+    @gen.coroutine
+    def publish_session_invalidation(self, user_id):
+        for q in self.subscribers:
+            q.put(user_id)
+
+    @gen.coroutine
+    def subscribe_session_invalidations(self):
+        self.invalidations = Queue()
+        self.subscribers.append(self.invalidations)
+
+    @gen.coroutine
+    def pop_session_invalidation(self):
+        user_id = yield self.invalidations.get()
+        if isinstance(user_id, Exception):
+            raise user_id
+        raise gen.Return(user_id)
+
+
+class TestUserCache(AsyncTestCase):
+    """Test session lookups, invalidation, and last login updates.
+    """
+
+    def setUp(self):
+        super(TestUserCache, self).setUp()
+        self.db = CountingUserDatabase()
+        self.cache = UserCache(self.db)
+
+    @gen_test
+    def test_session_lookup(self):
+        user = yield self.cache.user_from_session('s1')
+        self.assertEqual(user, {'username': 'p1', 'user_id': 1})
+
+    @gen_test
+    def test_unknown_session(self):
+        user = yield self.cache.user_from_session('nope')
+        self.assertIsNone(user)
+
+    @gen_test
+    def test_warm_lookup_no_database_calls(self):
+        yield self.cache.user_from_session('s1')
+        n_calls = self.db.n_calls
+
+        user = yield self.cache.user_from_session('s1')
+        userdict = yield self.cache.retrieve_user(1)
+
+        self.assertEqual(self.db.n_calls, n_calls)
+        self.assertEqual(user['username'], 'p1')
+        self.assertEqual(userdict['username'], 'p1')
+
+    @gen_test
+    def test_returns_copies(self):
+        user = yield self.cache.user_from_session('s1')
+        user['username'] = 'changed'
+
+        user = yield self.cache.user_from_session('s1')
+        self.assertEqual(user['username'], 'p1')
+
+    @gen_test
+    def test_expired_entries_reloaded(self):
+        self.cache.ttl = -1
+        yield self.cache.user_from_session('s1')
+        n_calls = self.db.n_calls
+
+        yield self.cache.user_from_session('s1')
+        self.assertEqual(self.db.n_calls, 2*n_calls)
+
+    @gen_test
+    def test_update_session_invalidates(self):
+        yield self.cache.user_from_session('s1')
+        yield self.cache.update_user_session(1, 's1-new')
+
+        user = yield self.cache.user_from_session('s1')
+        self.assertIsNone(user)
+
+        user = yield self.cache.user_from_session('s1-new')
+        self.assertEqual(user['user_id'], 1)
+
+    @gen_test
+    def test_last_login_batched(self):
+        yield self.cache.user_from_session('s1')
+        yield self.cache.user_from_session('s2')
+        n_calls = self.db.n_calls
+
+        yield self.cache.flush()
+
+        self.assertEqual(self.db.n_calls, n_calls + 1)
+        self.assertEqual(sorted(self.db.last_login.keys()), [1, 2])
+
+    @gen_test
+    def test_last_login_rate_limited(self):
+        t = int(time.time())
+        interval = self.cache.last_login_interval
+
+        self.cache.touch_last_login(1, t)
+        yield self.cache.flush()
+        self.cache.touch_last_login(1, t + 1)
+        yield self.cache.flush()
+
+        self.assertEqual(self.db.last_login, {1: t})
+
+        self.cache.touch_last_login(1, t + interval)
+        yield self.cache.flush()
+
+        self.assertEqual(self.db.last_login, {1: t + interval})
+
+    @gen_test
+    def test_flush_evicts_expired(self):
+        yield self.cache.user_from_session('s1')
+        self.cache._now = lambda: float('inf')
+
+        yield self.cache.flush()
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['n_users'], 0)
+        self.assertEqual(stats['n_sessions'], 0)
+
+
+class TestSharedUserCache(AsyncTestCase):
+    """Test invalidating sessions in the caches of several processes.
+    """
+
+    def setUp(self):
+        super(TestSharedUserCache, self).setUp()
+        sessions = {'s1': 1, 's2': 2}
+        subscribers = []
+        self.caches = []
+        for _ in range(2):
+            db = SharedUserDatabase(sessions, subscribers)
+            self.caches.append(UserCache(db, shared=True))
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.stop()
+        super(TestSharedUserCache, self).tearDown()
+
+    @gen.coroutine
+    def start(self):
+        for cache in self.caches:
+            cache.start()
+        while not all(c._subscribed for c in self.caches):
+            yield gen.moment
+
+    @gen.coroutine
+    def wait_for_sessions(self, cache, n_sessions):
+        while cache.stats()['n_sessions'] != n_sessions:
+            yield gen.moment
+
+    @gen_test
+    def test_update_session_invalidates_other_process(self):
+        yield self.start()
+        a, b = self.caches
+
+        yield b.user_from_session('s1')
+        yield a.update_user_session(1, 's1-new')
+        yield self.wait_for_sessions(b, 0)
+
+        user = yield b.user_from_session('s1')
+        self.assertIsNone(user)
+
+        user = yield b.user_from_session('s1-new')
+        self.assertEqual(user['user_id'], 1)
+
+    @gen_test
+    def test_not_cached_until_subscribed(self):
+        cache = self.caches[0]
+
+        yield cache.user_from_session('s1')
+        yield cache.user_from_session('s1')
+
+        self.assertEqual(cache.stats()['n_sessions'], 0)
+        self.assertEqual(cache.n_misses, 2)
+
+    @gen_test
+    def test_listener_failure_forgets_sessions(self):
+        yield self.start()
+        cache = self.caches[0]
+        cache.RETRY_SECONDS = 0
+
+        yield cache.user_from_session('s1')
+        self.assertEqual(cache.stats()['n_sessions'], 1)
+
+        cache.db.invalidations.put(GTRDBError('closed connection'))
+        yield self.wait_for_sessions(cache, 0)
+        self.assertFalse(cache._subscribed)
+
+        # Sessions are cached again once it has re-subscribed.
+        while not cache._subscribed:
+            yield gen.moment
+        yield cache.user_from_session('s1')
+        self.assertEqual(cache.stats()['n_sessions'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
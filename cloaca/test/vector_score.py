@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+from cloaca.game import Game
+from cloaca.player import Player
+from cloaca.building import Building
+from cloaca.card import Card
+import cloaca.card_manager as cm
+
+try:
+    import numpy
+    import cloaca.vector_score as vs
+except ImportError:
+    numpy = None
+
+import random
+import unittest
+
+# Buildings that change the scoring, plus Gate, which activates
+# incomplete Marble buildings.
+SCORING_BUILDINGS = ['Statue', 'Wall', 'Market', 'Insula', 'Aqueduct', 'Gate']
+
+
+def random_game(rng):
+    """Return a game with 1-5 players holding random vaults, influence,
+    stockpiles, hands and scoring buildings.
+    """
+    orders = [Card(i) for i in range(6, len(cm.standard_deck()))]
+
+    players = []
+    for i in range(rng.randint(1, 5)):
+        p = Player(i, 'p{0:d}'.format(i))
+        p.vault.set_content(rng.sample(orders, rng.randint(0, 8)))
+        p.stockpile.set_content(rng.sample(orders, rng.randint(0, 9)))
+        p.hand.set_content(rng.sample(orders, rng.randint(0, 4)))
+        p.influence = [rng.choice(cm.get_materials())
+                for _ in range(rng.randint(0, 4))]
+
+        for name in SCORING_BUILDINGS:
+            if rng.random() < 0.3:
+                card = cm.get_card(name)
+                p.buildings.append(Building(card, card.material,
+                        complete=rng.random() < 0.7))
+        players.append(p)
+
+    return Game(players=players)
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestVectorScore(unittest.TestCase):
+    """Compare the vectorized scoring with the Game methods on random
+    game states.
+    """
+
+    def setUp(self):
+        rng = random.Random(1234)
+        self.games = [random_game(rng) for _ in range(60)]
+        self.arrays = vs.game_arrays(self.games)
+
+    def per_player(self, f):
+        """Array [game, player] of f(game, player), 0 for padding."""
+        values = numpy.zeros(self.arrays.mask.shape, dtype=int)
+        for i, g in enumerate(self.games):
+            for j, p in enumerate(g.players):
+                values[i,j] = f(g, p)
+        return values
+
+    def test_vault_score(self):
+        numpy.testing.assert_array_equal(vs.vault_scores(self.arrays),
+                self.per_player(Game._vault_score))
+
+    def test_buildings_score(self):
+        numpy.testing.assert_array_equal(vs.buildings_scores(self.arrays),
+                self.per_player(Game._buildings_score))
+
+    def test_player_score(self):
+        numpy.testing.assert_array_equal(vs.player_scores(self.arrays),
+                self.per_player(Game._player_score))
+
+    def test_limits(self):
+        mask = self.arrays.mask
+        numpy.testing.assert_array_equal(vs.clientele_limits(self.arrays)[mask],
+                self.per_player(Game._clientele_limit)[mask])
+        numpy.testing.assert_array_equal(vs.vault_limits(self.arrays)[mask],
+                self.per_player(Game._vault_limit)[mask])
+
+    def test_winners(self):
+        winners = vs.winners(self.arrays)
+
+        for i, g in enumerate(self.games):
+            expected = [p.uid for p in g._calc_winners()]
+            self.assertEqual(list(numpy.flatnonzero(winners[i])), expected)
+
+    def test_ties(self):
+        """Equal scores are broken by hand size, and equal hands share
+        the win.
+        """
+        game = Game(players=[Player(i, 'p{0:d}'.format(i)) for i in range(3)])
+        for p in game.players:
+            p.influence = ['Wood']
+            p.hand.set_content([cm.get_card('Wall', 0)])
+        game.players[0].hand.set_content([])
+
+        winners = vs.winners(vs.game_arrays([game]))
+        self.assertEqual(list(numpy.flatnonzero(winners[0])), [1, 2])
+        self.assertEqual([p.uid for p in game._calc_winners()], [1, 2])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,265 @@
+"""Turn timers for players who stop responding.
+
+Each started game has a deadline for its expected action, restarted
+whenever the server stores a new state of the game. When a player doesn't
+act before the deadline, TurnTimer either plays a default action for them
+or abandons the game:
+
+    turn_timer = TurnTimer(server, timeout=300, on_expiry='default')
+    server.turn_timer = turn_timer
+    turn_timer.start()
+
+The default actions are the ones that are almost always legal and don't
+spend anything: think instead of leading or following, draw cards rather
+than a Jack, and skip the optional Thinker of a Latrine or Vomitorium.
+They can be replaced with `default_actions`. For any other expected
+action, the first legal action of cloaca.bot.candidate_actions() is
+played. If there is none, or the server rejects it, or with
+on_expiry='abandon', the game is ended with Game.abandon(). If the game
+can't be loaded or stored, its timer is retried after RETRY_SECONDS.
+
+Deadlines are kept in a TimerWheel, so that 100k idle games don't cost
+100k IOLoop timeouts. Starting, restarting and cancelling a timer is O(1)
+and a single PeriodicCallback advances the wheel every `tick` seconds.
+Timers fire at most one tick late. At most `max_expiries_per_tick` are
+handled per tick, and the rest are deferred to the next one.
+
+Timers are kept in memory in the process that stored the game. After a
+restart, a game's timer starts again with its next action. With several
+server processes, a timer that fires in one process for a game that has
+moved on in another is ignored.
+"""
+
+from cloaca.bot import candidate_actions, try_action
+from cloaca.error import GTRError
+from cloaca.message import GameAction
+import cloaca.encode_binary as encode
+import cloaca.message as message
+
+from tornado import gen
+import tornado.ioloop
+
+import logging
+import math
+import time
+
+lg = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 300.0
+DEFAULT_TICK = 1.0
+DEFAULT_SLOTS = 4096
+DEFAULT_MAX_EXPIRIES_PER_TICK = 100
+RETRY_SECONDS = 10.0
+
+# Actions tried in order for each expected action, before any others.
+DEFAULT_ACTIONS = {
+        message.THINKERORLEAD: [GameAction(message.THINKERORLEAD, True)],
+        message.FOLLOWROLE: [GameAction(message.FOLLOWROLE, 0)],
+        message.THINKERTYPE: [GameAction(message.THINKERTYPE, False),
+                              GameAction(message.THINKERTYPE, True)],
+        message.SKIPTHINKER: [GameAction(message.SKIPTHINKER, True)],
+        }
+
+
+class TimerWheel(object):
+    """Hashed timing wheel of `n_slots` slots of `tick` seconds.
+
+    Each timer is identified by a key and holds a value. A timer is put in
+    the slot of the tick that ends at or after its deadline, so a slot
+    holds the timers of every tick that maps to it. Timers of later
+    rotations are kept until their tick comes around.
+
+        wheel.add('a', deadline, value)
+        wheel.cancel('a')
+        expired = wheel.advance(now) # [(key, value), ...]
+    """
+
+    def __init__(self, tick=DEFAULT_TICK, n_slots=DEFAULT_SLOTS, now=0.0):
+        self.tick = tick
+        self.n_slots = n_slots
+
+        self._slots = [{} for _ in xrange(n_slots)] # key -> value
+        self._ticks = {} # key -> tick of the deadline
+        self._next_tick = int(now / tick) # first tick not yet advanced
+
+
+    def __len__(self):
+        return len(self._ticks)
+
+
+    def __contains__(self, key):
+        return key in self._ticks
+
+
+    def add(self, key, deadline, value=None):
+        """Start a timer for `key` expiring at `deadline`, replacing any
+        timer it already has.
+        """
+        self.cancel(key)
+
+        t = max(int(math.ceil(deadline / self.tick)), self._next_tick)
+        self._ticks[key] = t
+        self._slots[t % self.n_slots][key] = value
+
+
+    def cancel(self, key):
+        """Remove the timer for `key`. Return False if there wasn't one."""
+        t = self._ticks.pop(key, None)
+        if t is None:
+            return False
+
+        del self._slots[t % self.n_slots][key]
+        return True
+
+
+    def advance(self, now):
+        """Remove the timers with deadlines at or before `now` and return
+        a list of their (key, value) tuples.
+        """
+        now_tick = int(now / self.tick)
+        n_ticks = now_tick - self._next_tick + 1
+
+        expired = []
+        for t in xrange(self._next_tick,
+                self._next_tick + min(n_ticks, self.n_slots)):
+            slot = self._slots[t % self.n_slots]
+            for key in [k for k in slot if self._ticks[k] <= now_tick]:
+                expired.append((key, slot.pop(key)))
+                del self._ticks[key]
+
+        self._next_tick = max(self._next_tick, now_tick + 1)
+        return expired
+
+
+def default_action(game, default_actions=DEFAULT_ACTIONS):
+    """Return the action to play for the active player of `game` when they
+    run out of time, or None if there is no legal action.
+    """
+    candidates = (default_actions.get(game.expected_action, []) +
+            candidate_actions(game))
+    for action in candidates:
+        if try_action(game, action) is not None:
+            return action
+    return None
+
+
+class TurnTimer(object):
+    """Expire the turns of the games on `server`, a GTRServer, that wait
+    more than `timeout` seconds for an action. See the module
+    documentation.
+
+    `on_expiry` is 'default' to play a default action for the player, or
+    'abandon' to end the game.
+    """
+
+    def __init__(self, server, timeout=DEFAULT_TIMEOUT, on_expiry='default',
+            default_actions=DEFAULT_ACTIONS, tick=DEFAULT_TICK,
+            n_slots=DEFAULT_SLOTS,
+            max_expiries_per_tick=DEFAULT_MAX_EXPIRIES_PER_TICK):
+        if on_expiry not in ('default', 'abandon'):
+            raise ValueError('on_expiry must be "default" or "abandon", '
+                    'not {0!r}'.format(on_expiry))
+
+        self.server = server
+        self.timeout = timeout
+        self.on_expiry = on_expiry
+        self.default_actions = default_actions
+        self.tick = tick
+        self.max_expiries_per_tick = max_expiries_per_tick
+
+        # Timers are keyed by game ID with the action number they were
+        # started for.
+        self.wheel = TimerWheel(tick, n_slots, self._now())
+        self._callback = None
+
+        self.n_default_actions = 0
+        self.n_abandoned = 0
+
+
+    def _now(self):
+        return time.time()
+
+
+    def start(self):
+        """Begin advancing the timers on the current IOLoop."""
+        if self._callback is None:
+            self._callback = tornado.ioloop.PeriodicCallback(
+                    self._advance, self.tick * 1000)
+            self._callback.start()
+
+
+    def stop(self):
+        if self._callback is not None:
+            self._callback.stop()
+            self._callback = None
+
+
+    def update(self, game):
+        """Restart the timer of `game` after a new state was stored, or
+        cancel it if the game isn't waiting for an action.
+        """
+        if (not game.started or game.finished or
+                game.expected_action is None):
+            self.wheel.cancel(game.game_id)
+        else:
+            self.wheel.add(game.game_id, self._now() + self.timeout,
+                    game.action_number)
+
+
+    def _advance(self):
+        now = self._now()
+        expired = self.wheel.advance(now)
+
+        for game_id, action_number in expired[self.max_expiries_per_tick:]:
+            self.wheel.add(game_id, now, action_number)
+
+        for game_id, action_number in expired[:self.max_expiries_per_tick]:
+            tornado.ioloop.IOLoop.current().spawn_callback(
+                    self._expire, game_id, action_number)
+
+
+    @gen.coroutine
+    def _expire(self, game_id, action_number):
+        """Play a default action or abandon game `game_id` if it's still
+        waiting for action `action_number`.
+        """
+        try:
+            if self.on_expiry == 'default':
+                game_encoded = yield self.server.db.retrieve_game(game_id)
+                if game_encoded is None:
+                    return
+
+                game = encode.str_to_game(game_encoded)
+                if game.finished or game.action_number != action_number:
+                    return
+
+                action = default_action(game, self.default_actions)
+                if action is not None:
+                    lg.info('Player {0} ran out of time in game {1:d}. '
+                            'Playing {2!r}.'.format(game.active_player.name,
+                                game_id, action))
+                    self.n_default_actions += 1
+                    yield self.server.handle_game_actions(game_id,
+                            game.active_player.uid, [[action_number, action]])
+
+            # If a default action was rejected, the game is still waiting
+            # and no new state restarted its timer. This does nothing if
+            # the action was taken.
+            abandoned = yield self.server.abandon_game(game_id, action_number)
+            if abandoned:
+                self.n_abandoned += 1
+
+        except GTRError as e:
+            lg.warning('Failed to expire the turn in game {0:d}: {1}'
+                    .format(game_id, e.message))
+            if game_id not in self.wheel:
+                self.wheel.add(game_id, self._now() + RETRY_SECONDS,
+                        action_number)
+
+
+    def stats(self):
+        return {
+                'n_timers': len(self.wheel),
+                'n_default_actions': self.n_default_actions,
+                'n_abandoned': self.n_abandoned,
+                }
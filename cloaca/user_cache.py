@@ -0,0 +1,285 @@
+"""Cache of user records and sessions for the web handlers and game server.
+
+Every authenticated request resolves its session cookie to a user, and
+every GTRServer method looks up the user again. UserCache keeps the
+session -> user_id mapping and the user hashes in memory for `ttl` seconds
+so that warm requests don't go to the database at all.
+
+    user_cache = UserCache(database)
+    user_cache.start()
+
+    user = yield user_cache.user_from_session(session_auth)
+    userdict = yield user_cache.retrieve_user(user_id)
+
+Sessions are invalidated when they are replaced with
+UserCache.update_user_session(), which is used by login and logout. If
+several server processes share the database, the cache must be created
+with `shared=True`. The user ID is then published to the other processes,
+which drop their cached session and user hash for it (see
+GTRDBTornadis.publish_session_invalidation()). While a process isn't
+subscribed to the invalidations, eg. because the pub/sub connection
+failed, it doesn't cache sessions at all, and it forgets the sessions it
+has cached, since it may have missed invalidations.
+
+Updates to the <last_login> field are rate-limited to one per user per
+`last_login_interval` seconds. They are collected and written in a single
+pipeline every `flush_interval` seconds.
+"""
+
+from tornado import gen
+import tornado.ioloop
+
+from cloaca.error import GTRDBError
+
+import logging
+import time
+
+lg = logging.getLogger(__name__)
+
+
+class UserCache(object):
+    """TTL cache of user hashes and session tokens in front of
+    a cloaca.db.GTRDB.
+    """
+
+    RETRY_SECONDS = 1
+
+    def __init__(self, database, ttl=60, last_login_interval=300,
+            flush_interval=10, shared=False):
+        self.db = database
+        self.ttl = ttl
+        self.last_login_interval = last_login_interval
+        self.flush_interval = flush_interval
+
+        # Sessions are only cached while this is True. See start().
+        self.shared = shared
+        self._subscribed = not shared
+
+        self._users = {} # user_id -> (expiry, user dict)
+        self._sessions = {} # session_auth -> (expiry, user_id)
+        self._session_by_user = {} # user_id -> session_auth
+
+        self._last_login_written = {} # user_id -> last_login time
+        self._last_login_pending = {} # user_id -> last_login time
+
+        self._flush_callback = None
+
+        # Session lookups
+        self.n_hits = 0
+        self.n_misses = 0
+
+        # User hash lookups
+        self.n_user_hits = 0
+        self.n_user_misses = 0
+
+
+    def start(self):
+        """Begin the periodic flush of <last_login> updates and eviction
+        of expired entries on the current IOLoop. If the cache is shared,
+        also begin listening for session invalidations.
+        """
+        if self._flush_callback is None:
+            self._flush_callback = tornado.ioloop.PeriodicCallback(
+                    self.flush, self.flush_interval * 1000)
+            self._flush_callback.start()
+
+            if self.shared:
+                tornado.ioloop.IOLoop.current().spawn_callback(
+                        self._listen_invalidations)
+
+
+    def stop(self):
+        if self._flush_callback is not None:
+            self._flush_callback.stop()
+            self._flush_callback = None
+
+
+    @gen.coroutine
+    def _listen_invalidations(self):
+        """Drop the sessions replaced by other processes. Runs until
+        stop() is called, re-subscribing if the pub/sub connection fails.
+        """
+        while self._flush_callback is not None:
+            try:
+                yield self.db.subscribe_session_invalidations()
+                self._subscribed = True
+
+                while True:
+                    user_id = yield self.db.pop_session_invalidation()
+                    self._drop_user_session(user_id)
+                    self.invalidate_user(user_id)
+
+            except GTRDBError as e:
+                lg.error('Session invalidation listener failed: {0}'
+                        .format(e.message))
+                self._subscribed = False
+                self._sessions.clear()
+                self._session_by_user.clear()
+                yield gen.sleep(self.RETRY_SECONDS)
+
+
+    def _now(self):
+        return time.time()
+
+
+    @gen.coroutine
+    def user_from_session(self, session_auth):
+        """Return a copy of the user hash for the session token
+        `session_auth`, with the additional key 'user_id', or None if
+        the token doesn't match the user's current session.
+
+        Records a login for the user (see touch_last_login()).
+        """
+        now = self._now()
+
+        try:
+            expiry, user_id = self._sessions[session_auth]
+        except KeyError:
+            expiry = None
+
+        if expiry is None or expiry < now:
+            self._drop_session(session_auth)
+            self.n_misses += 1
+
+            user_id = yield self.db.retrieve_userid_from_session_auth(session_auth)
+            if user_id is None:
+                raise gen.Return(None)
+
+            user_session_auth = yield self.db.retrieve_user_session_auth(user_id)
+            if user_session_auth != session_auth:
+                raise gen.Return(None)
+
+            self._drop_user_session(user_id)
+            if self._subscribed:
+                self._sessions[session_auth] = (now + self.ttl, user_id)
+                self._session_by_user[user_id] = session_auth
+        else:
+            self.n_hits += 1
+
+        user_dict = yield self.retrieve_user(user_id)
+        user_dict['user_id'] = user_id
+
+        self.touch_last_login(user_id, int(now))
+
+        raise gen.Return(user_dict)
+
+
+    @gen.coroutine
+    def retrieve_user(self, user_id):
+        """Return a copy of the user hash for `user_id`, like
+        GTRDB.retrieve_user().
+        """
+        now = self._now()
+
+        try:
+            expiry, user_dict = self._users[user_id]
+        except KeyError:
+            expiry = None
+
+        if expiry is None or expiry < now:
+            self.n_user_misses += 1
+            user_dict = yield self.db.retrieve_user(user_id)
+            self._users[user_id] = (now + self.ttl, user_dict)
+        else:
+            self.n_user_hits += 1
+
+        raise gen.Return(dict(user_dict))
+
+
+    @gen.coroutine
+    def update_user_session(self, user_id, session_auth):
+        """Replace the session token for user `user_id` in the database,
+        invalidating the cached session, in every process if the cache is
+        shared.
+        """
+        yield self.db.update_user_session(user_id, session_auth)
+
+        # Dropped after the update, so the old session can't be reloaded.
+        self._drop_user_session(user_id)
+        self.invalidate_user(user_id)
+
+        if self.shared:
+            yield self.db.publish_session_invalidation(user_id)
+
+
+    def invalidate_user(self, user_id):
+        """Drop the cached user hash for `user_id`."""
+        self._users.pop(user_id, None)
+
+
+    def _drop_session(self, session_auth):
+        try:
+            _, user_id = self._sessions.pop(session_auth)
+        except KeyError:
+            return
+
+        if self._session_by_user.get(user_id) == session_auth:
+            del self._session_by_user[user_id]
+
+
+    def _drop_user_session(self, user_id):
+        try:
+            session_auth = self._session_by_user.pop(user_id)
+        except KeyError:
+            return
+
+        self._sessions.pop(session_auth, None)
+
+
+    def touch_last_login(self, user_id, last_login_time):
+        """Schedule an update of the user's <last_login> field, unless
+        one was written less than `last_login_interval` seconds ago.
+        """
+        last = self._last_login_written.get(user_id)
+        if last is None or last_login_time - last >= self.last_login_interval:
+            self._last_login_written[user_id] = last_login_time
+            self._last_login_pending[user_id] = last_login_time
+
+
+    @gen.coroutine
+    def flush(self):
+        """Write the pending <last_login> updates and evict expired
+        entries.
+        """
+        self._evict_expired()
+
+        if not self._last_login_pending:
+            return
+
+        pending = self._last_login_pending
+        self._last_login_pending = {}
+
+        try:
+            yield self.db.update_users_last_login(pending)
+        except Exception as e:
+            lg.warning('Failed to update last login times: {0!s}'.format(e))
+
+
+    def _evict_expired(self):
+        now = self._now()
+
+        for user_id, (expiry, _) in self._users.items():
+            if expiry < now:
+                del self._users[user_id]
+
+        for session_auth, (expiry, _) in self._sessions.items():
+            if expiry < now:
+                self._drop_session(session_auth)
+
+        # Forget write times that no longer limit the next write.
+        horizon = now - self.last_login_interval
+        for user_id, t in self._last_login_written.items():
+            if t < horizon:
+                del self._last_login_written[user_id]
+
+
+    def stats(self):
+        return {
+                'n_users': len(self._users),
+                'n_sessions': len(self._sessions),
+                'n_hits': self.n_hits,
+                'n_misses': self.n_misses,
+                'n_user_hits': self.n_user_hits,
+                'n_user_misses': self.n_user_misses,
+                'n_last_login_pending': len(self._last_login_pending),
+                }
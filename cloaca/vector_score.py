@@ -0,0 +1,159 @@
+"""Score many game states at once with NumPy.
+
+The scoring methods of Game (_player_score(), _vault_score(),
+_buildings_score(), _clientele_limit(), _vault_limit() and _calc_winners())
+work on one player at a time. For analytics and bot evaluation, the same
+rules are computed here for a batch of games in a few array operations.
+
+A batch is a GameArrays of dense arrays indexed by [game, player, ...].
+Games with fewer players than the batch width are padded, with `mask`
+marking the real players.
+
+    arrays = game_arrays(games)
+    scores = player_scores(arrays)
+    won = winners(arrays, scores)
+
+The active building flags are inputs, since deciding whether a building is
+active depends on the Gate and Stairway. game_arrays() takes them from
+Game._player_has_active_building().
+
+NumPy is required for this module.
+"""
+from collections import namedtuple
+
+import numpy
+
+import cloaca.card_manager as cm
+
+MATERIALS = cm.get_materials()
+
+# Value of each material, in the order of MATERIALS
+MATERIAL_VALUES = numpy.array([cm.get_value_of_material(m) for m in MATERIALS])
+
+_MATERIAL_INDEX = dict((m, i) for i, m in enumerate(MATERIALS))
+
+# Material index of each card by ident, or None for Jacks. Card.material
+# reads the card database, so look each name up only once.
+_CARD_MATERIAL_INDEX = dict(
+        (name, _MATERIAL_INDEX.get(cm.get_material_of_card(name)))
+        for name in set(cm.standard_deck()))
+_CARD_MATERIAL_INDEX = [_CARD_MATERIAL_INDEX[name]
+        for name in cm.standard_deck()]
+
+_BUILDING_FLAGS = ('Statue', 'Wall', 'Market', 'Insula', 'Aqueduct')
+
+GameArrays = namedtuple('GameArrays', [
+    'mask',        # (bool) real players, not padding
+    'vault',       # (int) [game, player, material] count of vault cards
+    'influence',   # (int) [game, player, material] count of influence sites
+    'stockpile',   # (int) number of stockpile cards
+    'hand',        # (int) number of cards in hand
+    'statue',      # (bool) Statue is active
+    'wall',        # (bool) Wall is active
+    'market',      # (bool) Market is active
+    'insula',      # (bool) Insula is active
+    'aqueduct',    # (bool) Aqueduct is active
+    ])
+
+
+def game_arrays(games, n_players=None):
+    """Return a GameArrays for the list of Game objects `games`, padded to
+    `n_players` players per game (the most in any game by default).
+    """
+    if n_players is None:
+        n_players = max(len(g.players) for g in games) if games else 0
+
+    shape = (len(games), n_players)
+    mask = numpy.zeros(shape, dtype=bool)
+    vault = numpy.zeros(shape + (len(MATERIALS),), dtype=int)
+    influence = numpy.zeros(shape + (len(MATERIALS),), dtype=int)
+    stockpile = numpy.zeros(shape, dtype=int)
+    hand = numpy.zeros(shape, dtype=int)
+    flags = dict((b, numpy.zeros(shape, dtype=bool)) for b in _BUILDING_FLAGS)
+
+    for i, game in enumerate(games):
+        for j, p in enumerate(game.players):
+            mask[i,j] = True
+            for card in p.vault:
+                vault[i,j,_CARD_MATERIAL_INDEX[card.ident]] += 1
+            for material in p.influence:
+                influence[i,j,_MATERIAL_INDEX[material]] += 1
+            stockpile[i,j] = len(p.stockpile)
+            hand[i,j] = len(p.hand)
+
+            active = game._active_building_names(p)
+            for b in _BUILDING_FLAGS:
+                flags[b][i,j] = b in active
+
+    return GameArrays(mask, vault, influence, stockpile, hand,
+            flags['Statue'], flags['Wall'], flags['Market'], flags['Insula'],
+            flags['Aqueduct'])
+
+
+def merchant_bonuses(arrays):
+    """Return a bool array [game, player, material] that is True if the
+    player has strictly more cards of that material in their vault than
+    any other player. See Game._vault_score().
+    """
+    vault = numpy.where(arrays.mask[...,numpy.newaxis], arrays.vault, -1)
+    maximum = vault.max(axis=1)[:,numpy.newaxis,:]
+    n_at_max = (vault == maximum).sum(axis=1)[:,numpy.newaxis,:]
+
+    return (vault == maximum) & (n_at_max == 1) & (maximum > 0)
+
+
+def vault_scores(arrays):
+    """Points from vault cards and merchant bonuses. See
+    Game._vault_score().
+    """
+    card_pts = (arrays.vault * MATERIAL_VALUES).sum(axis=2)
+    bonus_pts = 3 * merchant_bonuses(arrays).sum(axis=2)
+    return numpy.where(arrays.mask, card_pts + bonus_pts, 0)
+
+
+def influence_points(arrays):
+    """Influence, starting at 2, plus the value of each influence site.
+    See Player.influence_points.
+    """
+    return 2 + (arrays.influence * MATERIAL_VALUES).sum(axis=2)
+
+
+def buildings_scores(arrays):
+    """Points from influence, Statue and Wall. See
+    Game._buildings_score().
+    """
+    pts = (influence_points(arrays) + 3*arrays.statue
+            + numpy.where(arrays.wall, arrays.stockpile // 2, 0))
+    return numpy.where(arrays.mask, pts, 0)
+
+
+def player_scores(arrays):
+    """Total score of each player. See Game._player_score()."""
+    return buildings_scores(arrays) + vault_scores(arrays)
+
+
+def clientele_limits(arrays):
+    """See Game._clientele_limit()."""
+    limit = influence_points(arrays) + 2*arrays.insula
+    return numpy.where(arrays.aqueduct, 2*limit, limit)
+
+
+def vault_limits(arrays):
+    """See Game._vault_limit()."""
+    return influence_points(arrays) + 2*arrays.market
+
+
+def winners(arrays, scores=None):
+    """Return a bool array [game, player] marking the winners of each game,
+    the players with the highest score, with ties broken by the number of
+    cards in hand. See Game._calc_winners().
+    """
+    if scores is None:
+        scores = player_scores(arrays)
+
+    # Padding can't win, since real scores are at least 2.
+    scores = numpy.where(arrays.mask, scores, -1)
+    top = scores == scores.max(axis=1)[:,numpy.newaxis]
+
+    hand = numpy.where(top, arrays.hand, -1)
+    return top & (hand == hand.max(axis=1)[:,numpy.newaxis])
@@ -36,6 +36,13 @@ class Zone(object):
         self.cards = list(cards)
 
 
+    def copy(self):
+        """Return a new Zone with the same name and cards. The Card objects
+        are shared, since they are never modified.
+        """
+        return Zone(self.cards, self.name)
+
+
     def move_card(self, card, target_zone):
         """Move the card from this zone to the target_zone.
         
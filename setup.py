@@ -20,6 +20,10 @@ setup(name='cloaca',
             'futures>=3.0.5',
             'minify',
             ],
+        extras_require={
+            'fast': ['ujson'],
+            'analytics': ['numpy'],
+            },
         cmdclass={
             'minify_css' : minify.command.minify_css,
             },